@@ -29,7 +29,7 @@ __all__ = [
     "Tree", "TreeWithLinkedPointSources",
     "TreeBuilder", "box_flags_enum"]
 
-__doc__ = """
+__doc__ = r"""
 :mod:`boxtree` can do three main things:
 
 * it can sort particles into an adaptively refined quad/octree,
@@ -131,6 +131,31 @@ This indexing scheme has the following properties:
 
 * The lists in ``_lists`` are stored contiguously. The start of the next list
   is automatically the end of the previous one.
+
+.. _periodic-traversals:
+
+Periodic traversals
+-------------------
+
+:class:`boxtree.traversal.FMMTraversalBuilder` can build traversals that are
+periodic along some or all axes. Along these axes, the root box of the tree is
+taken to be the periodic cell, so the bounding box of the tree should be
+given explicitly (see the *bbox* argument of :class:`TreeBuilder`).
+
+Each entry of an interaction list may then refer to a box in one of the
+neighboring periodic images of the tree. For each list, an object array
+with one ``int8`` array per axis, named like the list with ``_lists``
+replaced by ``_image_shifts``, gives for each entry the shift
+:math:`s \in \{-1, 0, 1\}` of that image. The source box of an entry is to be
+taken as translated by :math:`s` times :attr:`Tree.root_extent`. Image shifts
+along non-periodic axes are zero.
+
+Together, the interaction lists of each target cover the sources in the
+:math:`3^p` images of the tree (including the tree itself) surrounding it,
+where :math:`p` is the number of periodic axes. Images further away are not
+included; accounting for them (e.g. by lattice sums) is left to the
+user. :func:`boxtree.fmm.drive_fmm` passes the image shifts on to the
+expansion wrangler.
 """
 
 # vim: filetype=pyopencl:fdm=marker
@@ -47,6 +47,20 @@ Area queries (Balls -> overlapping leaves)
 .. autoclass:: AreaQueryResult
 
 
+Several radii at once
+^^^^^^^^^^^^^^^^^^^^^
+
+.. autoclass:: MultiRadiusAreaQueryBuilder
+
+
+Particles in balls
+^^^^^^^^^^^^^^^^^^
+
+.. autoclass:: ParticleAreaQueryBuilder
+
+.. autoclass:: ParticleAreaQueryResult
+
+
 Inverse of area query (Leaves -> overlapping balls)
 ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
 
@@ -61,6 +75,28 @@ Space invader queries
 .. autoclass:: SpaceInvaderQueryBuilder
 
 
+k nearest neighbors
+^^^^^^^^^^^^^^^^^^^
+
+.. autoclass:: KNearestNeighborsBuilder
+
+.. autoclass:: KNearestNeighborsResult
+
+
+Point location
+^^^^^^^^^^^^^^
+
+.. autoclass:: PointLocator
+
+.. autoclass:: PointLocationResult
+
+
+Counting particles in balls
+^^^^^^^^^^^^^^^^^^^^^^^^^^^
+
+.. autoclass:: RangeCountQueryBuilder
+
+
 Peer Lists
 ^^^^^^^^^^
 
@@ -110,6 +146,17 @@ class AreaQueryResult(DeviceDataRecord):
 
     .. attribute:: leaves_near_ball_lists
 
+    .. attribute:: leaves_near_ball_image_shifts
+
+        Only present for periodic area queries. An object array of
+        :mod:`numpy` or :mod:`pyopencl` arrays of type :class:`numpy.int8`,
+        one per axis, each with an entry for each entry of
+        :attr:`leaves_near_ball_lists`. The entries are -1, 0, or 1 and give
+        the periodic image of the leaf that intersects the ball: the leaf
+        box shifted by ``image_shifts * tree.root_extent`` intersects the
+        ball. The same leaf may occur more than once in the list for a ball,
+        with different shifts.
+
     .. automethod:: get
 
     .. versionadded:: 2016.1
@@ -137,6 +184,110 @@ class LeavesToBallsLookup(DeviceDataRecord):
     .. automethod:: get
     """
 
+
+class ParticleAreaQueryResult(DeviceDataRecord):
+    """
+    .. attribute:: tree
+
+        The :class:`boxtree.Tree` instance used to build this lookup.
+
+    .. attribute:: particle_kind
+
+        Either ``"sources"`` or ``"targets"``.
+
+    .. attribute:: order
+
+        Either ``"tree"`` or ``"user"``, indicating the ordering of the
+        particle numbers in :attr:`particles_in_ball_lists`. See
+        :ref:`particle-orderings`.
+
+    .. attribute:: particles_in_ball_starts
+
+        Indices into :attr:`particles_in_ball_lists`.
+        ``particles_in_ball_lists[particles_in_ball_starts[ball_nr]:
+        particles_in_ball_starts[ball_nr]+1]``
+        results in a list of the particles that lie inside ball `ball_nr`.
+
+    .. attribute:: particles_in_ball_lists
+
+    .. attribute:: particle_distances
+
+        ``coord_t [*]`` (or *None*)
+
+        If requested, the distances from the ball centers to the particles
+        in :attr:`particles_in_ball_lists`, in the norm of the ball.
+
+    .. automethod:: get
+
+    .. versionadded:: 2016.1
+    """
+
+
+class KNearestNeighborsResult(DeviceDataRecord):
+    """
+    .. attribute:: tree
+
+        The :class:`boxtree.Tree` instance used to build this lookup.
+
+    .. attribute:: k
+
+        The number of neighbors found for each query point.
+
+    .. attribute:: particle_kind
+
+        Either ``"sources"`` or ``"targets"``, indicating which particles of
+        :attr:`tree` :attr:`neighbor_ids` refers to.
+
+    .. attribute:: neighbor_ids
+
+        ``particle_id_t [nqueries, k]``
+
+        For each query point, the (tree-order) numbers of its *k* nearest
+        particles, in order of increasing distance. Since each row holds
+        exactly *k* entries, this is also a CSR list with implied *starts*
+        ``k*numpy.arange(nqueries+1)``.
+
+    .. attribute:: neighbor_distances
+
+        ``coord_t [nqueries, k]``
+
+        The Euclidean distances between each query point and the particles
+        in :attr:`neighbor_ids`.
+
+    .. automethod:: get
+
+    .. versionadded:: 2016.1
+    """
+
+
+class PointLocationResult(DeviceDataRecord):
+    """
+    .. attribute:: tree
+
+        The :class:`boxtree.Tree` instance used to build this lookup.
+
+    .. attribute:: box_ids
+
+        ``box_id_t [npoints]``
+
+        For each point, the number of the leaf box containing it. If the
+        point lies in a part of a box that has no child there (because
+        empty boxes were pruned), this is the deepest box containing the
+        point, which is not a leaf. If the point lies outside the root box,
+        this is -1.
+
+    .. attribute:: box_levels
+
+        ``box_level_t [npoints]``
+
+        The level of each box in :attr:`box_ids` (0 for points outside the
+        root box).
+
+    .. automethod:: get
+
+    .. versionadded:: 2016.1
+    """
+
 # }}}
 
 
@@ -266,6 +417,17 @@ GUIDING_BOX_FINDER_MACRO = r"""//CL:mako//
 
 
 AREA_QUERY_WALKER_BODY = r"""
+    <%def name="check_ball_overlap(
+            is_overlapping, box_id, ball_radius, ball_center)">
+        %if ball_norm == "l2":
+            ${check_l2_ball_overlap(
+                is_overlapping, box_id, ball_radius, ball_center)}
+        %else:
+            ${check_l_infty_ball_overlap(
+                is_overlapping, box_id, ball_radius, ball_center)}
+        %endif
+    </%def>
+
     coord_vec_t ball_center;
     coord_t ball_radius;
     ${get_ball_center_and_radius("ball_center", "ball_radius", "i")}
@@ -289,7 +451,7 @@ AREA_QUERY_WALKER_BODY = r"""
         {
             bool is_overlapping;
 
-            ${check_l_infty_ball_overlap(
+            ${check_ball_overlap(
                 "is_overlapping", "peer_box", "ball_radius", "ball_center")}
 
             if (is_overlapping)
@@ -312,7 +474,7 @@ AREA_QUERY_WALKER_BODY = r"""
                     {
                         bool is_overlapping;
 
-                        ${check_l_infty_ball_overlap(
+                        ${check_ball_overlap(
                             "is_overlapping", "child_box_id",
                             "ball_radius", "ball_center")}
 
@@ -343,6 +505,121 @@ AREA_QUERY_TEMPLATE = (
     typedef ${dtype_to_ctype(ball_id_dtype)} ball_id_t;
     typedef ${dtype_to_ctype(peer_list_idx_dtype)} peer_list_idx_t;
 
+    <%
+        periodic_axes = [ax for ax, is_periodic
+            in zip(AXIS_NAMES[:dimensions], periodic) if is_periodic]
+    %>
+
+    <%def name="get_ball_center_and_radius(ball_center, ball_radius, i)">
+        %for ax in AXIS_NAMES[:dimensions]:
+            %if ax in periodic_axes:
+                ${ball_center}.${ax} = ball_${ax}[ball_nr]
+                    - image_shift_${ax} * root_extent;
+            %else:
+                ${ball_center}.${ax} = ball_${ax}[ball_nr];
+            %endif
+        %endfor
+       ${ball_radius} = ball_radii[ball_nr];
+    </%def>
+
+    <%def name="leaf_found_op(leaf_box_id, ball_center, ball_radius)">
+        APPEND_leaves(${leaf_box_id});
+        %for ax in periodic_axes:
+            APPEND_image_shifts_${ax}(image_shift_${ax});
+        %endfor
+    </%def>
+
+    void generate(LIST_ARG_DECL USER_ARG_DECL ball_id_t i)
+    {
+        %if chunked:
+            ball_id_t ball_nr = ball_offset + i;
+        %else:
+            ball_id_t ball_nr = i;
+        %endif
+
+    %if periodic_axes:
+        // Visit the periodic images of the tree (equivalently, shift the
+        // ball by whole periods) that the ball can reach.
+        for (int image = 0; image < ${3**len(periodic_axes)}; ++image)
+        {
+            %for iax, ax in enumerate(periodic_axes):
+                int image_shift_${ax} = (image / ${3**iax}) % 3 - 1;
+            %endfor
+
+            {
+                coord_t radius = ball_radii[ball_nr];
+                bool reaches_root_box = true;
+
+                %for ax in periodic_axes:
+                {
+                    coord_t center = ball_${ax}[ball_nr]
+                        - image_shift_${ax} * root_extent;
+                    reaches_root_box = reaches_root_box
+                        && center + radius >= bbox_min_${ax}
+                        && center - radius <= bbox_min_${ax} + root_extent;
+                }
+                %endfor
+
+                if (!reaches_root_box)
+                    continue;
+            }
+    %endif
+    """ +
+    AREA_QUERY_WALKER_BODY +
+    """
+    %if periodic_axes:
+        }
+    %endif
+    }
+    """)
+
+
+MULTI_RADIUS_AREA_QUERY_TEMPLATE = (
+    GUIDING_BOX_FINDER_MACRO + r"""//CL//
+    typedef ${dtype_to_ctype(ball_id_dtype)} ball_id_t;
+    typedef ${dtype_to_ctype(peer_list_idx_dtype)} peer_list_idx_t;
+
+    <%def name="get_ball_center_and_radius(ball_center, ball_radius, i)">
+        %for ax in AXIS_NAMES[:dimensions]:
+            ${ball_center}.${ax} = ball_${ax}[${i}];
+        %endfor
+        coord_t base_ball_radius = ball_radii[${i}];
+        ${ball_radius} = base_ball_radius * max_radius_multiplier;
+    </%def>
+
+    <%def name="leaf_found_op(leaf_box_id, ball_center, ball_radius)">
+        // The walk used the largest ball, so each leaf found still needs to
+        // be tested against each radius.
+        %for iradius in range(nradii):
+        {
+            coord_t radius = base_ball_radius * radius_multiplier_${iradius};
+            bool is_overlapping_radius;
+
+            ${check_ball_overlap(
+                "is_overlapping_radius", leaf_box_id, "radius", ball_center)}
+
+            if (is_overlapping_radius)
+            {
+                APPEND_leaves_${iradius}(${leaf_box_id});
+            }
+        }
+        %endfor
+    </%def>
+
+    void generate(LIST_ARG_DECL USER_ARG_DECL ball_id_t i)
+    {
+    """ +
+    AREA_QUERY_WALKER_BODY +
+    """
+    }
+    """)
+
+
+PARTICLE_AREA_QUERY_TEMPLATE = (
+    GUIDING_BOX_FINDER_MACRO + r"""//CL//
+    typedef ${dtype_to_ctype(ball_id_dtype)} ball_id_t;
+    typedef ${dtype_to_ctype(peer_list_idx_dtype)} peer_list_idx_t;
+
     <%def name="get_ball_center_and_radius(ball_center, ball_radius, i)">
         %for ax in AXIS_NAMES[:dimensions]:
             ${ball_center}.${ax} = ball_${ax}[${i}];
@@ -351,7 +628,39 @@ AREA_QUERY_TEMPLATE = (
     </%def>
 
     <%def name="leaf_found_op(leaf_box_id, ball_center, ball_radius)">
-        APPEND_leaves(${leaf_box_id});
+        particle_id_t particle_start = box_particle_starts[${leaf_box_id}];
+        particle_id_t particle_end = particle_start
+            + box_particle_counts_nonchild[${leaf_box_id}];
+
+        for (particle_id_t ipart = particle_start;
+                ipart < particle_end; ++ipart)
+        {
+            coord_t dist = 0;
+            %for ax in AXIS_NAMES[:dimensions]:
+                %if ball_norm == "l2":
+                    dist += (particles_${ax}[ipart] - ${ball_center}.${ax})
+                        * (particles_${ax}[ipart] - ${ball_center}.${ax});
+                %else:
+                    dist = fmax(dist,
+                        fabs(particles_${ax}[ipart] - ${ball_center}.${ax}));
+                %endif
+            %endfor
+            %if ball_norm == "l2":
+                dist = sqrt(dist);
+            %endif
+
+            if (dist <= ${ball_radius})
+            {
+                %if user_order:
+                    APPEND_particles(particle_user_ids[ipart]);
+                %else:
+                    APPEND_particles(ipart);
+                %endif
+                %if with_distances:
+                    APPEND_distances(dist);
+                %endif
+            }
+        }
     </%def>
 
     void generate(LIST_ARG_DECL USER_ARG_DECL ball_id_t i)
@@ -453,6 +762,219 @@ from pyopencl.elementwise import ElementwiseTemplate
 from boxtree.tools import InlineBinarySearch
 
 
+POINT_LOCATOR_TEMPLATE = r"""//CL//
+    bool outside = false;
+    %for ax in AXIS_NAMES[:dimensions]:
+        coord_t scaled_${ax} = (point_${ax}[i] - bbox_min_${ax}) / root_extent;
+        outside = outside || scaled_${ax} < 0 || scaled_${ax} >= 1;
+    %endfor
+
+    if (outside)
+    {
+        box_ids[i] = -1;
+        box_levels[i] = 0;
+        return;
+    }
+
+    box_id_t box_id = 0;
+    int level = 0;
+
+    while (box_flags[box_id] & BOX_HAS_CHILDREN)
+    {
+        // This uses the same binning as the tree build, see
+        // tree_build_kernels.py.
+        int morton_nr = 0
+        %for iax, ax in enumerate(AXIS_NAMES[:dimensions]):
+            | (((unsigned) (scaled_${ax} * (1U << (level + 1)))) & 1U)
+                << ${dimensions-1-iax}
+        %endfor
+            ;
+
+        box_id_t child_box_id = box_child_ids[
+            morton_nr * aligned_nboxes + box_id];
+
+        if (!child_box_id)
+            break;
+
+        box_id = child_box_id;
+        ++level;
+    }
+
+    box_ids[i] = box_id;
+    box_levels[i] = level;
+"""
+
+
+RANGE_COUNT_QUERY_ARGS = r"""//CL:mako//
+        coord_t *box_centers,
+        coord_t root_extent,
+        box_level_t *box_levels,
+        box_id_t aligned_nboxes,
+        box_id_t *box_child_ids,
+        box_flags_t *box_flags,
+        particle_id_t *box_particle_starts,
+        particle_id_t *box_particle_counts_nonchild,
+        particle_id_t *box_particle_counts_cumul,
+        %if weighted:
+            weight_t *weight_prefix_sums,
+        %endif
+        %for ax in AXIS_NAMES[:dimensions]:
+            coord_t *particles_${ax},
+        %endfor
+        coord_t *ball_radii,
+        %for ax in AXIS_NAMES[:dimensions]:
+            coord_t *ball_${ax},
+        %endfor
+        count_t *counts
+        """
+
+
+RANGE_COUNT_QUERY_BODY = r"""//CL:mako//
+    <%def name="classify_box(box_class, box_id)">
+        // 0: disjoint from the ball, 1: partially overlapping,
+        // 2: contained in the ball
+        {
+            ${load_center("box_center", box_id)}
+            coord_t box_rad = LEVEL_TO_RAD(box_levels[${box_id}]);
+
+            %if ball_norm == "l2":
+                coord_t near_dist_sq = 0;
+                coord_t far_dist_sq = 0;
+                %for iax in range(dimensions):
+                {
+                    coord_t axis_dist = fabs(
+                        ball_center.s${iax} - box_center.s${iax});
+                    coord_t near_axis_dist = fmax((coord_t) 0, axis_dist - box_rad);
+                    near_dist_sq += near_axis_dist * near_axis_dist;
+                    far_dist_sq += (axis_dist + box_rad) * (axis_dist + box_rad);
+                }
+                %endfor
+
+                coord_t radius_sq = ball_radius * ball_radius;
+                ${box_class} = (near_dist_sq > radius_sq) ? 0
+                    : (far_dist_sq <= radius_sq) ? 2 : 1;
+            %else:
+                coord_t max_dist = 0;
+                %for iax in range(dimensions):
+                    max_dist = fmax(max_dist,
+                        fabs(ball_center.s${iax} - box_center.s${iax}));
+                %endfor
+
+                ${box_class} = (max_dist > ball_radius + box_rad) ? 0
+                    : (max_dist + box_rad <= ball_radius) ? 2 : 1;
+            %endif
+        }
+    </%def>
+
+    <%def name="particle_range_total(start, end)">
+        %if weighted:
+            (weight_prefix_sums[${end}] - weight_prefix_sums[${start}])
+        %else:
+            (${end} - ${start})
+        %endif
+    </%def>
+
+    <%def name="add_box(box_id)">
+        {
+            particle_id_t start = box_particle_starts[${box_id}];
+            total += ${particle_range_total(
+                "start", "start + box_particle_counts_cumul[%s]" % box_id)};
+        }
+    </%def>
+
+    <%def name="add_nonchild_particles(box_id)">
+        {
+            particle_id_t start = box_particle_starts[${box_id}];
+            particle_id_t end = start + box_particle_counts_nonchild[${box_id}];
+
+            for (particle_id_t ipart = start; ipart < end; ++ipart)
+            {
+                coord_t dist = 0;
+                %for ax in AXIS_NAMES[:dimensions]:
+                {
+                    coord_t axis_dist = particles_${ax}[ipart] - ball_center.${ax};
+                    %if ball_norm == "l2":
+                        dist += axis_dist * axis_dist;
+                    %else:
+                        dist = fmax(dist, fabs(axis_dist));
+                    %endif
+                }
+                %endfor
+
+                %if ball_norm == "l2":
+                    if (dist <= ball_radius * ball_radius)
+                %else:
+                    if (dist <= ball_radius)
+                %endif
+                {
+                    total += ${particle_range_total("ipart", "ipart + 1")};
+                }
+            }
+        }
+    </%def>
+
+    coord_vec_t ball_center;
+    %for ax in AXIS_NAMES[:dimensions]:
+        ball_center.${ax} = ball_${ax}[i];
+    %endfor
+    coord_t ball_radius = ball_radii[i];
+
+    count_t total = 0;
+
+    // Descend from the root, but only into boxes that partially overlap the
+    // ball. Boxes inside the ball are counted as a whole, and only the
+    // particles owned directly by partially overlapping boxes are tested.
+
+    int root_class;
+    ${classify_box("root_class", "0")}
+
+    if (root_class == 2)
+    {
+        ${add_box("0")}
+    }
+    else if (root_class == 1)
+    {
+        ${add_nonchild_particles("0")}
+
+        if (box_flags[0] & BOX_HAS_CHILDREN)
+        {
+            ${walk_init("0")}
+
+            while (continue_walk)
+            {
+                box_id_t child_box_id = box_child_ids[
+                    walk_morton_nr * aligned_nboxes + walk_box_id];
+
+                if (child_box_id)
+                {
+                    int child_class;
+                    ${classify_box("child_class", "child_box_id")}
+
+                    if (child_class == 2)
+                    {
+                        ${add_box("child_box_id")}
+                    }
+                    else if (child_class == 1)
+                    {
+                        ${add_nonchild_particles("child_box_id")}
+
+                        if (box_flags[child_box_id] & BOX_HAS_CHILDREN)
+                        {
+                            ${walk_push("child_box_id")}
+                            continue;
+                        }
+                    }
+                }
+
+                ${walk_advance()}
+            }
+        }
+    }
+
+    counts[i] = total;
+"""
+
+
 STARTS_EXPANDER_TEMPLATE = ElementwiseTemplate(
     arguments=r"""
         idx_t *dst,
@@ -489,7 +1011,8 @@ class AreaQueryElementwiseTemplate(object):
                 peer_lists.peer_lists) + tuple(tree.bounding_box[0]) + args
 
     def __init__(self, extra_args, ball_center_and_radius_expr,
-                 leaf_found_op, preamble="", name="area_query_elwise"):
+                 leaf_found_op, preamble="", name="area_query_elwise",
+                 walker_body=AREA_QUERY_WALKER_BODY):
 
         def wrap_in_macro(decl, expr):
             return """
@@ -521,7 +1044,7 @@ class AreaQueryElementwiseTemplate(object):
                           leaf_found_op) +
             TRAVERSAL_PREAMBLE_MAKO_DEFS +
             GUIDING_BOX_FINDER_MACRO +
-            AREA_QUERY_WALKER_BODY,
+            walker_body,
             name=name,
             preamble=preamble)
 
@@ -529,7 +1052,7 @@ class AreaQueryElementwiseTemplate(object):
                  dimensions, coord_dtype, box_id_dtype,
                  peer_list_idx_dtype, max_levels,
                  extra_var_values=(), extra_type_aliases=(),
-                 extra_preamble=""):
+                 extra_preamble="", ball_norm="linf"):
         from pyopencl.tools import dtype_to_ctype
         from boxtree import box_flags_enum
         from boxtree.traversal import TRAVERSAL_PREAMBLE_TYPEDEFS_AND_DEFINES
@@ -546,6 +1069,7 @@ class AreaQueryElementwiseTemplate(object):
             ("AXIS_NAMES", AXIS_NAMES),
             ("box_flags_enum", box_flags_enum),
             ("peer_list_idx_dtype", peer_list_idx_dtype),
+            ("ball_norm", ball_norm),
             ("debug", False),
             ("root_extent_stretch_factor", TreeBuilder.ROOT_EXTENT_STRETCH_FACTOR),
             # Not used (but required by TRAVERSAL_PREAMBLE_TEMPLATE)
@@ -614,18 +1138,229 @@ SPACE_INVADER_QUERY_TEMPLATE = AreaQueryElementwiseTemplate(
     }""",
     name="space_invader_query")
 
-# }}}
 
+K_NEAREST_NEIGHBORS_PREAMBLE = r"""//CL//
+// Max-heaps of (squared distance, particle id) pairs in private memory
 
-# {{{ area query build
+inline void knn_heap_swap(coord_t *dist_sq, particle_id_t *ids, int a, int b)
+{
+    coord_t tmp_dist_sq = dist_sq[a];
+    dist_sq[a] = dist_sq[b];
+    dist_sq[b] = tmp_dist_sq;
 
-class AreaQueryBuilder(object):
-    """Given a set of :math:`l^\infty` "balls", this class helps build a
+    particle_id_t tmp_id = ids[a];
+    ids[a] = ids[b];
+    ids[b] = tmp_id;
+}
+
+inline void knn_heap_sift_down(
+    coord_t *dist_sq, particle_id_t *ids, int size, int pos)
+{
+    while (true)
+    {
+        int largest = pos;
+        int left = 2*pos + 1;
+        int right = left + 1;
+
+        if (left < size && dist_sq[left] > dist_sq[largest])
+            largest = left;
+        if (right < size && dist_sq[right] > dist_sq[largest])
+            largest = right;
+
+        if (largest == pos)
+            return;
+
+        knn_heap_swap(dist_sq, ids, pos, largest);
+        pos = largest;
+    }
+}
+
+inline void knn_heap_insert(
+    coord_t *dist_sq, particle_id_t *ids, int *size, int capacity,
+    coord_t new_dist_sq, particle_id_t new_id)
+{
+    if (*size < capacity)
+    {
+        int pos = (*size)++;
+        dist_sq[pos] = new_dist_sq;
+        ids[pos] = new_id;
+
+        while (pos > 0 && dist_sq[(pos - 1) / 2] < dist_sq[pos])
+        {
+            knn_heap_swap(dist_sq, ids, pos, (pos - 1) / 2);
+            pos = (pos - 1) / 2;
+        }
+    }
+    else if (new_dist_sq < dist_sq[0])
+    {
+        dist_sq[0] = new_dist_sq;
+        ids[0] = new_id;
+        knn_heap_sift_down(dist_sq, ids, capacity, 0);
+    }
+}
+
+// Turns the heap into a list sorted by increasing distance.
+inline void knn_heap_sort(coord_t *dist_sq, particle_id_t *ids, int size)
+{
+    for (int end = size - 1; end > 0; --end)
+    {
+        knn_heap_swap(dist_sq, ids, 0, end);
+        knn_heap_sift_down(dist_sq, ids, end, 0);
+    }
+}
+"""
+
+
+K_NEAREST_NEIGHBORS_WALKER_BODY = r"""
+    coord_vec_t query_point;
+    %for ax in AXIS_NAMES[:dimensions]:
+        query_point.${ax} = query_${ax}[i];
+    %endfor
+
+    coord_t heap_dist_sq[${k}];
+    particle_id_t heap_particle_ids[${k}];
+    int heap_size = 0;
+
+    // Start with the size of the leaf box containing the query point.
+    ${find_guiding_box("query_point", "((coord_t) 0)", "start_box")}
+    coord_t search_radius = LEVEL_TO_RAD(box_levels[start_box]);
+
+    // A ball of this radius contains the whole tree: its radius is the
+    // distance to the farthest corner of the root box.
+    coord_t max_search_radius = 0;
+    %for ax in AXIS_NAMES[:dimensions]:
+    {
+        coord_t max_axis_dist = fmax(
+            fabs(query_point.${ax} - bbox_min_${ax}),
+            fabs(query_point.${ax} - (bbox_min_${ax} + root_extent)));
+        %if ball_norm == "l2":
+            max_search_radius += max_axis_dist * max_axis_dist;
+        %else:
+            max_search_radius = fmax(max_search_radius, max_axis_dist);
+        %endif
+    }
+    %endfor
+    %if ball_norm == "l2":
+        max_search_radius = sqrt(max_search_radius);
+    %endif
+
+    bool is_last_pass = false;
+
+    while (true)
+    {
+        heap_size = 0;
+
+        {
+""" + AREA_QUERY_WALKER_BODY + r"""
+        }
+
+        if (is_last_pass || search_radius >= max_search_radius)
+            break;
+
+        if (heap_size == ${k})
+        {
+            // The k nearest particles are no farther away than the
+            // k-th nearest one found so far, so one more pass (if any)
+            // with that radius finds all of them.
+            if (heap_dist_sq[0] <= search_radius * search_radius)
+                break;
+
+            search_radius = sqrt(heap_dist_sq[0]) * (coord_t) 1.0001;
+            is_last_pass = true;
+        }
+        else
+        {
+            search_radius = 2 * search_radius;
+        }
+    }
+
+    knn_heap_sort(heap_dist_sq, heap_particle_ids, heap_size);
+
+    for (int j = 0; j < heap_size; ++j)
+    {
+        neighbor_ids[${k} * i + j] = heap_particle_ids[j];
+        neighbor_distances[${k} * i + j] = sqrt(heap_dist_sq[j]);
+    }
+"""
+
+
+K_NEAREST_NEIGHBORS_TEMPLATE = AreaQueryElementwiseTemplate(
+    extra_args="""
+    particle_id_t *box_particle_starts,
+    particle_id_t *box_particle_counts_nonchild,
+    %for ax in AXIS_NAMES[:dimensions]:
+        coord_t *particles_${ax},
+    %endfor
+    %for ax in AXIS_NAMES[:dimensions]:
+        coord_t *query_${ax},
+    %endfor
+    particle_id_t *neighbor_ids,
+    coord_t *neighbor_distances,
+    """,
+    ball_center_and_radius_expr=r"""
+    ${ball_center} = query_point;
+    ${ball_radius} = search_radius;
+    """,
+    leaf_found_op=r"""
+    {
+        particle_id_t particle_start = box_particle_starts[${leaf_box_id}];
+        particle_id_t particle_end = particle_start
+            + box_particle_counts_nonchild[${leaf_box_id}];
+
+        for (particle_id_t ipart = particle_start;
+                ipart < particle_end; ++ipart)
+        {
+            coord_vec_t diff;
+            %for ax in AXIS_NAMES[:dimensions]:
+                diff.${ax} = particles_${ax}[ipart] - ${ball_center}.${ax};
+            %endfor
+
+            knn_heap_insert(heap_dist_sq, heap_particle_ids, &heap_size,
+                ${k}, dot(diff, diff), ipart);
+        }
+    }""",
+    preamble=K_NEAREST_NEIGHBORS_PREAMBLE,
+    name="k_nearest_neighbors",
+    walker_body=K_NEAREST_NEIGHBORS_WALKER_BODY)
+
+# }}}
+
+
+# {{{ area query build
+
+def _check_ball_args(tree, ball_centers, ball_radii, ball_norm):
+    """Check the ball arguments shared by the ball-based query builders.
+
+    :returns: a tuple *(ball_id_dtype, max_levels)* for kernel generation.
+    """
+    from pytools import single_valued
+    if single_valued(bc.dtype for bc in ball_centers) != tree.coord_dtype:
+        raise TypeError("ball_centers dtype must match tree.coord_dtype")
+    if ball_radii.dtype != tree.coord_dtype:
+        raise TypeError("ball_radii dtype must match tree.coord_dtype")
+    if ball_norm not in ["linf", "l2"]:
+        raise ValueError("unknown ball norm: '%s'" % ball_norm)
+
+    # Ball numbers use the particle id type, which bounds the number of
+    # balls just like that of particles.
+    ball_id_dtype = tree.particle_id_dtype
+
+    from pytools import div_ceil
+    # Avoid generating too many kernels.
+    max_levels = div_ceil(tree.nlevels, 10) * 10
+
+    return ball_id_dtype, max_levels
+
+
+class AreaQueryBuilder(object):
+    """Given a set of :math:`l^\infty` "balls", this class helps build a
     look-up table from ball to leaf boxes that intersect with the ball.
 
     .. versionadded:: 2016.1
 
     .. automethod:: __call__
+
+    .. automethod:: iter_chunks
     """
     def __init__(self, context):
         self.context = context
@@ -635,7 +1370,8 @@ class AreaQueryBuilder(object):
 
     @memoize_method
     def get_area_query_kernel(self, dimensions, coord_dtype, box_id_dtype,
-                              ball_id_dtype, peer_list_idx_dtype, max_levels):
+                              ball_id_dtype, peer_list_idx_dtype, max_levels,
+                              ball_norm="linf", chunked=False, periodic=None):
         from pyopencl.tools import dtype_to_ctype
         from boxtree import box_flags_enum
 
@@ -661,6 +1397,9 @@ class AreaQueryBuilder(object):
             box_flags_enum=box_flags_enum,
             peer_list_idx_dtype=peer_list_idx_dtype,
             ball_id_dtype=ball_id_dtype,
+            ball_norm=ball_norm,
+            chunked=chunked,
+            periodic=periodic or (False,)*dimensions,
             debug=False,
             root_extent_stretch_factor=TreeBuilder.ROOT_EXTENT_STRETCH_FACTOR,
             # Not used (but required by TRAVERSAL_PREAMBLE_TEMPLATE)
@@ -684,14 +1423,25 @@ class AreaQueryBuilder(object):
             VectorArg(coord_dtype, "ball_"+ax)
             for ax in AXIS_NAMES[:dimensions]]
 
+        if chunked:
+            # Index of the first ball processed by this invocation
+            arg_decls.append(ScalarArg(ball_id_dtype, "ball_offset"))
+
+        image_shift_lists = [
+                "image_shifts_" + ax
+                for ax, is_periodic in zip(AXIS_NAMES, periodic or ())
+                if is_periodic]
+
         from pyopencl.algorithm import ListOfListsBuilder
         area_query_kernel = ListOfListsBuilder(
             self.context,
-            [("leaves", box_id_dtype)],
+            [("leaves", box_id_dtype)]
+            + [(name, np.int8) for name in image_shift_lists],
             str(template.render(**render_vars)),
             arg_decls=arg_decls,
             name_prefix="area_query",
-            count_sharing={},
+            count_sharing=dict(
+                (name, "leaves") for name in image_shift_lists),
             complex_kernel=True)
 
         logger.info("done building area query kernel")
@@ -700,7 +1450,7 @@ class AreaQueryBuilder(object):
     # }}}
 
     def __call__(self, queue, tree, ball_centers, ball_radii, peer_lists=None,
-                 wait_for=None):
+                 wait_for=None, ball_norm="linf", periodic=False, allocator=None):
         """
         :arg queue: a :class:`pyopencl.CommandQueue`
         :arg tree: a :class:`boxtree.Tree`.
@@ -718,53 +1468,624 @@ class AreaQueryBuilder(object):
         :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
             instances for whose completion this command waits before starting
             exeuction.
+        :arg ball_norm: either ``"linf"`` or ``"l2"``, the norm defining
+            the balls. With ``"l2"``, leaves are tested against the balls
+            with an exact box-to-sphere distance test.
+
+            .. versionadded:: 2016.1
+        :arg periodic: either a :class:`bool`, or a sequence of one
+            :class:`bool` per axis. Along periodic axes, the root box of
+            *tree* is taken to be the periodic cell, and balls also find
+            leaves in the neighboring periodic images of the tree. The
+            image each leaf was found in is recorded in
+            :attr:`AreaQueryResult.leaves_near_ball_image_shifts`. The tree
+            should be built with the periodic cell as its root box (see the
+            *bbox* argument of :class:`boxtree.TreeBuilder`). Ball centers
+            should lie inside the root box, and ball radii should not exceed
+            its size.
+
+            .. versionadded:: 2016.1
+        :arg allocator: an allocator for the result arrays, as accepted by
+            :class:`pyopencl.array.Array`.
+
+            .. versionadded:: 2016.1
         :returns: a tuple *(aq, event)*, where *aq* is an instance of
             :class:`AreaQueryResult`, and *event* is a :class:`pyopencl.Event`
             for dependency management.
         """
 
-        from pytools import single_valued
-        if single_valued(bc.dtype for bc in ball_centers) != tree.coord_dtype:
-            raise TypeError("ball_centers dtype must match tree.coord_dtype")
-        if ball_radii.dtype != tree.coord_dtype:
-            raise TypeError("ball_radii dtype must match tree.coord_dtype")
+        ball_id_dtype, max_levels = _check_ball_args(
+                tree, ball_centers, ball_radii, ball_norm)
+
+        if isinstance(periodic, bool):
+            periodic = (periodic,) * tree.dimensions
+        periodic = tuple(bool(is_periodic) for is_periodic in periodic)
+        if len(periodic) != tree.dimensions:
+            raise ValueError("periodic must have one entry per axis")
+        periodic_axes = [ax
+                for ax, is_periodic in zip(AXIS_NAMES, periodic)
+                if is_periodic]
+        if not periodic_axes:
+            periodic = None
+
+        if peer_lists is None:
+            peer_lists, evt = self.peer_list_finder(queue, tree, wait_for=wait_for,
+                    allocator=allocator)
+            wait_for = [evt]
+
+        if len(peer_lists.peer_list_starts) != tree.nboxes + 1:
+            raise ValueError("size of peer lists must match with number of boxes")
+
+        area_query_kernel = self.get_area_query_kernel(tree.dimensions,
+            tree.coord_dtype, tree.box_id_dtype, ball_id_dtype,
+            peer_lists.peer_list_starts.dtype, max_levels, ball_norm,
+            periodic=periodic)
+
+        logger.info("area query: run area query")
+
+        result, evt = area_query_kernel(
+                queue, len(ball_radii),
+                tree.box_centers.data, tree.root_extent,
+                tree.box_levels.data, tree.aligned_nboxes,
+                tree.box_child_ids.data, tree.box_flags.data,
+                peer_lists.peer_list_starts,
+                peer_lists.peer_lists, ball_radii.data,
+                *(tuple(tree.bounding_box[0]) +
+                  tuple(bc.data for bc in ball_centers)),
+                wait_for=wait_for, allocator=allocator)
+
+        logger.info("area query: done")
+
+        extra_kwargs = {}
+        if periodic_axes:
+            from pytools.obj_array import make_obj_array
+            extra_kwargs["leaves_near_ball_image_shifts"] = make_obj_array([
+                result["image_shifts_" + ax].lists
+                if ax in periodic_axes
+                else cl.array.zeros(
+                    queue, result["leaves"].count, np.int8,
+                    allocator=allocator)
+                for ax in AXIS_NAMES[:tree.dimensions]])
+
+        return AreaQueryResult(
+                tree=tree,
+                leaves_near_ball_starts=result["leaves"].starts,
+                leaves_near_ball_lists=result["leaves"].lists,
+                **extra_kwargs).with_queue(None), evt
+
+    def iter_chunks(self, queue, tree, ball_centers, ball_radii, chunk_size,
+                    peer_lists=None, wait_for=None, ball_norm="linf",
+                    download=False, allocator=None):
+        """Like :meth:`__call__`, but processes the balls in chunks of at
+        most *chunk_size* balls, so that the look-up table for all balls
+        never has to be held in device memory at once.
+
+        This is a generator. For each chunk, it yields a tuple
+        *(ball_slice, aq)*, where *ball_slice* is the :class:`slice` of
+        balls covered by the chunk and *aq* is an :class:`AreaQueryResult`
+        for just those balls, i.e. ball number ``ball_slice.start + i`` is
+        described by entry *i* of *aq*.
+
+        Device memory for the result of one chunk is returned to a memory
+        pool once *aq* is no longer referenced, and reused for later
+        chunks. If *allocator* is not given, a private
+        :class:`pyopencl.tools.MemoryPool` is used for this purpose.
+
+        Arguments are as for :meth:`__call__`, plus:
+
+        :arg chunk_size: the maximum number of balls per chunk.
+        :arg download: if *True*, the look-up tables in each *aq* are
+            :class:`numpy.ndarray` instances on the host (*aq.tree* is
+            unchanged). The download of each chunk is enqueued on a
+            separate queue before the computation of the next chunk.
+
+        The overlap between chunks is limited in two ways. Building the
+        look-up table of a chunk reads back its list sizes with a blocking
+        transfer, so enqueueing the next chunk waits until the current
+        chunk and the counting pass of the next one have completed. Also, with
+        *download*, each chunk is downloaded into newly allocated, pageable
+        host memory, which many implementations can only copy into
+        synchronously, so that the download may not overlap with the
+        computation of the next chunk at all.
+
+        .. versionadded:: 2016.1
+        """
+
+        ball_id_dtype, max_levels = _check_ball_args(
+                tree, ball_centers, ball_radii, ball_norm)
+        if chunk_size <= 0:
+            raise ValueError("chunk_size must be positive")
+
+        if allocator is None:
+            from pyopencl.tools import MemoryPool, ImmediateAllocator
+            allocator = MemoryPool(ImmediateAllocator(queue))
+
+        if peer_lists is None:
+            peer_lists, evt = self.peer_list_finder(queue, tree, wait_for=wait_for,
+                    allocator=allocator)
+            wait_for = [evt]
+
+        if len(peer_lists.peer_list_starts) != tree.nboxes + 1:
+            raise ValueError("size of peer lists must match with number of boxes")
+
+        area_query_kernel = self.get_area_query_kernel(tree.dimensions,
+            tree.coord_dtype, tree.box_id_dtype, ball_id_dtype,
+            peer_lists.peer_list_starts.dtype, max_levels, ball_norm,
+            chunked=True)
+
+        if download:
+            transfer_queue = cl.CommandQueue(queue.context, queue.device)
+
+        nballs = len(ball_radii)
+
+        def run_chunk(ball_start):
+            ball_slice = slice(ball_start, min(ball_start + chunk_size, nballs))
+
+            logger.info("area query: run area query for balls %d:%d",
+                    ball_slice.start, ball_slice.stop)
+
+            result, evt = area_query_kernel(
+                    queue, ball_slice.stop - ball_slice.start,
+                    tree.box_centers.data, tree.root_extent,
+                    tree.box_levels.data, tree.aligned_nboxes,
+                    tree.box_child_ids.data, tree.box_flags.data,
+                    peer_lists.peer_list_starts,
+                    peer_lists.peer_lists, ball_radii.data,
+                    *(tuple(tree.bounding_box[0]) +
+                      tuple(bc.data for bc in ball_centers) +
+                      (ball_slice.start,)),
+                    allocator=allocator,
+                    wait_for=wait_for)
+
+            return ball_slice, AreaQueryResult(
+                    tree=tree,
+                    leaves_near_ball_starts=result["leaves"].starts,
+                    leaves_near_ball_lists=result["leaves"].lists), evt
+
+        def start_download(aq, evt):
+            # The host arrays are handed to the caller, so they cannot be
+            # carved out of a reused (pinned) staging buffer.
+            host_arrays = {}
+            events = []
+            for name in ["leaves_near_ball_starts", "leaves_near_ball_lists"]:
+                ary = getattr(aq, name)
+                host_ary = np.empty(ary.shape, ary.dtype)
+                if ary.size:
+                    events.append(cl.enqueue_copy(
+                        transfer_queue, host_ary, ary.base_data,
+                        src_offset=ary.offset, is_blocking=False,
+                        wait_for=[evt]))
+                host_arrays[name] = host_ary
+
+            return aq.copy(**host_arrays), events
+
+        if not nballs:
+            return
+
+        pending = run_chunk(0)
+        for next_ball_start in range(chunk_size, nballs + chunk_size, chunk_size):
+            ball_slice, aq, evt = pending
+
+            if download:
+                aq, events = start_download(aq, evt)
+
+            # Enqueue the next chunk before handing out this one, so that
+            # the device is kept busy while the caller processes it.
+            if next_ball_start < nballs:
+                pending = run_chunk(next_ball_start)
+            else:
+                pending = None
+
+            if download:
+                cl.wait_for_events(events)
+            else:
+                aq = aq.with_queue(None)
+
+            yield ball_slice, aq
+
+            del aq
+
+        logger.info("area query: done")
+
+# }}}
+
+
+# {{{ multi-radius area query build
+
+class MultiRadiusAreaQueryBuilder(object):
+    """Like :class:`AreaQueryBuilder`, but for several balls with a common
+    center. Given one set of ball centers and radii and a sequence of
+    radius multipliers, this builds one look-up table from ball to leaf
+    boxes for each multiplier.
+
+    The peer list walk is only carried out once per ball, for the largest
+    ball. Each leaf found by the walk is then tested against all the radii.
+    This is cheaper than running :class:`AreaQueryBuilder` once per radius.
+
+    .. versionadded:: 2016.1
+
+    .. automethod:: __call__
+    """
+
+    def __init__(self, context):
+        self.context = context
+        self.peer_list_finder = PeerListFinder(self.context)
+
+    # {{{ Kernel generation
+
+    @memoize_method
+    def get_multi_radius_area_query_kernel(self, dimensions, coord_dtype,
+            box_id_dtype, ball_id_dtype, peer_list_idx_dtype, max_levels,
+            nradii, ball_norm):
+        from pyopencl.tools import dtype_to_ctype
+        from boxtree import box_flags_enum
+
+        logger.info("start building multi-radius area query kernel")
+
+        from boxtree.traversal import TRAVERSAL_PREAMBLE_TEMPLATE
+        from boxtree.tree_build import TreeBuilder
+
+        template = Template(
+            TRAVERSAL_PREAMBLE_TEMPLATE
+            + MULTI_RADIUS_AREA_QUERY_TEMPLATE,
+            strict_undefined=True)
+
+        render_vars = dict(
+            dimensions=dimensions,
+            dtype_to_ctype=dtype_to_ctype,
+            box_id_dtype=box_id_dtype,
+            particle_id_dtype=None,
+            coord_dtype=coord_dtype,
+            vec_types=cl.cltypes.vec_types,
+            max_levels=max_levels,
+            AXIS_NAMES=AXIS_NAMES,
+            box_flags_enum=box_flags_enum,
+            peer_list_idx_dtype=peer_list_idx_dtype,
+            ball_id_dtype=ball_id_dtype,
+            ball_norm=ball_norm,
+            nradii=nradii,
+            debug=False,
+            root_extent_stretch_factor=TreeBuilder.ROOT_EXTENT_STRETCH_FACTOR,
+            # Not used (but required by TRAVERSAL_PREAMBLE_TEMPLATE)
+            stick_out_factor=0)
+
+        from pyopencl.tools import VectorArg, ScalarArg
+        arg_decls = [
+            VectorArg(coord_dtype, "box_centers"),
+            ScalarArg(coord_dtype, "root_extent"),
+            VectorArg(np.uint8, "box_levels"),
+            ScalarArg(box_id_dtype, "aligned_nboxes"),
+            VectorArg(box_id_dtype, "box_child_ids"),
+            VectorArg(box_flags_enum.dtype, "box_flags"),
+            VectorArg(peer_list_idx_dtype, "peer_list_starts"),
+            VectorArg(box_id_dtype, "peer_lists"),
+            VectorArg(coord_dtype, "ball_radii"),
+            ScalarArg(coord_dtype, "max_radius_multiplier"),
+            ] + [
+            ScalarArg(coord_dtype, "radius_multiplier_%d" % iradius)
+            for iradius in range(nradii)
+            ] + [
+            ScalarArg(coord_dtype, "bbox_min_"+ax)
+            for ax in AXIS_NAMES[:dimensions]
+            ] + [
+            VectorArg(coord_dtype, "ball_"+ax)
+            for ax in AXIS_NAMES[:dimensions]]
+
+        from pyopencl.algorithm import ListOfListsBuilder
+        multi_radius_area_query_kernel = ListOfListsBuilder(
+            self.context,
+            [("leaves_%d" % iradius, box_id_dtype)
+                for iradius in range(nradii)],
+            str(template.render(**render_vars)),
+            arg_decls=arg_decls,
+            name_prefix="multi_radius_area_query",
+            count_sharing={},
+            complex_kernel=True)
+
+        logger.info("done building multi-radius area query kernel")
+        return multi_radius_area_query_kernel
+
+    # }}}
+
+    def __call__(self, queue, tree, ball_centers, ball_radii,
+                 radius_multipliers, peer_lists=None, wait_for=None,
+                 ball_norm="linf", allocator=None):
+        """
+        :arg queue: a :class:`pyopencl.CommandQueue`
+        :arg tree: a :class:`boxtree.Tree`.
+        :arg ball_centers: an object array of coordinate
+            :class:`pyopencl.array.Array` instances.
+            Their *dtype* must match *tree*'s
+            :attr:`boxtree.Tree.coord_dtype`.
+        :arg ball_radii: a
+            :class:`pyopencl.array.Array`
+            of positive numbers.
+            Its *dtype* must match *tree*'s
+            :attr:`boxtree.Tree.coord_dtype`.
+        :arg radius_multipliers: a sequence of positive numbers. The balls
+            queried for the *j*-th entry have radii
+            ``radius_multipliers[j] * ball_radii``.
+        :arg peer_lists: may either be *None* or an instance of
+            :class:`PeerListLookup` associated with `tree`.
+        :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
+            instances for whose completion this command waits before starting
+            execution.
+        :arg ball_norm: either ``"linf"`` or ``"l2"``, the norm defining
+            the balls. See :class:`AreaQueryBuilder`.
+        :arg allocator: an allocator for the result arrays, as accepted by
+            :class:`pyopencl.array.Array`.
+        :returns: a tuple *(aqs, event)*, where *aqs* is a list of
+            :class:`AreaQueryResult` instances, one per entry of
+            *radius_multipliers*, and *event* is a :class:`pyopencl.Event`
+            for dependency management.
+        """
+
+        ball_id_dtype, max_levels = _check_ball_args(
+                tree, ball_centers, ball_radii, ball_norm)
+
+        radius_multipliers = [
+                tree.coord_dtype.type(mult) for mult in radius_multipliers]
+        if not radius_multipliers:
+            raise ValueError("at least one radius multiplier is required")
+        if min(radius_multipliers) <= 0:
+            raise ValueError("radius multipliers must be positive")
+
+        if peer_lists is None:
+            peer_lists, evt = self.peer_list_finder(queue, tree, wait_for=wait_for,
+                    allocator=allocator)
+            wait_for = [evt]
+
+        if len(peer_lists.peer_list_starts) != tree.nboxes + 1:
+            raise ValueError("size of peer lists must match with number of boxes")
+
+        nradii = len(radius_multipliers)
+        multi_radius_area_query_kernel = self.get_multi_radius_area_query_kernel(
+            tree.dimensions, tree.coord_dtype, tree.box_id_dtype, ball_id_dtype,
+            peer_lists.peer_list_starts.dtype, max_levels, nradii, ball_norm)
+
+        logger.info("multi-radius area query: run area query for %d radii",
+                nradii)
+
+        result, evt = multi_radius_area_query_kernel(
+                queue, len(ball_radii),
+                tree.box_centers.data, tree.root_extent,
+                tree.box_levels.data, tree.aligned_nboxes,
+                tree.box_child_ids.data, tree.box_flags.data,
+                peer_lists.peer_list_starts,
+                peer_lists.peer_lists, ball_radii.data,
+                max(radius_multipliers),
+                *(tuple(radius_multipliers) +
+                  tuple(tree.bounding_box[0]) +
+                  tuple(bc.data for bc in ball_centers)),
+                wait_for=wait_for, allocator=allocator)
+
+        logger.info("multi-radius area query: done")
+
+        return [
+                AreaQueryResult(
+                    tree=tree,
+                    leaves_near_ball_starts=result["leaves_%d" % iradius].starts,
+                    leaves_near_ball_lists=result["leaves_%d" % iradius].lists)
+                .with_queue(None)
+                for iradius in range(nradii)], evt
+
+# }}}
 
-        ball_id_dtype = tree.particle_id_dtype  # ?
 
-        from pytools import div_ceil
-        # Avoid generating too many kernels.
-        max_levels = div_ceil(tree.nlevels, 10) * 10
+# {{{ particle area query build
+
+class ParticleAreaQueryBuilder(object):
+    """Given a set of :math:`l^\\infty` (or :math:`l^2`) balls, this class
+    helps build a look-up table from ball to the sources (or targets) inside
+    the ball.
+
+    Like :class:`AreaQueryBuilder`, this finds the leaf boxes intersecting
+    each ball, but it then tests the particles in those leaves against the
+    ball on the device. The result is sized by a counting pass and then
+    filled by a writing pass.
+
+    .. versionadded:: 2016.1
+
+    .. automethod:: __call__
+    """
+
+    def __init__(self, context):
+        self.context = context
+        self.peer_list_finder = PeerListFinder(self.context)
+
+    # {{{ Kernel generation
+
+    @memoize_method
+    def get_particle_area_query_kernel(self, dimensions, coord_dtype,
+            box_id_dtype, particle_id_dtype, ball_id_dtype,
+            peer_list_idx_dtype, max_levels, user_order, with_distances,
+            ball_norm):
+        from pyopencl.tools import dtype_to_ctype
+        from boxtree import box_flags_enum
+
+        logger.info("start building particle area query kernel")
+
+        from boxtree.traversal import TRAVERSAL_PREAMBLE_TEMPLATE
+        from boxtree.tree_build import TreeBuilder
+
+        template = Template(
+            TRAVERSAL_PREAMBLE_TEMPLATE
+            + PARTICLE_AREA_QUERY_TEMPLATE,
+            strict_undefined=True)
+
+        render_vars = dict(
+            dimensions=dimensions,
+            dtype_to_ctype=dtype_to_ctype,
+            box_id_dtype=box_id_dtype,
+            particle_id_dtype=particle_id_dtype,
+            coord_dtype=coord_dtype,
+            vec_types=cl.cltypes.vec_types,
+            max_levels=max_levels,
+            AXIS_NAMES=AXIS_NAMES,
+            box_flags_enum=box_flags_enum,
+            peer_list_idx_dtype=peer_list_idx_dtype,
+            ball_id_dtype=ball_id_dtype,
+            user_order=user_order,
+            with_distances=with_distances,
+            ball_norm=ball_norm,
+            debug=False,
+            root_extent_stretch_factor=TreeBuilder.ROOT_EXTENT_STRETCH_FACTOR,
+            # Not used (but required by TRAVERSAL_PREAMBLE_TEMPLATE)
+            stick_out_factor=0)
+
+        from pyopencl.tools import VectorArg, ScalarArg
+        arg_decls = [
+            VectorArg(coord_dtype, "box_centers"),
+            ScalarArg(coord_dtype, "root_extent"),
+            VectorArg(np.uint8, "box_levels"),
+            ScalarArg(box_id_dtype, "aligned_nboxes"),
+            VectorArg(box_id_dtype, "box_child_ids"),
+            VectorArg(box_flags_enum.dtype, "box_flags"),
+            VectorArg(peer_list_idx_dtype, "peer_list_starts"),
+            VectorArg(box_id_dtype, "peer_lists"),
+            VectorArg(coord_dtype, "ball_radii"),
+            VectorArg(particle_id_dtype, "box_particle_starts"),
+            VectorArg(particle_id_dtype, "box_particle_counts_nonchild"),
+            VectorArg(particle_id_dtype, "particle_user_ids"),
+            ] + [
+            ScalarArg(coord_dtype, "bbox_min_"+ax)
+            for ax in AXIS_NAMES[:dimensions]
+            ] + [
+            VectorArg(coord_dtype, "ball_"+ax)
+            for ax in AXIS_NAMES[:dimensions]
+            ] + [
+            VectorArg(coord_dtype, "particles_"+ax)
+            for ax in AXIS_NAMES[:dimensions]]
+
+        lists = [("particles", particle_id_dtype)]
+        count_sharing = {}
+        if with_distances:
+            lists.append(("distances", coord_dtype))
+            count_sharing["distances"] = "particles"
+
+        from pyopencl.algorithm import ListOfListsBuilder
+        particle_area_query_kernel = ListOfListsBuilder(
+            self.context,
+            lists,
+            str(template.render(**render_vars)),
+            arg_decls=arg_decls,
+            name_prefix="particle_area_query",
+            count_sharing=count_sharing,
+            complex_kernel=True)
+
+        logger.info("done building particle area query kernel")
+        return particle_area_query_kernel
+
+    # }}}
+
+    def __call__(self, queue, tree, ball_centers, ball_radii,
+                 particle_kind="sources", order="tree", with_distances=False,
+                 peer_lists=None, wait_for=None, ball_norm="linf",
+                 allocator=None):
+        """
+        :arg queue: a :class:`pyopencl.CommandQueue`
+        :arg tree: a :class:`boxtree.Tree`.
+        :arg ball_centers: an object array of coordinate
+            :class:`pyopencl.array.Array` instances.
+            Their *dtype* must match *tree*'s
+            :attr:`boxtree.Tree.coord_dtype`.
+        :arg ball_radii: a
+            :class:`pyopencl.array.Array`
+            of positive numbers.
+            Its *dtype* must match *tree*'s
+            :attr:`boxtree.Tree.coord_dtype`.
+        :arg particle_kind: either ``"sources"`` or ``"targets"``.
+        :arg order: either ``"tree"`` or ``"user"``, the ordering in which
+            particles are numbered in the result.
+        :arg with_distances: whether to also return the distances from the
+            ball centers to the particles found.
+        :arg peer_lists: may either be *None* or an instance of
+            :class:`PeerListLookup` associated with `tree`.
+        :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
+            instances for whose completion this command waits before starting
+            execution.
+        :arg ball_norm: either ``"linf"`` or ``"l2"``, the norm defining
+            the balls and the reported distances.
+        :arg allocator: an allocator for the result arrays, as accepted by
+            :class:`pyopencl.array.Array`.
+        :returns: a tuple *(paq, event)*, where *paq* is an instance of
+            :class:`ParticleAreaQueryResult`, and *event* is a
+            :class:`pyopencl.Event` for dependency management.
+        """
+
+        ball_id_dtype, max_levels = _check_ball_args(
+                tree, ball_centers, ball_radii, ball_norm)
+
+        if order not in ["tree", "user"]:
+            raise ValueError("unknown order: '%s'" % order)
+        user_order = order == "user"
+
+        if particle_kind == "sources":
+            if tree.sources_have_extent:
+                raise ValueError("particle area queries are not supported "
+                        "for sources with extent")
+            particles = tree.sources
+            box_particle_starts = tree.box_source_starts
+            box_particle_counts_nonchild = tree.box_source_counts_nonchild
+            if user_order:
+                particle_user_ids = tree.user_source_ids
+        elif particle_kind == "targets":
+            if tree.targets_have_extent:
+                raise ValueError("particle area queries are not supported "
+                        "for targets with extent")
+            particles = tree.targets
+            box_particle_starts = tree.box_target_starts
+            box_particle_counts_nonchild = tree.box_target_counts_nonchild
+            if user_order:
+                particle_user_ids = tree.get_user_target_ids(queue)
+        else:
+            raise ValueError("unknown particle kind: '%s'" % particle_kind)
+
+        if not user_order:
+            # not accessed
+            particle_user_ids = box_particle_starts
 
         if peer_lists is None:
-            peer_lists, evt = self.peer_list_finder(queue, tree, wait_for=wait_for)
+            peer_lists, evt = self.peer_list_finder(queue, tree, wait_for=wait_for,
+                    allocator=allocator)
             wait_for = [evt]
 
         if len(peer_lists.peer_list_starts) != tree.nboxes + 1:
             raise ValueError("size of peer lists must match with number of boxes")
 
-        area_query_kernel = self.get_area_query_kernel(tree.dimensions,
-            tree.coord_dtype, tree.box_id_dtype, ball_id_dtype,
-            peer_lists.peer_list_starts.dtype, max_levels)
+        particle_area_query_kernel = self.get_particle_area_query_kernel(
+            tree.dimensions, tree.coord_dtype, tree.box_id_dtype,
+            tree.particle_id_dtype, ball_id_dtype,
+            peer_lists.peer_list_starts.dtype, max_levels,
+            user_order, with_distances, ball_norm)
 
-        logger.info("area query: run area query")
+        logger.info("particle area query: run particle area query")
 
-        result, evt = area_query_kernel(
+        result, evt = particle_area_query_kernel(
                 queue, len(ball_radii),
                 tree.box_centers.data, tree.root_extent,
                 tree.box_levels.data, tree.aligned_nboxes,
                 tree.box_child_ids.data, tree.box_flags.data,
-                peer_lists.peer_list_starts.data,
-                peer_lists.peer_lists.data, ball_radii.data,
-                *(tuple(tree.bounding_box[0]) +
-                  tuple(bc.data for bc in ball_centers)),
-                wait_for=wait_for)
+                peer_lists.peer_list_starts,
+                peer_lists.peer_lists, ball_radii.data,
+                box_particle_starts.data, box_particle_counts_nonchild.data,
+                particle_user_ids.data,
+                *(tuple(tree.bounding_box[0])
+                  + tuple(bc.data for bc in ball_centers)
+                  + tuple(p.data for p in particles)),
+                wait_for=wait_for, allocator=allocator)
 
-        logger.info("area query: done")
+        logger.info("particle area query: done")
 
-        return AreaQueryResult(
+        return ParticleAreaQueryResult(
                 tree=tree,
-                leaves_near_ball_starts=result["leaves"].starts,
-                leaves_near_ball_lists=result["leaves"].lists).with_queue(None), evt
+                particle_kind=particle_kind,
+                order=order,
+                particles_in_ball_starts=result["particles"].starts,
+                particles_in_ball_lists=result["particles"].lists,
+                particle_distances=(
+                    result["distances"].lists if with_distances else None)
+                ).with_queue(None), evt
 
 # }}}
 
@@ -799,7 +2120,7 @@ class LeavesToBallsLookupBuilder(object):
                 type_aliases=(("idx_t", idx_dtype),))
 
     def __call__(self, queue, tree, ball_centers, ball_radii, peer_lists=None,
-                 wait_for=None):
+                 wait_for=None, ball_norm="linf", allocator=None):
         """
         :arg queue: a :class:`pyopencl.CommandQueue`
         :arg tree: a :class:`boxtree.Tree`.
@@ -817,6 +2138,15 @@ class LeavesToBallsLookupBuilder(object):
         :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
             instances for whose completion this command waits before starting
             execution.
+        :arg ball_norm: either ``"linf"`` or ``"l2"``, the norm defining
+            the balls. See :class:`AreaQueryBuilder`.
+
+            .. versionadded:: 2016.1
+        :arg allocator: an allocator for the result arrays, as accepted by
+            :class:`pyopencl.array.Array`.
+
+            .. versionadded:: 2016.1
+
         :returns: a tuple *(lbl, event)*, where *lbl* is an instance of
             :class:`LeavesToBallsLookup`, and *event* is a :class:`pyopencl.Event`
             for dependency management.
@@ -831,7 +2161,8 @@ class LeavesToBallsLookupBuilder(object):
         logger.info("leaves-to-balls lookup: run area query")
 
         area_query, evt = self.area_query_builder(
-                queue, tree, ball_centers, ball_radii, peer_lists, wait_for)
+                queue, tree, ball_centers, ball_radii, peer_lists, wait_for,
+                ball_norm=ball_norm, allocator=allocator)
         wait_for = [evt]
 
         logger.info("leaves-to-balls lookup: expand starts")
@@ -849,7 +2180,8 @@ class LeavesToBallsLookupBuilder(object):
 
         starts_expander_knl = self.get_starts_expander_kernel(tree.box_id_dtype)
         expanded_starts = cl.array.empty(
-                queue, len(area_query.leaves_near_ball_lists), tree.box_id_dtype)
+                queue, len(area_query.leaves_near_ball_lists), tree.box_id_dtype,
+                allocator=allocator)
         evt = starts_expander_knl(
                 expanded_starts,
                 area_query.leaves_near_ball_starts.with_queue(queue),
@@ -866,7 +2198,7 @@ class LeavesToBallsLookupBuilder(object):
                         # values
                         expanded_starts,
                         nkeys, starts_dtype=tree.box_id_dtype,
-                        wait_for=wait_for)
+                        allocator=allocator, wait_for=wait_for)
 
         logger.info("leaves-to-balls lookup: built")
 
@@ -909,19 +2241,20 @@ class SpaceInvaderQueryBuilder(object):
 
     @memoize_method
     def get_space_invader_query_kernel(self, dimensions, coord_dtype,
-                box_id_dtype, peer_list_idx_dtype, max_levels):
+                box_id_dtype, peer_list_idx_dtype, max_levels, ball_norm="linf"):
         return SPACE_INVADER_QUERY_TEMPLATE.generate(
                 self.context,
                 dimensions,
                 coord_dtype,
                 box_id_dtype,
                 peer_list_idx_dtype,
-                max_levels)
+                max_levels,
+                ball_norm=ball_norm)
 
     # }}}
 
     def __call__(self, queue, tree, ball_centers, ball_radii, peer_lists=None,
-                 wait_for=None):
+                 wait_for=None, ball_norm="linf", allocator=None):
         """
         :arg queue: a :class:`pyopencl.CommandQueue`
         :arg tree: a :class:`boxtree.Tree`.
@@ -939,6 +2272,17 @@ class SpaceInvaderQueryBuilder(object):
         :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
             instances for whose completion this command waits before starting
             execution.
+        :arg ball_norm: either ``"linf"`` or ``"l2"``, the norm defining
+            the balls. This only affects which balls are considered to
+            intersect a leaf box, the distances are always measured in the
+            :math:`l^\\infty` norm.
+
+            .. versionadded:: 2016.1
+        :arg allocator: an allocator for the result arrays, as accepted by
+            :class:`pyopencl.array.Array`.
+
+            .. versionadded:: 2016.1
+
         :returns: a tuple *(sqi, event)*, where *sqi* is an instance of
             :class:`pyopencl.array.Array`, and *event* is a :class:`pyopencl.Event`
             for dependency management. The *dtype* of *sqi* is
@@ -952,18 +2296,12 @@ class SpaceInvaderQueryBuilder(object):
               outer space invader distance for *i*.
         """
 
-        from pytools import single_valued
-        if single_valued(bc.dtype for bc in ball_centers) != tree.coord_dtype:
-            raise TypeError("ball_centers dtype must match tree.coord_dtype")
-        if ball_radii.dtype != tree.coord_dtype:
-            raise TypeError("ball_radii dtype must match tree.coord_dtype")
-
-        from pytools import div_ceil
-        # Avoid generating too many kernels.
-        max_levels = div_ceil(tree.nlevels, 10) * 10
+        _, max_levels = _check_ball_args(
+                tree, ball_centers, ball_radii, ball_norm)
 
         if peer_lists is None:
-            peer_lists, evt = self.peer_list_finder(queue, tree, wait_for=wait_for)
+            peer_lists, evt = self.peer_list_finder(queue, tree, wait_for=wait_for,
+                    allocator=allocator)
             wait_for = [evt]
 
         if len(peer_lists.peer_list_starts) != tree.nboxes + 1:
@@ -971,11 +2309,12 @@ class SpaceInvaderQueryBuilder(object):
 
         space_invader_query_kernel = self.get_space_invader_query_kernel(
             tree.dimensions, tree.coord_dtype, tree.box_id_dtype,
-            peer_lists.peer_list_starts.dtype, max_levels)
+            peer_lists.peer_list_starts.dtype, max_levels, ball_norm)
 
         logger.info("space invader query: run space invader query")
 
-        outer_space_invader_dists = cl.array.zeros(queue, tree.nboxes, np.float32)
+        outer_space_invader_dists = cl.array.zeros(queue, tree.nboxes, np.float32,
+                allocator=allocator)
         if not wait_for:
             wait_for = []
         wait_for = wait_for + outer_space_invader_dists.events
@@ -1006,6 +2345,497 @@ class SpaceInvaderQueryBuilder(object):
 # }}}
 
 
+# {{{ k nearest neighbors build
+
+class KNearestNeighborsBuilder(object):
+    """Given a set of query points, this class finds the *k* sources (or
+    targets) of a :class:`boxtree.Tree` nearest to each of them, in the
+    Euclidean norm.
+
+    For each query point, this performs an area query (see
+    :class:`AreaQueryBuilder`) with an :math:`l^2` ball the size of
+    the leaf box containing the point, collecting the nearest particles in a
+    bounded priority queue. The radius of the ball is doubled until *k*
+    particles are found, after which at most one more pass, with the
+    distance to the *k*-th particle found as the radius, makes the result
+    exact.
+
+    .. versionadded:: 2016.1
+
+    .. attribute:: MAX_K
+
+        The largest supported *k*. Each work item keeps its *k* nearest
+        particles found so far in private memory, so larger values would
+        spill to (slow) global memory or fail to build.
+
+    .. automethod:: __call__
+    """
+
+    MAX_K = 64
+
+    def __init__(self, context):
+        self.context = context
+        self.peer_list_finder = PeerListFinder(self.context)
+
+    # {{{ Kernel generation
+
+    @memoize_method
+    def get_k_nearest_neighbors_kernel(self, dimensions, coord_dtype,
+            box_id_dtype, particle_id_dtype, peer_list_idx_dtype, max_levels,
+            k):
+        return K_NEAREST_NEIGHBORS_TEMPLATE.generate(
+                self.context,
+                dimensions,
+                coord_dtype,
+                box_id_dtype,
+                peer_list_idx_dtype,
+                max_levels,
+                extra_var_values=(("k", k),),
+                extra_type_aliases=(("particle_id_t", particle_id_dtype),),
+                ball_norm="l2")
+
+    # }}}
+
+    def __call__(self, queue, tree, query_points, k, particle_kind="sources",
+                 peer_lists=None, wait_for=None, allocator=None):
+        """
+        :arg queue: a :class:`pyopencl.CommandQueue`
+        :arg tree: a :class:`boxtree.Tree`.
+        :arg query_points: an object array of coordinate
+            :class:`pyopencl.array.Array` instances.
+            Their *dtype* must match *tree*'s
+            :attr:`boxtree.Tree.coord_dtype`.
+        :arg k: the number of neighbors to find for each query point. Must
+            not exceed the number of particles of *particle_kind* or
+            :attr:`MAX_K`.
+        :arg particle_kind: either ``"sources"`` or ``"targets"``.
+        :arg peer_lists: may either be *None* or an instance of
+            :class:`PeerListLookup` associated with `tree`.
+        :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
+            instances for whose completion this command waits before starting
+            execution.
+        :arg allocator: an allocator for the result arrays, as accepted by
+            :class:`pyopencl.array.Array`.
+        :returns: a tuple *(knn, event)*, where *knn* is an instance of
+            :class:`KNearestNeighborsResult`, and *event* is a
+            :class:`pyopencl.Event` for dependency management.
+        """
+
+        from pytools import single_valued
+        if single_valued(qp.dtype for qp in query_points) != tree.coord_dtype:
+            raise TypeError("query_points dtype must match tree.coord_dtype")
+
+        if particle_kind == "sources":
+            if tree.sources_have_extent:
+                raise ValueError("k nearest neighbors are not supported "
+                        "for sources with extent")
+            particles = tree.sources
+            nparticles = tree.nsources
+            box_particle_starts = tree.box_source_starts
+            box_particle_counts_nonchild = tree.box_source_counts_nonchild
+        elif particle_kind == "targets":
+            if tree.targets_have_extent:
+                raise ValueError("k nearest neighbors are not supported "
+                        "for targets with extent")
+            particles = tree.targets
+            nparticles = tree.ntargets
+            box_particle_starts = tree.box_target_starts
+            box_particle_counts_nonchild = tree.box_target_counts_nonchild
+        else:
+            raise ValueError("unknown particle kind: '%s'" % particle_kind)
+
+        if not 0 < k <= nparticles:
+            raise ValueError("k must be positive and not exceed the number "
+                    "of %s" % particle_kind)
+        if k > self.MAX_K:
+            raise ValueError("k must not exceed %d" % self.MAX_K)
+
+        from pytools import div_ceil
+        # Avoid generating too many kernels.
+        max_levels = div_ceil(tree.nlevels, 10) * 10
+
+        if peer_lists is None:
+            peer_lists, evt = self.peer_list_finder(queue, tree, wait_for=wait_for,
+                    allocator=allocator)
+            wait_for = [evt]
+
+        if len(peer_lists.peer_list_starts) != tree.nboxes + 1:
+            raise ValueError("size of peer lists must match with number of boxes")
+
+        knn_kernel = self.get_k_nearest_neighbors_kernel(
+            tree.dimensions, tree.coord_dtype, tree.box_id_dtype,
+            tree.particle_id_dtype, peer_lists.peer_list_starts.dtype,
+            max_levels, k)
+
+        logger.info("k nearest neighbors: run k nearest neighbors query")
+
+        nqueries = len(query_points[0])
+        neighbor_ids = cl.array.empty(
+                queue, (nqueries, k), tree.particle_id_dtype,
+                allocator=allocator)
+        neighbor_distances = cl.array.empty(
+                queue, (nqueries, k), tree.coord_dtype, allocator=allocator)
+
+        evt = knn_kernel(
+                *K_NEAREST_NEIGHBORS_TEMPLATE.unwrap_args(
+                    tree, peer_lists,
+                    box_particle_starts,
+                    box_particle_counts_nonchild,
+                    *(tuple(particles) + tuple(query_points) + (
+                        neighbor_ids, neighbor_distances))),
+                wait_for=wait_for,
+                queue=queue,
+                range=slice(nqueries))
+
+        logger.info("k nearest neighbors: done")
+
+        return KNearestNeighborsResult(
+                tree=tree,
+                k=k,
+                particle_kind=particle_kind,
+                neighbor_ids=neighbor_ids,
+                neighbor_distances=neighbor_distances).with_queue(None), evt
+
+# }}}
+
+
+# {{{ range count query build
+
+class RangeCountQueryBuilder(object):
+    """Given a set of :math:`l^\\infty` (or :math:`l^2`) balls, this class
+    counts the sources (or targets) inside each ball, or sums weights
+    attached to them, without building lists of particles or leaves.
+
+    Each ball descends the tree from the root box. Boxes entirely inside
+    the ball contribute their cumulative particle count (or weight) at
+    once, and only the particles of boxes cut by the ball boundary are
+    tested individually.
+
+    .. versionadded:: 2016.1
+
+    .. automethod:: __call__
+    """
+
+    def __init__(self, context):
+        self.context = context
+
+    @memoize_method
+    def get_range_count_query_kernel(self, dimensions, coord_dtype,
+            box_id_dtype, particle_id_dtype, box_level_dtype, count_dtype,
+            max_levels, weighted, ball_norm):
+        from pyopencl.tools import dtype_to_ctype
+        from boxtree import box_flags_enum
+        from boxtree.traversal import (
+                TRAVERSAL_PREAMBLE_MAKO_DEFS,
+                TRAVERSAL_PREAMBLE_TYPEDEFS_AND_DEFINES)
+
+        logger.info("start building range count query kernel")
+
+        render_vars = (
+            ("dimensions", dimensions),
+            ("dtype_to_ctype", dtype_to_ctype),
+            ("box_id_dtype", box_id_dtype),
+            ("particle_id_dtype", particle_id_dtype),
+            ("coord_dtype", coord_dtype),
+            ("vec_types", tuple(cl.cltypes.vec_types.items())),
+            ("max_levels", max_levels),
+            ("AXIS_NAMES", AXIS_NAMES),
+            ("box_flags_enum", box_flags_enum),
+            ("weighted", weighted),
+            ("ball_norm", ball_norm),
+            ("debug", False),
+            # Not used (but required by TRAVERSAL_PREAMBLE_TEMPLATE)
+            ("stick_out_factor", 0),
+        )
+
+        preamble = Template(
+            # HACK: box_flags_t and coord_t are defined here and
+            # by the type aliases below, so disable typedef redifinition
+            # warnings.
+            """
+            #pragma clang diagnostic push
+            #pragma clang diagnostic ignored "-Wtypedef-redefinition"
+            """ +
+            TRAVERSAL_PREAMBLE_TYPEDEFS_AND_DEFINES +
+            """
+            #pragma clang diagnostic pop
+            """,
+            strict_undefined=True).render(**dict(render_vars))
+
+        template = ElementwiseTemplate(
+                arguments=RANGE_COUNT_QUERY_ARGS,
+                operation=(
+                    "//CL:mako//\n"
+                    + TRAVERSAL_PREAMBLE_MAKO_DEFS
+                    + RANGE_COUNT_QUERY_BODY),
+                name="range_count_query")
+
+        range_count_query_kernel = template.build(self.context,
+                type_aliases=(
+                    ("coord_t", coord_dtype),
+                    ("box_id_t", box_id_dtype),
+                    ("particle_id_t", particle_id_dtype),
+                    ("box_level_t", box_level_dtype),
+                    ("box_flags_t", box_flags_enum.dtype),
+                    ("count_t", count_dtype),
+                    ("weight_t", count_dtype),
+                ),
+                var_values=render_vars,
+                more_preamble=preamble)
+
+        logger.info("done building range count query kernel")
+        return range_count_query_kernel
+
+    @memoize_method
+    def get_prefix_sum_kernel(self, dtype):
+        from pyopencl.tools import VectorArg
+        from pyopencl.scan import GenericScanKernel
+        return GenericScanKernel(self.context, dtype,
+                arguments=[
+                    VectorArg(dtype, "values", with_offset=True),
+                    VectorArg(dtype, "prefix_sums", with_offset=True)],
+                input_expr="values[i]",
+                scan_expr="a+b", neutral="0",
+                output_statement="prefix_sums[i] = prev_item;",
+                name_prefix="range_count_weight_prefix_sum")
+
+    def __call__(self, queue, tree, ball_centers, ball_radii,
+                 particle_kind="sources", weights=None, ball_norm="linf",
+                 wait_for=None, allocator=None):
+        """
+        :arg queue: a :class:`pyopencl.CommandQueue`
+        :arg tree: a :class:`boxtree.Tree`.
+        :arg ball_centers: an object array of coordinate
+            :class:`pyopencl.array.Array` instances.
+            Their *dtype* must match *tree*'s
+            :attr:`boxtree.Tree.coord_dtype`.
+        :arg ball_radii: a
+            :class:`pyopencl.array.Array`
+            of positive numbers.
+            Its *dtype* must match *tree*'s
+            :attr:`boxtree.Tree.coord_dtype`.
+        :arg particle_kind: either ``"sources"`` or ``"targets"``.
+        :arg weights: may either be *None*, to count particles, or a
+            :class:`pyopencl.array.Array` with one weight per particle of
+            *particle_kind* in user order, to sum these weights. (For
+            floating point weights, sums over whole boxes are computed as
+            differences of prefix sums, and are subject to the corresponding
+            rounding.)
+        :arg ball_norm: either ``"linf"`` or ``"l2"``, the norm defining
+            the balls.
+        :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
+            instances for whose completion this command waits before starting
+            execution.
+        :arg allocator: an allocator for the result arrays, as accepted by
+            :class:`pyopencl.array.Array`.
+        :returns: a tuple *(counts, event)*, where *counts* is a
+            :class:`pyopencl.array.Array` with one entry per ball, of type
+            :attr:`boxtree.Tree.particle_id_dtype` if *weights* is *None*
+            and of the type of *weights* otherwise, and *event* is a
+            :class:`pyopencl.Event` for dependency management.
+        """
+
+        _, max_levels = _check_ball_args(
+                tree, ball_centers, ball_radii, ball_norm)
+
+        if particle_kind == "sources":
+            particles = tree.sources
+            nparticles = tree.nsources
+            box_particle_starts = tree.box_source_starts
+            box_particle_counts_nonchild = tree.box_source_counts_nonchild
+            box_particle_counts_cumul = tree.box_source_counts_cumul
+        elif particle_kind == "targets":
+            particles = tree.targets
+            nparticles = tree.ntargets
+            box_particle_starts = tree.box_target_starts
+            box_particle_counts_nonchild = tree.box_target_counts_nonchild
+            box_particle_counts_cumul = tree.box_target_counts_cumul
+        else:
+            raise ValueError("unknown particle kind: '%s'" % particle_kind)
+
+        if wait_for is None:
+            wait_for = []
+        else:
+            wait_for = list(wait_for)
+
+        weighted = weights is not None
+        if weighted:
+            if len(weights) != nparticles:
+                raise ValueError("weights must have one entry per particle")
+
+            count_dtype = weights.dtype
+
+            # The zero at the end makes the last entry of the exclusive scan
+            # the total.
+            tree_order_weights = cl.array.zeros(queue, nparticles + 1,
+                    count_dtype, allocator=allocator)
+            wait_for = wait_for + list(tree_order_weights.events)
+            if particle_kind == "sources":
+                tree_order_weights_view = cl.array.take(
+                        weights, tree.user_source_ids,
+                        out=tree_order_weights[:nparticles], queue=queue,
+                        wait_for=wait_for)
+            else:
+                tree_order_weights_view, = cl.array.multi_put(
+                        [weights], tree.sorted_target_ids,
+                        out=[tree_order_weights[:nparticles]], queue=queue,
+                        wait_for=wait_for)
+
+            weight_prefix_sums = cl.array.empty(queue, nparticles + 1,
+                    count_dtype, allocator=allocator)
+            evt = self.get_prefix_sum_kernel(count_dtype)(
+                    tree_order_weights, weight_prefix_sums, queue=queue,
+                    wait_for=tree_order_weights_view.events)
+            wait_for = [evt]
+            extra_args = (weight_prefix_sums,)
+        else:
+            count_dtype = tree.particle_id_dtype
+            extra_args = ()
+
+        range_count_query_kernel = self.get_range_count_query_kernel(
+                tree.dimensions, tree.coord_dtype, tree.box_id_dtype,
+                tree.particle_id_dtype, tree.box_level_dtype, count_dtype,
+                max_levels, weighted, ball_norm)
+
+        nballs = len(ball_radii)
+        counts = cl.array.empty(queue, nballs, count_dtype, allocator=allocator)
+
+        logger.info("range count query: run range count query")
+
+        evt = range_count_query_kernel(
+                tree.box_centers, tree.root_extent, tree.box_levels,
+                tree.aligned_nboxes, tree.box_child_ids, tree.box_flags,
+                box_particle_starts, box_particle_counts_nonchild,
+                box_particle_counts_cumul,
+                *(extra_args
+                    + tuple(particles)
+                    + (ball_radii,)
+                    + tuple(ball_centers)
+                    + (counts,)),
+                queue=queue,
+                range=slice(nballs),
+                wait_for=wait_for)
+
+        logger.info("range count query: done")
+
+        return counts, evt
+
+# }}}
+
+
+# {{{ point locator build
+
+class PointLocator(object):
+    """Given a set of points, this class finds the leaf box containing each
+    point by descending the tree from the root box.
+
+    .. versionadded:: 2016.1
+
+    .. automethod:: __call__
+    """
+
+    def __init__(self, context):
+        self.context = context
+
+    @memoize_method
+    def get_point_locator_kernel(self, dimensions, coord_dtype, box_id_dtype,
+            box_level_dtype):
+        from pyopencl.tools import dtype_to_ctype
+        from boxtree import box_flags_enum
+
+        logger.info("start building point locator kernel")
+
+        render_vars = dict(
+            dimensions=dimensions,
+            AXIS_NAMES=AXIS_NAMES)
+
+        coord_t = dtype_to_ctype(coord_dtype)
+        box_id_t = dtype_to_ctype(box_id_dtype)
+
+        from pyopencl.tools import VectorArg, ScalarArg
+        arguments = [
+            VectorArg(box_flags_enum.dtype, "box_flags"),
+            VectorArg(box_id_dtype, "box_child_ids"),
+            ScalarArg(box_id_dtype, "aligned_nboxes"),
+            ScalarArg(coord_dtype, "root_extent"),
+            VectorArg(box_id_dtype, "box_ids"),
+            VectorArg(box_level_dtype, "box_levels"),
+            ] + [
+            ScalarArg(coord_dtype, "bbox_min_"+ax)
+            for ax in AXIS_NAMES[:dimensions]
+            ] + [
+            VectorArg(coord_dtype, "point_"+ax)
+            for ax in AXIS_NAMES[:dimensions]]
+
+        from pyopencl.elementwise import ElementwiseKernel
+        point_locator_kernel = ElementwiseKernel(
+            self.context,
+            arguments,
+            str(Template(POINT_LOCATOR_TEMPLATE, strict_undefined=True)
+                .render(**render_vars)),
+            name="locate_points",
+            preamble=(
+                "typedef %s coord_t;\n" % coord_t
+                + "typedef %s box_id_t;\n" % box_id_t
+                + box_flags_enum.get_c_defines()
+                + box_flags_enum.get_c_typedef()))
+
+        logger.info("done building point locator kernel")
+        return point_locator_kernel
+
+    def __call__(self, queue, tree, points, wait_for=None, allocator=None):
+        """
+        :arg queue: a :class:`pyopencl.CommandQueue`
+        :arg tree: a :class:`boxtree.Tree`.
+        :arg points: an object array of coordinate
+            :class:`pyopencl.array.Array` instances.
+            Their *dtype* must match *tree*'s
+            :attr:`boxtree.Tree.coord_dtype`.
+        :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
+            instances for whose completion this command waits before starting
+            execution.
+        :arg allocator: an allocator for the result arrays, as accepted by
+            :class:`pyopencl.array.Array`.
+        :returns: a tuple *(pl, event)*, where *pl* is an instance of
+            :class:`PointLocationResult`, and *event* is a
+            :class:`pyopencl.Event` for dependency management.
+        """
+
+        from pytools import single_valued
+        if single_valued(pt.dtype for pt in points) != tree.coord_dtype:
+            raise TypeError("points dtype must match tree.coord_dtype")
+
+        npoints = single_valued(len(pt) for pt in points)
+
+        point_locator_kernel = self.get_point_locator_kernel(
+            tree.dimensions, tree.coord_dtype, tree.box_id_dtype,
+            tree.box_level_dtype)
+
+        box_ids = cl.array.empty(queue, npoints, tree.box_id_dtype,
+                allocator=allocator)
+        box_levels = cl.array.empty(queue, npoints, tree.box_level_dtype,
+                allocator=allocator)
+
+        logger.info("point locator: run point locator")
+
+        evt = point_locator_kernel(
+                tree.box_flags, tree.box_child_ids, tree.aligned_nboxes,
+                tree.root_extent, box_ids, box_levels,
+                *(tuple(tree.bounding_box[0]) + tuple(points)),
+                queue=queue,
+                range=slice(npoints),
+                wait_for=wait_for)
+
+        logger.info("point locator: done")
+
+        return PointLocationResult(
+                tree=tree,
+                box_ids=box_ids,
+                box_levels=box_levels).with_queue(None), evt
+
+# }}}
+
+
 # {{{ peer list build
 
 
@@ -1026,6 +2856,14 @@ class PeerListFinder(object):
     .. [1] Rachh, Manas, Andreas Klöckner, and Michael O'Neil. "Fast
        algorithms for Quadrature by Expansion I: Globally valid expansions."
 
+    Since the peer lists depend only on the tree, they are cached on the
+    :class:`boxtree.Tree` instance they were computed for, so that the
+    builders in this module, when run back to back on the same tree, only
+    find them once. The cache is invalidated if any of the tree arrays the
+    peer lists are derived from are replaced. Peer lists built with a
+    caller-provided allocator are not cached, so that their memory is not
+    kept alive beyond the caller's use of it.
+
     .. versionadded:: 2016.1
 
     .. automethod:: __call__
@@ -1034,6 +2872,37 @@ class PeerListFinder(object):
     def __init__(self, context):
         self.context = context
 
+    # {{{ caching
+
+    @staticmethod
+    def _get_cache_key(tree):
+        return (
+                (tree.nboxes, tree.root_extent),
+                (tree.box_centers, tree.box_levels, tree.box_child_ids,
+                    tree.box_flags))
+
+    @classmethod
+    def _get_cached(cls, tree):
+        try:
+            (scalars, arrays), (peer_list_starts, peer_lists, evt) = \
+                    tree.__dict__["_peer_list_cache"]
+        except KeyError:
+            return None
+
+        new_scalars, new_arrays = cls._get_cache_key(tree)
+        if (scalars != new_scalars
+                or any(ary is not new_ary
+                    for ary, new_ary in zip(arrays, new_arrays))):
+            del tree.__dict__["_peer_list_cache"]
+            return None
+
+        return PeerListLookup(
+                tree=tree,
+                peer_list_starts=peer_list_starts,
+                peer_lists=peer_lists), evt
+
+    # }}}
+
     # {{{ Kernel generation
 
     @memoize_method
@@ -1095,17 +2964,31 @@ class PeerListFinder(object):
 
     # }}}
 
-    def __call__(self, queue, tree, wait_for=None):
+    def __call__(self, queue, tree, wait_for=None, use_cache=True,
+            allocator=None):
         """
         :arg queue: a :class:`pyopencl.CommandQueue`
         :arg tree: a :class:`boxtree.Tree`.
         :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
             instances for whose completion this command waits before starting
             execution.
+        :arg use_cache: if *False*, ignore peer lists cached on *tree* and
+            recompute them.
+        :arg allocator: an allocator for the result arrays, as accepted by
+            :class:`pyopencl.array.Array`. If given, the result is not
+            cached on *tree*.
         :returns: a tuple *(pl, event)*, where *pl* is an instance of
             :class:`PeerListLookup`, and *event* is a :class:`pyopencl.Event`
             for dependency management.
         """
+        if use_cache:
+            cached = self._get_cached(tree)
+            if cached is not None:
+                logger.info("peer list finder: using cached peer lists")
+                peer_lists, evt = cached
+                return peer_lists, cl.enqueue_marker(
+                        queue, wait_for=list(wait_for or []) + [evt])
+
         from pytools import div_ceil
         # Avoid generating too many kernels.
         max_levels = div_ceil(tree.nlevels, 10) * 10
@@ -1120,14 +3003,23 @@ class PeerListFinder(object):
                 tree.box_centers.data, tree.root_extent,
                 tree.box_levels.data, tree.aligned_nboxes,
                 tree.box_child_ids.data, tree.box_flags.data,
-                wait_for=wait_for)
+                wait_for=wait_for, allocator=allocator)
 
         logger.info("peer list finder: done")
 
-        return PeerListLookup(
+        peer_lists = PeerListLookup(
                 tree=tree,
                 peer_list_starts=result["peers"].starts,
-                peer_lists=result["peers"].lists).with_queue(None), evt
+                peer_lists=result["peers"].lists).with_queue(None)
+
+        if allocator is None:
+            # Only store the arrays, as the lookup would refer back to the
+            # tree and thereby keep it from being freed by reference counting.
+            tree.__dict__["_peer_list_cache"] = (
+                    self._get_cache_key(tree),
+                    (peer_lists.peer_list_starts, peer_lists.peer_lists, evt))
+
+        return peer_lists, evt
 
 # }}}
 
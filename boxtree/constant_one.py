@@ -0,0 +1,436 @@
+from __future__ import division, absolute_import
+
+__copyright__ = "Copyright (C) 2016 Andreas Kloeckner"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+from six.moves import range
+
+import numpy as np
+from pytools import Record
+from boxtree.tree import ParticleReorderer
+from boxtree.tools import expand_ranges
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__doc__ = """
+Checking interaction completeness
+---------------------------------
+
+A Green's function that is constant 1 everywhere makes every 'expansion'
+exact, so an FMM with it computes the sum of all source weights at every
+target. This is only true if the traversal has every source interact with
+every target exactly once.
+
+.. autoclass:: ConstantOneExpansionWrangler
+
+    .. automethod:: box_target_starts
+    .. automethod:: box_target_counts_nonchild
+    .. automethod:: box_target_ids
+
+.. autoclass:: FMMInteractionCheckResult()
+
+    .. automethod:: get_failed_target_ids
+
+.. autofunction:: check_fmm_interactions
+"""
+
+
+# {{{ helpers
+
+def _sum_segments(values, starts, counts):
+    """Return the sums of *values* over the ranges given by *starts* and
+    *counts*. The ranges may be empty and need not be sorted.
+    """
+    result = np.zeros(len(starts), dtype=values.dtype)
+
+    nonempty = counts > 0
+    if not nonempty.any():
+        return result
+
+    starts = starts[nonempty]
+
+    # np.add.reduceat sums from each index up to the next one, so sums
+    # over arbitrary ranges are found at every other index. The padding
+    # keeps range ends in bounds.
+    indices = np.empty(2*len(starts), dtype=np.intp)
+    indices[0::2] = starts
+    indices[1::2] = starts + counts[nonempty]
+
+    padded_values = np.concatenate([values, np.zeros(1, dtype=values.dtype)])
+    result[nonempty] = np.add.reduceat(padded_values, indices)[0::2]
+
+    return result
+
+
+def _sum_csr_rows(starts, lists, values, factors=None):
+    """Return the sums of *values* over the entries of each row of the
+    list given by *starts* and *lists*. If given, *factors* holds a factor
+    for each entry of *lists*.
+    """
+    starts = np.asarray(starts)
+
+    entry_values = values[lists]
+    if factors is not None:
+        entry_values = entry_values * factors
+
+    return _sum_segments(entry_values, starts[:-1], np.diff(starts))
+
+
+def _get_image_codes(image_shifts):
+    """Return a number in :math:`[0, 3^d)` for each of the periodic image
+    shifts in *image_shifts*, an object array of one shift array per axis.
+    """
+    codes = 0
+    for iaxis, axis_shifts in enumerate(image_shifts):
+        codes = codes + (axis_shifts.astype(np.intp) + 1) * 3**iaxis
+
+    return codes
+
+# }}}
+
+
+# {{{ constant-one wrangler
+
+class ConstantOneExpansionWrangler(object):
+    """An expansion wrangler (see
+    :class:`boxtree.fmm.ExpansionWranglerInterface`) for a Green's function
+    that is constant 1 everywhere. All its operations are vectorized with
+    :mod:`numpy`, so it remains usable for trees with millions of particles.
+
+    :arg tree: a :class:`boxtree.Tree` whose bulk data lives in
+        :class:`numpy.ndarray` instances.
+    :arg dtype: the data type of expansions and potentials. Integer types
+        make the computation exact; unsigned types wrap around on overflow.
+    :arg image_weights: only used with periodic traversals. If given, an
+        array of :math:`3^d` weights, one for each periodic image shift. An
+        interaction with a source box shifted by :math:`(s_0, \\dots,
+        s_{d-1})` is multiplied by the weight at index
+        :math:`\\sum_i (s_i+1) 3^i`.
+
+    .. versionadded:: 2016.1
+    """
+
+    def __init__(self, tree, dtype=np.float64, image_weights=None):
+        self.tree = tree
+        self.dtype = np.dtype(dtype)
+        self.reorderer = ParticleReorderer(tree)
+
+        if image_weights is not None:
+            image_weights = np.asarray(image_weights, dtype=self.dtype)
+            if image_weights.shape != (3**tree.dimensions,):
+                raise ValueError("image_weights must have one entry per "
+                        "periodic image shift")
+
+        self.image_weights = image_weights
+
+    def multipole_expansion_zeros(self):
+        return np.zeros(self.tree.nboxes, dtype=self.dtype)
+
+    local_expansion_zeros = multipole_expansion_zeros
+
+    def potential_zeros(self):
+        return np.zeros(self.tree.ntargets, dtype=self.dtype)
+
+    def _get_box_source_sums(self, boxes, src_weights):
+        return _sum_segments(src_weights,
+                self.tree.box_source_starts[boxes],
+                self.tree.box_source_counts_nonchild[boxes])
+
+    def _get_image_factors(self, image_shifts):
+        if image_shifts is None or self.image_weights is None:
+            return None
+
+        return self.image_weights[_get_image_codes(image_shifts)]
+
+    # {{{ overridable target lists, e.g. for filtered targets
+
+    def box_target_starts(self):
+        """Return the start of each box's range of targets in the potential
+        array. Override this and :meth:`box_target_counts_nonchild` for
+        filtered targets in tree order.
+        """
+        return self.tree.box_target_starts
+
+    def box_target_counts_nonchild(self):
+        """Return the number of targets each box owns. See
+        :meth:`box_target_starts`.
+        """
+        return self.tree.box_target_counts_nonchild
+
+    def box_target_ids(self, boxes):
+        """Return a tuple *(target_ids, counts)*. *target_ids* holds the
+        indices into the potential array of the targets owned by each box in
+        *boxes*, one box after the other, and *counts* the number of targets
+        of each box. Override this for targets that do not form contiguous
+        ranges, e.g. filtered targets in user order.
+        """
+        counts = self.box_target_counts_nonchild()[boxes]
+        return expand_ranges(self.box_target_starts()[boxes], counts), counts
+
+    # }}}
+
+    def _add_to_box_targets(self, pot, boxes, box_values):
+        """Add *box_values* to *pot* at each target owned by the
+        corresponding entry of *boxes*.
+        """
+        target_ids, counts = self.box_target_ids(boxes)
+
+        # Boxes own disjoint sets of targets, so there are no repeated
+        # indices here.
+        pot[target_ids] += np.repeat(box_values, counts)
+        return pot
+
+    def reorder_sources(self, source_array):
+        return self.reorderer.reorder_sources(source_array)
+
+    def reorder_potentials(self, potentials):
+        return self.reorderer.reorder_potentials(potentials)
+
+    def form_multipoles(self, level_start_source_box_nrs, source_boxes, src_weights):
+        mpoles = self.multipole_expansion_zeros()
+        mpoles[source_boxes] += self._get_box_source_sums(source_boxes, src_weights)
+        return mpoles
+
+    def coarsen_multipoles(self, level_start_source_parent_box_nrs,
+            source_parent_boxes, mpoles, coarsest_level=2):
+        tree = self.tree
+
+        # 2 is the last relevant source_level.
+        # 1 is the last relevant target_level.
+        # (Periodic traversals also need level 1 and pass coarsest_level=1.)
+        # (Nobody needs a multipole on level 0, i.e. for the root box.)
+        for source_level in range(tree.nlevels-1, coarsest_level-1, -1):
+            start, stop = level_start_source_parent_box_nrs[
+                            source_level:source_level+2]
+            boxes = source_parent_boxes[start:stop]
+
+            child_ids = tree.box_child_ids[:, boxes]
+            child_mpoles = np.where(child_ids != 0, mpoles[child_ids], 0)
+            mpoles[boxes] += child_mpoles.sum(axis=0).astype(self.dtype)
+
+    def eval_direct(self, target_boxes, neighbor_sources_starts,
+            neighbor_sources_lists, src_weights, image_shifts=None):
+        box_source_sums = self._get_box_source_sums(
+                np.arange(self.tree.nboxes), src_weights)
+
+        return self._add_to_box_targets(
+                self.potential_zeros(), target_boxes,
+                _sum_csr_rows(neighbor_sources_starts, neighbor_sources_lists,
+                    box_source_sums, self._get_image_factors(image_shifts)))
+
+    def multipole_to_local(self,
+            level_start_target_or_target_parent_box_nrs,
+            target_or_target_parent_boxes,
+            starts, lists, mpole_exps, image_shifts=None):
+        local_exps = self.local_expansion_zeros()
+        local_exps[target_or_target_parent_boxes] += _sum_csr_rows(
+                starts, lists, mpole_exps,
+                self._get_image_factors(image_shifts))
+        return local_exps
+
+    def eval_multipoles(self, level_start_target_box_nrs, target_boxes,
+            sep_smaller_nonsiblings_by_level, mpole_exps, image_shifts=None):
+        contribs = np.zeros(len(target_boxes), dtype=self.dtype)
+
+        if image_shifts is None:
+            image_shifts = [None] * len(sep_smaller_nonsiblings_by_level)
+
+        for ssn, ssn_image_shifts in zip(
+                sep_smaller_nonsiblings_by_level, image_shifts):
+            contribs += _sum_csr_rows(ssn.starts, ssn.lists, mpole_exps,
+                    self._get_image_factors(ssn_image_shifts))
+
+        return self._add_to_box_targets(
+                self.potential_zeros(), target_boxes, contribs)
+
+    def form_locals(self,
+            level_start_target_or_target_parent_box_nrs,
+            target_or_target_parent_boxes, starts, lists, src_weights,
+            image_shifts=None):
+        box_source_sums = self._get_box_source_sums(
+                np.arange(self.tree.nboxes), src_weights)
+
+        local_exps = self.local_expansion_zeros()
+        local_exps[target_or_target_parent_boxes] += _sum_csr_rows(
+                starts, lists, box_source_sums,
+                self._get_image_factors(image_shifts))
+        return local_exps
+
+    def refine_locals(self, level_start_target_or_target_parent_box_nrs,
+            target_or_target_parent_boxes, local_exps):
+
+        for target_lev in range(1, self.tree.nlevels):
+            start, stop = level_start_target_or_target_parent_box_nrs[
+                    target_lev:target_lev+2]
+            boxes = target_or_target_parent_boxes[start:stop]
+            local_exps[boxes] += local_exps[self.tree.box_parent_ids[boxes]]
+
+        return local_exps
+
+    def eval_locals(self, level_start_target_box_nrs, target_boxes, local_exps):
+        return self._add_to_box_targets(
+                self.potential_zeros(), target_boxes, local_exps[target_boxes])
+
+# }}}
+
+
+# {{{ interaction check
+
+class FMMInteractionCheckResult(Record):
+    """The outcome of :func:`check_fmm_interactions`. All per-target arrays
+    are in user target order.
+
+    .. attribute:: nsources
+
+    .. attribute:: nimages
+
+        The number of periodic images of each source that are to reach each
+        target, i.e. :math:`3^p` for a traversal with :math:`p` periodic
+        axes.
+
+    .. attribute:: interaction_counts
+
+        The number of source particles that reached each target, counting
+        repeated interactions.
+
+    .. attribute:: nmissing
+
+        For each target, by how much *interaction_counts* falls short of
+        *nimages* times *nsources*.
+
+    .. attribute:: nduplicated
+
+        For each target, by how much *interaction_counts* exceeds
+        *nimages* times *nsources*.
+
+    .. attribute:: is_exact
+
+        For each target, a :class:`bool` indicating whether every source
+        (image) reached it exactly once. Unlike the counts, this also detects
+        missing interactions that are made up for by duplicated ones.
+
+    .. attribute:: all_exact
+
+        *True* if *is_exact* holds for every target.
+    """
+
+    def get_failed_target_ids(self):
+        """Return the (user-order) indices of the targets for which
+        *is_exact* does not hold.
+        """
+        return np.flatnonzero(~self.is_exact)
+
+
+def check_fmm_interactions(traversal, queue=None, seed=15):
+    """Run :func:`boxtree.fmm.drive_fmm` on *traversal* with a
+    :class:`ConstantOneExpansionWrangler` to check that every source
+    interacts with every target exactly once.
+
+    Two FMMs are run, both in exact integer arithmetic: one with unit
+    weights to count interactions per target, and one with random 64-bit
+    weights whose sum (modulo :math:`2^{64}`) reveals, with overwhelming
+    probability, whether the set of interactions at a target is right.
+
+    For periodic traversals, each target is to interact with each source in
+    every image of the tree covered by the interaction lists. Random weights
+    per image are then used to also check the image shifts.
+
+    :arg traversal: a :class:`boxtree.traversal.FMMTraversalInfo`. If its
+        data lives on the device, *queue* is used to transfer it to the
+        host first.
+    :arg seed: the seed for the random weights.
+    :returns: a :class:`FMMInteractionCheckResult`.
+
+    .. versionadded:: 2016.1
+    """
+    if not isinstance(traversal.tree.box_source_starts, np.ndarray):
+        if queue is None:
+            raise ValueError("a queue is required to check a traversal "
+                    "on the device")
+        traversal = traversal.get(queue=queue)
+
+    from boxtree.fmm import drive_fmm
+
+    tree = traversal.tree
+    nsources = tree.nsources
+
+    periodic = getattr(traversal, "periodic", None)
+    if periodic is None:
+        periodic = (False,) * tree.dimensions
+    nimages = 3**sum(periodic)
+
+    logger.info("check fmm interactions: count")
+
+    interaction_counts = drive_fmm(traversal,
+            ConstantOneExpansionWrangler(tree, np.int64),
+            np.ones(nsources, dtype=np.int64))
+
+    logger.info("check fmm interactions: checksum")
+
+    uint64_info = np.iinfo(np.uint64)
+    rng = np.random.RandomState(seed)
+    weights = rng.randint(uint64_info.max, size=nsources, dtype=np.uint64)
+
+    if nimages == 1:
+        image_weights = None
+        expected_checksum = np.sum(weights, dtype=np.uint64)
+    else:
+        image_weights = rng.randint(
+                uint64_info.max, size=3**tree.dimensions, dtype=np.uint64)
+
+        # Only images shifted along periodic axes are to be reached.
+        image_codes = np.arange(3**tree.dimensions)
+        is_valid_image = np.all([
+                is_periodic | ((image_codes // 3**iaxis) % 3 == 1)
+                for iaxis, is_periodic in enumerate(periodic)],
+                axis=0)
+
+        # Multiplying arrays rather than scalars wraps around silently.
+        expected_checksum = (
+                np.sum(weights, dtype=np.uint64, keepdims=True)
+                * np.sum(image_weights[is_valid_image], dtype=np.uint64,
+                    keepdims=True))[0]
+
+    checksums = drive_fmm(traversal,
+            ConstantOneExpansionWrangler(tree, np.uint64, image_weights),
+            weights)
+
+    expected_count = nimages * nsources
+    is_exact = (
+            (interaction_counts == expected_count)
+            & (checksums == expected_checksum))
+
+    return FMMInteractionCheckResult(
+            nsources=nsources,
+            nimages=nimages,
+            interaction_counts=interaction_counts,
+            nmissing=np.maximum(expected_count - interaction_counts, 0),
+            nduplicated=np.maximum(interaction_counts - expected_count, 0),
+            is_exact=is_exact,
+            all_exact=bool(is_exact.all()))
+
+# }}}
+
+# vim: filetype=pyopencl:fdm=marker
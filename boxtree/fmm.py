@@ -26,7 +26,143 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-def drive_fmm(traversal, expansion_wrangler, src_weights):
+# {{{ release-on-consume bookkeeping
+
+def _get_nbytes(val):
+    import numpy as np
+
+    if val is None:
+        return 0
+    elif isinstance(val, np.ndarray) and val.dtype == object:
+        return sum(_get_nbytes(subval) for subval in val.flat)
+    elif isinstance(val, (list, tuple)):
+        return sum(_get_nbytes(subval) for subval in val)
+    elif hasattr(val, "starts") and hasattr(val, "lists"):
+        # a CSR list, as in sep_smaller_by_level
+        return _get_nbytes(val.starts) + _get_nbytes(val.lists)
+    else:
+        return getattr(val, "nbytes", 0)
+
+
+class _ConsumedDataReleaser(object):
+    """Releases traversal fields and forgets intermediate arrays in
+    :func:`drive_fmm` once they are no longer needed, and keeps track of
+    the peak memory use with and without doing so.
+
+    Only the traversal fields and intermediate arrays handed to this object
+    are accounted for.
+    """
+
+    def __init__(self, traversal, enabled):
+        if enabled:
+            regenerate = traversal.__dict__.get("_regenerate")
+            if regenerate is None:
+                raise ValueError("release_consumed needs a traversal that "
+                        "can regenerate released fields, see "
+                        "FMMTraversalInfo.release")
+
+            # Release fields of a copy, so the caller's traversal stays
+            # intact. (Making the copy regenerates any fields released
+            # earlier.)
+            traversal = traversal.copy()
+            traversal._regenerate = regenerate
+
+        self.traversal = traversal
+        self.enabled = enabled
+
+        self.array_nbytes = {}
+        self.live_array_names = set()
+        self.total_array_nbytes = 0
+
+        self.peak_nbytes = 0
+        self.peak_nbytes_without_release = 0
+
+        if not enabled:
+            return
+
+        self.traversal_nbytes = self._get_traversal_nbytes()
+        self.released_traversal_nbytes = 0
+
+    def _get_traversal_nbytes(self):
+        # Some fields may share data, e.g. target_boxes and source_boxes.
+        values = dict(
+                (id(val), val)
+                for name, val in self.traversal.__dict__.items()
+                if name in self.traversal.__class__.fields
+                and name != "tree")
+        return sum(_get_nbytes(val) for val in values.values())
+
+    def _update_peaks(self):
+        live_array_nbytes = sum(
+                self.array_nbytes[name] for name in self.live_array_names)
+
+        self.peak_nbytes = max(self.peak_nbytes,
+                self.traversal_nbytes - self.released_traversal_nbytes
+                + live_array_nbytes)
+        self.peak_nbytes_without_release = max(
+                self.peak_nbytes_without_release,
+                self.traversal_nbytes + self.total_array_nbytes)
+
+    def track(self, name, value):
+        if not self.enabled:
+            return
+
+        nbytes = _get_nbytes(value)
+        self.total_array_nbytes += nbytes - self.array_nbytes.get(name, 0)
+        self.array_nbytes[name] = nbytes
+        self.live_array_names.add(name)
+        self._update_peaks()
+
+    def forget(self, *names):
+        if not self.enabled:
+            return
+
+        self.live_array_names.difference_update(names)
+
+    def release(self, *field_names):
+        if not self.enabled:
+            return
+
+        nbytes_before = self._get_traversal_nbytes()
+        self.traversal.release(*field_names)
+        self.released_traversal_nbytes += (
+                nbytes_before - self._get_traversal_nbytes())
+
+    def report(self):
+        if not self.enabled:
+            return
+
+        logger.info("fmm: peak memory of traversal and intermediate arrays "
+                "%.1f MB with release-on-consume (%.1f MB without)"
+                % (self.peak_nbytes / 1e6,
+                    self.peak_nbytes_without_release / 1e6))
+
+# }}}
+
+
+def _get_image_shift_kwargs(traversal, field_name):
+    """For periodic traversals, return the keyword arguments that pass the
+    image shifts in *field_name* of *traversal* on to the expansion wrangler.
+    """
+    if getattr(traversal, "periodic", None) is None:
+        return {}
+
+    return {"image_shifts": getattr(traversal, field_name)}
+
+
+def _get_coarsen_kwargs(traversal):
+    """For periodic traversals, return the keyword arguments that make the
+    expansion wrangler form multipoles down to level 1, which are needed
+    for boxes in the neighboring images of the tree.
+    """
+    if getattr(traversal, "periodic", None) is None:
+        return {}
+
+    return {"coarsest_level": 1}
+
+
+def drive_fmm(traversal, expansion_wrangler, src_weights,
+        release_consumed=False):
     """Top-level driver routine for a fast multipole calculation.
 
     In part, this is intended as a template for custom FMMs, in the sense that
@@ -42,10 +178,30 @@ def drive_fmm(traversal, expansion_wrangler, src_weights):
         :class:`ExpansionWranglerInterface`.
     :arg src_weights: Source 'density/weights/charges'.
         Passed unmodified to *expansion_wrangler*.
+    :arg release_consumed: If *True*, each interaction list is released
+        (see :meth:`boxtree.traversal.FMMTraversalInfo.release`) and each
+        intermediate array is dropped as soon as the last stage using it has
+        finished. The resulting savings in peak memory are logged. Lists are
+        released on a copy of *traversal*, which itself is left unchanged,
+        so their memory is only freed if the caller does not hold on to
+        them, e.g. if *traversal* is a temporary. *traversal* must support
+        :meth:`~boxtree.traversal.FMMTraversalInfo.release`.
 
     Returns the potentials computed by *expansion_wrangler*.
+
+    If *traversal* is periodic (see :ref:`periodic-traversals`), the image
+    shifts of each interaction list are passed to the corresponding method of
+    *expansion_wrangler* as the keyword argument *image_shifts*, and
+    :meth:`ExpansionWranglerInterface.coarsen_multipoles` receives
+    *coarsest_level=1*.
+
+    .. versionchanged:: 2016.1
+
+        Added *release_consumed* and support for periodic traversals.
     """
     wrangler = expansion_wrangler
+    releaser = _ConsumedDataReleaser(traversal, release_consumed)
+    traversal = releaser.traversal
 
     # Interface guidelines: Attributes of the tree are assumed to be known
     # to the expansion wrangler and should not be passed.
@@ -55,6 +211,11 @@ def drive_fmm(traversal, expansion_wrangler, src_weights):
     logger.debug("reorder source weights")
 
     src_weights = wrangler.reorder_sources(src_weights)
+    releaser.track("src_weights", src_weights)
+
+    # not used by the FMM itself
+    releaser.release("colleagues_starts", "colleagues_lists",
+            "colleagues_image_shifts")
 
     # {{{ "Step 2.1:" Construct local multipoles
 
@@ -63,6 +224,8 @@ def drive_fmm(traversal, expansion_wrangler, src_weights):
             traversal.level_start_source_box_nrs,
             traversal.source_boxes,
             src_weights)
+    releaser.track("mpole_exps", mpole_exps)
+    releaser.release("source_boxes")
 
     # }}}
 
@@ -72,7 +235,9 @@ def drive_fmm(traversal, expansion_wrangler, src_weights):
     wrangler.coarsen_multipoles(
             traversal.level_start_source_parent_box_nrs,
             traversal.source_parent_boxes,
-            mpole_exps)
+            mpole_exps,
+            **_get_coarsen_kwargs(traversal))
+    releaser.release("source_parent_boxes")
 
     # mpole_exps is called Phi in [1]
 
@@ -85,7 +250,13 @@ def drive_fmm(traversal, expansion_wrangler, src_weights):
             traversal.target_boxes,
             traversal.neighbor_source_boxes_starts,
             traversal.neighbor_source_boxes_lists,
-            src_weights)
+            src_weights,
+            **_get_image_shift_kwargs(
+                traversal, "neighbor_source_boxes_image_shifts"))
+    releaser.track("potentials", potentials)
+    releaser.release(
+            "neighbor_source_boxes_starts", "neighbor_source_boxes_lists",
+            "neighbor_source_boxes_image_shifts")
 
     # these potentials are called alpha in [1]
 
@@ -99,7 +270,11 @@ def drive_fmm(traversal, expansion_wrangler, src_weights):
             traversal.target_or_target_parent_boxes,
             traversal.sep_siblings_starts,
             traversal.sep_siblings_lists,
-            mpole_exps)
+            mpole_exps,
+            **_get_image_shift_kwargs(traversal, "sep_siblings_image_shifts"))
+    releaser.track("local_exps", local_exps)
+    releaser.release("sep_siblings_starts", "sep_siblings_lists",
+            "sep_siblings_image_shifts")
 
     # local_exps represents both Gamma and Delta in [1]
 
@@ -116,7 +291,15 @@ def drive_fmm(traversal, expansion_wrangler, src_weights):
             traversal.level_start_target_box_nrs,
             traversal.target_boxes,
             traversal.sep_smaller_by_level,
-            mpole_exps)
+            mpole_exps,
+            **_get_image_shift_kwargs(
+                traversal, "sep_smaller_image_shifts_by_level"))
+    releaser.track("potentials", potentials)
+    releaser.release("sep_smaller_by_level", "sep_smaller_image_shifts_by_level")
+
+    if release_consumed:
+        del mpole_exps
+        releaser.forget("mpole_exps")
 
     # these potentials are called beta in [1]
 
@@ -129,6 +312,7 @@ def drive_fmm(traversal, expansion_wrangler, src_weights):
                 traversal.sep_close_smaller_starts,
                 traversal.sep_close_smaller_lists,
                 src_weights)
+        releaser.release("sep_close_smaller_starts", "sep_close_smaller_lists")
 
     # }}}
 
@@ -141,7 +325,11 @@ def drive_fmm(traversal, expansion_wrangler, src_weights):
             traversal.target_or_target_parent_boxes,
             traversal.sep_bigger_starts,
             traversal.sep_bigger_lists,
-            src_weights)
+            src_weights,
+            **_get_image_shift_kwargs(traversal, "sep_bigger_image_shifts"))
+    releaser.track("local_exps", local_exps)
+    releaser.release("sep_bigger_starts", "sep_bigger_lists",
+            "sep_bigger_image_shifts")
 
     if traversal.sep_close_bigger_starts is not None:
         logger.debug("evaluate separated close bigger interactions directly "
@@ -152,6 +340,11 @@ def drive_fmm(traversal, expansion_wrangler, src_weights):
                 traversal.sep_close_bigger_starts,
                 traversal.sep_close_bigger_lists,
                 src_weights)
+        releaser.release("sep_close_bigger_starts", "sep_close_bigger_lists")
+
+    if release_consumed:
+        del src_weights
+        releaser.forget("src_weights")
 
     # }}}
 
@@ -163,6 +356,7 @@ def drive_fmm(traversal, expansion_wrangler, src_weights):
             traversal.level_start_target_or_target_parent_box_nrs,
             traversal.target_or_target_parent_boxes,
             local_exps)
+    releaser.release("target_or_target_parent_boxes")
 
     # }}}
 
@@ -174,17 +368,119 @@ def drive_fmm(traversal, expansion_wrangler, src_weights):
             traversal.level_start_target_box_nrs,
             traversal.target_boxes,
             local_exps)
+    releaser.track("potentials", potentials)
+    releaser.release("target_boxes")
+
+    if release_consumed:
+        del local_exps
+        releaser.forget("local_exps")
 
     # }}}
 
     logger.debug("reorder potentials")
     result = wrangler.reorder_potentials(potentials)
 
+    releaser.report()
+
     logger.info("fmm complete")
 
     return result
 
 
+def drive_dual_tree_fmm(traversal, expansion_wrangler, src_weights):
+    """Top-level driver routine for a fast multipole calculation based on
+    the near and far interaction lists obtained from a dual tree traversal.
+
+    All far-field interactions are handled by translating multipole
+    expansions into local expansions, so that of the
+    :class:`ExpansionWranglerInterface`, :meth:`eval_multipoles` and
+    :meth:`form_locals` are not used. Note that the far source boxes
+    of a target box may reside on a different level than the target box.
+
+    :arg traversal: A :class:`boxtree.traversal.DualTreeTraversalInfo`
+        instance.
+    :arg expansion_wrangler: An object exhibiting the
+        :class:`ExpansionWranglerInterface`.
+    :arg src_weights: Source 'density/weights/charges'.
+        Passed unmodified to *expansion_wrangler*.
+
+    Returns the potentials computed by *expansion_wrangler*.
+
+    .. versionadded:: 2016.1
+    """
+    wrangler = expansion_wrangler
+
+    logger.info("start dual tree fmm")
+
+    logger.debug("reorder source weights")
+
+    src_weights = wrangler.reorder_sources(src_weights)
+
+    # {{{ construct and propagate multipoles upward
+
+    logger.debug("construct local multipoles")
+    mpole_exps = wrangler.form_multipoles(
+            traversal.level_start_source_box_nrs,
+            traversal.source_boxes,
+            src_weights)
+
+    logger.debug("propagate multipoles upward")
+    wrangler.coarsen_multipoles(
+            traversal.level_start_source_parent_box_nrs,
+            traversal.source_parent_boxes,
+            mpole_exps)
+
+    # }}}
+
+    # {{{ direct evaluation from near source boxes
+
+    logger.debug("direct evaluation from near source boxes")
+    potentials = wrangler.eval_direct(
+            traversal.target_or_target_parent_boxes,
+            traversal.near_source_boxes_starts,
+            traversal.near_source_boxes_lists,
+            src_weights)
+
+    # }}}
+
+    # {{{ translate far source boxes' mpoles to local
+
+    logger.debug("translate far source boxes' mpoles to local")
+    local_exps = wrangler.multipole_to_local(
+            traversal.level_start_target_or_target_parent_box_nrs,
+            traversal.target_or_target_parent_boxes,
+            traversal.far_source_boxes_starts,
+            traversal.far_source_boxes_lists,
+            mpole_exps)
+
+    # }}}
+
+    # {{{ propagate local_exps downward and evaluate
+
+    logger.debug("propagate local_exps downward")
+
+    wrangler.refine_locals(
+            traversal.level_start_target_or_target_parent_box_nrs,
+            traversal.target_or_target_parent_boxes,
+            local_exps)
+
+    logger.debug("evaluate locals")
+
+    potentials = potentials + wrangler.eval_locals(
+            traversal.level_start_target_box_nrs,
+            traversal.target_boxes,
+            local_exps)
+
+    # }}}
+
+    logger.debug("reorder potentials")
+    result = wrangler.reorder_potentials(potentials)
+
+    logger.info("dual tree fmm complete")
+
+    return result
+
+
 # {{{ expansion wrangler interface
 
 class ExpansionWranglerInterface:
@@ -196,6 +492,18 @@ class ExpansionWranglerInterface:
 
     Will usually hold a reference (and thereby be specific to) a
     :class:`boxtree.Tree` instance.
+
+    For periodic traversals (see :ref:`periodic-traversals`), the methods
+    consuming interaction lists (:meth:`eval_direct`,
+    :meth:`multipole_to_local`, :meth:`eval_multipoles` and
+    :meth:`form_locals`) receive an additional keyword argument
+    *image_shifts*, an object array of one :class:`numpy.int8` array per
+    axis, parallel to *lists*. The source box of each list entry is then to
+    be taken as shifted by ``image_shifts * tree.root_extent``. For
+    :meth:`eval_multipoles`, *image_shifts* is a list with one such object
+    array per level. Multipole expansions are needed down to level 1 for
+    periodic traversals, so :meth:`coarsen_multipoles` receives
+    *coarsest_level=1*.
     """
 
     def multipole_expansion_zeros(self):
@@ -239,11 +547,14 @@ class ExpansionWranglerInterface:
         """
 
     def coarsen_multipoles(self, level_start_source_parent_box_nrs,
-            source_parent_boxes, mpoles):
-        """For each box in *source_parent_boxes*,
-        gather (and translate) the box's children's multipole expansions in
-        *mpole* and add the resulting expansion into the box's multipole
-        expansion in *mpole*.
+            source_parent_boxes, mpoles, coarsest_level=2):
+        """For each box in *source_parent_boxes* on level *coarsest_level*
+        or finer, gather (and translate) the box's children's multipole
+        expansions in *mpole* and add the resulting expansion into the box's
+        multipole expansion in *mpole*.
+
+        Non-periodic FMMs need no multipoles on levels 0 and 1, since no
+        boxes on those levels are well-separated from each other.
 
         :returns: *mpoles*
         """
@@ -0,0 +1,893 @@
+from __future__ import division, absolute_import
+
+__copyright__ = "Copyright (C) 2016 Andreas Kloeckner"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+from six.moves import range
+
+import numpy as np
+from pytools import Record, memoize
+from pytools.obj_array import make_obj_array
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__doc__ = """
+Building trees and traversals on the host
+-----------------------------------------
+
+The builders in this module do not need OpenCL. They produce the same data
+structures as :class:`boxtree.TreeBuilder` and
+:class:`boxtree.traversal.FMMTraversalBuilder`, but with all bulk data in
+:class:`numpy.ndarray` instances, i.e. as if :meth:`boxtree.Tree.get` had
+been called on them. This makes it possible to run :func:`boxtree.fmm.drive_fmm`
+with a host-side expansion wrangler on machines without an OpenCL runtime.
+
+Particles with extent are not supported.
+
+.. autoclass:: HostTreeBuilder
+
+    .. automethod:: __call__
+
+.. autoclass:: HostTraversalBuilder
+
+    .. automethod:: __call__
+"""
+
+
+# {{{ helpers
+
+@memoize
+def _get_spread_table(dimensions):
+    """Return a table mapping each byte value to its bits, spaced
+    *dimensions* apart.
+    """
+    values = np.arange(256, dtype=np.uint64)
+    result = np.zeros(256, dtype=np.uint64)
+    for ibit in range(8):
+        result |= ((values >> np.uint64(ibit)) & np.uint64(1)) \
+                << np.uint64(ibit*dimensions)
+
+    return result
+
+
+def _interleave_bits(coords, nbits):
+    """Return the Morton keys of the integer coordinates *coords* (of shape
+    *(dimensions, n)*), each of which has at most *nbits* bits. As in
+    :class:`boxtree.TreeBuilder`, the first axis ends up in the most
+    significant bit of each group.
+    """
+    dimensions = len(coords)
+    spread_table = _get_spread_table(dimensions)
+
+    result = np.zeros(coords.shape[1], dtype=np.uint64)
+    for iaxis in range(dimensions):
+        coord = coords[iaxis].astype(np.uint64)
+        for ibyte in range((nbits + 7) // 8):
+            byte = (coord >> np.uint64(8*ibyte)) & np.uint64(0xff)
+            result |= spread_table[byte] << np.uint64(
+                    8*ibyte*dimensions + dimensions-1-iaxis)
+
+    return result
+
+
+def _make_csr(nrows, rows, values, dtype, deduplicate=True):
+    """Return *(starts, lists)* of a CSR list with the entries *values* in rows
+    *rows*. Unless *deduplicate* is *False*, repeated entries are dropped and
+    each row is sorted.
+    """
+    if deduplicate:
+        nvalues = int(np.max(values)) + 1 if len(values) else 1
+        pair_keys = np.sort(rows.astype(np.int64) * nvalues + values)
+        if len(pair_keys):
+            keep = np.ones(len(pair_keys), dtype=np.bool_)
+            keep[1:] = pair_keys[1:] != pair_keys[:-1]
+            pair_keys = pair_keys[keep]
+
+        rows = pair_keys // nvalues
+        values = pair_keys % nvalues
+    elif np.any(rows[1:] < rows[:-1]):
+        order = np.argsort(rows, kind="mergesort")
+        rows = rows[order]
+        values = values[order]
+
+    starts = np.zeros(nrows+1, dtype=dtype)
+    np.cumsum(np.bincount(rows, minlength=nrows), out=starts[1:])
+
+    return starts, values.astype(dtype)
+
+
+class _BuiltList(Record):
+    """A host-side counterpart of :class:`pyopencl.algorithm.BuiltList`, so
+    that this module does not need :mod:`pyopencl`.
+
+    .. attribute:: count
+    .. attribute:: starts
+    .. attribute:: lists
+    """
+
+    def __init__(self, count, starts, lists):
+        Record.__init__(self, count=count, starts=starts, lists=lists)
+
+# }}}
+
+
+# {{{ tree builder
+
+class HostTreeBuilder(object):
+    """Builds a :class:`boxtree.Tree` using :mod:`numpy` only.
+
+    Particles are sorted once by their Morton key at the finest representable
+    level. Every box is then a contiguous range of particles, and each level
+    of the tree is found by splitting the ranges of the boxes to be refined
+    where the Morton key prefix changes. Empty boxes are never created, so
+    the resulting tree is pruned.
+
+    .. versionadded:: 2016.1
+    """
+
+    box_level_dtype = np.dtype(np.uint8)
+    particle_id_dtype = np.dtype(np.int32)
+    box_id_dtype = np.dtype(np.int32)
+
+    # same as boxtree.tree_build_kernels.refine_weight_dtype, which is not
+    # imported here since that module needs pyopencl's scan machinery
+    refine_weight_dtype = np.dtype(np.int32)
+
+    def __call__(self, particles, kind="adaptive", max_particles_in_box=None,
+            targets=None, refine_weights=None, max_leaf_refine_weight=None,
+            bbox=None, stick_out_factor=0.25):
+        """
+        :arg particles: an object array of (XYZ) point coordinate arrays,
+            each a :class:`numpy.ndarray`.
+        :arg kind: ``"adaptive"`` or ``"non-adaptive"``. See
+            :ref:`tree-kinds`.
+
+        The remaining arguments are as for :meth:`boxtree.TreeBuilder.__call__`.
+
+        :returns: a :class:`boxtree.Tree` whose bulk data lives in
+            :class:`numpy.ndarray` instances. (Unlike
+            :meth:`boxtree.TreeBuilder.__call__`, no event is returned.)
+        """
+
+        # {{{ input processing
+
+        if kind not in ["adaptive", "non-adaptive"]:
+            raise ValueError("unknown tree kind \"{0}\"".format(kind))
+
+        from pytools import single_valued
+        from boxtree.tree import Tree, box_flags_enum
+        from boxtree.tools import expand_ranges
+
+        particles = [np.asarray(coord) for coord in particles]
+        dimensions = len(particles)
+        coord_dtype = single_valued(coord.dtype for coord in particles)
+
+        sources_are_targets = targets is None
+        nsources = single_valued(len(coord) for coord in particles)
+
+        if sources_are_targets:
+            ntargets = nsources
+            srcntgts = particles
+        else:
+            targets = [np.asarray(coord) for coord in targets]
+            if single_valued(coord.dtype for coord in targets) != coord_dtype:
+                raise TypeError("sources and targets must have same coordinate "
+                        "dtype")
+
+            ntargets = single_valued(len(coord) for coord in targets)
+            srcntgts = [
+                    np.concatenate([src_i, tgt_i])
+                    for src_i, tgt_i in zip(particles, targets)]
+
+        nsrcntgts = len(srcntgts[0])
+
+        refine_weight_dtype = self.refine_weight_dtype
+
+        specified_max_particles_in_box = max_particles_in_box is not None
+        specified_refine_weights = refine_weights is not None and \
+            max_leaf_refine_weight is not None
+
+        if specified_max_particles_in_box and specified_refine_weights:
+            raise ValueError("may only specify one of max_particles_in_box and "
+                    "refine_weights/max_leaf_refine_weight")
+        elif not specified_max_particles_in_box and not specified_refine_weights:
+            raise ValueError("must specify either max_particles_in_box or "
+                    "refine_weights/max_leaf_refine_weight")
+        elif specified_max_particles_in_box:
+            refine_weights = np.ones(nsrcntgts, dtype=refine_weight_dtype)
+            max_leaf_refine_weight = max_particles_in_box
+        else:
+            refine_weights = np.asarray(refine_weights)
+            if refine_weights.dtype != refine_weight_dtype:
+                raise TypeError("refine_weights must have dtype '%s'"
+                        % refine_weight_dtype)
+
+        if max_leaf_refine_weight <= 0:
+            raise ValueError("max_leaf_refine_weight must be positive")
+        if nsrcntgts:
+            if max_leaf_refine_weight < np.max(refine_weights):
+                raise ValueError("entries of refine_weights cannot exceed "
+                        "max_leaf_refine_weight")
+            if np.min(refine_weights) < 0:
+                raise ValueError(
+                        "all entries of refine_weights must be nonnegative")
+
+        # }}}
+
+        # {{{ bounding box
+
+        from boxtree.tree_build import TreeBuilder
+
+        particle_min = np.array([np.min(coord) for coord in srcntgts])
+        particle_max = np.array([np.max(coord) for coord in srcntgts])
+
+        if bbox is None:
+            root_extent = coord_dtype.type(
+                    np.max(particle_max - particle_min)
+                    * (1 + TreeBuilder.ROOT_EXTENT_STRETCH_FACTOR))
+            bbox_min = particle_min.astype(coord_dtype)
+
+            # A single particle, or coincident ones, have no extent. Use the
+            # smallest one that still makes for a box of nonzero size.
+            root_extent = coord_dtype.type(max(root_extent,
+                    np.finfo(coord_dtype).eps * max(1, np.max(np.abs(bbox_min)))))
+        else:
+            bbox = np.asarray(bbox, dtype=coord_dtype)
+            if bbox.shape != (dimensions, 2):
+                raise ValueError("bbox has an invalid shape")
+
+            bbox_min = bbox[:, 0].copy()
+            extents = bbox[:, 1] - bbox[:, 0]
+            root_extent = coord_dtype.type(np.max(extents))
+
+            if not np.allclose(extents, root_extent):
+                raise ValueError("bbox must be a cube")
+            if not root_extent > 0:
+                raise ValueError("bbox must have a positive extent")
+
+            if (np.any(particle_min < bbox_min)
+                    or np.any((particle_max - bbox_min) / root_extent >= 1)):
+                raise ValueError("particles must lie inside bbox")
+
+        bbox_max = bbox_min + root_extent
+
+        # }}}
+
+        # {{{ sort by morton key
+
+        # Keys of the finest level must fit into 64 bits.
+        nbits = 63 // dimensions
+
+        int_coords = np.empty((dimensions, nsrcntgts), dtype=np.int64)
+        for iaxis, coord in enumerate(srcntgts):
+            scaled = np.floor(
+                    (coord.astype(np.float64) - bbox_min[iaxis])
+                    / root_extent * 2**nbits)
+            int_coords[iaxis] = np.clip(scaled, 0, 2**nbits - 1)
+
+        keys = _interleave_bits(int_coords, nbits)
+        sorted_srcntgt_ids = np.argsort(keys, kind="mergesort")
+        keys = keys[sorted_srcntgt_ids]
+        int_coords = int_coords[:, sorted_srcntgt_ids]
+
+        refine_weights_cumul = np.zeros(nsrcntgts+1, dtype=np.int64)
+        np.cumsum(refine_weights[sorted_srcntgt_ids], out=refine_weights_cumul[1:])
+
+        del refine_weights
+
+        # }}}
+
+        # {{{ refine level by level
+
+        level_starts = [np.zeros(1, dtype=np.intp)]
+        level_counts = [np.array([nsrcntgts], dtype=np.intp)]
+        level_parent_ids = [np.zeros(1, dtype=np.intp)]
+        level_morton_nrs = [np.zeros(1, dtype=np.intp)]
+
+        level_start_box_nrs = [0, 1]
+
+        level = 0
+        while level < nbits:
+            starts = level_starts[-1]
+            counts = level_counts[-1]
+            box_ids = np.arange(level_start_box_nrs[-2], level_start_box_nrs[-1])
+
+            weights = (
+                    refine_weights_cumul[starts+counts]
+                    - refine_weights_cumul[starts])
+
+            # Boxes whose particles all have the same key (i.e. coincide at
+            # the finest level) cannot be split up.
+            nonempty = counts > 0
+            splittable = np.zeros(len(starts), dtype=np.bool_)
+            splittable[nonempty] = (
+                    keys[starts[nonempty]]
+                    != keys[starts[nonempty] + counts[nonempty] - 1])
+
+            split = (weights > max_leaf_refine_weight) & splittable
+
+            if not split.any():
+                break
+
+            if kind == "non-adaptive":
+                split = counts > 0
+
+            idx = expand_ranges(starts[split], counts[split])
+            child_keys = keys[idx] >> np.uint64(dimensions*(nbits - level - 1))
+
+            is_child_start = np.ones(len(idx), dtype=np.bool_)
+            is_child_start[1:] = child_keys[1:] != child_keys[:-1]
+            child_start_indices = np.flatnonzero(is_child_start)
+
+            level_starts.append(idx[child_start_indices])
+            level_counts.append(np.diff(np.append(child_start_indices, len(idx))))
+            level_parent_ids.append(
+                    np.repeat(box_ids[split], counts[split])[child_start_indices])
+            level_morton_nrs.append(
+                    (child_keys[child_start_indices]
+                        & np.uint64(2**dimensions - 1)).astype(np.intp))
+
+            level_start_box_nrs.append(
+                    level_start_box_nrs[-1] + len(child_start_indices))
+
+            level += 1
+
+        nlevels = len(level_starts)
+        nboxes = level_start_box_nrs[-1]
+
+        box_srcntgt_starts = np.concatenate(level_starts)
+        box_srcntgt_counts_cumul = np.concatenate(level_counts)
+        box_parent_ids = np.concatenate(level_parent_ids).astype(self.box_id_dtype)
+        box_morton_nrs = np.concatenate(level_morton_nrs)
+        box_levels = np.repeat(
+                np.arange(nlevels), np.diff(level_start_box_nrs)).astype(
+                        self.box_level_dtype)
+
+        del level_starts
+        del level_counts
+        del level_parent_ids
+        del level_morton_nrs
+
+        logger.info("host tree build: %d levels, %d boxes" % (nlevels, nboxes))
+
+        # }}}
+
+        # {{{ box geometry and children
+
+        box_ids = np.arange(nboxes)
+
+        box_child_ids = np.zeros((2**dimensions, nboxes), dtype=self.box_id_dtype)
+        box_child_ids[box_morton_nrs[1:], box_parent_ids[1:]] = box_ids[1:]
+
+        box_has_children = np.zeros(nboxes, dtype=np.bool_)
+        box_has_children[box_parent_ids[1:]] = True
+
+        box_int_coords = (
+                int_coords[:, np.minimum(box_srcntgt_starts, nsrcntgts-1)]
+                >> (nbits - box_levels.astype(np.int64)))
+        box_sizes = root_extent / 2**box_levels.astype(np.float64)
+        box_centers = (
+                bbox_min[:, np.newaxis]
+                + (box_int_coords + 0.5) * box_sizes).astype(coord_dtype)
+
+        # }}}
+
+        # {{{ particle ids and per-box counts
+
+        if sources_are_targets:
+            user_source_ids = sorted_srcntgt_ids.astype(self.particle_id_dtype)
+
+            sorted_target_ids = np.empty(ntargets, dtype=self.particle_id_dtype)
+            sorted_target_ids[user_source_ids] = np.arange(ntargets)
+
+            box_source_starts = box_srcntgt_starts.astype(self.particle_id_dtype)
+            box_source_counts_cumul = box_srcntgt_counts_cumul.astype(
+                    self.particle_id_dtype)
+            box_target_starts = box_source_starts
+            box_target_counts_cumul = box_source_counts_cumul
+        else:
+            is_source = sorted_srcntgt_ids < nsources
+
+            user_source_ids = sorted_srcntgt_ids[is_source].astype(
+                    self.particle_id_dtype)
+
+            sorted_target_ids = np.empty(ntargets, dtype=self.particle_id_dtype)
+            sorted_target_ids[sorted_srcntgt_ids[~is_source] - nsources] = \
+                    np.arange(ntargets)
+
+            sources_before = np.zeros(nsrcntgts+1, dtype=np.intp)
+            np.cumsum(is_source, out=sources_before[1:])
+            targets_before = np.arange(nsrcntgts+1) - sources_before
+
+            box_srcntgt_stops = box_srcntgt_starts + box_srcntgt_counts_cumul
+
+            box_source_starts = sources_before[box_srcntgt_starts].astype(
+                    self.particle_id_dtype)
+            box_source_counts_cumul = (
+                    sources_before[box_srcntgt_stops] - box_source_starts).astype(
+                            self.particle_id_dtype)
+            box_target_starts = targets_before[box_srcntgt_starts].astype(
+                    self.particle_id_dtype)
+            box_target_counts_cumul = (
+                    targets_before[box_srcntgt_stops] - box_target_starts).astype(
+                            self.particle_id_dtype)
+
+        def nonchild(counts_cumul):
+            return np.where(box_has_children, 0, counts_cumul).astype(
+                    self.particle_id_dtype)
+
+        box_source_counts_nonchild = nonchild(box_source_counts_cumul)
+        if sources_are_targets:
+            box_target_counts_nonchild = box_source_counts_nonchild
+        else:
+            box_target_counts_nonchild = nonchild(box_target_counts_cumul)
+
+        # }}}
+
+        # {{{ box flags
+
+        box_flags = np.zeros(nboxes, dtype=box_flags_enum.dtype)
+        box_flags[box_source_counts_nonchild > 0] |= box_flags_enum.HAS_OWN_SOURCES
+        box_flags[box_target_counts_nonchild > 0] |= box_flags_enum.HAS_OWN_TARGETS
+        box_flags[box_has_children & (box_source_counts_cumul > 0)] |= \
+                box_flags_enum.HAS_CHILD_SOURCES
+        box_flags[box_has_children & (box_target_counts_cumul > 0)] |= \
+                box_flags_enum.HAS_CHILD_TARGETS
+
+        # }}}
+
+        sources = make_obj_array([coord[user_source_ids] for coord in particles])
+        if sources_are_targets:
+            targets = sources
+        else:
+            tree_target_ids = np.empty(ntargets, dtype=self.particle_id_dtype)
+            tree_target_ids[sorted_target_ids] = np.arange(ntargets)
+            targets = make_obj_array([coord[tree_target_ids] for coord in targets])
+
+        level_start_box_nrs = np.array(level_start_box_nrs, dtype=self.box_id_dtype)
+
+        return Tree(
+                sources_are_targets=sources_are_targets,
+                sources_have_extent=False,
+                targets_have_extent=False,
+
+                particle_id_dtype=self.particle_id_dtype,
+                box_id_dtype=self.box_id_dtype,
+                coord_dtype=coord_dtype,
+                box_level_dtype=self.box_level_dtype,
+
+                root_extent=root_extent,
+                stick_out_factor=stick_out_factor,
+
+                bounding_box=(bbox_min, bbox_max),
+                level_start_box_nrs=level_start_box_nrs,
+                level_start_box_nrs_dev=level_start_box_nrs,
+
+                sources=sources,
+                targets=targets,
+
+                box_source_starts=box_source_starts,
+                box_source_counts_nonchild=box_source_counts_nonchild,
+                box_source_counts_cumul=box_source_counts_cumul,
+                box_target_starts=box_target_starts,
+                box_target_counts_nonchild=box_target_counts_nonchild,
+                box_target_counts_cumul=box_target_counts_cumul,
+
+                box_parent_ids=box_parent_ids,
+                box_child_ids=box_child_ids,
+                box_centers=box_centers,
+                box_levels=box_levels,
+                box_flags=box_flags,
+
+                user_source_ids=user_source_ids,
+                sorted_target_ids=sorted_target_ids,
+
+                _is_pruned=True)
+
+# }}}
+
+
+# {{{ traversal builder
+
+class _BoxGeometry(object):
+    """Integer box coordinates of a host :class:`boxtree.Tree`, with lookup of
+    boxes by position and adjacency tests.
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.dimensions = tree.dimensions
+
+        nboxes = tree.nboxes
+        self.box_levels = tree.box_levels.astype(np.int64)
+        self.level_start_box_nrs = tree.level_start_box_nrs
+        self.max_level = tree.nlevels - 1
+
+        # Trees of a single particle (or of coincident ones) may have a root
+        # extent of zero.
+        root_extent = max(tree.root_extent, np.finfo(tree.coord_dtype).tiny)
+        box_sizes = root_extent / 2**self.box_levels.astype(np.float64)
+        self.box_coords = np.floor(
+                (tree.box_centers[:, :nboxes]
+                    - tree.bounding_box[0][:, np.newaxis]) / box_sizes
+                ).astype(np.int64)
+
+        # Boxes sorted by Morton key within each level, for lookup.
+        box_keys = _interleave_bits(self.box_coords, self.max_level)
+        self.sorted_box_ids = np.lexsort((box_keys, self.box_levels))
+        self.sorted_box_keys = box_keys[self.sorted_box_ids]
+
+        self.neighbor_offsets = np.array(
+                np.unravel_index(
+                    np.arange(3**self.dimensions), (3,)*self.dimensions)) - 1
+        self.neighbor_offsets = self.neighbor_offsets[
+                :, np.any(self.neighbor_offsets != 0, axis=0)]
+
+    def find_boxes(self, coords, levels, exact=False):
+        """Return the ids of the deepest boxes containing the cells with
+        integer coordinates *coords* on *levels*, or -1 where there is none.
+        If *exact*, only return boxes on *levels*.
+        """
+        result = np.full(len(levels), -1, dtype=np.intp)
+
+        in_domain = np.all((0 <= coords) & (coords < 2**levels), axis=0)
+
+        # Process queries grouped by level, so that each group only visits
+        # the levels needed to resolve it.
+        order = np.argsort(levels, kind="mergesort")
+        order = order[in_domain[order]]
+        query_levels = levels[order]
+        group_starts = np.searchsorted(
+                query_levels, np.arange(self.max_level + 2))
+
+        for query_level in range(self.max_level + 1):
+            pending = order[
+                    group_starts[query_level]:group_starts[query_level+1]]
+
+            for level in range(query_level, -1, -1):
+                if not len(pending) or (exact and level < query_level):
+                    break
+
+                keys = _interleave_bits(
+                        coords[:, pending] >> (query_level - level),
+                        self.max_level)
+
+                start = self.level_start_box_nrs[level]
+                stop = self.level_start_box_nrs[level+1]
+                level_keys = self.sorted_box_keys[start:stop]
+
+                pos = np.minimum(
+                        np.searchsorted(level_keys, keys), len(level_keys)-1)
+                found = level_keys[pos] == keys
+
+                result[pending[found]] = self.sorted_box_ids[start + pos[found]]
+                pending = pending[~found]
+
+        return result
+
+    def find_neighbors(self, boxes, exact=False):
+        """Return *(indices, neighbors)*, where *neighbors* are the deepest
+        boxes (not deeper than the box itself) containing the cells adjacent
+        to ``boxes[indices]``.
+        """
+        noffsets = self.neighbor_offsets.shape[1]
+
+        coords = (self.box_coords[:, boxes, np.newaxis]
+                + self.neighbor_offsets[:, np.newaxis, :]).reshape(
+                        self.dimensions, -1)
+        indices = np.repeat(np.arange(len(boxes)), noffsets)
+
+        neighbors = self.find_boxes(coords, self.box_levels[boxes][indices],
+                exact=exact)
+
+        found = neighbors >= 0
+        return indices[found], neighbors[found]
+
+    def find_parent_neighbors(self, boxes):
+        """Like :meth:`find_neighbors`, but for the parents of *boxes*. Each
+        parent is only looked up once.
+        """
+        parents, parent_indices = np.unique(
+                self.tree.box_parent_ids[boxes], return_inverse=True)
+        parent_indices = parent_indices.ravel()
+
+        indices, neighbors = self.find_neighbors(parents)
+
+        from boxtree.tools import expand_ranges
+        nchildren = np.bincount(parent_indices, minlength=len(parents))
+        child_starts = np.cumsum(nchildren) - nchildren
+        children_by_parent = np.argsort(parent_indices, kind="mergesort")
+
+        return (
+                children_by_parent[
+                    expand_ranges(child_starts[indices], nchildren[indices])],
+                np.repeat(neighbors, nchildren[indices]))
+
+    def are_adjacent_or_overlapping(self, boxes_a, boxes_b, same_level=False):
+        """Vectorized equivalent of ``is_adjacent_or_overlapping`` in the
+        traversal kernels, in exact integer arithmetic. Pass *same_level* if
+        all pairs of boxes are known to be on the same level.
+        """
+        result = np.ones(len(boxes_a), dtype=np.bool_)
+
+        if not same_level:
+            shift_a = self.max_level - self.box_levels[boxes_a]
+            shift_b = self.max_level - self.box_levels[boxes_b]
+
+        for iaxis in range(self.dimensions):
+            coords_a = self.box_coords[iaxis, boxes_a]
+            coords_b = self.box_coords[iaxis, boxes_b]
+
+            if same_level:
+                result &= np.abs(coords_a - coords_b) <= 1
+            else:
+                low_a = coords_a << shift_a
+                low_b = coords_b << shift_b
+                result &= (
+                        (low_a <= (coords_b + 1) << shift_b)
+                        & (low_b <= (coords_a + 1) << shift_a))
+
+        return result
+
+
+class HostTraversalBuilder(object):
+    """Builds a :class:`boxtree.traversal.FMMTraversalInfo` for a host
+    :class:`boxtree.Tree` using :mod:`numpy` only.
+
+    The tree may come from :class:`HostTreeBuilder` or from
+    :meth:`boxtree.Tree.get`. Instead of walking the tree per box, neighbors
+    are found by looking up the cells adjacent to each box in per-level
+    sorted arrays of box Morton keys. The interaction lists contain the same
+    boxes as those built by :class:`boxtree.traversal.FMMTraversalBuilder`,
+    though possibly in a different order within each list.
+
+    .. versionadded:: 2016.1
+    """
+
+    def __call__(self, tree):
+        """
+        :arg tree: a :class:`boxtree.Tree` whose bulk data lives in
+            :class:`numpy.ndarray` instances.
+        :returns: a :class:`boxtree.traversal.FMMTraversalInfo` whose bulk
+            data lives in :class:`numpy.ndarray` instances.
+        """
+
+        if not tree._is_pruned:
+            raise ValueError("tree must be pruned for traversal generation")
+        if tree.sources_have_extent or tree.targets_have_extent:
+            raise NotImplementedError("host traversal generation does not "
+                    "support particles with extent")
+
+        from boxtree.tree import box_flags_enum
+        from boxtree.traversal import FMMTraversalInfo
+        from boxtree.tools import expand_ranges
+
+        box_id_dtype = tree.box_id_dtype
+        box_flags = tree.box_flags
+        box_levels = tree.box_levels
+        box_parent_ids = tree.box_parent_ids
+
+        geo = _BoxGeometry(tree)
+        adjacent = geo.are_adjacent_or_overlapping
+
+        logger.info("start building host traversal")
+
+        # {{{ box lists
+
+        def boxes_with_flags(flags):
+            return np.flatnonzero(box_flags & flags).astype(box_id_dtype)
+
+        source_boxes = boxes_with_flags(box_flags_enum.HAS_OWN_SOURCES)
+        source_parent_boxes = boxes_with_flags(box_flags_enum.HAS_CHILD_SOURCES)
+        if tree.sources_are_targets:
+            target_boxes = source_boxes
+        else:
+            target_boxes = boxes_with_flags(box_flags_enum.HAS_OWN_TARGETS)
+        target_or_target_parent_boxes = boxes_with_flags(
+                box_flags_enum.HAS_OWN_TARGETS | box_flags_enum.HAS_CHILD_TARGETS)
+
+        def level_starts(box_list):
+            return np.searchsorted(
+                    box_list, tree.level_start_box_nrs).astype(box_id_dtype)
+
+        ntarget_boxes = len(target_boxes)
+        ntarget_or_target_parent_boxes = len(target_or_target_parent_boxes)
+
+        target_box_numbers = np.full(tree.nboxes, -1, dtype=np.intp)
+        target_box_numbers[target_boxes] = np.arange(ntarget_boxes)
+
+        def has_flags(boxes, flags):
+            return (box_flags[boxes] & flags) != 0
+
+        # }}}
+
+        # {{{ colleagues
+
+        nonroot_boxes = np.arange(1, tree.nboxes)
+        indices, colleagues = geo.find_neighbors(nonroot_boxes, exact=True)
+        colleagues_starts, colleagues_lists = _make_csr(
+                tree.nboxes, nonroot_boxes[indices], colleagues, box_id_dtype,
+                deduplicate=False)
+
+        # }}}
+
+        # {{{ neighbor source boxes ("list 1")
+
+        # same size or bigger source boxes, including the target box itself
+        indices, neighbors = geo.find_neighbors(target_boxes)
+        is_source = has_flags(neighbors, box_flags_enum.HAS_OWN_SOURCES)
+        rows = [indices[is_source], np.flatnonzero(
+            has_flags(target_boxes, box_flags_enum.HAS_OWN_SOURCES))]
+        values = [neighbors[is_source], target_boxes[rows[-1]]]
+
+        # smaller source boxes, found from the source side
+        indices, neighbors = geo.find_neighbors(source_boxes)
+        is_target = (
+                has_flags(neighbors, box_flags_enum.HAS_OWN_TARGETS)
+                & (box_levels[neighbors] < box_levels[source_boxes[indices]]))
+        rows.append(target_box_numbers[neighbors[is_target]])
+        values.append(source_boxes[indices[is_target]])
+
+        neighbor_source_boxes_starts, neighbor_source_boxes_lists = _make_csr(
+                ntarget_boxes, np.concatenate(rows), np.concatenate(values),
+                box_id_dtype)
+
+        # }}}
+
+        # {{{ well-separated siblings ("list 2")
+
+        nonroot_indices = np.flatnonzero(box_levels[target_or_target_parent_boxes])
+        parents = box_parent_ids[target_or_target_parent_boxes[nonroot_indices]]
+        ncolleagues = colleagues_starts[parents+1] - colleagues_starts[parents]
+
+        rows = np.repeat(nonroot_indices, ncolleagues)
+        parent_colleagues = colleagues_lists[
+                expand_ranges(colleagues_starts[parents], ncolleagues)]
+
+        nchildren = 2**tree.dimensions
+        rows = np.repeat(rows, nchildren)
+        siblings = tree.box_child_ids[:, parent_colleagues].T.ravel()
+
+        is_sep = siblings != 0
+        is_sep[is_sep] = ~adjacent(
+                target_or_target_parent_boxes[rows[is_sep]], siblings[is_sep],
+                same_level=True)
+
+        sep_siblings_starts, sep_siblings_lists = _make_csr(
+                ntarget_or_target_parent_boxes, rows[is_sep], siblings[is_sep],
+                box_id_dtype, deduplicate=False)
+
+        # }}}
+
+        # {{{ separated smaller ("list 3")
+
+        # Found from the source side: a source box is in a target box's list 3
+        # if its parent is adjacent to the target box, but it is not.
+
+        source_or_source_parent_boxes = boxes_with_flags(
+                box_flags_enum.HAS_OWN_SOURCES | box_flags_enum.HAS_CHILD_SOURCES)
+        source_or_source_parent_boxes = source_or_source_parent_boxes[
+                box_levels[source_or_source_parent_boxes] > 0]
+
+        indices, neighbors = geo.find_parent_neighbors(
+                source_or_source_parent_boxes)
+        smaller = source_or_source_parent_boxes[indices]
+
+        is_sep = has_flags(neighbors, box_flags_enum.HAS_OWN_TARGETS)
+        is_sep[is_sep] = ~adjacent(neighbors[is_sep], smaller[is_sep])
+        sep_smaller_starts, sep_smaller_lists = _make_csr(
+                ntarget_boxes, target_box_numbers[neighbors[is_sep]],
+                smaller[is_sep], box_id_dtype)
+
+        # split by source level
+        rows = np.repeat(np.arange(ntarget_boxes), np.diff(sep_smaller_starts))
+        smaller_levels = box_levels[sep_smaller_lists]
+
+        sep_smaller_by_level = []
+        for ilevel in range(tree.nlevels):
+            on_level = smaller_levels == ilevel
+            starts, lists = _make_csr(
+                    ntarget_boxes, rows[on_level], sep_smaller_lists[on_level],
+                    box_id_dtype, deduplicate=False)
+            sep_smaller_by_level.append(
+                    _BuiltList(count=len(lists), starts=starts, lists=lists))
+
+        # }}}
+
+        # {{{ separated bigger ("list 4")
+
+        indices, neighbors = geo.find_parent_neighbors(
+                target_or_target_parent_boxes[nonroot_indices])
+        bigger_rows = nonroot_indices[indices]
+
+        is_sep = has_flags(neighbors, box_flags_enum.HAS_OWN_SOURCES)
+        is_sep[is_sep] = ~adjacent(
+                target_or_target_parent_boxes[bigger_rows[is_sep]],
+                neighbors[is_sep])
+
+        sep_bigger_starts, sep_bigger_lists = _make_csr(
+                ntarget_or_target_parent_boxes, bigger_rows[is_sep],
+                neighbors[is_sep], box_id_dtype)
+
+        # }}}
+
+        logger.info("host traversal built")
+
+        trav = FMMTraversalInfo(
+                tree=tree,
+                periodic=None,
+
+                source_boxes=source_boxes,
+                target_boxes=target_boxes,
+
+                level_start_source_box_nrs=level_starts(source_boxes),
+                level_start_target_box_nrs=level_starts(target_boxes),
+
+                source_parent_boxes=source_parent_boxes,
+                level_start_source_parent_box_nrs=level_starts(
+                    source_parent_boxes),
+
+                target_or_target_parent_boxes=target_or_target_parent_boxes,
+                level_start_target_or_target_parent_box_nrs=level_starts(
+                    target_or_target_parent_boxes),
+
+                colleagues_starts=colleagues_starts,
+                colleagues_lists=colleagues_lists,
+                colleagues_image_shifts=None,
+
+                neighbor_source_boxes_starts=neighbor_source_boxes_starts,
+                neighbor_source_boxes_lists=neighbor_source_boxes_lists,
+                neighbor_source_boxes_image_shifts=None,
+
+                sep_siblings_starts=sep_siblings_starts,
+                sep_siblings_lists=sep_siblings_lists,
+                sep_siblings_image_shifts=None,
+
+                sep_smaller_by_level=sep_smaller_by_level,
+                sep_smaller_image_shifts_by_level=None,
+
+                sep_close_smaller_starts=None,
+                sep_close_smaller_lists=None,
+
+                sep_bigger_starts=sep_bigger_starts,
+                sep_bigger_lists=sep_bigger_lists,
+                sep_bigger_image_shifts=None,
+
+                sep_close_bigger_starts=None,
+                sep_close_bigger_lists=None)
+
+        def regenerate(trav, field_names):
+            new_trav = self(trav.tree)
+            return dict(
+                    (name, getattr(new_trav, name)) for name in field_names)
+
+        # see FMMTraversalInfo.release
+        trav._regenerate = regenerate
+
+        return trav
+
+# }}}
+
+# vim: foldmethod=marker
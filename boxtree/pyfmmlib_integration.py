@@ -30,15 +30,111 @@ import numpy as np
 
 __doc__ = """Integrates :mod:`boxtree` with
 `pyfmmlib <http://pypi.python.org/pypi/pyfmmlib>`_.
+
+.. autoclass:: HelmholtzExpansionWrangler
+
+.. autoclass:: TranslationOperatorCache
 """
 
 
+# {{{ translation operator cache
+
+class TranslationOperatorCache(object):
+    """A least-recently-used cache of dense translation operators, bounded
+    by the total number of bytes held.
+
+    .. attribute:: max_nbytes
+
+    .. attribute:: nbytes
+
+        The number of bytes currently held by cached operators.
+
+    .. attribute:: nhits
+    .. attribute:: nmisses
+
+    .. versionadded:: 2016.1
+    """
+
+    def __init__(self, max_nbytes):
+        from collections import OrderedDict
+        self._operators = OrderedDict()
+
+        self.max_nbytes = max_nbytes
+        self.nbytes = 0
+        self.nhits = 0
+        self.nmisses = 0
+
+    def __len__(self):
+        return len(self._operators)
+
+    def __contains__(self, key):
+        return key in self._operators
+
+    def get(self, key):
+        """Return the operator stored under *key*, or *None*."""
+        try:
+            op = self._operators.pop(key)
+        except KeyError:
+            self.nmisses += 1
+            return None
+
+        self.nhits += 1
+
+        # re-insert to mark as most recently used
+        self._operators[key] = op
+        return op
+
+    def insert(self, key, op):
+        """Store *op* under *key*, evicting least recently used operators
+        as needed to stay within :attr:`max_nbytes`. Operators larger than
+        :attr:`max_nbytes` are not stored.
+        """
+        if op.nbytes > self.max_nbytes:
+            return
+
+        old_op = self._operators.pop(key, None)
+        if old_op is not None:
+            self.nbytes -= old_op.nbytes
+
+        while self._operators and self.nbytes + op.nbytes > self.max_nbytes:
+            _, evicted_op = self._operators.popitem(last=False)
+            self.nbytes -= evicted_op.nbytes
+
+        self._operators[key] = op
+        self.nbytes += op.nbytes
+
+    def clear(self):
+        self._operators.clear()
+        self.nbytes = 0
+
+# }}}
+
+
 class HelmholtzExpansionWrangler(object):
     """Implements the :class:`boxtree.fmm.ExpansionWranglerInterface`
     by using pyfmmlib.
+
+    Translations (multipole-to-multipole, multipole-to-local and
+    local-to-local) only depend on the levels of the boxes involved and on
+    the offset between their centers, which is an integer multiple of half
+    the size of the smaller box. Translations are therefore grouped by
+    these parameters and applied to all boxes in a group as one dense
+    matrix product. The dense operators are kept in a
+    :class:`TranslationOperatorCache` of at most
+    *translation_cache_max_nbytes* bytes. Groups that are too small to
+    amortize building an operator are translated one box at a time.
+
+    The tree may be given as a :class:`boxtree.tools.LazyHostRecord` (see
+    :meth:`boxtree.tools.DeviceDataRecord.get_lazy`), in which case only
+    the tree arrays the wrangler actually reads are downloaded.
+
+    .. versionchanged:: 2016.1
+
+        Added *translation_cache_max_nbytes*.
     """
 
-    def __init__(self, tree, helmholtz_k, nterms, ifgrad=False):
+    def __init__(self, tree, helmholtz_k, nterms, ifgrad=False,
+            translation_cache_max_nbytes=2**28):
         self.tree = tree
         self.helmholtz_k = helmholtz_k
         self.nterms = nterms
@@ -61,6 +157,12 @@ class HelmholtzExpansionWrangler(object):
 
         self.common_extra_kwargs = common_extra_kwargs
 
+        self.translation_cache = TranslationOperatorCache(
+                translation_cache_max_nbytes)
+
+        from boxtree.tree import ParticleReorderer
+        self.reorderer = ParticleReorderer(tree)
+
     # {{{ overridable target lists for the benefit of the QBX FMM
 
     def box_target_starts(self):
@@ -273,6 +375,148 @@ class HelmholtzExpansionWrangler(object):
 
     # }}}
 
+    # {{{ grouped translations
+
+    def _get_translation_operator(self, name, target_level, source_level,
+            offset):
+        """Build the dense matrix of the translation *name* from a box on
+        *source_level* to a box on *target_level* whose center is displaced
+        by *offset* (in units of half the size of the smaller box).
+        The matrix is built column by column by translating unit expansions.
+        """
+        tree = self.tree
+        rscale = 1  # FIXME
+
+        rout = self.get_translation_routine(name)
+
+        kwargs = {}
+        if self.dim == 3:
+            kwargs["radius"] = tree.root_extent * 2**(-target_level)
+
+        half_box_size = (
+                tree.root_extent * 2**(-max(target_level, source_level)) / 2)
+
+        # Translations only depend on the difference between the centers.
+        tgt_center = np.zeros(self.dim, dtype=np.float64)
+        src_center = np.array(offset, dtype=np.float64) * half_box_size
+
+        exp_shape = self.expansion_shape(self.nterms)
+        unit_exp = np.zeros(exp_shape, self.dtype)
+
+        result = np.empty((unit_exp.size, unit_exp.size), self.dtype)
+        for i in range(unit_exp.size):
+            unit_exp.flat[i] = 1
+            result[:, i] = rout(
+                    self.helmholtz_k,
+                    rscale, src_center, unit_exp,
+                    rscale, tgt_center, self.nterms, **kwargs)[..., 0].reshape(-1)
+            unit_exp.flat[i] = 0
+
+        return result
+
+    def _translate(self, name, target_boxes, source_boxes, source_exps,
+            target_exps, source_translations=None):
+        """Add the translations of *source_exps[source_boxes]* onto
+        *target_exps[target_boxes]*, grouping the pairs by levels and
+        center offset so that each group is applied as a matrix product.
+        If given, *source_translations* holds a displacement of the source
+        box center for each pair, of shape ``(dim, npairs)``.
+        """
+        tree = self.tree
+        rscale = 1  # FIXME
+
+        if len(target_boxes) == 0:
+            return
+
+        target_levels = tree.box_levels[target_boxes].astype(np.int64)
+        source_levels = tree.box_levels[source_boxes].astype(np.int64)
+
+        source_centers = tree.box_centers[:, source_boxes]
+        if source_translations is not None:
+            source_centers = source_centers + source_translations
+
+        half_box_sizes = (
+                tree.root_extent
+                * 2.**(-np.maximum(target_levels, source_levels)) / 2)
+        offsets = np.rint(
+                (source_centers - tree.box_centers[:, target_boxes])
+                / half_box_sizes).astype(np.int64)
+
+        group_keys, group_indices = np.unique(
+                np.vstack([target_levels, source_levels, offsets]).T,
+                axis=0, return_inverse=True)
+        group_indices = group_indices.reshape(-1)
+
+        order = np.argsort(group_indices, kind="mergesort")
+        group_starts = np.zeros(len(group_keys) + 1, np.intp)
+        np.cumsum(
+                np.bincount(group_indices, minlength=len(group_keys)),
+                out=group_starts[1:])
+
+        exp_shape = self.expansion_shape(self.nterms)
+        ncoeffs = np.prod(exp_shape)
+
+        rout = None
+
+        for igroup, group_key in enumerate(group_keys):
+            group_pairs = order[group_starts[igroup]:group_starts[igroup+1]]
+            group_tgt_boxes = target_boxes[group_pairs]
+            group_src_boxes = source_boxes[group_pairs]
+            group_src_centers = source_centers[:, group_pairs]
+
+            target_level, source_level = (int(lev) for lev in group_key[:2])
+            offset = tuple(int(ofs) for ofs in group_key[2:])
+            key = (name, target_level, source_level, offset)
+
+            op = self.translation_cache.get(key)
+            if op is None and len(group_pairs) >= ncoeffs:
+                op = self._get_translation_operator(
+                        name, target_level, source_level, offset)
+                self.translation_cache.insert(key, op)
+
+            if op is not None:
+                # For a given target box, each offset occurs at most once,
+                # so the target boxes within a group are unique.
+                target_exps[group_tgt_boxes] += (
+                        source_exps[group_src_boxes].reshape(-1, ncoeffs)
+                        .dot(op.T)
+                        .reshape((-1,) + exp_shape))
+                continue
+
+            # {{{ too few pairs to amortize building the operator
+
+            if rout is None:
+                rout = self.get_translation_routine(name)
+
+            kwargs = {}
+            if self.dim == 3:
+                kwargs["radius"] = tree.root_extent * 2**(-target_level)
+
+            for tgt_ibox, src_ibox, src_center in zip(
+                    group_tgt_boxes, group_src_boxes, group_src_centers.T):
+                target_exps[tgt_ibox] += rout(
+                        self.helmholtz_k,
+                        rscale, src_center,
+                        source_exps[src_ibox],
+                        rscale, tree.box_centers[:, tgt_ibox],
+                        self.nterms, **kwargs)[..., 0]
+
+            # }}}
+
+    # }}}
+
+    def _get_image_translations(self, image_shifts):
+        """Return the displacements of the source boxes given by the
+        periodic *image_shifts* of an interaction list, of shape
+        ``(dim, nentries)``, or *None* if *image_shifts* is *None*.
+        """
+        if image_shifts is None:
+            return None
+
+        return np.array(
+                [axis_shifts for axis_shifts in image_shifts],
+                dtype=np.float64) * self.tree.root_extent
+
     def _get_source_slice(self, ibox):
         pstart = self.tree.box_source_starts[ibox]
         return slice(
@@ -283,13 +527,18 @@ class HelmholtzExpansionWrangler(object):
         return slice(
                 pstart, pstart + self.box_target_counts_nonchild()[ibox])
 
-    def _get_sources(self, pslice):
+    def _get_sources(self, pslice, translation=None):
         # FIXME yuck!
-        return np.array([
+        sources = np.array([
             self.tree.sources[idim][pslice]
             for idim in range(self.dim)
             ], order="F")
 
+        if translation is not None:
+            sources += translation[:, np.newaxis]
+
+        return sources
+
     def _get_targets(self, pslice):
         # FIXME yuck!
         return np.array([
@@ -298,10 +547,10 @@ class HelmholtzExpansionWrangler(object):
             ], order="F")
 
     def reorder_sources(self, source_array):
-        return source_array[self.tree.user_source_ids]
+        return self.reorderer.reorder_sources(source_array)
 
     def reorder_potentials(self, potentials):
-        return potentials[self.tree.sorted_target_ids]
+        return self.reorderer.reorder_potentials(potentials)
 
     def form_multipoles(self, level_start_source_box_nrs, source_boxes, src_weights):
         rscale = 1  # FIXME
@@ -325,43 +574,32 @@ class HelmholtzExpansionWrangler(object):
         return mpoles
 
     def coarsen_multipoles(self, level_start_source_parent_box_nrs,
-            source_parent_boxes, mpoles):
+            source_parent_boxes, mpoles, coarsest_level=2):
         tree = self.tree
-        rscale = 1  # FIXME
-
-        mpmp = self.get_translation_routine("%ddmpmp")
 
         # 2 is the last relevant source_level.
         # 1 is the last relevant target_level.
+        # (Periodic traversals also need level 1 and pass coarsest_level=1.)
         # (Nobody needs a multipole on level 0, i.e. for the root box.)
-        for source_level in range(tree.nlevels-1, 1, -1):
+        for source_level in range(tree.nlevels-1, coarsest_level-1, -1):
             start, stop = level_start_source_parent_box_nrs[
                             source_level:source_level+2]
-            target_level = source_level - 1
-
-            for ibox in source_parent_boxes[start:stop]:
-                parent_center = tree.box_centers[:, ibox]
-                for child in tree.box_child_ids[:, ibox]:
-                    if child:
-                        child_center = tree.box_centers[:, child]
 
-                        kwargs = {}
-                        if self.dim == 3:
-                            kwargs["radius"] = tree.root_extent * 2**(-target_level)
+            parent_boxes = np.asarray(source_parent_boxes[start:stop])
+            child_ids = tree.box_child_ids[:, parent_boxes]
+            child_morton_nrs, iparents = np.nonzero(child_ids)
 
-                        new_mp = mpmp(
-                                self.helmholtz_k,
-                                rscale, child_center, mpoles[child],
-                                rscale, parent_center, self.nterms,
-                                **kwargs)
-
-                        mpoles[ibox] += new_mp[..., 0]
+            self._translate("%ddmpmp",
+                    target_boxes=parent_boxes[iparents],
+                    source_boxes=child_ids[child_morton_nrs, iparents],
+                    source_exps=mpoles, target_exps=mpoles)
 
     def eval_direct(self, target_boxes, neighbor_sources_starts,
-            neighbor_sources_lists, src_weights):
+            neighbor_sources_lists, src_weights, image_shifts=None):
         output = self.output_zeros()
 
         ev = self.get_direct_eval_routine()
+        translations = self._get_image_translations(image_shifts)
 
         for itgt_box, tgt_ibox in enumerate(target_boxes):
             tgt_pslice = self._get_target_slice(tgt_ibox)
@@ -374,14 +612,17 @@ class HelmholtzExpansionWrangler(object):
             tgt_grad_result = 0
 
             start, end = neighbor_sources_starts[itgt_box:itgt_box+2]
-            for src_ibox in neighbor_sources_lists[start:end]:
+            for ientry in range(start, end):
+                src_ibox = neighbor_sources_lists[ientry]
                 src_pslice = self._get_source_slice(src_ibox)
 
                 if src_pslice.stop - src_pslice.start == 0:
                     continue
 
                 tmp_pot, tmp_grad = ev(
-                        sources=self._get_sources(src_pslice),
+                        sources=self._get_sources(src_pslice,
+                            None if translations is None
+                            else translations[:, ientry]),
                         charge=src_weights[src_pslice],
                         targets=self._get_targets(tgt_pslice), zk=self.helmholtz_k)
 
@@ -396,52 +637,41 @@ class HelmholtzExpansionWrangler(object):
     def multipole_to_local(self,
             level_start_target_or_target_parent_box_nrs,
             target_or_target_parent_boxes,
-            starts, lists, mpole_exps):
-        tree = self.tree
+            starts, lists, mpole_exps, image_shifts=None):
         local_exps = self.local_expansion_zeros()
 
-        rscale = 1
-
-        mploc = self.get_translation_routine("%ddmploc")
-
-        for lev in range(self.tree.nlevels):
-            lstart, lstop = level_start_target_or_target_parent_box_nrs[lev:lev+2]
-            if lstart == lstop:
-                continue
-
-            for itgt_box, tgt_ibox in enumerate(
-                    target_or_target_parent_boxes[lstart:lstop]):
-                start, end = starts[lstart + itgt_box:lstart + itgt_box+2]
-                tgt_center = tree.box_centers[:, tgt_ibox]
-
-                #print tgt_ibox, "<-", lists[start:end]
-                tgt_loc = 0
-
-                for src_ibox in lists[start:end]:
-                    src_center = tree.box_centers[:, src_ibox]
+        starts = np.asarray(starts)
+        target_boxes = np.repeat(
+                np.asarray(target_or_target_parent_boxes),
+                np.diff(starts))
 
-                    kwargs = {}
-                    if self.dim == 3:
-                        kwargs["radius"] = tree.root_extent * 2**(-lev)
+        translations = self._get_image_translations(image_shifts)
+        if translations is not None:
+            translations = translations[:, starts[0]:starts[-1]]
 
-                    tgt_loc = tgt_loc + mploc(
-                            self.helmholtz_k,
-                            rscale, src_center, mpole_exps[src_ibox],
-                            rscale, tgt_center, self.nterms, **kwargs)[..., 0]
-
-                local_exps[tgt_ibox] += tgt_loc
+        self._translate("%ddmploc",
+                target_boxes=target_boxes,
+                source_boxes=np.asarray(lists[starts[0]:starts[-1]]),
+                source_exps=mpole_exps, target_exps=local_exps,
+                source_translations=translations)
 
         return local_exps
 
     def eval_multipoles(self, level_start_target_box_nrs, target_boxes,
-            sep_smaller_nonsiblings_by_level, mpole_exps):
+            sep_smaller_nonsiblings_by_level, mpole_exps, image_shifts=None):
         output = self.output_zeros()
 
         rscale = 1
 
         mpeval = self.get_expn_eval_routine("mp")
 
-        for ssn in sep_smaller_nonsiblings_by_level:
+        if image_shifts is None:
+            image_shifts = [None] * len(sep_smaller_nonsiblings_by_level)
+
+        for ssn, ssn_image_shifts in zip(
+                sep_smaller_nonsiblings_by_level, image_shifts):
+            translations = self._get_image_translations(ssn_image_shifts)
+
             for itgt_box, tgt_ibox in enumerate(target_boxes):
                 tgt_pslice = self._get_target_slice(tgt_ibox)
 
@@ -451,10 +681,14 @@ class HelmholtzExpansionWrangler(object):
                 tgt_pot = 0
                 tgt_grad = 0
                 start, end = ssn.starts[itgt_box:itgt_box+2]
-                for src_ibox in ssn.lists[start:end]:
-
-                    tmp_pot, tmp_grad = mpeval(self.helmholtz_k, rscale, self.
-                            tree.box_centers[:, src_ibox], mpole_exps[src_ibox],
+                for ientry in range(start, end):
+                    src_ibox = ssn.lists[ientry]
+                    src_center = self.tree.box_centers[:, src_ibox]
+                    if translations is not None:
+                        src_center = src_center + translations[:, ientry]
+
+                    tmp_pot, tmp_grad = mpeval(self.helmholtz_k, rscale,
+                            src_center, mpole_exps[src_ibox],
                             self._get_targets(tgt_pslice))
 
                     tgt_pot = tgt_pot + tmp_pot
@@ -467,18 +701,21 @@ class HelmholtzExpansionWrangler(object):
 
     def form_locals(self,
             level_start_target_or_target_parent_box_nrs,
-            target_or_target_parent_boxes, starts, lists, src_weights):
+            target_or_target_parent_boxes, starts, lists, src_weights,
+            image_shifts=None):
         rscale = 1  # FIXME
         local_exps = self.local_expansion_zeros()
 
         formta = self.get_routine("%ddformta")
+        translations = self._get_image_translations(image_shifts)
 
         for itgt_box, tgt_ibox in enumerate(target_or_target_parent_boxes):
             start, end = starts[itgt_box:itgt_box+2]
 
             contrib = 0
 
-            for src_ibox in lists[start:end]:
+            for ientry in range(start, end):
+                src_ibox = lists[ientry]
                 src_pslice = self._get_source_slice(src_ibox)
                 tgt_center = self.tree.box_centers[:, tgt_ibox]
 
@@ -487,7 +724,10 @@ class HelmholtzExpansionWrangler(object):
 
                 ier, mpole = formta(
                         self.helmholtz_k, rscale,
-                        self._get_sources(src_pslice), src_weights[src_pslice],
+                        self._get_sources(src_pslice,
+                            None if translations is None
+                            else translations[:, ientry]),
+                        src_weights[src_pslice],
                         tgt_center, self.nterms)
                 if ier:
                     raise RuntimeError("formta failed")
@@ -500,29 +740,16 @@ class HelmholtzExpansionWrangler(object):
 
     def refine_locals(self, level_start_target_or_target_parent_box_nrs,
             target_or_target_parent_boxes, local_exps):
-        rscale = 1  # FIXME
-
-        locloc = self.get_translation_routine("%ddlocloc")
-
         for target_lev in range(1, self.tree.nlevels):
             start, stop = level_start_target_or_target_parent_box_nrs[
                     target_lev:target_lev+2]
 
-            for tgt_ibox in target_or_target_parent_boxes[start:stop]:
-                tgt_center = self.tree.box_centers[:, tgt_ibox]
-                src_ibox = self.tree.box_parent_ids[tgt_ibox]
-                src_center = self.tree.box_centers[:, src_ibox]
-
-                kwargs = {}
-                if self.dim == 3:
-                    kwargs["radius"] = self.tree.root_extent * 2**(-target_lev)
-
-                tmp_loc_exp = locloc(
-                            self.helmholtz_k,
-                            rscale, src_center, local_exps[src_ibox],
-                            rscale, tgt_center, self.nterms, **kwargs)[..., 0]
+            target_boxes = np.asarray(target_or_target_parent_boxes[start:stop])
 
-                local_exps[tgt_ibox] += tmp_loc_exp
+            self._translate("%ddlocloc",
+                    target_boxes=target_boxes,
+                    source_boxes=self.tree.box_parent_ids[target_boxes],
+                    source_exps=local_exps, target_exps=local_exps)
 
         return local_exps
 
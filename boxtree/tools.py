@@ -24,10 +24,12 @@ THE SOFTWARE.
 
 
 import numpy as np
-from pytools import Record, memoize_method
+from pytools import Record, memoize, memoize_method
 import pyopencl as cl
 import pyopencl.array  # noqa
-from pyopencl.tools import dtype_to_c_struct
+from pyopencl.clrandom import PhiloxGenerator
+from pyopencl.elementwise import ElementwiseTemplate
+from pyopencl.tools import dtype_to_c_struct, context_dependent_memoize
 from mako.template import Template
 from pytools.obj_array import make_obj_array
 
@@ -45,7 +47,41 @@ def padded_bin(i, l):
 
 
 # NOTE: Order of positional args should match GappyCopyAndMapKernel.__call__()
-def realloc_array(queue, allocator, new_shape, ary, zero_fill=False, wait_for=[]):
+def realloc_array(queue, allocator, new_shape, ary, zero_fill=False, wait_for=[],
+        reuse_capacity=False):
+    """Return a tuple *(new_ary, event)*, where *new_ary* is an array of length
+    *new_shape* whose leading entries are those of the one-dimensional array
+    *ary*. If *zero_fill* is *True*, entries beyond the length of *ary* are
+    zero.
+
+    :arg reuse_capacity: if *True*, the caller asserts that *ary* is the only
+        user of its underlying buffer (i.e. it is not a view of a larger
+        array). If that buffer has enough capacity for *new_shape* entries
+        (for instance because a :class:`pyopencl.tools.MemoryPool` rounded up
+        its size), *new_ary* is then a view of that buffer and no copy is
+        made. *ary* must then no longer be used.
+    """
+
+    base_data = ary.base_data
+    new_nbytes = new_shape * ary.dtype.itemsize
+
+    if (reuse_capacity
+            and base_data is not None
+            and ary.offset == 0
+            and len(ary.shape) == 1
+            and base_data.size >= new_nbytes):
+        evt = cl.enqueue_marker(queue, wait_for=wait_for + ary.events)
+        new_ary = cl.array.Array(queue, new_shape, ary.dtype,
+                data=base_data, allocator=allocator, events=[evt])
+
+        if zero_fill and new_shape > len(ary):
+            tail = new_ary[len(ary):]
+            tail.fill(0)
+            evt = tail.events[-1]
+            new_ary.add_event(evt)
+
+        return new_ary, evt
+
     if zero_fill:
         array_maker = cl.array.zeros
     else:
@@ -54,7 +90,8 @@ def realloc_array(queue, allocator, new_shape, ary, zero_fill=False, wait_for=[]
     new_ary = array_maker(queue, shape=new_shape, dtype=ary.dtype,
                           allocator=allocator)
 
-    evt = cl.enqueue_copy(queue, new_ary.data, ary.data, byte_count=ary.nbytes,
+    evt = cl.enqueue_copy(queue, new_ary.data, ary.data,
+                          byte_count=min(ary.nbytes, new_ary.nbytes),
                           wait_for=wait_for + new_ary.events)
 
     return new_ary, evt
@@ -91,154 +128,500 @@ def reverse_index_array(indices, target_size=None, result_fill_value=None,
     return result
 
 
+def expand_ranges(starts, counts):
+    """Return the concatenation of ``range(start, start+count)`` over all
+    entries of *starts* and *counts*, as a :class:`numpy.ndarray`.
+    """
+    counts = np.asarray(counts)
+    offsets = np.cumsum(counts) - counts
+    return (np.arange(np.sum(counts), dtype=np.intp)
+            + np.repeat(np.asarray(starts) - offsets, counts))
+
+
 # {{{ particle distribution generators
 
-def make_normal_particle_array(queue, nparticles, dims, dtype, seed=15):
-    from pyopencl.clrandom import PhiloxGenerator
-    rng = PhiloxGenerator(queue.context, seed=seed)
+@context_dependent_memoize
+def _get_philox_kernel(context, dtype, distribution):
+    return PhiloxGenerator(context).get_gen_kernel(dtype, distribution)
+
+
+class _PhiloxGenerator(PhiloxGenerator):
+    """A :class:`pyopencl.clrandom.PhiloxGenerator` that shares its kernels
+    with all other instances on the same context, so that creating one per
+    call does not rebuild them.
+    """
+
+    def get_gen_kernel(self, dtype, distribution):
+        return _get_philox_kernel(self.context, dtype, distribution)
+
+
+def _get_seeded_generator(context, seed):
+    return _PhiloxGenerator(context, seed=seed)
+
+
+PLUMMER_TEMPLATE = ElementwiseTemplate(
+    arguments=r"""//CL:mako//
+        %for ax in axis_names:
+            coord_t *${ax},
+        %endfor
+        coord_t scale
+        """,
+    operation=r"""//CL:mako//
+        // On entry, the coordinate arrays hold uniform random numbers.
+        coord_t mass_fraction = x[i];
+
+        %if dims == 2:
+            coord_t r = scale * sqrt(mass_fraction / (1 - mass_fraction));
+            coord_t phi = 2 * (coord_t) M_PI * y[i];
+
+            x[i] = r * cos(phi);
+            y[i] = r * sin(phi);
+        %elif dims == 3:
+            coord_t r = scale * rsqrt(
+                pow(mass_fraction, (coord_t) -2 / (coord_t) 3) - 1);
+            coord_t cos_theta = 2 * y[i] - 1;
+            coord_t sin_theta = sqrt(fmax(1 - cos_theta*cos_theta, (coord_t) 0));
+            coord_t phi = 2 * (coord_t) M_PI * z[i];
+
+            x[i] = r * sin_theta * cos(phi);
+            y[i] = r * sin_theta * sin(phi);
+            z[i] = r * cos_theta;
+        %endif
+        """,
+    name="make_plummer_dist")
+
+
+GAUSSIAN_MIXTURE_TEMPLATE = ElementwiseTemplate(
+    arguments=r"""//CL:mako//
+        %for ax in axis_names:
+            coord_t *${ax},
+        %endfor
+        coord_t *component_u,
+        coord_t *component_cdf,
+        int ncomponents,
+        coord_t *centers,
+        coord_t *scales
+        """,
+    operation=r"""//CL:mako//
+        // On entry, the coordinate arrays hold standard normal random numbers.
+        // Mixtures have few components, so a linear search is fine here.
+        int k = 0;
+        while (k < ncomponents - 1 && component_u[i] >= component_cdf[k])
+            ++k;
+
+        %for iax, ax in enumerate(axis_names):
+            ${ax}[i] = centers[${dims}*k + ${iax}] + scales[k] * ${ax}[i];
+        %endfor
+        """,
+    name="make_gaussian_mixture_dist")
+
+
+MESH_SURFACE_TEMPLATE = ElementwiseTemplate(
+    arguments=r"""//CL:mako//
+        %for ax in axis_names:
+            coord_t *${ax},
+        %endfor
+        coord_t *element_cdf,
+        int nelements,
+        int *elements,
+        coord_t *vertices,
+        int nvertices
+        """,
+    operation=r"""//CL:mako//
+        // On entry, the coordinate arrays hold uniform random numbers.
+        // The first one picks the element, the others the point on it.
+        coord_t element_u = x[i];
+        int lo = 0;
+        int hi = nelements - 1;
+        while (lo < hi)
+        {
+            int mid = lo + (hi - lo) / 2;
+            if (element_cdf[mid] <= element_u)
+                lo = mid + 1;
+            else
+                hi = mid;
+        }
+
+        %if dims == 2:
+            coord_t bary_1 = y[i];
+            coord_t bary_0 = 1 - bary_1;
+        %elif dims == 3:
+            coord_t sqrt_u = sqrt(y[i]);
+            coord_t bary_0 = 1 - sqrt_u;
+            coord_t bary_1 = sqrt_u * (1 - z[i]);
+            coord_t bary_2 = sqrt_u * z[i];
+        %endif
+
+        %for iax, ax in enumerate(axis_names):
+            ${ax}[i] = 0
+            %for ivertex in range(dims):
+                + bary_${ivertex}
+                    * vertices[${iax}*nvertices + elements[${dims}*lo + ${ivertex}]]
+            %endfor
+                ;
+        %endfor
+        """,
+    name="make_mesh_surface_dist")
+
+
+@context_dependent_memoize
+def _get_distribution_kernel(context, template, dims, dtype):
+    return template.build(
+            context,
+            type_aliases=(("coord_t", dtype),),
+            var_values=(
+                ("dims", dims),
+                ("axis_names", AXIS_NAMES[:dims]),
+                ))
+
+
+def _run_distribution_kernel(template, queue, dims, dtype, coords, *args):
+    knl = _get_distribution_kernel(queue.context, template, dims, np.dtype(dtype))
+    evt = knl(*(list(coords) + list(args)), queue=queue)
 
+    for coord in coords:
+        coord.add_event(evt)
+
+    return make_obj_array(list(coords))
+
+
+def _make_normal_particles(queue, rng, nparticles, dims, dtype, seed):
     return make_obj_array([
         rng.normal(queue, nparticles, dtype=dtype)
         for i in range(dims)])
 
 
-def make_surface_particle_array(queue, nparticles, dims, dtype, seed=15):
-    import loopy as lp
+def _make_plummer_particles(queue, rng, nparticles, dims, dtype, seed,
+        scale=1, mass_cutoff=0.999):
+    if dims not in (2, 3):
+        raise NotImplementedError
 
-    if dims == 2:
-        def get_2d_knl(dtype):
-            knl = lp.make_kernel(
-                "{[i]: 0<=i<n}",
-                """
-                    <> phi = 2*M_PI/n * i
-                    x[i] = 0.5* (3*cos(phi) + 2*sin(3*phi))
-                    y[i] = 0.5* (1*sin(phi) + 1.5*sin(2*phi))
-                    """,
-                [
-                    lp.GlobalArg("x,y", dtype, shape=lp.auto),
-                    lp.ValueArg("n", np.int32),
-                    ],
-                name="make_surface_dist")
+    coords = [rng.uniform(queue, nparticles, dtype=dtype, a=0, b=mass_cutoff)]
+    coords.extend(
+            rng.uniform(queue, nparticles, dtype=dtype)
+            for i in range(1, dims))
 
-            knl = lp.split_iname(knl, "i", 128, outer_tag="g.0", inner_tag="l.0")
+    return _run_distribution_kernel(PLUMMER_TEMPLATE, queue, dims, dtype,
+            coords, np.dtype(dtype).type(scale))
 
-            return knl
 
-        evt, result = get_2d_knl(dtype)(queue, n=nparticles)
+def _make_gaussian_mixture_particles(queue, rng, nparticles, dims, dtype, seed,
+        centers=None, scales=None, weights=None, ncomponents=8):
+    if centers is None:
+        centers = np.random.RandomState(seed).uniform(
+                -1, 1, size=(ncomponents, dims))
 
-        result = [x.ravel() for x in result]
+    centers = np.asarray(centers, dtype=dtype)
+    if len(centers.shape) != 2 or centers.shape[1] != dims:
+        raise ValueError("centers must have shape (ncomponents, dims)")
 
-        return make_obj_array(result)
-    elif dims == 3:
-        n = int(nparticles**0.5)
+    ncomponents = len(centers)
+
+    if scales is None:
+        scales = 0.5 ** np.arange(ncomponents)
+    if weights is None:
+        weights = np.ones(ncomponents)
+
+    scales = np.asarray(scales, dtype=dtype)
+    weights = np.asarray(weights, dtype=np.float64)
+    if scales.shape != (ncomponents,) or weights.shape != (ncomponents,):
+        raise ValueError("must specify one scale and one weight per component")
+
+    component_cdf = np.cumsum(weights)
+    component_cdf /= component_cdf[-1]
 
-        def get_3d_knl(dtype):
-            knl = lp.make_kernel(
-                "{[i,j]: 0<=i,j<n}",
-                """
-                    <> phi = 2*M_PI/n * i
-                    <> theta = 2*M_PI/n * j
-                    x[i,j] = 5*cos(phi) * (3 + cos(theta))
-                    y[i,j] = 5*sin(phi) * (3 + cos(theta))
-                    z[i,j] = 5*sin(theta)
-                    """,
-                [
-                    lp.GlobalArg("x,y,z,", dtype, shape=lp.auto),
-                    lp.ValueArg("n", np.int32),
-                    ])
+    coords = [rng.normal(queue, nparticles, dtype=dtype) for i in range(dims)]
+    component_u = rng.uniform(queue, nparticles, dtype=dtype)
 
-            knl = lp.split_iname(knl, "i", 16, outer_tag="g.1", inner_tag="l.1")
-            knl = lp.split_iname(knl, "j", 16, outer_tag="g.0", inner_tag="l.0")
+    return _run_distribution_kernel(GAUSSIAN_MIXTURE_TEMPLATE, queue, dims, dtype,
+            coords,
+            component_u,
+            cl.array.to_device(queue, component_cdf.astype(dtype)),
+            np.int32(ncomponents),
+            cl.array.to_device(queue, centers.ravel()),
+            cl.array.to_device(queue, scales))
 
-            return knl
 
-        evt, result = get_3d_knl(dtype)(queue, n=n)
+def _make_mesh_surface_particles(queue, rng, nparticles, dims, dtype, seed,
+        vertices, elements):
+    vertices = np.asarray(vertices, dtype=np.float64)
+    elements = np.asarray(elements, dtype=np.int32)
 
-        result = [x.ravel() for x in result]
+    if len(vertices.shape) != 2 or vertices.shape[0] != dims:
+        raise ValueError("vertices must have shape (dims, nvertices)")
+    if len(elements.shape) != 2 or elements.shape[1] != dims:
+        raise ValueError("elements must have shape (nelements, dims)")
 
-        return make_obj_array(result)
+    # edges[iaxis, ielement, iedge]
+    corners = vertices[:, elements]
+    edges = corners[:, :, 1:] - corners[:, :, :1]
+
+    if dims == 2:
+        measures = np.sqrt(np.sum(edges[:, :, 0]**2, axis=0))
+    elif dims == 3:
+        measures = 0.5 * np.sqrt(np.sum(
+            np.cross(edges[:, :, 0], edges[:, :, 1], axis=0)**2, axis=0))
     else:
         raise NotImplementedError
 
+    element_cdf = np.cumsum(measures)
+    element_cdf /= element_cdf[-1]
 
-def make_uniform_particle_array(queue, nparticles, dims, dtype, seed=15):
+    coords = [rng.uniform(queue, nparticles, dtype=dtype) for i in range(dims)]
+
+    return _run_distribution_kernel(MESH_SURFACE_TEMPLATE, queue, dims, dtype,
+            coords,
+            cl.array.to_device(queue, element_cdf.astype(dtype)),
+            np.int32(len(elements)),
+            cl.array.to_device(queue, elements.ravel()),
+            cl.array.to_device(queue, vertices.astype(dtype).ravel()),
+            np.int32(vertices.shape[1]))
+
+
+_RANDOM_PARTICLE_DISTRIBUTIONS = {
+        "normal": _make_normal_particles,
+        "plummer": _make_plummer_particles,
+        "gaussian_mixture": _make_gaussian_mixture_particles,
+        "mesh_surface": _make_mesh_surface_particles,
+        }
+
+
+def make_normal_particle_array(queue, nparticles, dims, dtype, seed=15):
+    rng = _get_seeded_generator(queue.context, seed)
+    return _make_normal_particles(queue, rng, nparticles, dims, dtype, seed)
+
+
+def make_plummer_particle_array(queue, nparticles, dims, dtype, seed=15,
+        scale=1, mass_cutoff=0.999):
+    """Make a clustered particle distribution following the Plummer model
+    centered at the origin, i.e. with density proportional to
+    :math:`(1+r^2/a^2)^{-5/2}` in 3D and :math:`(1+r^2/a^2)^{-2}` in 2D.
+
+    :arg scale: the scale radius :math:`a`.
+    :arg mass_cutoff: the fraction of the total mass that is sampled. This
+        bounds the radius of the outermost particles.
+
+    .. versionadded:: 2016.1
+    """
+    rng = _get_seeded_generator(queue.context, seed)
+    return _make_plummer_particles(queue, rng, nparticles, dims, dtype, seed,
+            scale=scale, mass_cutoff=mass_cutoff)
+
+
+def make_gaussian_mixture_particle_array(queue, nparticles, dims, dtype, seed=15,
+        centers=None, scales=None, weights=None, ncomponents=8):
+    """Make a particle distribution from a mixture of isotropic Gaussians.
+
+    :arg centers: an array of shape *(ncomponents, dims)*. If not given,
+        *ncomponents* centers are drawn uniformly from :math:`[-1,1]^d`.
+    :arg scales: the standard deviation of each component. Defaults to
+        :math:`2^{-k}` for component *k*, which gives clusters of many
+        different sizes.
+    :arg weights: the relative number of particles in each component.
+        Defaults to equal weights.
+
+    .. versionadded:: 2016.1
+    """
+    rng = _get_seeded_generator(queue.context, seed)
+    return _make_gaussian_mixture_particles(
+            queue, rng, nparticles, dims, dtype, seed,
+            centers=centers, scales=scales, weights=weights,
+            ncomponents=ncomponents)
+
+
+def make_mesh_surface_particle_array(queue, nparticles, vertices, elements, dtype,
+        seed=15):
+    """Make particles distributed uniformly (by length or area) on the surface
+    given by a mesh of line segments (2D) or triangles (3D).
+
+    :arg vertices: an array of shape *(dims, nvertices)*.
+    :arg elements: an integer array of shape *(nelements, dims)* of indices
+        into *vertices*.
+
+    .. versionadded:: 2016.1
+    """
+    dims = len(vertices)
+    rng = _get_seeded_generator(queue.context, seed)
+    return _make_mesh_surface_particles(queue, rng, nparticles, dims, dtype, seed,
+            vertices=vertices, elements=elements)
+
+
+def iter_particle_array_chunks(queue, nparticles, chunk_size, dims, dtype,
+        distribution="normal", seed=15, **kwargs):
+    """Generate *nparticles* particles from a random *distribution* in chunks,
+    without allocating the whole set at once.
+
+    :arg distribution: one of ``"normal"``, ``"plummer"``,
+        ``"gaussian_mixture"`` and ``"mesh_surface"``. *kwargs* are passed
+        on to the corresponding ``make_*_particle_array`` function.
+    :returns: an iterator of object arrays of :class:`pyopencl.array.Array`
+        instances, each holding *chunk_size* particles, except possibly the
+        last one. The random number stream continues from one chunk to the
+        next, so the chunks depend only on *seed*.
+
+    .. versionadded:: 2016.1
+    """
+    try:
+        make_particles = _RANDOM_PARTICLE_DISTRIBUTIONS[distribution]
+    except KeyError:
+        raise ValueError("unknown particle distribution: '%s'" % distribution)
+
+    if chunk_size <= 0:
+        raise ValueError("chunk_size must be positive")
+
+    rng = _get_seeded_generator(queue.context, seed)
+
+    def generate_chunks():
+        for start in range(0, nparticles, chunk_size):
+            yield make_particles(
+                    queue, rng, min(chunk_size, nparticles - start), dims, dtype,
+                    seed, **kwargs)
+
+    return generate_chunks()
+
+
+# {{{ loopy-based generators
+
+@memoize
+def _get_surface_2d_kernel(dtype):
     import loopy as lp
 
-    if dims == 2:
-        n = int(nparticles**0.5)
+    knl = lp.make_kernel(
+        "{[i]: 0<=i<n}",
+        """
+            <> phi = 2*M_PI/n * i
+            x[i] = 0.5* (3*cos(phi) + 2*sin(3*phi))
+            y[i] = 0.5* (1*sin(phi) + 1.5*sin(2*phi))
+            """,
+        [
+            lp.GlobalArg("x,y", dtype, shape=lp.auto),
+            lp.ValueArg("n", np.int32),
+            ],
+        name="make_surface_dist")
 
-        def get_2d_knl(dtype):
-            knl = lp.make_kernel(
-                "{[i,j]: 0<=i,j<n}",
-                """
-                    <> xx = 4*i/(n-1)
-                    <> yy = 4*j/(n-1)
-                    <float64> angle = 0.3
-                    <> s = sin(angle)
-                    <> c = cos(angle)
-                    x[i,j] = c*xx + s*yy - 2
-                    y[i,j] = -s*xx + c*yy - 2
-                    """,
-                [
-                    lp.GlobalArg("x,y", dtype, shape=lp.auto),
-                    lp.ValueArg("n", np.int32),
-                    ], assumptions="n>0")
-
-            knl = lp.split_iname(knl, "i", 16, outer_tag="g.1", inner_tag="l.1")
-            knl = lp.split_iname(knl, "j", 16, outer_tag="g.0", inner_tag="l.0")
-
-            return knl
-
-        evt, result = get_2d_knl(dtype)(queue, n=n)
-
-        result = [x.ravel() for x in result]
-
-        return make_obj_array(result)
-    elif dims == 3:
-        n = int(nparticles**(1/3))
+    knl = lp.split_iname(knl, "i", 128, outer_tag="g.0", inner_tag="l.0")
+
+    return knl
+
+
+@memoize
+def _get_surface_3d_kernel(dtype):
+    import loopy as lp
+
+    knl = lp.make_kernel(
+        "{[i,j]: 0<=i,j<n}",
+        """
+            <> phi = 2*M_PI/n * i
+            <> theta = 2*M_PI/n * j
+            x[i,j] = 5*cos(phi) * (3 + cos(theta))
+            y[i,j] = 5*sin(phi) * (3 + cos(theta))
+            z[i,j] = 5*sin(theta)
+            """,
+        [
+            lp.GlobalArg("x,y,z,", dtype, shape=lp.auto),
+            lp.ValueArg("n", np.int32),
+            ])
+
+    knl = lp.split_iname(knl, "i", 16, outer_tag="g.1", inner_tag="l.1")
+    knl = lp.split_iname(knl, "j", 16, outer_tag="g.0", inner_tag="l.0")
+
+    return knl
 
-        def get_3d_knl(dtype):
-            knl = lp.make_kernel(
-                "{[i,j,k]: 0<=i,j,k<n}",
-                """
-                    <> xx = i/(n-1)
-                    <> yy = j/(n-1)
-                    <> zz = k/(n-1)
 
-                    <float64> phi = 0.3
-                    <> s1 = sin(phi)
-                    <> c1 = cos(phi)
+@memoize
+def _get_uniform_2d_kernel(dtype):
+    import loopy as lp
 
-                    <> xxx = c1*xx + s1*yy
-                    <> yyy = -s1*xx + c1*yy
-                    <> zzz = zz
+    knl = lp.make_kernel(
+        "{[i,j]: 0<=i,j<n}",
+        """
+            <> xx = 4*i/(n-1)
+            <> yy = 4*j/(n-1)
+            <float64> angle = 0.3
+            <> s = sin(angle)
+            <> c = cos(angle)
+            x[i,j] = c*xx + s*yy - 2
+            y[i,j] = -s*xx + c*yy - 2
+            """,
+        [
+            lp.GlobalArg("x,y", dtype, shape=lp.auto),
+            lp.ValueArg("n", np.int32),
+            ], assumptions="n>0")
+
+    knl = lp.split_iname(knl, "i", 16, outer_tag="g.1", inner_tag="l.1")
+    knl = lp.split_iname(knl, "j", 16, outer_tag="g.0", inner_tag="l.0")
+
+    return knl
+
+
+@memoize
+def _get_uniform_3d_kernel(dtype):
+    import loopy as lp
 
-                    <float64> theta = 0.7
-                    <> s2 = sin(theta)
-                    <> c2 = cos(theta)
+    knl = lp.make_kernel(
+        "{[i,j,k]: 0<=i,j,k<n}",
+        """
+            <> xx = i/(n-1)
+            <> yy = j/(n-1)
+            <> zz = k/(n-1)
 
-                    x[i,j,k] = 4 * (c2*xxx + s2*zzz) - 2
-                    y[i,j,k] = 4 * yyy - 2
-                    z[i,j,k] = 4 * (-s2*xxx + c2*zzz) - 2
-                    """,
-                [
-                    lp.GlobalArg("x,y,z", dtype, shape=lp.auto),
-                    lp.ValueArg("n", np.int32),
-                    ], assumptions="n>0")
+            <float64> phi = 0.3
+            <> s1 = sin(phi)
+            <> c1 = cos(phi)
 
-            knl = lp.split_iname(knl, "j", 16, outer_tag="g.1", inner_tag="l.1")
-            knl = lp.split_iname(knl, "k", 16, outer_tag="g.0", inner_tag="l.0")
+            <> xxx = c1*xx + s1*yy
+            <> yyy = -s1*xx + c1*yy
+            <> zzz = zz
 
-            return knl
+            <float64> theta = 0.7
+            <> s2 = sin(theta)
+            <> c2 = cos(theta)
 
-        evt, result = get_3d_knl(dtype)(queue, n=n)
+            x[i,j,k] = 4 * (c2*xxx + s2*zzz) - 2
+            y[i,j,k] = 4 * yyy - 2
+            z[i,j,k] = 4 * (-s2*xxx + c2*zzz) - 2
+            """,
+        [
+            lp.GlobalArg("x,y,z", dtype, shape=lp.auto),
+            lp.ValueArg("n", np.int32),
+            ], assumptions="n>0")
 
-        result = [x.ravel() for x in result]
+    knl = lp.split_iname(knl, "j", 16, outer_tag="g.1", inner_tag="l.1")
+    knl = lp.split_iname(knl, "k", 16, outer_tag="g.0", inner_tag="l.0")
 
-        return make_obj_array(result)
+    return knl
+
+# }}}
+
+
+def make_surface_particle_array(queue, nparticles, dims, dtype, seed=15):
+    if dims == 2:
+        evt, result = _get_surface_2d_kernel(dtype)(queue, n=nparticles)
+    elif dims == 3:
+        n = int(nparticles**0.5)
+        evt, result = _get_surface_3d_kernel(dtype)(queue, n=n)
     else:
         raise NotImplementedError
 
+    result = [x.ravel() for x in result]
+
+    return make_obj_array(result)
+
+
+def make_uniform_particle_array(queue, nparticles, dims, dtype, seed=15):
+    if dims == 2:
+        n = int(nparticles**0.5)
+        evt, result = _get_uniform_2d_kernel(dtype)(queue, n=n)
+    elif dims == 3:
+        n = int(nparticles**(1/3))
+        evt, result = _get_uniform_3d_kernel(dtype)(queue, n=n)
+    else:
+        raise NotImplementedError
+
+    result = [x.ravel() for x in result]
+
+    return make_obj_array(result)
+
 
 def make_rotated_uniform_particle_array(queue, nparticles, dims, dtype, seed=15):
     raise NotImplementedError
@@ -259,31 +642,36 @@ class DeviceDataRecord(Record):
     instances on the host.
     """
 
-    def _transform_arrays(self, f):
-        result = {}
+    @staticmethod
+    def _transform_value(f, val):
+        from pyopencl.algorithm import BuiltList
+        from boxtree.host_build import _BuiltList as HostBuiltList
+        if isinstance(val, np.ndarray) and val.dtype == object:
+            from pytools.obj_array import with_object_array_or_scalar
+            return with_object_array_or_scalar(f, val)
+        elif isinstance(val, list):
+            return [DeviceDataRecord._transform_value(f, i) for i in val]
+        elif isinstance(val, (BuiltList, HostBuiltList)):
+            return type(val)(
+                    count=val.count,
+                    starts=f(val.starts),
+                    lists=f(val.lists))
+        else:
+            return f(val)
 
-        def transform_val(val):
-            from pyopencl.algorithm import BuiltList
-            if isinstance(val, np.ndarray) and val.dtype == object:
-                from pytools.obj_array import with_object_array_or_scalar
-                return with_object_array_or_scalar(f, val)
-            elif isinstance(val, list):
-                return [transform_val(i) for i in val]
-            elif isinstance(val, BuiltList):
-                return BuiltList(
-                        count=val.count,
-                        starts=f(val.starts),
-                        lists=f(val.lists))
-            else:
-                return f(val)
+    def _transform_arrays(self, f, exclude_fields=frozenset()):
+        result = {}
 
         for field_name in self.__class__.fields:
+            if field_name in exclude_fields:
+                continue
+
             try:
                 attr = getattr(self, field_name)
             except AttributeError:
                 pass
             else:
-                result[field_name] = transform_val(attr)
+                result[field_name] = self._transform_value(f, attr)
 
         return self.copy(**result)
 
@@ -303,6 +691,140 @@ class DeviceDataRecord(Record):
 
         return self._transform_arrays(try_get)
 
+    def get_async(self, queue=None, fields=None, pinned=True):
+        """Start transferring the device data of `self` to the host without
+        blocking. All copies are enqueued at once, and nothing waits for them
+        until :meth:`HostTransfer.wait` is called on the return value.
+
+        :arg queue: the :class:`pyopencl.CommandQueue` on which to enqueue the
+            copies. If not given, each array's own queue is used.
+        :arg fields: if given, an iterable of field names. Only these fields
+            are transferred; all other fields keep their original values in
+            the resulting record. Fields holding a nested
+            :class:`DeviceDataRecord` are transferred in full.
+        :arg pinned: if *True*, the host arrays are carved out of a single
+            page-locked staging buffer, which allows the copies to run
+            asynchronously on most implementations.
+        :returns: a :class:`HostTransfer`.
+
+        .. versionadded:: 2016.1
+        """
+
+        if fields is None:
+            field_names = list(self.__class__.fields)
+        else:
+            field_names = list(fields)
+            unknown = set(field_names) - set(self.__class__.fields)
+            if unknown:
+                raise ValueError("unknown fields: %s"
+                        % ", ".join(sorted(unknown)))
+
+        values = {}
+        for field_name in field_names:
+            try:
+                values[field_name] = getattr(self, field_name)
+            except AttributeError:
+                pass
+
+        # {{{ gather device arrays
+
+        device_arrays = {}
+
+        def gather(val):
+            if isinstance(val, DeviceDataRecord):
+                # Nested records (such as a traversal's tree) are
+                # transferred in full, as by :meth:`get`.
+                return val._transform_arrays(gather)
+            elif isinstance(val, cl.array.Array):
+                device_arrays[id(val)] = val
+            return val
+
+        for val in values.values():
+            self._transform_value(gather, val)
+
+        # }}}
+
+        # {{{ lay out host arrays in the staging buffer
+
+        alignment = 128
+
+        byte_offsets = {}
+        total_nbytes = 0
+        for key, ary in device_arrays.items():
+            if not (ary.flags.c_contiguous or ary.flags.f_contiguous):
+                continue
+            byte_offsets[key] = total_nbytes
+            total_nbytes += (ary.nbytes + alignment - 1) // alignment * alignment
+
+        staging = None
+        if pinned and total_nbytes:
+            some_ary = next(iter(device_arrays.values()))
+            map_queue = queue if queue is not None else some_ary.queue
+            if map_queue is None:
+                raise ValueError("no queue given and arrays have no queue")
+
+            staging_buf = cl.Buffer(map_queue.context,
+                    cl.mem_flags.READ_WRITE | cl.mem_flags.ALLOC_HOST_PTR,
+                    total_nbytes)
+            staging, _ = cl.enqueue_map_buffer(map_queue, staging_buf,
+                    cl.map_flags.READ | cl.map_flags.WRITE, 0,
+                    (total_nbytes,), np.uint8, is_blocking=True)
+
+        # }}}
+
+        # {{{ enqueue copies
+
+        host_arrays = {}
+        events = []
+
+        for key, ary in device_arrays.items():
+            copy_queue = queue if queue is not None else ary.queue
+            if copy_queue is None:
+                raise ValueError("no queue given and array has no queue")
+
+            if key not in byte_offsets:
+                # Non-contiguous arrays fall back to a blocking transfer.
+                host_arrays[key] = ary.get(queue=copy_queue)
+                continue
+
+            if staging is not None:
+                host_ary = np.ndarray(ary.shape, ary.dtype, buffer=staging,
+                        offset=byte_offsets[key], strides=ary.strides)
+            else:
+                host_ary = np.empty(ary.shape, ary.dtype,
+                        order="F" if ary.flags.f_contiguous
+                        and not ary.flags.c_contiguous else "C")
+
+            host_arrays[key] = host_ary
+
+            if ary.size:
+                events.append(cl.enqueue_copy(copy_queue, host_ary,
+                        ary.base_data, src_offset=ary.offset,
+                        is_blocking=False, wait_for=ary.events))
+
+        # }}}
+
+        def to_host(val):
+            if isinstance(val, DeviceDataRecord):
+                return val._transform_arrays(to_host)
+            elif isinstance(val, cl.array.Array):
+                return host_arrays[id(val)]
+            return val
+
+        result = self.copy(**dict(
+            (field_name, self._transform_value(to_host, val))
+            for field_name, val in values.items()))
+
+        return HostTransfer(result, events)
+
+    def get_lazy(self, queue):
+        """Return a :class:`LazyHostRecord` that downloads each field of
+        `self` to the host only when it is first accessed.
+
+        .. versionadded:: 2016.1
+        """
+        return LazyHostRecord(self, queue)
+
     def with_queue(self, queue):
         """Return a copy of `self` in
         all :class:`pyopencl.array.Array` objects are assigned to
@@ -323,6 +845,238 @@ class DeviceDataRecord(Record):
 
         return self._transform_arrays(try_with_queue)
 
+    def to_device(self, queue, exclude_fields=frozenset()):
+        """Return a copy of `self` in which all :class:`numpy.ndarray`
+        instances are transferred to the device as
+        :class:`pyopencl.array.Array` objects (with no queue assigned).
+
+        :arg exclude_fields: a :class:`frozenset` of names of fields to leave
+            unchanged, e.g. fields that are meant to live on the host.
+
+        .. versionadded:: 2016.1
+        """
+
+        def try_to_device(attr):
+            if isinstance(attr, np.ndarray):
+                return cl.array.to_device(queue, attr).with_queue(None)
+            else:
+                return attr
+
+        return self._transform_arrays(try_to_device,
+                exclude_fields=exclude_fields)
+
+
+class HostTransfer(object):
+    """A pending device-to-host transfer of a :class:`DeviceDataRecord`, as
+    returned by :meth:`DeviceDataRecord.get_async`.
+
+    .. attribute:: events
+
+        A list of :class:`pyopencl.Event` instances, one per enqueued copy.
+
+    .. automethod:: is_done
+    .. automethod:: wait
+
+    .. versionadded:: 2016.1
+    """
+
+    def __init__(self, result, events):
+        self._result = result
+        self.events = events
+
+    def is_done(self):
+        """Return *True* if all copies have completed."""
+        return all(
+                evt.command_execution_status == cl.command_execution_status.COMPLETE
+                for evt in self.events)
+
+    def wait(self):
+        """Wait for all copies to complete and return the record with its
+        data on the host.
+        """
+        if self.events:
+            cl.wait_for_events(self.events)
+        return self._result
+
+
+class LazyHostRecord(object):
+    """A host-side view of a :class:`DeviceDataRecord` that transfers each
+    field on first access and caches it, as returned by
+    :meth:`DeviceDataRecord.get_lazy`. Fields that are never accessed are
+    never transferred.
+
+    Methods of the underlying record's class are bound to the view, so that
+    they see host data. Properties are evaluated on the device record, since
+    the ones defined by :mod:`boxtree` only depend on array shapes.
+
+    .. attribute:: record
+
+        The underlying :class:`DeviceDataRecord`.
+
+    .. attribute:: fetched_nbytes
+
+        A :class:`dict` mapping the name of each field transferred so far to
+        the number of bytes transferred for it. Fields holding a nested
+        :class:`DeviceDataRecord` (such as a traversal's tree) are not
+        transferred, but wrapped in a :class:`LazyHostRecord` of their own,
+        whose transfers count towards :attr:`total_fetched_nbytes`.
+
+    .. autoattribute:: total_fetched_nbytes
+    .. automethod:: fetch
+
+    .. versionadded:: 2016.1
+    """
+
+    def __init__(self, record, queue):
+        self.record = record
+        self.queue = queue
+        self.fetched_nbytes = {}
+        self._nested_records = {}
+
+    @property
+    def total_fetched_nbytes(self):
+        """The total number of bytes transferred so far, including those
+        transferred for nested records.
+        """
+        return (sum(self.fetched_nbytes.values())
+                + sum(nested.total_fetched_nbytes
+                    for nested in self._nested_records.values()))
+
+    def fetch(self, *field_names):
+        """Transfer the fields named *field_names* that are not yet cached,
+        using a single :meth:`DeviceDataRecord.get_async`.
+        """
+        field_names = [name for name in field_names
+                if name not in self.fetched_nbytes
+                and name not in self._nested_records]
+
+        for name in list(field_names):
+            device_value = getattr(self.record, name, None)
+            if isinstance(device_value, DeviceDataRecord):
+                nested = LazyHostRecord(device_value, self.queue)
+                self._nested_records[name] = nested
+                setattr(self, name, nested)
+                field_names.remove(name)
+
+        if not field_names:
+            return
+
+        host_record = self.record.get_async(
+                self.queue, fields=field_names, pinned=False).wait()
+
+        for name in field_names:
+            try:
+                device_value = getattr(self.record, name)
+            except AttributeError:
+                continue
+
+            nbytes = [0]
+
+            def count(val):
+                if isinstance(val, DeviceDataRecord):
+                    return val._transform_arrays(count)
+                elif isinstance(val, cl.array.Array):
+                    nbytes[0] += val.nbytes
+                return val
+
+            DeviceDataRecord._transform_value(count, device_value)
+
+            self.fetched_nbytes[name] = nbytes[0]
+            setattr(self, name, getattr(host_record, name))
+
+    def __getattr__(self, name):
+        # Only called if regular lookup fails, i.e. for uncached fields.
+        if name.startswith("__"):
+            raise AttributeError(name)
+
+        record = self.__dict__["record"]
+
+        cls_attr = None
+        for cls in type(record).__mro__:
+            if name in cls.__dict__:
+                cls_attr = cls.__dict__[name]
+                break
+
+        import types
+        if isinstance(cls_attr, types.FunctionType):
+            return types.MethodType(cls_attr, self)
+        elif name in record.__class__.fields:
+            self.fetch(name)
+            try:
+                return self.__dict__[name]
+            except KeyError:
+                raise AttributeError(name)
+        else:
+            return getattr(record, name)
+
+# }}}
+
+
+# {{{ memory accounting
+
+class AccountingAllocator(object):
+    """An allocator that hands out memory from a
+    :class:`pyopencl.tools.MemoryPool` and keeps track of how much of it is
+    in use. Pass an instance as the *allocator* argument of a builder to
+    find out how much device memory the builder needs, e.g. to size a pool
+    for a long-running process. To obtain figures per builder call, use a
+    new instance (sharing the same pool) for each call, or call
+    :meth:`reset_peak` in between.
+
+    Memory in use is measured as the number of bytes the pool has handed out
+    beyond those it had handed out when this instance was created.
+
+    .. attribute:: pool
+
+    .. attribute:: nallocations
+
+        The number of allocations made through this allocator.
+
+    .. attribute:: allocated_nbytes
+
+        The total number of bytes allocated through this allocator.
+
+    .. attribute:: peak_nbytes
+
+        The largest value :attr:`live_nbytes` has reached since creation or
+        the last call to :meth:`reset_peak`.
+
+    .. autoattribute:: live_nbytes
+
+    .. automethod:: reset_peak
+
+    .. versionadded:: 2016.1
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.base_nbytes = pool.active_bytes
+
+        self.nallocations = 0
+        self.allocated_nbytes = 0
+        self.peak_nbytes = 0
+
+    @property
+    def live_nbytes(self):
+        """The number of bytes currently in use."""
+        return max(self.pool.active_bytes - self.base_nbytes, 0)
+
+    def __call__(self, nbytes):
+        result = self.pool(nbytes)
+
+        self.nallocations += 1
+        self.allocated_nbytes += nbytes
+
+        # Memory in use only grows through allocations, so checking here
+        # catches every peak.
+        self.peak_nbytes = max(self.peak_nbytes, self.live_nbytes)
+
+        return result
+
+    def reset_peak(self):
+        """Reset :attr:`peak_nbytes` to the current :attr:`live_nbytes`."""
+        self.peak_nbytes = self.live_nbytes
+
 # }}}
 
 
@@ -338,25 +1092,31 @@ def get_type_moniker(dtype):
 
 GAPPY_COPY_TPL = Template(r"""//CL//
 
-    typedef ${dtype_to_ctype(dtype)} value_t;
-
     %if from_indices:
-        value_t val = input_ary[from_indices[i]];
+        ${dtype_to_ctype(from_dtype)} src_i = from_indices[i];
     %else:
-        value_t val = input_ary[i];
-    %endif
-
-    // Optionally, noodle values through a lookup table.
-    %if map_values:
-        val = value_map[val];
+        long src_i = i;
     %endif
 
     %if to_indices:
-        output_ary[to_indices[i]] = val;
+        ${dtype_to_ctype(to_dtype)} dst_i = to_indices[i];
     %else:
-        output_ary[i] = val;
+        long dst_i = i;
     %endif
 
+    %for iary, (dtype, map_values) in enumerate(zip(dtypes, map_value_flags)):
+    {
+        ${dtype_to_ctype(dtype)} val = input_ary_${iary}[src_i];
+
+        // Optionally, noodle values through a lookup table.
+        %if map_values:
+            val = value_map[val];
+        %endif
+
+        output_ary_${iary}[dst_i] = val;
+    }
+    %endfor
+
 """, strict_undefined=True)
 
 
@@ -365,14 +1125,15 @@ class GappyCopyAndMapKernel:
         self.context = context
 
     @memoize_method
-    def _get_kernel(self, dtype, src_index_dtype, dst_index_dtype,
-                    have_src_indices, have_dst_indices, map_values):
+    def _get_kernel(self, dtypes, src_index_dtype, dst_index_dtype,
+                    have_src_indices, have_dst_indices, map_value_flags,
+                    map_values_dtype):
         from pyopencl.tools import VectorArg
 
-        args = [
-                VectorArg(dtype, "input_ary", with_offset=True),
-                VectorArg(dtype, "output_ary", with_offset=True),
-               ]
+        args = []
+        for iary, dtype in enumerate(dtypes):
+            args.append(VectorArg(dtype, "input_ary_%d" % iary, with_offset=True))
+            args.append(VectorArg(dtype, "output_ary_%d" % iary, with_offset=True))
 
         if have_src_indices:
             args.append(VectorArg(src_index_dtype, "from_indices", with_offset=True))
@@ -380,23 +1141,27 @@ class GappyCopyAndMapKernel:
         if have_dst_indices:
             args.append(VectorArg(dst_index_dtype, "to_indices", with_offset=True))
 
-        if map_values:
-            args.append(VectorArg(dtype, "value_map", with_offset=True))
+        if any(map_value_flags):
+            args.append(VectorArg(map_values_dtype, "value_map", with_offset=True))
 
         from pyopencl.tools import dtype_to_ctype
         src = GAPPY_COPY_TPL.render(
-                dtype=dtype,
+                dtypes=dtypes,
                 dtype_to_ctype=dtype_to_ctype,
                 from_dtype=src_index_dtype,
                 to_dtype=dst_index_dtype,
                 from_indices=have_src_indices,
                 to_indices=have_dst_indices,
-                map_values=map_values)
+                map_value_flags=map_value_flags)
+
+        preamble = "\n".join(
+                dtype_to_c_struct(self.context.devices[0], dtype)
+                for dtype in sorted(set(dtypes), key=str))
 
         from pyopencl.elementwise import ElementwiseKernel
         return ElementwiseKernel(self.context,
                 args, str(src),
-                preamble=dtype_to_c_struct(self.context.devices[0], dtype),
+                preamble=preamble,
                 name="gappy_copy_and_map")
 
     # NOTE: Order of positional args should match realloc_array()
@@ -408,10 +1173,42 @@ class GappyCopyAndMapKernel:
         box IDs).
         """
 
+        (result,), evt = self.copy_many(queue, allocator, new_shape, [ary],
+                src_indices=src_indices, dst_indices=dst_indices,
+                map_values=map_values, zero_fill=zero_fill,
+                wait_for=wait_for, range=range, debug=debug)
+
+        return result, evt
+
+    def copy_many(self, queue, allocator, new_shape, arys, src_indices=None,
+                  dst_indices=None, map_values=None, map_value_flags=None,
+                  zero_fill=False, wait_for=None, range=None, debug=False):
+        """Like :meth:`__call__`, but moves all of the arrays in *arys*, which
+        may have different dtypes, with a single kernel launch.
+
+        :arg map_value_flags: a sequence of one :class:`bool` per entry of
+            *arys*, indicating whether the values of that array are mapped
+            through *map_values*. If not given, all arrays are mapped if
+            *map_values* is given.
+        :returns: a tuple *(results, event)*, where *results* is a list with
+            one new array per entry of *arys*.
+        """
+
+        arys = list(arys)
+
         have_src_indices = src_indices is not None
         have_dst_indices = dst_indices is not None
         have_map_values = map_values is not None
 
+        if map_value_flags is None:
+            map_value_flags = (have_map_values,) * len(arys)
+        map_value_flags = tuple(bool(flag) for flag in map_value_flags)
+
+        if len(map_value_flags) != len(arys):
+            raise ValueError("must specify one map_value_flags entry per array")
+        if any(map_value_flags) and not have_map_values:
+            raise ValueError("map_value_flags given without map_values")
+
         if not (have_src_indices or have_dst_indices):
             raise ValueError("must specify at least one of src or dest indices")
 
@@ -422,7 +1219,8 @@ class GappyCopyAndMapKernel:
             elif have_src_indices:
                 range = slice(src_indices.shape[0])
                 if debug:
-                    assert int(cl.array.max(src_indices).get()) < len(ary)
+                    assert int(cl.array.max(src_indices).get()) < min(
+                            len(ary) for ary in arys)
             elif have_dst_indices:
                 range = slice(dst_indices.shape[0])
                 if debug:
@@ -433,32 +1231,38 @@ class GappyCopyAndMapKernel:
         else:
             array_maker = cl.array.empty
 
-        result = array_maker(queue, new_shape, ary.dtype, allocator=allocator)
-
-        kernel = self._get_kernel(ary.dtype,
-                                  src_indices.dtype if have_src_indices else None,
-                                  dst_indices.dtype if have_dst_indices else None,
-                                  have_src_indices,
-                                  have_dst_indices,
-                                  have_map_values)
-
-        args = (ary, result)
+        results = [
+                array_maker(queue, new_shape, ary.dtype, allocator=allocator)
+                for ary in arys]
+
+        if not arys:
+            return results, cl.enqueue_marker(queue, wait_for=wait_for)
+
+        kernel = self._get_kernel(
+                tuple(ary.dtype for ary in arys),
+                src_indices.dtype if have_src_indices else None,
+                dst_indices.dtype if have_dst_indices else None,
+                have_src_indices,
+                have_dst_indices,
+                map_value_flags,
+                map_values.dtype if have_map_values else None)
+
+        args = ()
+        for ary, result in zip(arys, results):
+            args += (ary, result)
         args += (src_indices,) if have_src_indices else ()
         args += (dst_indices,) if have_dst_indices else ()
-        args += (map_values,) if have_map_values else ()
+        args += (map_values,) if any(map_value_flags) else ()
 
         evt = kernel(*args, queue=queue, range=range, wait_for=wait_for)
 
-        return result, evt
+        return results, evt
 
 # }}}
 
 
 # {{{ map values through table
 
-from pyopencl.elementwise import ElementwiseTemplate
-
-
 MAP_VALUES_TPL = ElementwiseTemplate(
     arguments="""//CL//
         dst_value_t *dst,
@@ -23,13 +23,13 @@ THE SOFTWARE.
 """
 
 import numpy as np
-from pytools import Record, memoize_method, memoize_in
+from pytools import Record, memoize, memoize_method
 import pyopencl as cl
 import pyopencl.array  # noqa
 import pyopencl.cltypes  # noqa
 from pyopencl.elementwise import ElementwiseTemplate
 from mako.template import Template
-from boxtree.tools import AXIS_NAMES, DeviceDataRecord
+from boxtree.tools import AXIS_NAMES, DeviceDataRecord, InlineBinarySearch
 
 import logging
 logger = logging.getLogger(__name__)
@@ -118,6 +118,28 @@ TRAVERSAL_PREAMBLE_MAKO_DEFS = r"""//CL:mako//
         ${is_overlapping} = max_dist <= size_sum;
     }
 </%def>
+
+<%def name="check_l2_ball_overlap(
+        is_overlapping, box_id, ball_radius, ball_center)">
+    {
+        ${load_center("box_center", box_id)}
+        int box_level = box_levels[${box_id}];
+
+        coord_t box_rad = LEVEL_TO_RAD(box_level);
+
+        // squared distance from the ball center to the closest point of the box
+        coord_t dist_sq = 0;
+        %for i in range(dimensions):
+        {
+            coord_t axis_dist = fmax((coord_t) 0,
+                fabs(${ball_center}.s${i} - box_center.s${i}) - box_rad);
+            dist_sq += axis_dist * axis_dist;
+        }
+        %endfor
+
+        ${is_overlapping} = dist_sq <= ${ball_radius} * ${ball_radius};
+    }
+</%def>
 """
 
 
@@ -203,6 +225,71 @@ inline bool is_adjacent_or_overlapping(
 
 # }}}
 
+# {{{ periodic images
+
+# Along periodic axes, the root box is the periodic cell. Each list entry then
+# refers to a box in one of the periodic images of the tree, given by an
+# image shift of -1, 0 or 1 (in units of the root extent) per periodic axis.
+# The walks below visit the images by shifting the target box the opposite
+# way.
+
+PERIODIC_IMAGE_MAKO_DEFS = r"""//CL:mako//
+<%def name="image_loop_begin(center, shifted_center, level)">
+    %if periodic_axes:
+        for (int image = 0; image < ${3**len(periodic_axes)}; ++image)
+        {
+            %for iax, ax in enumerate(periodic_axes):
+                int image_shift_${ax} = (image / ${3**iax}) % 3 - 1;
+            %endfor
+
+            coord_vec_t ${shifted_center} = ${center};
+            %for ax in periodic_axes:
+                ${shifted_center}.${ax} -= image_shift_${ax} * root_extent;
+            %endfor
+
+            // Skip images of the tree that the box is not adjacent to.
+            if (!is_adjacent_or_overlapping(root_extent,
+                    ${shifted_center}, ${level}, root_center, 0, false))
+                continue;
+    %else:
+        {
+            coord_vec_t ${shifted_center} = ${center};
+    %endif
+</%def>
+
+<%def name="image_loop_end()">
+        }
+</%def>
+
+<%def name="is_unshifted_image()">
+    %if periodic_axes:
+        (image == ${(3**len(periodic_axes) - 1) // 2})
+    %else:
+        true
+    %endif
+</%def>
+
+<%def name="load_colleague_image_shifts(i)">
+    %for ax in periodic_axes:
+        int image_shift_${ax} = colleagues_image_shifts_${ax}[${i}];
+    %endfor
+</%def>
+
+<%def name="shift_center(name, sign)">
+    %for ax in periodic_axes:
+        ${name}.${ax} ${sign}= image_shift_${ax} * root_extent;
+    %endfor
+</%def>
+
+<%def name="append_image_shifts(list_name)">
+    %for ax in periodic_axes:
+        APPEND_${list_name}_image_shifts_${ax}(image_shift_${ax});
+    %endfor
+</%def>
+"""
+
+# }}}
+
 # {{{ sources and their parents, targets
 
 SOURCES_PARENTS_AND_TARGETS_TEMPLATE = r"""//CL//
@@ -272,10 +359,22 @@ COLLEAGUES_TEMPLATE = r"""//CL//
 void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t box_id)
 {
     ${load_center("center", "box_id")}
+    ${load_center("root_center", "0")}
 
     if (box_id == 0)
     {
-        // The root has no colleagues.
+        %if periodic_axes:
+            // The root's colleagues are its own periodic images.
+            ${image_loop_begin("center", "shifted_center", "0")}
+                if (!${is_unshifted_image()})
+                {
+                    APPEND_colleagues(0);
+                    ${append_image_shifts("colleagues")}
+                }
+            ${image_loop_end()}
+        %else:
+            // The root has no colleagues.
+        %endif
         return;
     }
 
@@ -283,6 +382,8 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t box_id)
 
     dbg_printf(("box id: %d level: %d\n", box_id, level));
 
+    ${image_loop_begin("center", "shifted_center", "level")}
+
     // To find this box's colleagues, start at the top of the tree, descend
     // into adjacent (or overlapping) parents.
     ${walk_init(0)}
@@ -299,15 +400,20 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t box_id)
             ${load_center("child_center", "child_box_id")}
 
             bool a_or_o = is_adjacent_or_overlapping(root_extent,
-                center, level, child_center, box_levels[child_box_id], false);
+                shifted_center, level, child_center, box_levels[child_box_id],
+                false);
 
             if (a_or_o)
             {
                 // child_box_id lives on walk_level+1.
-                if (walk_level+1 == level  && child_box_id != box_id)
+                if (walk_level+1 == level)
                 {
-                    dbg_printf(("    colleague\n"));
-                    APPEND_colleagues(child_box_id);
+                    if (child_box_id != box_id || !${is_unshifted_image()})
+                    {
+                        dbg_printf(("    colleague\n"));
+                        APPEND_colleagues(child_box_id);
+                        ${append_image_shifts("colleagues")}
+                    }
                 }
                 else
                 {
@@ -328,6 +434,8 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t box_id)
 
         ${walk_advance()}
     }
+
+    ${image_loop_end()}
 }
 
 """
@@ -346,11 +454,14 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
     box_id_t box_id = target_boxes[target_box_number];
 
     ${load_center("center", "box_id")}
+    ${load_center("root_center", "0")}
 
     int level = box_levels[box_id];
 
     dbg_printf(("box id: %d level: %d\n", box_id, level));
 
+    ${image_loop_begin("center", "shifted_center", "level")}
+
     // root box is not part of walk, check it up front.
     // Also no need to check for overlap-iness. The root box
     // overlaps *everybody*.
@@ -360,6 +471,7 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
         if (root_flags & BOX_HAS_OWN_SOURCES)
         {
             APPEND_neighbor_source_boxes(0);
+            ${append_image_shifts("neighbor_source_boxes")}
         }
     }
 
@@ -380,7 +492,8 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
             ${load_center("child_center", "child_box_id")}
 
             bool a_or_o = is_adjacent_or_overlapping(root_extent,
-                center, level, child_center, box_levels[child_box_id], false);
+                shifted_center, level, child_center, box_levels[child_box_id],
+                false);
 
             if (a_or_o)
             {
@@ -391,6 +504,7 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
                     dbg_printf(("    neighbor source box\n"));
 
                     APPEND_neighbor_source_boxes(child_box_id);
+                    ${append_image_shifts("neighbor_source_boxes")}
                 }
 
                 if (flags & BOX_HAS_CHILD_SOURCES)
@@ -413,6 +527,8 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
 
         ${walk_advance()}
     }
+
+    ${image_loop_end()}
 }
 
 """
@@ -442,13 +558,18 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
     for (box_id_t i = parent_coll_start; i < parent_coll_stop; ++i)
     {
         box_id_t parent_colleague = colleagues_list[i];
+        ${load_colleague_image_shifts("i")}
 
         for (int morton_nr = 0; morton_nr < ${2**dimensions}; ++morton_nr)
         {
             box_id_t sib_box_id = box_child_ids[
                     morton_nr * aligned_nboxes + parent_colleague];
 
+            if (!sib_box_id)
+                continue;
+
             ${load_center("sib_center", "sib_box_id")}
+            ${shift_center("sib_center", "+")}
 
             bool sep = !is_adjacent_or_overlapping(root_extent,
                 center, level, sib_center, box_levels[sib_box_id], false);
@@ -456,6 +577,7 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
             if (sep)
             {
                 APPEND_sep_siblings(sib_box_id);
+                ${append_image_shifts("sep_siblings")}
             }
         }
     }
@@ -487,6 +609,11 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
     {
         box_id_t colleague = colleagues_list[i];
 
+        // Shift the target box rather than the colleague's descendants.
+        ${load_colleague_image_shifts("i")}
+        coord_vec_t shifted_center = center;
+        ${shift_center("shifted_center", "-")}
+
         ${walk_init("colleague")}
 
         while (continue_walk)
@@ -527,7 +654,7 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
                 int child_level = box_levels[child_box_id];
 
                 bool a_or_o = is_adjacent_or_overlapping(root_extent,
-                    center, level, child_center, child_level, false);
+                    shifted_center, level, child_center, child_level, false);
 
                 if (a_or_o)
                 {
@@ -550,7 +677,7 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
                     %if sources_have_extent or targets_have_extent:
                         const bool a_or_o_with_stick_out =
                             is_adjacent_or_overlapping(root_extent,
-                                center, level, child_center,
+                                shifted_center, level, child_center,
                                 child_level, true);
                     %else:
                         const bool a_or_o_with_stick_out = false;
@@ -563,7 +690,10 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
                     if (!a_or_o_with_stick_out)
                     {
                         if (sep_smaller_source_level == child_level)
+                        {
                             APPEND_sep_smaller(child_box_id);
+                            ${append_image_shifts("sep_smaller")}
+                        }
                     }
                     else
                     {
@@ -693,9 +823,14 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
     // Look for colleagues of parents that are non-adjacent to tgt_ibox.
     // Walk up the tree from tgt_ibox.
 
+    %if periodic_axes:
+    // Box 0 (== level 0) has its periodic images as colleagues.
+    for (int walk_level = box_level - 1; walk_level >= 0;
+    %else:
     // Box 0 (== level 0) doesn't have any colleagues, so we can stop the
     // search for such colleagues there.
     for (int walk_level = box_level - 1; walk_level != 0;
+    %endif
             // {{{ advance
             --walk_level,
             current_parent_box_id = box_parent_ids[current_parent_box_id]
@@ -713,6 +848,8 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
             if (box_flags[colleague_box_id] & BOX_HAS_OWN_SOURCES)
             {
                 ${load_center("colleague_center", "colleague_box_id")}
+                ${load_colleague_image_shifts("i")}
+                ${shift_center("colleague_center", "+")}
                 bool a_or_o = is_adjacent_or_overlapping(root_extent,
                     center, box_level, colleague_center, walk_level, false);
 
@@ -751,6 +888,7 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
                             // to be far enough away to let the interaction into
                             // our local downward subtree.
                             APPEND_sep_bigger(colleague_box_id);
+                            ${append_image_shifts("sep_bigger")}
                         }
                         else
                         {
@@ -770,6 +908,613 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
 # }}}
 
 
+# {{{ dual tree traversal
+
+DUAL_TREE_TEMPLATE = r"""//CL//
+
+<%def name="process_source_box(src_box_id)">
+    // Follows the dual tree recursion from the pair (ancestors[a_level],
+    // ${src_box_id}) on, as far as this can be done without splitting the
+    // source box. Sets 'descend' if the source box needs to be split.
+
+    descend = false;
+
+    {
+        ${load_center("src_center", src_box_id)}
+        int src_level = box_levels[${src_box_id}];
+        box_flags_t src_flags = box_flags[${src_box_id}];
+        coord_t src_rad = LEVEL_TO_RAD(src_level);
+
+        while (true)
+        {
+            box_id_t tgt_ancestor = ancestors[a_level];
+            ${load_center("tgt_center", "tgt_ancestor")}
+            coord_t tgt_rad = LEVEL_TO_RAD(a_level);
+
+            coord_t dist_squared = 0;
+            %for i in range(dimensions):
+                dist_squared +=
+                    (tgt_center.s${i} - src_center.s${i})
+                    * (tgt_center.s${i} - src_center.s${i});
+            %endfor
+
+            // radii of the circumscribing balls
+            coord_t rad_sum = (tgt_rad + src_rad) * sqrt((coord_t) ${dimensions});
+
+            // Expansion wranglers are not expected to provide multipole
+            // expansions on levels 0 and 1.
+            if (src_level >= 2
+                    && rad_sum * rad_sum < theta * theta * dist_squared)
+            {
+                // well-separated: multipole acceptance criterion holds
+                if (a_level == level)
+                {
+                    dbg_printf(("    far source box %d\n", ${src_box_id}));
+                    APPEND_far_source_boxes(${src_box_id});
+                }
+                break;
+            }
+
+            bool tgt_splittable = box_flags[tgt_ancestor] & BOX_HAS_CHILD_TARGETS;
+            bool src_splittable = src_flags & BOX_HAS_CHILD_SOURCES;
+
+            if (tgt_splittable && (!src_splittable || a_level <= src_level))
+            {
+                // Split the target box. Of its children, only the one on the
+                // way to box_id is of interest here. If box_id itself gets
+                // split, its children take care of the interaction.
+
+                if (a_level == level)
+                    break;
+
+                ++a_level;
+                continue;
+            }
+
+            if (src_splittable)
+            {
+                descend = true;
+                break;
+            }
+
+            // Both boxes are leaves. (Non-leaf ancestors are always
+            // splittable, so the target box must be box_id.)
+            dbg_printf(("    near source box %d\n", ${src_box_id}));
+            APPEND_near_source_boxes(${src_box_id});
+            break;
+        }
+    }
+</%def>
+
+void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
+{
+    // /!\ target_box_number is *not* a box_id, despite the type.
+    // It's the number of the target box we're currently processing.
+
+    box_id_t box_id = target_or_target_parent_boxes[target_box_number];
+    int level = box_levels[box_id];
+
+    dbg_printf(("box id: %d level: %d\n", box_id, level));
+
+    if (!(box_flags[0] & (BOX_HAS_OWN_SOURCES | BOX_HAS_CHILD_SOURCES)))
+        return;
+
+    // The dual tree recursion only ever splits the target side along the
+    // chain of ancestors of box_id. Record that chain, indexed by level.
+    box_id_t ancestors[NLEVELS];
+    {
+        box_id_t ancestor = box_id;
+        for (int ancestor_level = level; ancestor_level >= 0; --ancestor_level)
+        {
+            ancestors[ancestor_level] = ancestor;
+            ancestor = box_parent_ids[ancestor];
+        }
+    }
+
+    // The recursion starts with the pair (root, root).
+    int a_level = 0;
+    bool descend;
+
+    ${process_source_box("0")}
+
+    if (!descend)
+        return;
+
+    // Level of the target-side box paired with the source box on each level
+    // of the walk stack.
+    int walk_a_level[NLEVELS];
+
+    ${walk_init(0)}
+    walk_a_level[0] = a_level;
+
+    while (continue_walk)
+    {
+        box_id_t child_box_id = box_child_ids[
+                walk_morton_nr * aligned_nboxes + walk_box_id];
+
+        dbg_printf(("  walk box id: %d morton: %d child id: %d level: %d\n",
+            walk_box_id, walk_morton_nr, child_box_id, walk_level));
+
+        if (child_box_id && (box_flags[child_box_id]
+                    & (BOX_HAS_OWN_SOURCES | BOX_HAS_CHILD_SOURCES)))
+        {
+            a_level = walk_a_level[walk_level];
+
+            ${process_source_box("child_box_id")}
+
+            if (descend)
+            {
+                dbg_printf(("    descend\n"));
+
+                ${walk_push("child_box_id")}
+                walk_a_level[walk_level] = a_level;
+
+                continue;
+            }
+        }
+
+        ${walk_advance()}
+    }
+}
+
+"""
+
+# }}}
+
+
+# {{{ traversal statistics
+
+class InteractionListStatistics(Record):
+    """Size statistics for one CSR interaction list of a
+    :class:`FMMTraversalInfo`. See :meth:`FMMTraversalInfo.get_statistics`.
+
+    .. attribute:: name
+
+        A string identifying the list, e.g. ``"neighbor_source_boxes"`` or
+        ``"sep_smaller_by_level[3]"``.
+
+    .. attribute:: nrows
+
+        Number of rows (i.e. target boxes) in the list.
+
+    .. attribute:: nentries
+
+        Total number of entries in the list.
+
+    .. attribute:: max_row_length
+
+    .. attribute:: mean_row_length
+
+    .. attribute:: nbytes
+
+        Device memory occupied by the *starts* and *lists* arrays.
+
+    .. attribute:: level_nentries
+
+        :class:`numpy.ndarray` of shape ``(nlevels,)`` with the number of
+        entries in the rows of target boxes on each level.
+
+    .. attribute:: level_max_row_length
+
+        :class:`numpy.ndarray` of shape ``(nlevels,)`` with the maximum
+        row length among target boxes on each level.
+
+    .. versionadded:: 2016.1
+    """
+
+
+class TraversalStatistics(Record):
+    """Size statistics and an estimated cost of an FMM using a
+    :class:`FMMTraversalInfo`. See :meth:`FMMTraversalInfo.get_statistics`.
+
+    .. attribute:: lists
+
+        A list of :class:`InteractionListStatistics`, one for each interaction
+        list present in the traversal.
+
+    .. attribute:: nbytes
+
+        Total device memory occupied by the interaction lists.
+
+    .. attribute:: estimated_cost
+
+        A :class:`dict` mapping the names of the stages of
+        :func:`boxtree.fmm.drive_fmm` to an estimated operation count.
+
+    .. attribute:: total_estimated_cost
+
+    .. versionadded:: 2016.1
+    """
+
+    @property
+    def total_estimated_cost(self):
+        return sum(self.estimated_cost.values())
+
+    def __str__(self):
+        lines = ["%-26s %10s %12s %8s %10s %12s" % (
+            "list", "rows", "entries", "max", "mean", "bytes")]
+        for lstats in self.lists:
+            lines.append("%-26s %10d %12d %8d %10.2f %12d" % (
+                lstats.name, lstats.nrows, lstats.nentries,
+                lstats.max_row_length, lstats.mean_row_length, lstats.nbytes))
+
+        lines.append("")
+        for stage, cost in sorted(self.estimated_cost.items()):
+            lines.append("%-26s %14.4g" % (stage, cost))
+        lines.append("%-26s %14.4g" % ("total", self.total_estimated_cost))
+
+        return "\n".join(lines)
+
+
+LEVEL_MAX_ROW_LENGTH_TEMPLATE = ElementwiseTemplate(
+    arguments="""//CL//
+        box_id_t *starts,
+        box_id_t *level_starts,
+        box_id_t level_starts_len,
+        int *level_max_row_length
+        """,
+    operation="""//CL//
+        int row_length = (int) (starts[i+1] - starts[i]);
+        size_t level = bsearch(level_starts, level_starts_len, i);
+        atomic_max(level_max_row_length + level, row_length);
+        """,
+    name="level_max_row_length",
+    preamble=str(InlineBinarySearch("box_id_t")))
+
+
+@memoize
+def _get_level_max_row_length_kernel(context, box_id_dtype):
+    return LEVEL_MAX_ROW_LENGTH_TEMPLATE.build(
+            context,
+            type_aliases=(("box_id_t", box_id_dtype),))
+
+
+@memoize
+def _get_interaction_cost_kernel(context, box_id_dtype, particle_id_dtype,
+        weigh_by_targets, weigh_by_sources):
+    """Return a reduction kernel summing, over the rows of a CSR list,
+    the number of target particles (or one) in the row's target box times
+    the number of source particles (or one) in each listed source box.
+    """
+
+    from pyopencl.reduction import ReductionKernel
+    from pyopencl.tools import dtype_to_ctype
+    return ReductionKernel(
+            context, np.float64, neutral="0", reduce_expr="a+b",
+            map_expr="row_cost(i, boxes, starts, lists, "
+            "box_target_counts_nonchild, box_source_counts_nonchild)",
+            arguments=(
+                "{box_id_t} *boxes, {box_id_t} *starts, {box_id_t} *lists, "
+                "{particle_id_t} *box_target_counts_nonchild, "
+                "{particle_id_t} *box_source_counts_nonchild".format(
+                    box_id_t=dtype_to_ctype(box_id_dtype),
+                    particle_id_t=dtype_to_ctype(particle_id_dtype))),
+            name="interaction_cost",
+            preamble=Template(r"""//CL:mako//
+                double row_cost(size_t irow,
+                    __global ${box_id_t} *boxes,
+                    __global ${box_id_t} *starts,
+                    __global ${box_id_t} *lists,
+                    __global ${particle_id_t} *box_target_counts_nonchild,
+                    __global ${particle_id_t} *box_source_counts_nonchild)
+                {
+                    double source_cost = 0;
+                    for (${box_id_t} j = starts[irow]; j < starts[irow+1]; ++j)
+                    {
+                        %if weigh_by_sources:
+                            source_cost +=
+                                box_source_counts_nonchild[lists[j]];
+                        %else:
+                            source_cost += 1;
+                        %endif
+                    }
+
+                    %if weigh_by_targets:
+                        return box_target_counts_nonchild[boxes[irow]]
+                            * source_cost;
+                    %else:
+                        return source_cost;
+                    %endif
+                }
+                """, strict_undefined=True).render(
+                    box_id_t=dtype_to_ctype(box_id_dtype),
+                    particle_id_t=dtype_to_ctype(particle_id_dtype),
+                    weigh_by_targets=weigh_by_targets,
+                    weigh_by_sources=weigh_by_sources))
+
+
+def _get_expansion_size(dimensions, nterms):
+    # coefficient counts of the Helmholtz expansions in
+    # :mod:`boxtree.pyfmmlib_integration`
+    if dimensions == 2:
+        return 2*nterms + 1
+    elif dimensions == 3:
+        return (nterms+1)*(2*nterms+1)
+    else:
+        return (nterms+1)**(dimensions-1)
+
+# }}}
+
+
+# {{{ close list merging
+
+MERGED_ROW_EXTENTS_TEMPLATE = Template(r"""//CL:mako//
+    /* target_or_target_parent_boxes is sorted by box id and contains all
+     * target boxes, so it can be bisected to find the target box.
+     */
+    ${box_id_t} itarget_or_target_parent_box = 0;
+    {
+        ${box_id_t} box_id = target_boxes[itgt_box];
+        ${box_id_t} hi = ntarget_or_target_parent_boxes;
+        while (hi - itarget_or_target_parent_box > 1)
+        {
+            ${box_id_t} mid = (itarget_or_target_parent_box + hi) / 2;
+            if (target_or_target_parent_boxes[mid] <= box_id)
+                itarget_or_target_parent_box = mid;
+            else
+                hi = mid;
+        }
+    }
+
+    ${box_id_t} neighbor_source_boxes_start =
+        neighbor_source_boxes_starts[itgt_box];
+    ${box_id_t} neighbor_source_boxes_count =
+        neighbor_source_boxes_starts[itgt_box + 1]
+        - neighbor_source_boxes_start;
+
+    %if have_close_smaller:
+        ${box_id_t} sep_close_smaller_start =
+            sep_close_smaller_starts[itgt_box];
+        ${box_id_t} sep_close_smaller_count =
+            sep_close_smaller_starts[itgt_box + 1]
+            - sep_close_smaller_start;
+    %else:
+        ${box_id_t} sep_close_smaller_count = 0;
+    %endif
+
+    %if have_close_bigger:
+        ${box_id_t} sep_close_bigger_start =
+            sep_close_bigger_starts[itarget_or_target_parent_box];
+        ${box_id_t} sep_close_bigger_count =
+            sep_close_bigger_starts[itarget_or_target_parent_box + 1]
+            - sep_close_bigger_start;
+    %else:
+        ${box_id_t} sep_close_bigger_count = 0;
+    %endif
+    """, strict_undefined=True)
+
+
+MERGED_ROW_LENGTH_TEMPLATE = Template(r"""//CL:mako//
+    inline ${box_id_t} get_merged_row_length(
+        ${box_id_t} itgt_box,
+        %for name in starts_arg_names:
+            __global const ${box_id_t} *${name},
+        %endfor
+        ${box_id_t} ntarget_or_target_parent_boxes)
+    {
+        ${row_extents}
+
+        return neighbor_source_boxes_count
+            + sep_close_smaller_count
+            + sep_close_bigger_count;
+    }
+    """, strict_undefined=True)
+
+
+MERGED_LISTS_COPY_TEMPLATE = Template(r"""//CL:mako//
+    ${box_id_t} itgt_box = i;
+
+    ${row_extents}
+
+    ${box_id_t} cur_idx = new_neighbor_source_boxes_starts[itgt_box];
+
+    #define COPY_FROM(NAME) \
+        for (${box_id_t} j = 0; j < NAME##_count; ++j) \
+            new_neighbor_source_boxes_lists[cur_idx++] = \
+                NAME##_lists[NAME##_start + j];
+
+    COPY_FROM(neighbor_source_boxes)
+    %if have_close_smaller:
+        COPY_FROM(sep_close_smaller)
+    %endif
+    %if have_close_bigger:
+        COPY_FROM(sep_close_bigger)
+    %endif
+    """, strict_undefined=True)
+
+
+class _MergeCloseListsKernels(Record):
+    pass
+
+
+@memoize
+def _get_merge_close_lists_kernels(context, box_id_dtype,
+        have_close_smaller, have_close_bigger):
+    from pyopencl.tools import dtype_to_ctype, VectorArg, ScalarArg
+    from pyopencl.scan import GenericScanKernel
+    from pyopencl.elementwise import ElementwiseKernel
+
+    box_id_t = dtype_to_ctype(box_id_dtype)
+
+    starts_arg_names = [
+            "target_boxes",
+            "target_or_target_parent_boxes",
+            "neighbor_source_boxes_starts",
+            ]
+    lists_arg_names = ["neighbor_source_boxes_lists"]
+
+    if have_close_smaller:
+        starts_arg_names.append("sep_close_smaller_starts")
+        lists_arg_names.append("sep_close_smaller_lists")
+    if have_close_bigger:
+        starts_arg_names.append("sep_close_bigger_starts")
+        lists_arg_names.append("sep_close_bigger_lists")
+
+    starts_args = (
+            [VectorArg(box_id_dtype, name, with_offset=True)
+                for name in starts_arg_names]
+            + [ScalarArg(box_id_dtype, "ntarget_or_target_parent_boxes")])
+    new_starts_arg = VectorArg(box_id_dtype, "new_neighbor_source_boxes_starts",
+            with_offset=True)
+
+    render_vars = dict(
+            box_id_t=box_id_t,
+            have_close_smaller=have_close_smaller,
+            have_close_bigger=have_close_bigger)
+    row_extents = MERGED_ROW_EXTENTS_TEMPLATE.render(**render_vars)
+
+    starts_scan = GenericScanKernel(
+            context, box_id_dtype,
+            arguments=starts_args + [new_starts_arg],
+            input_expr="get_merged_row_length(i, %s)" % ", ".join(
+                starts_arg_names + ["ntarget_or_target_parent_boxes"]),
+            scan_expr="a+b", neutral="0",
+            output_statement="""
+                if (i == 0)
+                    new_neighbor_source_boxes_starts[0] = 0;
+                new_neighbor_source_boxes_starts[i + 1] = item;
+                """,
+            preamble=MERGED_ROW_LENGTH_TEMPLATE.render(
+                starts_arg_names=starts_arg_names,
+                row_extents=row_extents,
+                **render_vars),
+            name_prefix="merge_close_lists_starts")
+
+    lists_copier = ElementwiseKernel(
+            context,
+            starts_args
+            + [VectorArg(box_id_dtype, name, with_offset=True)
+                for name in lists_arg_names]
+            + [new_starts_arg,
+                VectorArg(box_id_dtype, "new_neighbor_source_boxes_lists",
+                    with_offset=True)],
+            MERGED_LISTS_COPY_TEMPLATE.render(
+                row_extents=row_extents,
+                **render_vars),
+            name="merge_close_lists_copy")
+
+    return _MergeCloseListsKernels(
+            starts_scan=starts_scan,
+            lists_copier=lists_copier)
+
+# }}}
+
+
+# {{{ list 1 schedule
+
+class List1Schedule(DeviceDataRecord):
+    """A grouping of the target boxes of a :class:`FMMTraversalInfo` by the
+    amount of direct-evaluation work each of them incurs through
+    :attr:`FMMTraversalInfo.neighbor_source_boxes_starts` ("list 1"),
+    to help split that work evenly among workers.
+    See :meth:`FMMTraversalInfo.get_list_1_schedule`.
+
+    The work of a target box is the number of its targets times the number
+    of sources in the source boxes of its list 1 row.
+
+    Unless otherwise indicated, all bulk data in this data structure is stored
+    in a :class:`pyopencl.array.Array`. See also :meth:`get`.
+
+    .. attribute:: target_box_work
+
+        ``int64 [ntarget_boxes]``
+
+        The work of each target box. Indexed like
+        :attr:`FMMTraversalInfo.target_boxes`.
+
+    .. attribute:: nbuckets
+
+    .. attribute:: bucket_starts
+
+        ``box_id_t [nbuckets+1]``
+
+        Indices into :attr:`target_box_nrs` at which each bucket starts.
+        Bucket *i* holds the target boxes with work in
+        ``[2**(nbuckets-2-i), 2**(nbuckets-1-i))``, except for the last
+        bucket, which holds the target boxes with no work at all.
+
+    .. attribute:: target_box_nrs
+
+        ``box_id_t [ntarget_boxes]``
+
+        Indices into :attr:`FMMTraversalInfo.target_boxes`, grouped into
+        buckets by decreasing work.
+
+    .. attribute:: work_prefix_sums
+
+        ``int64 [ntarget_boxes+1]``
+
+        Exclusive prefix sums of the work of the target boxes in the order
+        of :attr:`target_box_nrs`. The last entry is the total work.
+
+    .. automethod:: partition
+
+    .. versionadded:: 2016.1
+    """
+
+    def partition(self, nparts):
+        """Split :attr:`target_box_nrs` into *nparts* contiguous ranges of
+        approximately equal work.
+
+        :returns: a :class:`numpy.ndarray` of *nparts+1* indices into
+            :attr:`target_box_nrs` at which the ranges start and end.
+        """
+        work_prefix_sums = self.work_prefix_sums
+        if isinstance(work_prefix_sums, cl.array.Array):
+            work_prefix_sums = work_prefix_sums.get()
+
+        result = np.searchsorted(work_prefix_sums,
+                np.linspace(0, work_prefix_sums[-1], nparts+1))
+        result[0] = 0
+        result[-1] = len(work_prefix_sums) - 1
+
+        return result
+
+
+LIST_1_WORK_TEMPLATE = ElementwiseTemplate(
+    arguments="""//CL//
+        box_id_t *target_boxes,
+        box_id_t *neighbor_source_boxes_starts,
+        box_id_t *neighbor_source_boxes_lists,
+        particle_id_t *box_target_counts_nonchild,
+        particle_id_t *box_source_counts_nonchild,
+        long *target_box_work,
+        int *bucket_keys
+        """,
+    operation="""//CL//
+        long nsources = 0;
+        for (box_id_t j = neighbor_source_boxes_starts[i];
+                j < neighbor_source_boxes_starts[i+1]; ++j)
+            nsources += box_source_counts_nonchild[
+                neighbor_source_boxes_lists[j]];
+
+        long work = box_target_counts_nonchild[target_boxes[i]] * nsources;
+        target_box_work[i] = work;
+
+        // floor(log2(work)) + 1, or zero if there is no work
+        bucket_keys[i] = (work == 0) ? 0 : (int) (64 - clz(work));
+        """,
+    name="list_1_work")
+
+
+@memoize
+def _get_list_1_work_kernel(context, box_id_dtype, particle_id_dtype):
+    return LIST_1_WORK_TEMPLATE.build(
+            context,
+            type_aliases=(
+                ("box_id_t", box_id_dtype),
+                ("particle_id_t", particle_id_dtype),
+                ))
+
+
+@memoize
+def _get_key_value_sorter(context):
+    from pyopencl.algorithm import KeyValueSorter
+    return KeyValueSorter(context)
+
+# }}}
+
+
 # {{{ traversal info (output)
 
 class FMMTraversalInfo(DeviceDataRecord):
@@ -790,6 +1535,14 @@ class FMMTraversalInfo(DeviceDataRecord):
 
         An instance of :class:`boxtree.Tree`.
 
+    .. attribute:: periodic
+
+        *None*, or, for a periodic traversal, a tuple with one :class:`bool`
+        per axis indicating whether the traversal is periodic along that
+        axis. See :ref:`periodic-traversals`.
+
+        .. versionadded:: 2016.1
+
     .. ------------------------------------------------------------------------
     .. rubric:: Basic box lists for iteration
     .. ------------------------------------------------------------------------
@@ -869,6 +1622,14 @@ class FMMTraversalInfo(DeviceDataRecord):
 
         ``box_id_t [*]``
 
+    .. attribute:: colleagues_image_shifts
+
+        An object array of ``int8 [*]``, one per axis, parallel to
+        :attr:`colleagues_lists`, or *None* for non-periodic traversals.
+        See :ref:`periodic-traversals`.
+
+        .. versionadded:: 2016.1
+
     .. ------------------------------------------------------------------------
     .. rubric:: Neighbor Sources ("List 1")
     .. ------------------------------------------------------------------------
@@ -884,6 +1645,14 @@ class FMMTraversalInfo(DeviceDataRecord):
 
         ``box_id_t [*]``
 
+    .. attribute:: neighbor_source_boxes_image_shifts
+
+        An object array of ``int8 [*]``, one per axis, parallel to
+        :attr:`neighbor_source_boxes_lists`, or *None* for non-periodic traversals.
+        See :ref:`periodic-traversals`.
+
+        .. versionadded:: 2016.1
+
     .. ------------------------------------------------------------------------
     .. rubric:: Separated Siblings ("List 2")
     .. ------------------------------------------------------------------------
@@ -899,6 +1668,14 @@ class FMMTraversalInfo(DeviceDataRecord):
 
         ``box_id_t [*]``
 
+    .. attribute:: sep_siblings_image_shifts
+
+        An object array of ``int8 [*]``, one per axis, parallel to
+        :attr:`sep_siblings_lists`, or *None* for non-periodic traversals.
+        See :ref:`periodic-traversals`.
+
+        .. versionadded:: 2016.1
+
     .. ------------------------------------------------------------------------
     .. rubric:: Separated Smaller Boxes ("List 3")
     .. ------------------------------------------------------------------------
@@ -923,7 +1700,15 @@ class FMMTraversalInfo(DeviceDataRecord):
         *starts* has shape/type ``box_id_t [ntargets+1]``. *lists* is of type
         ``box_id_t``.
 
-    .. attribute:: sep_close_smaller_starts
+    .. attribute:: sep_smaller_image_shifts_by_level
+
+        A list with one object array of ``int8 [*]`` per axis for each level,
+        parallel to the *lists* in :attr:`sep_smaller_by_level`, or *None* for
+        non-periodic traversals. See :ref:`periodic-traversals`.
+
+        .. versionadded:: 2016.1
+
+    .. attribute:: sep_close_smaller_starts
 
         ``box_id_t [ntargets+1]`` (or *None*)
 
@@ -954,6 +1739,14 @@ class FMMTraversalInfo(DeviceDataRecord):
 
         ``box_id_t [*]``
 
+    .. attribute:: sep_bigger_image_shifts
+
+        An object array of ``int8 [*]``, one per axis, parallel to
+        :attr:`sep_bigger_lists`, or *None* for non-periodic traversals.
+        See :ref:`periodic-traversals`.
+
+        .. versionadded:: 2016.1
+
     .. attribute:: sep_close_bigger_starts
 
         ``box_id_t [ntarget_or_target_parent_boxes+1]`` (or *None*)
@@ -965,150 +1758,91 @@ class FMMTraversalInfo(DeviceDataRecord):
 
     # {{{ "close" list merging -> "unified list 1"
 
-    def merge_close_lists(self, queue, debug=False):
+    def merge_close_lists(self, queue, debug=False, allocator=None):
         """Return a new :class:`FMMTraversalInfo` instance with the contents of
         :attr:`sep_close_smaller_starts` and :attr:`sep_close_bigger_starts`
         merged into :attr:`neighbor_source_boxes_starts` and these two
         attributes set to *None*.
+
+        The result is cached on *self*, so that repeated calls are cheap.
+        Cached results are rebound to *queue*. Releasing fields of *self*
+        (see :meth:`release`) drops the cached result. If there are no close
+        lists, *self* is returned.
+
+        :arg debug: if *True*, the cache is bypassed, and the lists are
+            merged (and checked) anew.
+        :arg allocator: an allocator for the merged lists, as accepted by
+            :class:`pyopencl.array.Array`. If given, the cache is bypassed,
+            so that the result lives in memory from *allocator*.
+
+        .. versionchanged:: 2016.1
+
+            The result is cached. Added *allocator*.
         """
 
-        from boxtree.tools import reverse_index_array
-        target_or_target_parent_boxes_from_all_boxes = reverse_index_array(
-                self.target_or_target_parent_boxes, target_size=self.tree.nboxes,
-                queue=queue)
-        target_or_target_parent_boxes_from_tgt_boxes = cl.array.take(
-                target_or_target_parent_boxes_from_all_boxes,
-                self.target_boxes, queue=queue)
-
-        del target_or_target_parent_boxes_from_all_boxes
-
-        @memoize_in(self, "merge_close_lists_kernel")
-        def get_new_nb_sources_knl(write_counts):
-            from pyopencl.elementwise import ElementwiseTemplate
-            return ElementwiseTemplate("""//CL:mako//
-                /* input: */
-                box_id_t *target_or_target_parent_boxes_from_tgt_boxes,
-                box_id_t *neighbor_source_boxes_starts,
-                box_id_t *sep_close_smaller_starts,
-                box_id_t *sep_close_bigger_starts,
-
-                %if not write_counts:
-                    box_id_t *neighbor_source_boxes_lists,
-                    box_id_t *sep_close_smaller_lists,
-                    box_id_t *sep_close_bigger_lists,
-
-                    box_id_t *new_neighbor_source_boxes_starts,
-                %endif
-
-                /* output: */
-
-                %if write_counts:
-                    box_id_t *new_neighbor_source_boxes_counts,
-                %else:
-                    box_id_t *new_neighbor_source_boxes_lists,
-                %endif
-                """,
-                """//CL:mako//
-                box_id_t itgt_box = i;
-                box_id_t itarget_or_target_parent_box =
-                    target_or_target_parent_boxes_from_tgt_boxes[itgt_box];
-
-                box_id_t neighbor_source_boxes_start =
-                    neighbor_source_boxes_starts[itgt_box];
-                box_id_t neighbor_source_boxes_count =
-                    neighbor_source_boxes_starts[itgt_box + 1]
-                    - neighbor_source_boxes_start;
-
-                box_id_t sep_close_smaller_start =
-                    sep_close_smaller_starts[itgt_box];
-                box_id_t sep_close_smaller_count =
-                    sep_close_smaller_starts[itgt_box + 1]
-                    - sep_close_smaller_start;
-
-                box_id_t sep_close_bigger_start =
-                    sep_close_bigger_starts[itarget_or_target_parent_box];
-                box_id_t sep_close_bigger_count =
-                    sep_close_bigger_starts[itarget_or_target_parent_box + 1]
-                    - sep_close_bigger_start;
-
-                %if write_counts:
-                    if (itgt_box == 0)
-                        new_neighbor_source_boxes_counts[0] = 0;
-
-                    new_neighbor_source_boxes_counts[itgt_box + 1] =
-                        neighbor_source_boxes_count
-                        + sep_close_smaller_count
-                        + sep_close_bigger_count
-                        ;
-                %else:
-
-                    box_id_t cur_idx = new_neighbor_source_boxes_starts[itgt_box];
-
-                    #define COPY_FROM(NAME) \
-                        for (box_id_t i = 0; i < NAME##_count; ++i) \
-                            new_neighbor_source_boxes_lists[cur_idx++] = \
-                                NAME##_lists[NAME##_start+i];
-
-                    COPY_FROM(neighbor_source_boxes)
-                    COPY_FROM(sep_close_smaller)
-                    COPY_FROM(sep_close_bigger)
-
-                %endif
-                """).build(
-                        queue.context,
-                        type_aliases=(
-                            ("box_id_t", self.tree.box_id_dtype),
-                            ),
-                        var_values=(
-                            ("write_counts", write_counts),
-                            )
-                        )
+        have_close_smaller = self.sep_close_smaller_starts is not None
+        have_close_bigger = self.sep_close_bigger_starts is not None
+
+        if not (have_close_smaller or have_close_bigger):
+            return self
+
+        use_cache = not debug and allocator is None
+
+        if use_cache:
+            try:
+                merged = self.__dict__["_merged_close_lists"]
+            except KeyError:
+                pass
+            else:
+                return merged.with_queue(queue)
+
+        knls = _get_merge_close_lists_kernels(queue.context,
+                self.tree.box_id_dtype, have_close_smaller, have_close_bigger)
+
+        starts_args = [
+                self.target_boxes,
+                self.target_or_target_parent_boxes,
+                self.neighbor_source_boxes_starts,
+                ]
+        lists_args = [self.neighbor_source_boxes_lists]
+
+        if have_close_smaller:
+            starts_args.append(self.sep_close_smaller_starts)
+            lists_args.append(self.sep_close_smaller_lists)
+        if have_close_bigger:
+            starts_args.append(self.sep_close_bigger_starts)
+            lists_args.append(self.sep_close_bigger_lists)
+
+        starts_args.append(self.ntarget_or_target_parent_boxes)
 
         ntarget_boxes = len(self.target_boxes)
-        new_neighbor_source_boxes_counts = cl.array.empty(
-                queue, ntarget_boxes+1, self.tree.box_id_dtype)
-        get_new_nb_sources_knl(True)(
-            # input:
-            target_or_target_parent_boxes_from_tgt_boxes,
-            self.neighbor_source_boxes_starts,
-            self.sep_close_smaller_starts,
-            self.sep_close_bigger_starts,
-
-            # output:
-            new_neighbor_source_boxes_counts,
-            range=slice(ntarget_boxes),
-            queue=queue)
-
-        new_neighbor_source_boxes_starts = cl.array.cumsum(
-                new_neighbor_source_boxes_counts)
-        del new_neighbor_source_boxes_counts
+
+        new_neighbor_source_boxes_starts = cl.array.empty(
+                queue, ntarget_boxes+1, self.tree.box_id_dtype,
+                allocator=allocator)
+        new_neighbor_source_boxes_starts[0:1].fill(0)
+
+        if ntarget_boxes:
+            knls.starts_scan(
+                    *(starts_args + [new_neighbor_source_boxes_starts]),
+                    size=ntarget_boxes, queue=queue)
 
         new_neighbor_source_boxes_lists = cl.array.empty(
                 queue,
                 int(new_neighbor_source_boxes_starts[ntarget_boxes].get()),
-                self.tree.box_id_dtype)
-
-        new_neighbor_source_boxes_lists.fill(999999999)
+                self.tree.box_id_dtype, allocator=allocator)
 
-        get_new_nb_sources_knl(False)(
-            # input:
-            target_or_target_parent_boxes_from_tgt_boxes,
+        if debug:
+            new_neighbor_source_boxes_lists.fill(999999999)
 
-            self.neighbor_source_boxes_starts,
-            self.sep_close_smaller_starts,
-            self.sep_close_bigger_starts,
-            self.neighbor_source_boxes_lists,
-            self.sep_close_smaller_lists,
-            self.sep_close_bigger_lists,
+        if ntarget_boxes:
+            knls.lists_copier(
+                    *(starts_args + lists_args + [
+                        new_neighbor_source_boxes_starts,
+                        new_neighbor_source_boxes_lists]),
+                    range=slice(ntarget_boxes), queue=queue)
 
-            new_neighbor_source_boxes_starts,
-
-            # output:
-            new_neighbor_source_boxes_lists,
-            range=slice(ntarget_boxes),
-            queue=queue)
-
-        return self.copy(
+        result = self.copy(
             neighbor_source_boxes_starts=new_neighbor_source_boxes_starts,
             neighbor_source_boxes_lists=new_neighbor_source_boxes_lists,
             sep_close_smaller_starts=None,
@@ -1116,6 +1850,290 @@ class FMMTraversalInfo(DeviceDataRecord):
             sep_close_bigger_starts=None,
             sep_close_bigger_lists=None)
 
+        if allocator is None:
+            self._merged_close_lists = result
+        return result
+
+    # }}}
+
+    # {{{ releasing and regenerating lists
+
+    def release(self, *field_names):
+        """Drop the data stored in the attributes named by *field_names*
+        to free the memory they occupy. As soon as one of them is accessed
+        again, the released attributes are regenerated. Only the lists
+        holding them are rebuilt, from :attr:`tree`.
+
+        Only traversals created by :class:`FMMTraversalBuilder` (or
+        :class:`boxtree.host_build.HostTraversalBuilder`), and the results
+        of :meth:`get` and :meth:`with_queue` on them, can regenerate their
+        attributes. For all others, e.g. results of :meth:`copy` or
+        :meth:`merge_close_lists`, this raises :exc:`ValueError`.
+
+        .. versionadded:: 2016.1
+        """
+
+        if self.__dict__.get("_regenerate") is None:
+            raise ValueError("this traversal cannot regenerate released "
+                    "fields, so it does not support releasing them")
+
+        released_fields = self.__dict__.setdefault("_released_fields", set())
+
+        # The merged lists hold on to the data of (most of) the fields, so
+        # keeping them would keep that memory from being freed.
+        self.__dict__.pop("_merged_close_lists", None)
+
+        for name in field_names:
+            if name not in self.__class__.fields or name == "tree":
+                raise ValueError("cannot release field '%s'" % name)
+
+            if name in self.__dict__:
+                del self.__dict__[name]
+                released_fields.add(name)
+
+    def _regenerate_released_fields(self):
+        released_fields = self.__dict__["_released_fields"]
+
+        logger.info("traversal: regenerate released fields")
+
+        # Merged lists may still refer to data from before the release.
+        self.__dict__.pop("_merged_close_lists", None)
+
+        regenerate = self.__dict__["_regenerate"]
+        for name, value in regenerate(self, sorted(released_fields)).items():
+            setattr(self, name, value)
+
+        released_fields.clear()
+
+    def __getattr__(self, name):
+        # only called if regular attribute lookup fails
+        if name in self.__dict__.get("_released_fields", ()):
+            self._regenerate_released_fields()
+            return self.__dict__[name]
+
+        raise AttributeError("'%s' object has no attribute '%s'"
+                % (self.__class__.__name__, name))
+
+    def _transform_arrays(self, f, exclude_fields=frozenset()):
+        result = super(FMMTraversalInfo, self)._transform_arrays(
+                f, exclude_fields=exclude_fields)
+
+        # The regenerator rebuilds lists to match the traversal's tree, on
+        # the host or on the device.
+        regenerate = self.__dict__.get("_regenerate")
+        if regenerate is not None:
+            result._regenerate = regenerate
+
+        return result
+
+    # }}}
+
+    # {{{ list 1 schedule
+
+    def get_list_1_schedule(self, queue):
+        """Group the target boxes by the work they incur in "list 1",
+        heaviest first, so that direct evaluation can be split evenly among
+        workers. To have "close" interactions included, call this on the
+        result of :meth:`merge_close_lists`.
+
+        :returns: a :class:`List1Schedule`.
+
+        .. versionadded:: 2016.1
+        """
+
+        tree = self.tree
+        ntarget_boxes = len(self.target_boxes)
+
+        target_box_work = cl.array.empty(queue, ntarget_boxes, np.int64)
+        bucket_keys = cl.array.empty(queue, ntarget_boxes, np.int32)
+
+        if ntarget_boxes:
+            knl = _get_list_1_work_kernel(queue.context,
+                    tree.box_id_dtype, tree.particle_id_dtype)
+            knl(self.target_boxes,
+                    self.neighbor_source_boxes_starts,
+                    self.neighbor_source_boxes_lists,
+                    tree.box_target_counts_nonchild,
+                    tree.box_source_counts_nonchild,
+                    target_box_work, bucket_keys,
+                    range=slice(ntarget_boxes), queue=queue)
+
+            nbuckets = int(cl.array.max(bucket_keys, queue=queue).get()) + 1
+        else:
+            nbuckets = 1
+
+        # sort heaviest buckets first
+        bucket_keys = (nbuckets - 1) - bucket_keys
+
+        bucket_starts, target_box_nrs, _ = _get_key_value_sorter(
+                queue.context)(
+                        queue, bucket_keys,
+                        cl.array.arange(queue, ntarget_boxes,
+                            dtype=tree.box_id_dtype),
+                        nbuckets, starts_dtype=tree.box_id_dtype)
+
+        work_prefix_sums = cl.array.zeros(queue, ntarget_boxes+1, np.int64)
+        if ntarget_boxes:
+            work_prefix_sums[1:] = cl.array.cumsum(
+                    cl.array.take(target_box_work, target_box_nrs, queue=queue))
+
+        return List1Schedule(
+                target_box_work=target_box_work,
+                nbuckets=nbuckets,
+                bucket_starts=bucket_starts,
+                target_box_nrs=target_box_nrs,
+                work_prefix_sums=work_prefix_sums).with_queue(None)
+
+    # }}}
+
+    # {{{ statistics
+
+    def _get_list_statistics(self, queue, name, starts, lists, level_starts):
+        nlevels = self.tree.nlevels
+        nrows = len(starts) - 1
+        level_starts = np.asarray(level_starts, dtype=self.tree.box_id_dtype)
+
+        level_starts_dev = cl.array.to_device(queue, level_starts)
+        level_nentries = np.diff(
+                cl.array.take(starts, level_starts_dev, queue=queue).get())
+
+        level_max_row_length = cl.array.zeros(queue, nlevels, np.int32)
+        if nrows:
+            knl = _get_level_max_row_length_kernel(
+                    queue.context, self.tree.box_id_dtype)
+            knl(starts, level_starts_dev, nlevels+1, level_max_row_length,
+                    range=slice(nrows), queue=queue)
+
+        level_max_row_length = level_max_row_length.get()
+        nentries = int(np.sum(level_nentries))
+
+        return InteractionListStatistics(
+                name=name,
+                nrows=nrows,
+                nentries=nentries,
+                max_row_length=int(level_max_row_length.max()),
+                mean_row_length=nentries / nrows if nrows else 0.,
+                nbytes=starts.nbytes + lists.nbytes,
+                level_nentries=level_nentries,
+                level_max_row_length=level_max_row_length)
+
+    def _get_interaction_cost(self, queue, boxes, starts, lists,
+            weigh_by_targets, weigh_by_sources):
+        if not len(boxes):
+            return 0.
+
+        tree = self.tree
+        knl = _get_interaction_cost_kernel(queue.context,
+                tree.box_id_dtype, tree.particle_id_dtype,
+                weigh_by_targets, weigh_by_sources)
+
+        return float(knl(boxes, starts, lists,
+                tree.box_target_counts_nonchild,
+                tree.box_source_counts_nonchild,
+                range=slice(len(boxes)), queue=queue).get())
+
+    def get_statistics(self, queue, nterms=10):
+        """Compute the sizes of the interaction lists in this traversal
+        and estimate the cost of an FMM using it.
+
+        All per-row work is done on the device. Only per-level summaries
+        are transferred to the host.
+
+        :arg nterms: The expansion order assumed in the cost estimate.
+            The number of coefficients per expansion is taken to be that
+            of the Helmholtz expansions in :mod:`boxtree.pyfmmlib_integration`.
+        :returns: A :class:`TraversalStatistics` instance.
+
+        .. versionadded:: 2016.1
+        """
+
+        tree = self.tree
+
+        target_level_starts = self.level_start_target_box_nrs
+        totp_level_starts = self.level_start_target_or_target_parent_box_nrs
+
+        # (name, starts, lists, level starts, row boxes, FMM stage)
+        list_info = [
+                ("colleagues", self.colleagues_starts, self.colleagues_lists,
+                    tree.level_start_box_nrs, None, None),
+                ("neighbor_source_boxes", self.neighbor_source_boxes_starts,
+                    self.neighbor_source_boxes_lists, target_level_starts,
+                    self.target_boxes, "eval_direct"),
+                ("sep_siblings", self.sep_siblings_starts,
+                    self.sep_siblings_lists, totp_level_starts,
+                    self.target_or_target_parent_boxes, "multipole_to_local"),
+                ]
+
+        for ilevel, sep_smaller in enumerate(self.sep_smaller_by_level):
+            list_info.append(
+                    ("sep_smaller_by_level[%d]" % ilevel, sep_smaller.starts,
+                        sep_smaller.lists, target_level_starts,
+                        self.target_boxes, "eval_multipoles"))
+
+        if self.sep_close_smaller_starts is not None:
+            list_info.append(
+                    ("sep_close_smaller", self.sep_close_smaller_starts,
+                        self.sep_close_smaller_lists, target_level_starts,
+                        self.target_boxes, "eval_direct"))
+
+        list_info.append(
+                ("sep_bigger", self.sep_bigger_starts, self.sep_bigger_lists,
+                    totp_level_starts, self.target_or_target_parent_boxes,
+                    "form_locals"))
+
+        if self.sep_close_bigger_starts is not None:
+            list_info.append(
+                    ("sep_close_bigger", self.sep_close_bigger_starts,
+                        self.sep_close_bigger_lists, totp_level_starts,
+                        self.target_or_target_parent_boxes, "eval_direct"))
+
+        list_stats = [
+                self._get_list_statistics(queue, name, starts, lists,
+                    level_starts)
+                for name, starts, lists, level_starts, _, _ in list_info]
+
+        # {{{ cost estimate
+
+        ncoeffs = _get_expansion_size(tree.dimensions, nterms)
+
+        # stage -> (weigh by targets, weigh by sources, cost per interaction)
+        list_stage_weights = {
+                "eval_direct": (True, True, 1),
+                "multipole_to_local": (False, False, ncoeffs**2),
+                "eval_multipoles": (True, False, ncoeffs),
+                "form_locals": (False, True, ncoeffs),
+                }
+
+        estimated_cost = {
+                "form_multipoles": tree.nsources * ncoeffs,
+                "coarsen_multipoles": (
+                    len(self.source_boxes) + len(self.source_parent_boxes))
+                * ncoeffs**2,
+                "refine_locals": (
+                    self.ntarget_or_target_parent_boxes * ncoeffs**2),
+                "eval_locals": tree.ntargets * ncoeffs,
+                }
+
+        for stage in list_stage_weights:
+            estimated_cost[stage] = 0
+
+        for _, starts, lists, _, boxes, stage in list_info:
+            if stage is None:
+                continue
+
+            weigh_by_targets, weigh_by_sources, weight = \
+                    list_stage_weights[stage]
+            estimated_cost[stage] += weight * self._get_interaction_cost(
+                    queue, boxes, starts, lists,
+                    weigh_by_targets, weigh_by_sources)
+
+        # }}}
+
+        return TraversalStatistics(
+                lists=list_stats,
+                nbytes=sum(lstats.nbytes for lstats in list_stats),
+                estimated_cost=estimated_cost)
+
     # }}}
 
     # {{{ debugging aids
@@ -1135,6 +2153,97 @@ class FMMTraversalInfo(DeviceDataRecord):
 # }}}
 
 
+# {{{ dual tree traversal info (output)
+
+class DualTreeTraversalInfo(DeviceDataRecord):
+    """Interaction lists resulting from a dual tree traversal with a
+    multipole acceptance criterion.
+
+    A pair of a target box and a source box is accepted as well-separated if
+    the balls circumscribing the two boxes, scaled by :math:`1/\\theta`,
+    do not overlap. Starting from the pair (root, root), pairs that are not
+    accepted are refined by splitting the bigger of the two boxes (the target
+    box if both are of equal size). Pairs of leaves that are not accepted
+    are interacted directly. As in :func:`boxtree.fmm.drive_fmm`, no
+    multipole expansions of boxes on levels 0 and 1 are needed, i.e. pairs
+    with such source boxes are never accepted.
+
+    This is consumed by :func:`boxtree.fmm.drive_dual_tree_fmm`.
+
+    Unless otherwise indicated, all bulk data in this data structure is stored
+    in a :class:`pyopencl.array.Array`. See also :meth:`get`.
+
+    .. attribute:: tree
+
+        An instance of :class:`boxtree.Tree`.
+
+    .. attribute:: theta
+
+        The opening angle used in the multipole acceptance criterion.
+
+    .. ------------------------------------------------------------------------
+    .. rubric:: Basic box lists for iteration
+    .. ------------------------------------------------------------------------
+
+    .. attribute:: source_boxes
+    .. attribute:: target_boxes
+    .. attribute:: source_parent_boxes
+    .. attribute:: target_or_target_parent_boxes
+    .. attribute:: level_start_source_box_nrs
+    .. attribute:: level_start_target_box_nrs
+    .. attribute:: level_start_source_parent_box_nrs
+    .. attribute:: level_start_target_or_target_parent_box_nrs
+
+        All as in :class:`FMMTraversalInfo`.
+
+    .. ------------------------------------------------------------------------
+    .. rubric:: Near sources
+    .. ------------------------------------------------------------------------
+
+    Source leaves that interact directly with each target leaf.  Indexed like
+    :attr:`target_or_target_parent_boxes`, with empty entries for boxes
+    that have children. See :ref:`csr`.
+
+    .. attribute:: near_source_boxes_starts
+
+        ``box_id_t [ntarget_or_target_parent_boxes+1]``
+
+    .. attribute:: near_source_boxes_lists
+
+        ``box_id_t [*]``
+
+    .. ------------------------------------------------------------------------
+    .. rubric:: Far sources
+    .. ------------------------------------------------------------------------
+
+    Source boxes (on any level) whose multipole expansions get translated
+    into the local expansion of each target box. Indexed like
+    :attr:`target_or_target_parent_boxes`. See :ref:`csr`.
+
+    .. attribute:: far_source_boxes_starts
+
+        ``box_id_t [ntarget_or_target_parent_boxes+1]``
+
+    .. attribute:: far_source_boxes_lists
+
+        ``box_id_t [*]``
+
+    .. versionadded:: 2016.1
+    """
+
+    def get_box_list(self, what, index):
+        starts = getattr(self, what+"_starts")
+        lists = getattr(self, what+"_lists")
+        start, stop = starts[index:index+2]
+        return lists[start:stop]
+
+    @property
+    def ntarget_or_target_parent_boxes(self):
+        return len(self.target_or_target_parent_boxes)
+
+# }}}
+
+
 class _KernelInfo(Record):
     pass
 
@@ -1145,19 +2254,14 @@ class FMMTraversalBuilder:
 
     # {{{ kernel builder
 
-    @memoize_method
-    def get_kernel_info(self, dimensions, particle_id_dtype, box_id_dtype,
-            coord_dtype, box_level_dtype, max_levels,
-            sources_are_targets, sources_have_extent, targets_have_extent,
-            stick_out_factor):
-
-        logger.info("traversal build kernels: start build")
-
-        debug = False
-
+    @staticmethod
+    def get_render_vars(dimensions, particle_id_dtype, box_id_dtype,
+            coord_dtype, max_levels, sources_are_targets, sources_have_extent,
+            targets_have_extent, stick_out_factor, debug=False,
+            periodic_axes=()):
         from pyopencl.tools import dtype_to_ctype
         from boxtree.tree import box_flags_enum
-        render_vars = dict(
+        return dict(
                 dimensions=dimensions,
                 dtype_to_ctype=dtype_to_ctype,
                 particle_id_dtype=particle_id_dtype,
@@ -1172,9 +2276,25 @@ class FMMTraversalBuilder:
                 sources_have_extent=sources_have_extent,
                 targets_have_extent=targets_have_extent,
                 stick_out_factor=stick_out_factor,
+                periodic_axes=periodic_axes,
                 )
+
+    @memoize_method
+    def get_box_list_kernel_info(self, dimensions, particle_id_dtype,
+            box_id_dtype, coord_dtype, box_level_dtype, max_levels,
+            sources_are_targets, sources_have_extent, targets_have_extent,
+            stick_out_factor):
+
+        debug = False
+
+        from boxtree.tree import box_flags_enum
+        render_vars = self.get_render_vars(dimensions, particle_id_dtype,
+                box_id_dtype, coord_dtype, max_levels, sources_are_targets,
+                sources_have_extent, targets_have_extent, stick_out_factor,
+                debug=debug)
+
         from pyopencl.algorithm import ListOfListsBuilder
-        from pyopencl.tools import VectorArg, ScalarArg
+        from pyopencl.tools import VectorArg
 
         result = {}
 
@@ -1212,6 +2332,33 @@ class FMMTraversalBuilder:
 
         # }}}
 
+        return _KernelInfo(**result)
+
+    @memoize_method
+    def get_kernel_info(self, dimensions, particle_id_dtype, box_id_dtype,
+            coord_dtype, box_level_dtype, max_levels,
+            sources_are_targets, sources_have_extent, targets_have_extent,
+            stick_out_factor, periodic_axes=()):
+
+        logger.info("traversal build kernels: start build")
+
+        debug = False
+
+        from boxtree.tree import box_flags_enum
+        render_vars = self.get_render_vars(dimensions, particle_id_dtype,
+                box_id_dtype, coord_dtype, max_levels, sources_are_targets,
+                sources_have_extent, targets_have_extent, stick_out_factor,
+                debug=debug, periodic_axes=periodic_axes)
+
+        from pyopencl.algorithm import ListOfListsBuilder
+        from pyopencl.tools import VectorArg, ScalarArg
+
+        result = self.get_box_list_kernel_info(
+                dimensions, particle_id_dtype, box_id_dtype,
+                coord_dtype, box_level_dtype, max_levels,
+                sources_are_targets, sources_have_extent, targets_have_extent,
+                stick_out_factor).get_copy_kwargs()
+
         # {{{ build list N builders
 
         base_args = [
@@ -1223,6 +2370,10 @@ class FMMTraversalBuilder:
                 VectorArg(box_flags_enum.dtype, "box_flags"),
                 ]
 
+        colleague_image_shift_args = [
+                VectorArg(np.int8, "colleagues_image_shifts_" + ax)
+                for ax in periodic_axes]
+
         for list_name, template, extra_args, extra_lists in [
                 ("colleagues", COLLEAGUES_TEMPLATE, [], []),
                 ("neighbor_source_boxes", NEIGBHOR_SOURCE_BOXES_TEMPLATE,
@@ -1235,14 +2386,14 @@ class FMMTraversalBuilder:
                             VectorArg(box_id_dtype, "box_parent_ids"),
                             VectorArg(box_id_dtype, "colleagues_starts"),
                             VectorArg(box_id_dtype, "colleagues_list"),
-                            ], []),
+                            ] + colleague_image_shift_args, []),
                 ("sep_smaller", SEP_SMALLER_TEMPLATE,
                         [
                             VectorArg(box_id_dtype, "target_boxes"),
                             VectorArg(box_id_dtype, "colleagues_starts"),
                             VectorArg(box_id_dtype, "colleagues_list"),
                             ScalarArg(box_id_dtype, "sep_smaller_source_level"),
-                            ],
+                            ] + colleague_image_shift_args,
                             ["sep_close_smaller"]
                             if sources_have_extent or targets_have_extent
                             else []),
@@ -1253,7 +2404,7 @@ class FMMTraversalBuilder:
                             VectorArg(box_id_dtype, "colleagues_starts"),
                             VectorArg(box_id_dtype, "colleagues_list"),
                             #ScalarArg(box_id_dtype, "sep_bigger_source_level"),
-                            ],
+                            ] + colleague_image_shift_args,
                             ["sep_close_bigger"]
                             if sources_have_extent or targets_have_extent
                             else []),
@@ -1261,16 +2412,23 @@ class FMMTraversalBuilder:
             src = Template(
                     TRAVERSAL_PREAMBLE_TEMPLATE
                     + HELPER_FUNCTION_TEMPLATE
+                    + PERIODIC_IMAGE_MAKO_DEFS
                     + template,
                     strict_undefined=True).render(**render_vars)
 
+            image_shift_lists = [
+                    list_name + "_image_shifts_" + ax for ax in periodic_axes]
+
             result[list_name+"_builder"] = ListOfListsBuilder(self.context,
                     [(list_name, box_id_dtype)]
                     + [(extra_list_name, box_id_dtype)
-                        for extra_list_name in extra_lists],
+                        for extra_list_name in extra_lists]
+                    + [(name, np.int8) for name in image_shift_lists],
                     str(src),
                     arg_decls=base_args + extra_args,
                     debug=debug, name_prefix=list_name,
+                    count_sharing=dict(
+                        (name, list_name) for name in image_shift_lists),
                     complex_kernel=True)
 
         # }}}
@@ -1281,29 +2439,27 @@ class FMMTraversalBuilder:
 
     # }}}
 
-    # {{{ driver
+    # {{{ box lists
 
-    def __call__(self, queue, tree, wait_for=None, debug=False):
-        """
-        :arg queue: A :class:`pyopencl.CommandQueue` instance.
-        :arg tree: A :class:`boxtree.Tree` instance.
-        :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
-            instances for whose completion this command waits before starting
-            exeuction.
-        :return: A tuple *(trav, event)*, where *trav* is a new instance of
-            :class:`FMMTraversalInfo` and *event* is a :class:`pyopencl.Event`
-            for dependency management.
-        """
+    def build_box_lists(self, queue, tree, wait_for=None, debug=False,
+            allocator=None):
+        """Find the lists of source boxes, target boxes and their parents,
+        along with their level starts.
 
-        if not tree._is_pruned:
-            raise ValueError("tree must be pruned for traversal generation")
+        :arg allocator: an allocator for the box lists, as accepted by
+            :class:`pyopencl.array.Array`.
+
+        :returns: a tuple *(box_lists, wait_for)*, where *box_lists* is a
+            :class:`dict` mapping the names of the box list attributes of
+            :class:`FMMTraversalInfo` (such as *source_boxes* and
+            *level_start_source_box_nrs*) to their values, and *wait_for*
+            is a list of :class:`pyopencl.Event` instances.
+        """
 
-        # Generated code shouldn't depend on the *exact* number of tree levels.
-        # So round up to the next multiple of 5.
         from pytools import div_ceil
         max_levels = div_ceil(tree.nlevels, 5) * 5
 
-        knl_info = self.get_kernel_info(
+        knl_info = self.get_box_list_kernel_info(
                 tree.dimensions, tree.particle_id_dtype, tree.box_id_dtype,
                 tree.coord_dtype, tree.box_level_dtype, max_levels,
                 tree.sources_are_targets,
@@ -1316,14 +2472,13 @@ class FMMTraversalBuilder:
 
             logger.debug(s)
 
-        logger.info("start building traversal")
-
         # {{{ source boxes, their parents, and target boxes
 
         fin_debug("building list of source boxes, their parents, and target boxes")
 
         result, evt = knl_info.sources_parents_and_targets_builder(
-                queue, tree.nboxes, tree.box_flags.data, wait_for=wait_for)
+                queue, tree.nboxes, tree.box_flags.data, wait_for=wait_for,
+                allocator=allocator)
         wait_for = [evt]
 
         source_parent_boxes = result["source_parent_boxes"].lists
@@ -1341,7 +2496,7 @@ class FMMTraversalBuilder:
 
         def extract_level_start_box_nrs(box_list, wait_for):
             result = cl.array.empty(queue,
-                    tree.nlevels+1, tree.box_id_dtype) \
+                    tree.nlevels+1, tree.box_id_dtype, allocator=allocator) \
                             .fill(len(box_list))
             evt = knl_info.level_start_box_nrs_extractor(
                     tree.level_start_box_nrs_dev,
@@ -1385,156 +2540,520 @@ class FMMTraversalBuilder:
 
         # }}}
 
-        # {{{ colleagues
+        return dict(
+                source_boxes=source_boxes,
+                target_boxes=target_boxes,
 
-        fin_debug("finding colleagues")
+                level_start_source_box_nrs=level_start_source_box_nrs,
+                level_start_target_box_nrs=level_start_target_box_nrs,
 
-        result, evt = knl_info.colleagues_builder(
-                queue, tree.nboxes,
-                tree.box_centers.data, tree.root_extent, tree.box_levels.data,
-                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags.data,
-                wait_for=wait_for)
-        wait_for = [evt]
-        colleagues = result["colleagues"]
+                source_parent_boxes=source_parent_boxes,
+                level_start_source_parent_box_nrs=level_start_source_parent_box_nrs,
 
-        # }}}
+                target_or_target_parent_boxes=target_or_target_parent_boxes,
+                level_start_target_or_target_parent_box_nrs=(
+                    level_start_target_or_target_parent_box_nrs),
+                ), wait_for
 
-        # {{{ neighbor source boxes ("list 1")
+    # }}}
 
-        fin_debug("finding neighbor source boxes ('list 1')")
+    # {{{ driver
 
-        result, evt = knl_info.neighbor_source_boxes_builder(
-                queue, len(target_boxes),
-                tree.box_centers.data, tree.root_extent, tree.box_levels.data,
-                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags.data,
-                target_boxes.data, wait_for=wait_for)
+    def _build_lists(self, queue, tree, periodic, list_names=None,
+            wait_for=None, debug=False, allocator=None):
+        """Build the box lists and those interaction lists named in
+        *list_names* (keys of :data:`_LIST_FIELDS`, all if *None*).
 
-        wait_for = [evt]
-        neighbor_source_boxes = result["neighbor_source_boxes"]
+        :returns: a tuple *(fields, event)*, where *fields* is a
+            :class:`dict` of :class:`FMMTraversalInfo` fields.
+        """
+        if list_names is None:
+            list_names = frozenset(_LIST_FIELDS)
 
-        # }}}
+        periodic_axes = ()
+        if periodic is not None:
+            periodic_axes = tuple(ax
+                    for ax, is_periodic in zip(AXIS_NAMES, periodic)
+                    if is_periodic)
 
-        # {{{ well-separated siblings ("list 2")
+        # Generated code shouldn't depend on the *exact* number of tree levels.
+        # So round up to the next multiple of 5.
+        from pytools import div_ceil
+        max_levels = div_ceil(tree.nlevels, 5) * 5
 
-        fin_debug("finding well-separated siblings ('list 2')")
+        knl_info = self.get_kernel_info(
+                tree.dimensions, tree.particle_id_dtype, tree.box_id_dtype,
+                tree.coord_dtype, tree.box_level_dtype, max_levels,
+                tree.sources_are_targets,
+                tree.sources_have_extent, tree.targets_have_extent,
+                tree.stick_out_factor, periodic_axes)
 
-        result, evt = knl_info.sep_siblings_builder(
-                queue, len(target_or_target_parent_boxes),
-                tree.box_centers.data, tree.root_extent, tree.box_levels.data,
-                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags.data,
-                target_or_target_parent_boxes.data, tree.box_parent_ids.data,
-                colleagues.starts.data, colleagues.lists.data, wait_for=wait_for)
-        wait_for = [evt]
-        sep_siblings = result["sep_siblings"]
+        def fin_debug(s):
+            if debug:
+                queue.finish()
 
-        # }}}
+            logger.debug(s)
 
-        with_extent = tree.sources_have_extent or tree.targets_have_extent
+        def get_image_shifts(result, list_name):
+            if periodic is None:
+                return None
 
-        # {{{ separated smaller ("list 3")
+            from pytools.obj_array import make_obj_array
+            return make_obj_array([
+                result[list_name + "_image_shifts_" + ax].lists
+                if ax in periodic_axes
+                else cl.array.zeros(
+                    queue, result[list_name].count, np.int8,
+                    allocator=allocator)
+                for ax in AXIS_NAMES[:tree.dimensions]])
 
-        fin_debug("finding separated smaller ('list 3')")
+        fields, wait_for = self.build_box_lists(queue, tree,
+                wait_for=wait_for, debug=debug, allocator=allocator)
 
-        sep_smaller_base_args = (
-                queue, len(target_boxes),
-                tree.box_centers.data, tree.root_extent, tree.box_levels.data,
-                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags.data,
-                target_boxes.data,
-                colleagues.starts.data, colleagues.lists.data)
+        target_boxes = fields["target_boxes"]
+        target_or_target_parent_boxes = \
+                fields["target_or_target_parent_boxes"]
 
-        wait_for = []
-        sep_smaller_by_level = []
+        # {{{ colleagues
 
-        for ilevel in range(tree.nlevels):
-            fin_debug("finding separated smaller ('list 3 level %d')" % ilevel)
+        # Lists 2, 3 and 4 are found among the colleagues.
+        if list_names & frozenset(
+                ["colleagues", "sep_siblings", "sep_smaller", "sep_bigger"]):
+            fin_debug("finding colleagues")
+
+            result, evt = knl_info.colleagues_builder(
+                    queue, tree.nboxes,
+                    tree.box_centers.data, tree.root_extent,
+                    tree.box_levels.data, tree.aligned_nboxes,
+                    tree.box_child_ids.data, tree.box_flags.data,
+                    wait_for=wait_for, allocator=allocator)
+            wait_for = [evt]
+            colleagues = result["colleagues"]
+
+            colleague_image_shift_args = tuple(
+                    result["colleagues_image_shifts_" + ax].lists.data
+                    for ax in periodic_axes)
+
+            if "colleagues" in list_names:
+                fields.update(
+                        colleagues_starts=colleagues.starts,
+                        colleagues_lists=colleagues.lists,
+                        colleagues_image_shifts=get_image_shifts(
+                            result, "colleagues"))
 
-            result, evt = knl_info.sep_smaller_builder(
-                    *(sep_smaller_base_args + (ilevel,)),
-                    omit_lists=("sep_close_smaller",) if with_extent else (),
-                    wait_for=wait_for)
+        # }}}
 
-            sep_smaller_by_level.append(result["sep_smaller"])
-            wait_for.append(evt)
+        # {{{ neighbor source boxes ("list 1")
 
-        if with_extent:
-            fin_debug("finding separated smaller close ('list 3 close')")
-            result, evt = knl_info.sep_smaller_builder(
-                    *(sep_smaller_base_args + (-1,)),
-                    omit_lists=("sep_smaller",),
-                    wait_for=wait_for)
-            sep_close_smaller_starts = result["sep_close_smaller"].starts
-            sep_close_smaller_lists = result["sep_close_smaller"].lists
+        if "neighbor_source_boxes" in list_names:
+            fin_debug("finding neighbor source boxes ('list 1')")
+
+            result, evt = knl_info.neighbor_source_boxes_builder(
+                    queue, len(target_boxes),
+                    tree.box_centers.data, tree.root_extent,
+                    tree.box_levels.data, tree.aligned_nboxes,
+                    tree.box_child_ids.data, tree.box_flags.data,
+                    target_boxes, wait_for=wait_for, allocator=allocator)
+
+            wait_for = [evt]
+            fields.update(
+                    neighbor_source_boxes_starts=(
+                        result["neighbor_source_boxes"].starts),
+                    neighbor_source_boxes_lists=(
+                        result["neighbor_source_boxes"].lists),
+                    neighbor_source_boxes_image_shifts=get_image_shifts(
+                        result, "neighbor_source_boxes"))
 
-            wait_for.append(evt)
-        else:
-            sep_close_smaller_starts = None
-            sep_close_smaller_lists = None
+        # }}}
+
+        # {{{ well-separated siblings ("list 2")
+
+        if "sep_siblings" in list_names:
+            fin_debug("finding well-separated siblings ('list 2')")
+
+            result, evt = knl_info.sep_siblings_builder(
+                    queue, len(target_or_target_parent_boxes),
+                    tree.box_centers.data, tree.root_extent,
+                    tree.box_levels.data, tree.aligned_nboxes,
+                    tree.box_child_ids.data, tree.box_flags.data,
+                    target_or_target_parent_boxes, tree.box_parent_ids.data,
+                    colleagues.starts, colleagues.lists,
+                    *colleague_image_shift_args, wait_for=wait_for,
+                    allocator=allocator)
+            wait_for = [evt]
+            fields.update(
+                    sep_siblings_starts=result["sep_siblings"].starts,
+                    sep_siblings_lists=result["sep_siblings"].lists,
+                    sep_siblings_image_shifts=get_image_shifts(
+                        result, "sep_siblings"))
+
+        # }}}
+
+        with_extent = tree.sources_have_extent or tree.targets_have_extent
+
+        # {{{ separated smaller ("list 3")
+
+        if "sep_smaller" in list_names:
+            fin_debug("finding separated smaller ('list 3')")
+
+            sep_smaller_base_args = (
+                    queue, len(target_boxes),
+                    tree.box_centers.data, tree.root_extent,
+                    tree.box_levels.data, tree.aligned_nboxes,
+                    tree.box_child_ids.data, tree.box_flags.data,
+                    target_boxes,
+                    colleagues.starts, colleagues.lists)
+
+            level_wait_for = wait_for
+            wait_for = []
+            sep_smaller_by_level = []
+            sep_smaller_image_shifts_by_level = []
+
+            for ilevel in range(tree.nlevels):
+                fin_debug("finding separated smaller ('list 3 level %d')"
+                        % ilevel)
+
+                result, evt = knl_info.sep_smaller_builder(
+                        *(sep_smaller_base_args + (ilevel,)
+                            + colleague_image_shift_args),
+                        omit_lists=(
+                            ("sep_close_smaller",) if with_extent else ()),
+                        wait_for=level_wait_for, allocator=allocator)
+
+                sep_smaller_by_level.append(result["sep_smaller"])
+                sep_smaller_image_shifts_by_level.append(
+                        get_image_shifts(result, "sep_smaller"))
+                wait_for.append(evt)
+
+            if periodic is None:
+                sep_smaller_image_shifts_by_level = None
+
+            if with_extent:
+                fin_debug("finding separated smaller close ('list 3 close')")
+                result, evt = knl_info.sep_smaller_builder(
+                        *(sep_smaller_base_args + (-1,)),
+                        omit_lists=("sep_smaller",),
+                        wait_for=level_wait_for, allocator=allocator)
+                sep_close_smaller_starts = result["sep_close_smaller"].starts
+                sep_close_smaller_lists = result["sep_close_smaller"].lists
+
+                wait_for.append(evt)
+            else:
+                sep_close_smaller_starts = None
+                sep_close_smaller_lists = None
+
+            fields.update(
+                    sep_smaller_by_level=sep_smaller_by_level,
+                    sep_smaller_image_shifts_by_level=(
+                        sep_smaller_image_shifts_by_level),
+                    sep_close_smaller_starts=sep_close_smaller_starts,
+                    sep_close_smaller_lists=sep_close_smaller_lists)
 
         # }}}
 
         # {{{ separated bigger ("list 4")
 
-        fin_debug("finding separated bigger ('list 4')")
+        if "sep_bigger" in list_names:
+            fin_debug("finding separated bigger ('list 4')")
+
+            result, evt = knl_info.sep_bigger_builder(
+                    queue, len(target_or_target_parent_boxes),
+                    tree.box_centers.data, tree.root_extent,
+                    tree.box_levels.data, tree.aligned_nboxes,
+                    tree.box_child_ids.data, tree.box_flags.data,
+                    target_or_target_parent_boxes, tree.box_parent_ids.data,
+                    colleagues.starts, colleagues.lists,
+                    *colleague_image_shift_args, wait_for=wait_for,
+                    allocator=allocator)
+            wait_for = [evt]
+
+            if with_extent:
+                sep_close_bigger_starts = result["sep_close_bigger"].starts
+                sep_close_bigger_lists = result["sep_close_bigger"].lists
+            else:
+                sep_close_bigger_starts = None
+                sep_close_bigger_lists = None
+
+            fields.update(
+                    sep_bigger_starts=result["sep_bigger"].starts,
+                    sep_bigger_lists=result["sep_bigger"].lists,
+                    sep_bigger_image_shifts=get_image_shifts(
+                        result, "sep_bigger"),
+                    sep_close_bigger_starts=sep_close_bigger_starts,
+                    sep_close_bigger_lists=sep_close_bigger_lists)
 
-        result, evt = knl_info.sep_bigger_builder(
-                queue, len(target_or_target_parent_boxes),
-                tree.box_centers.data, tree.root_extent, tree.box_levels.data,
-                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags.data,
-                target_or_target_parent_boxes.data, tree.box_parent_ids.data,
-                colleagues.starts.data, colleagues.lists.data, wait_for=wait_for)
-        wait_for = [evt]
-        sep_bigger = result["sep_bigger"]
+        # }}}
 
-        if with_extent:
-            sep_close_bigger_starts = result["sep_close_bigger"].starts
-            sep_close_bigger_lists = result["sep_close_bigger"].lists
+        if len(wait_for) == 1:
+            evt, = wait_for
         else:
-            sep_close_bigger_starts = None
-            sep_close_bigger_lists = None
+            evt = cl.enqueue_marker(queue, wait_for=wait_for)
 
-        # }}}
+        return fields, evt
+
+    def __call__(self, queue, tree, wait_for=None, debug=False,
+            allocator=None, periodic=False):
+        """
+        :arg queue: A :class:`pyopencl.CommandQueue` instance.
+        :arg tree: A :class:`boxtree.Tree` instance.
+        :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
+            instances for whose completion this command waits before starting
+            exeuction.
+        :arg allocator: an allocator for all arrays of the traversal, as
+            accepted by :class:`pyopencl.array.Array`, e.g. a
+            :class:`pyopencl.tools.MemoryPool`.
+        :arg periodic: either a :class:`bool`, or a sequence of one
+            :class:`bool` per axis. Along periodic axes, the root box of
+            *tree* is taken to be the periodic cell (see the *bbox* argument
+            of :class:`boxtree.TreeBuilder`), and the interaction lists
+            include boxes in the neighboring periodic images of the tree.
+            See :ref:`periodic-traversals`. Periodic traversals of trees
+            whose sources or targets have extent are not supported, and
+            raise :exc:`ValueError`.
+        :return: A tuple *(trav, event)*, where *trav* is a new instance of
+            :class:`FMMTraversalInfo` and *event* is a :class:`pyopencl.Event`
+            for dependency management.
+
+        .. versionchanged:: 2016.1
+
+            Added *allocator* and *periodic*.
+        """
+
+        if not tree._is_pruned:
+            raise ValueError("tree must be pruned for traversal generation")
+
+        if isinstance(periodic, bool):
+            periodic = (periodic,) * tree.dimensions
+        periodic = tuple(bool(is_periodic) for is_periodic in periodic)
+        if len(periodic) != tree.dimensions:
+            raise ValueError("periodic must have one entry per axis")
+        if not any(periodic):
+            periodic = None
+        elif tree.sources_have_extent or tree.targets_have_extent:
+            raise ValueError("periodic traversals are not supported for trees "
+                    "with source or target extent")
 
-        evt, = wait_for
+        logger.info("start building traversal")
+
+        fields, evt = self._build_lists(queue, tree, periodic,
+                wait_for=wait_for, debug=debug, allocator=allocator)
 
         logger.info("traversal built")
 
-        return FMMTraversalInfo(
+        trav = FMMTraversalInfo(
                 tree=tree,
+                periodic=periodic,
+                **fields).with_queue(None)
 
-                source_boxes=source_boxes,
-                target_boxes=target_boxes,
+        # see FMMTraversalInfo.release
+        trav._regenerate = _ListRegenerator(self, periodic)
 
-                level_start_source_box_nrs=level_start_source_box_nrs,
-                level_start_target_box_nrs=level_start_target_box_nrs,
+        return trav, evt
 
-                source_parent_boxes=source_parent_boxes,
-                level_start_source_parent_box_nrs=level_start_source_parent_box_nrs,
+    # }}}
 
-                target_or_target_parent_boxes=target_or_target_parent_boxes,
-                level_start_target_or_target_parent_box_nrs=(
-                    level_start_target_or_target_parent_box_nrs),
 
-                colleagues_starts=colleagues.starts,
-                colleagues_lists=colleagues.lists,
+# {{{ list regeneration
+
+# the interaction lists that FMMTraversalBuilder._build_lists can build
+# separately, with the traversal fields that hold each of them
+_LIST_FIELDS = {
+        "colleagues": (
+            "colleagues_starts", "colleagues_lists", "colleagues_image_shifts"),
+        "neighbor_source_boxes": (
+            "neighbor_source_boxes_starts", "neighbor_source_boxes_lists",
+            "neighbor_source_boxes_image_shifts"),
+        "sep_siblings": (
+            "sep_siblings_starts", "sep_siblings_lists",
+            "sep_siblings_image_shifts"),
+        "sep_smaller": (
+            "sep_smaller_by_level", "sep_smaller_image_shifts_by_level",
+            "sep_close_smaller_starts", "sep_close_smaller_lists"),
+        "sep_bigger": (
+            "sep_bigger_starts", "sep_bigger_lists", "sep_bigger_image_shifts",
+            "sep_close_bigger_starts", "sep_close_bigger_lists"),
+        }
+
 
-                neighbor_source_boxes_starts=neighbor_source_boxes.starts,
-                neighbor_source_boxes_lists=neighbor_source_boxes.lists,
+class _ListRegenerator(object):
+    """Rebuilds released fields of an :class:`FMMTraversalInfo` (see
+    :meth:`FMMTraversalInfo.release`) from the traversal's own tree.
 
-                sep_siblings_starts=sep_siblings.starts,
-                sep_siblings_lists=sep_siblings.lists,
+    Only the box lists and the interaction lists containing the released
+    fields are rebuilt. To keep memory from being held on to, this keeps
+    neither a queue nor a tree: the lists are built on a new queue, and the
+    tree of a host traversal is transferred to the device for the duration
+    of the rebuild. The rebuilt lists use the default allocator.
+    """
+
+    def __init__(self, builder, periodic):
+        self.builder = builder
+        self.periodic = periodic
+
+    def __call__(self, trav, field_names):
+        queue = cl.CommandQueue(self.builder.context)
+
+        tree = trav.tree
+        on_host = not isinstance(tree.box_levels, cl.array.Array)
+        if on_host:
+            tree = tree.to_device(queue,
+                    exclude_fields=frozenset(["level_start_box_nrs"]))
+
+        list_names = frozenset(
+                list_name
+                for list_name, list_fields in _LIST_FIELDS.items()
+                if set(list_fields) & set(field_names))
+
+        fields, evt = self.builder._build_lists(
+                queue, tree, self.periodic, list_names)
+        evt.wait()
 
-                sep_smaller_by_level=sep_smaller_by_level,
+        if on_host:
+            def transform(ary):
+                return ary.get(queue=queue)
+        else:
+            def transform(ary):
+                return ary.with_queue(None)
+
+        result = {}
+        for name in field_names:
+            value = fields[name]
+            if value is not None:
+                value = FMMTraversalInfo._transform_value(transform, value)
+            result[name] = value
+
+        return result
+
+# }}}
 
-                sep_close_smaller_starts=sep_close_smaller_starts,
-                sep_close_smaller_lists=sep_close_smaller_lists,
 
-                sep_bigger_starts=sep_bigger.starts,
-                sep_bigger_lists=sep_bigger.lists,
+# {{{ dual tree traversal builder
 
-                sep_close_bigger_starts=sep_close_bigger_starts,
-                sep_close_bigger_lists=sep_close_bigger_lists,
-                ).with_queue(None), evt
+class DualTreeTraversalBuilder(object):
+    """Builds a :class:`DualTreeTraversalInfo` by means of a dual tree
+    traversal with a configurable multipole acceptance criterion.
+
+    .. automethod:: __call__
+
+    .. versionadded:: 2016.1
+    """
+
+    def __init__(self, context):
+        self.context = context
+        self.traversal_builder = FMMTraversalBuilder(context)
+
+    # {{{ kernel builder
+
+    @memoize_method
+    def get_dual_tree_list_builder(self, dimensions, particle_id_dtype,
+            box_id_dtype, coord_dtype, max_levels, sources_are_targets):
+        debug = False
+
+        render_vars = FMMTraversalBuilder.get_render_vars(dimensions,
+                particle_id_dtype, box_id_dtype, coord_dtype, max_levels,
+                sources_are_targets,
+                sources_have_extent=False, targets_have_extent=False,
+                stick_out_factor=0, debug=debug)
+
+        src = Template(
+                TRAVERSAL_PREAMBLE_TEMPLATE
+                + DUAL_TREE_TEMPLATE,
+                strict_undefined=True).render(**render_vars)
+
+        from boxtree.tree import box_flags_enum
+        from pyopencl.algorithm import ListOfListsBuilder
+        from pyopencl.tools import VectorArg, ScalarArg
+
+        return ListOfListsBuilder(self.context,
+                [
+                    ("near_source_boxes", box_id_dtype),
+                    ("far_source_boxes", box_id_dtype),
+                    ],
+                str(src),
+                arg_decls=[
+                    VectorArg(coord_dtype, "box_centers"),
+                    ScalarArg(coord_dtype, "root_extent"),
+                    VectorArg(np.uint8, "box_levels"),
+                    ScalarArg(box_id_dtype, "aligned_nboxes"),
+                    VectorArg(box_id_dtype, "box_child_ids"),
+                    VectorArg(box_flags_enum.dtype, "box_flags"),
+                    VectorArg(box_id_dtype, "box_parent_ids"),
+                    VectorArg(box_id_dtype, "target_or_target_parent_boxes"),
+                    ScalarArg(coord_dtype, "theta"),
+                    ],
+                debug=debug, name_prefix="dual_tree",
+                complex_kernel=True)
 
     # }}}
 
+    def __call__(self, queue, tree, theta=0.5, wait_for=None, debug=False,
+            allocator=None):
+        """
+        :arg queue: A :class:`pyopencl.CommandQueue` instance.
+        :arg tree: A :class:`boxtree.Tree` instance.
+        :arg theta: The opening angle of the multipole acceptance criterion,
+            with 0 < *theta* < 1. Smaller values lead to more accurate
+            but more expensive far-field interactions.
+        :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
+            instances for whose completion this command waits before starting
+            exeuction.
+        :arg allocator: an allocator for all arrays of the traversal, as
+            accepted by :class:`pyopencl.array.Array`.
+        :return: A tuple *(trav, event)*, where *trav* is a new instance of
+            :class:`DualTreeTraversalInfo` and *event* is a
+            :class:`pyopencl.Event` for dependency management.
+        """
+
+        if not tree._is_pruned:
+            raise ValueError("tree must be pruned for traversal generation")
+
+        if tree.sources_have_extent or tree.targets_have_extent:
+            raise ValueError("dual tree traversal does not support particles "
+                    "with extent")
+
+        if not 0 < theta < 1:
+            raise ValueError("theta must be between 0 and 1")
+
+        from pytools import div_ceil
+        max_levels = div_ceil(tree.nlevels, 5) * 5
+
+        logger.info("start building dual tree traversal")
+
+        box_lists, wait_for = self.traversal_builder.build_box_lists(
+                queue, tree, wait_for=wait_for, debug=debug,
+                allocator=allocator)
+
+        target_or_target_parent_boxes = \
+                box_lists["target_or_target_parent_boxes"]
+
+        dual_tree_list_builder = self.get_dual_tree_list_builder(
+                tree.dimensions, tree.particle_id_dtype, tree.box_id_dtype,
+                tree.coord_dtype, max_levels, tree.sources_are_targets)
+
+        result, evt = dual_tree_list_builder(
+                queue, len(target_or_target_parent_boxes),
+                tree.box_centers.data, tree.root_extent, tree.box_levels.data,
+                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags.data,
+                tree.box_parent_ids.data, target_or_target_parent_boxes,
+                theta, wait_for=wait_for, allocator=allocator)
+
+        near_source_boxes = result["near_source_boxes"]
+        far_source_boxes = result["far_source_boxes"]
+
+        logger.info("dual tree traversal built")
+
+        return DualTreeTraversalInfo(
+                tree=tree,
+                theta=theta,
+
+                near_source_boxes_starts=near_source_boxes.starts,
+                near_source_boxes_lists=near_source_boxes.lists,
+
+                far_source_boxes_starts=far_source_boxes.starts,
+                far_source_boxes_lists=far_source_boxes.lists,
+
+                **box_lists).with_queue(None), evt
+
+# }}}
+
 # vim: filetype=pyopencl:fdm=marker
@@ -27,6 +27,8 @@ import pyopencl as cl
 import numpy as np
 from boxtree.tools import DeviceDataRecord
 from cgen import Enum
+from pyopencl.elementwise import ElementwiseTemplate
+from pyopencl.tools import context_dependent_memoize
 
 import logging
 logger = logging.getLogger(__name__)
@@ -335,36 +337,140 @@ class Tree(DeviceDataRecord):
         # user_source_ids : tree order source indices -> user order source indices
         # tree_source_ids : user order source indices -> tree order source indices
 
-        tree_source_ids = self._reverse_index_lookup(
-                self.user_source_ids, self.nsources)
-        return tree_source_ids[user_indices]
+        return self.get_tree_source_ids()[user_indices]
 
     def indices_to_tree_target_order(self, user_indices):
         # sorted_target_ids : user order target indices -> tree order target indices
 
         return self.sorted_target_ids[user_indices]
 
+    # }}}
+
+    # {{{ reverse permutations
+
+    def _get_reverse_permutation(self, name, forward, queue):
+        cache = self.__dict__.setdefault("_reverse_permutation_cache", {})
+
+        try:
+            result = cache[name]
+        except KeyError:
+            if isinstance(forward, np.ndarray):
+                result = self._reverse_index_lookup(forward, len(forward))
+            else:
+                if queue is None:
+                    raise ValueError("a queue is required to find %s "
+                            "on the device" % name)
+
+                from boxtree.tools import reverse_index_array
+                result = reverse_index_array(forward, queue=queue)
+                result.finish()
+                result = result.with_queue(None)
+
+            cache[name] = result
+
+        if queue is not None and isinstance(result, cl.array.Array):
+            result = result.with_queue(queue)
+
+        return result
+
+    def get_tree_source_ids(self, queue=None):
+        """Return the inverse of :attr:`user_source_ids`, i.e. an array
+        mapping user source numbers to tree source numbers.
+
+        The array is computed on first use and then kept. It lives on the
+        host or on the device, like :attr:`user_source_ids`. In the latter
+        case, *queue* must be given when the array is first computed.
+
+        .. versionadded:: 2016.1
+        """
+        return self._get_reverse_permutation(
+                "tree_source_ids", self.user_source_ids, queue)
+
+    def get_user_target_ids(self, queue=None):
+        """Return the inverse of :attr:`sorted_target_ids`, i.e. an array
+        mapping tree target numbers to user target numbers.
+
+        See :meth:`get_tree_source_ids`.
+
+        .. versionadded:: 2016.1
+        """
+        return self._get_reverse_permutation(
+                "user_target_ids", self.sorted_target_ids, queue)
+
+    # }}}
+
+    # {{{ particle-to-box lookup
+
+    def _get_particle_box_nrs(self, particle_kind):
+        starts = getattr(self, "box_%s_starts" % particle_kind)
+        counts = getattr(self, "box_%s_counts_nonchild" % particle_kind)
+
+        # The box arrays may have been reassigned since the map was built,
+        # so check that it was built from the same ones.
+        cache = self.__dict__.setdefault("_particle_box_nrs_cache", {})
+        cache_key = ((self.nboxes,), (starts, counts))
+        try:
+            (scalars, arrays), result = cache[particle_kind]
+        except KeyError:
+            pass
+        else:
+            new_scalars, new_arrays = cache_key
+            if (scalars == new_scalars
+                    and all(ary is new_ary
+                        for ary, new_ary in zip(arrays, new_arrays))):
+                return result
+
+        # Each particle belongs to the non-child list of exactly one box, and
+        # these lists are disjoint and contiguous in tree order.
+        nonempty_boxes, = np.nonzero(counts)
+        nonempty_boxes = nonempty_boxes[
+                np.argsort(starts[nonempty_boxes], kind="mergesort")]
+
+        result = np.repeat(
+                nonempty_boxes.astype(self.box_id_dtype),
+                counts[nonempty_boxes])
+
+        cache[particle_kind] = (cache_key, result)
+        return result
+
+    def find_box_nrs_for_targets(self, itargets):
+        """
+        :arg itargets: an array of target numbers in tree order
+        :returns: an array of the numbers of the boxes whose non-child
+            target lists contain the targets
+
+        The particle-to-box map is built on first use and then kept,
+        so that each lookup costs :math:`O(1)`. See
+        :func:`boxtree.tree.find_particle_box_nrs` for a device-side
+        equivalent.
+
+        .. versionadded:: 2016.1
+        """
+        return self._get_particle_box_nrs("target")[itargets]
+
+    def find_box_nrs_for_sources(self, isources):
+        """
+        :arg isources: an array of source numbers in tree order
+        :returns: an array of the numbers of the boxes whose non-child
+            source lists contain the sources
+
+        See :meth:`find_box_nrs_for_targets`.
+
+        .. versionadded:: 2016.1
+        """
+        return self._get_particle_box_nrs("source")[isources]
+
     def find_box_nr_for_target(self, itarget):
         """
         :arg itarget: target number in tree order
         """
-        crit = (
-                (self.box_target_starts <= itarget)
-                &
-                (itarget < self.box_target_starts + self.box_target_counts_nonchild))
-
-        return int(np.where(crit)[0])
+        return int(self.find_box_nrs_for_targets(itarget))
 
     def find_box_nr_for_source(self, isource):
         """
         :arg isource: source number in tree order
         """
-        crit = (
-                (self.box_source_starts <= isource)
-                &
-                (isource < self.box_source_starts + self.box_source_counts_nonchild))
-
-        return int(np.where(crit)[0])
+        return int(self.find_box_nrs_for_sources(isource))
 
     # }}}
 
@@ -612,6 +718,266 @@ def link_point_sources(queue, tree, point_source_starts, point_sources,
 # }}}
 
 
+# {{{ particle-to-box lookup
+
+PARTICLE_BOX_NRS_TEMPLATE = ElementwiseTemplate(
+    arguments="""//CL:mako//
+        particle_id_t *box_particle_starts,
+        particle_id_t *box_particle_counts_nonchild,
+        box_id_t *particle_box_nrs
+        """,
+    operation=r"""//CL:mako//
+        particle_id_t start = box_particle_starts[i];
+        particle_id_t end = start + box_particle_counts_nonchild[i];
+
+        for (particle_id_t ipart = start; ipart < end; ++ipart)
+            particle_box_nrs[ipart] = i;
+        """,
+    name="find_particle_box_nrs")
+
+
+@context_dependent_memoize
+def _get_particle_box_nrs_kernel(context, particle_id_dtype, box_id_dtype):
+    return PARTICLE_BOX_NRS_TEMPLATE.build(
+            context,
+            type_aliases=(
+                ("particle_id_t", particle_id_dtype),
+                ("box_id_t", box_id_dtype),
+                ))
+
+
+def find_particle_box_nrs(queue, tree, particle_kind="sources", wait_for=None):
+    """Find the box whose non-child particle list contains each particle.
+    This is the device-side equivalent of
+    :meth:`boxtree.Tree.find_box_nrs_for_sources` and
+    :meth:`boxtree.Tree.find_box_nrs_for_targets`.
+
+    :arg particle_kind: either ``"sources"`` or ``"targets"``
+    :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
+        instances for whose completion this command waits before starting
+        execution.
+    :returns: a tuple *(box_nrs, event)*, where *box_nrs* is a
+        :class:`pyopencl.array.Array` of type
+        :attr:`boxtree.Tree.box_id_dtype` indexed by particle number in tree
+        order, and *event* is a :class:`pyopencl.Event` for dependency
+        management. To look up particles in bulk, index *box_nrs* with
+        :func:`pyopencl.array.take`.
+
+    .. versionadded:: 2016.1
+    """
+    if particle_kind == "sources":
+        starts = tree.box_source_starts
+        counts_nonchild = tree.box_source_counts_nonchild
+        nparticles = tree.nsources
+    elif particle_kind == "targets":
+        starts = tree.box_target_starts
+        counts_nonchild = tree.box_target_counts_nonchild
+        nparticles = tree.ntargets
+    else:
+        raise ValueError("unknown particle kind: '%s'" % particle_kind)
+
+    knl = _get_particle_box_nrs_kernel(
+            queue.context, tree.particle_id_dtype, tree.box_id_dtype)
+
+    box_nrs = cl.array.empty(queue, nparticles, tree.box_id_dtype)
+    evt = knl(starts, counts_nonchild, box_nrs,
+            range=slice(tree.nboxes), queue=queue, wait_for=wait_for)
+
+    return box_nrs, evt
+
+# }}}
+
+
+# {{{ particle reordering
+
+def _map_particle_arrays(f, val):
+    if isinstance(val, np.ndarray) and val.dtype == object:
+        from pytools.obj_array import make_obj_array
+        return make_obj_array([_map_particle_arrays(f, v) for v in val])
+    elif isinstance(val, list):
+        return [_map_particle_arrays(f, v) for v in val]
+    elif isinstance(val, tuple):
+        return tuple(_map_particle_arrays(f, v) for v in val)
+    else:
+        return f(val)
+
+
+class ParticleReorderer(object):
+    """Moves per-particle data of a :class:`Tree` between
+    :ref:`user and tree order <particle-orderings>`, using
+    :attr:`Tree.user_source_ids` and :attr:`Tree.sorted_target_ids`.
+
+    The methods of this class accept a single array, or a (possibly nested)
+    :class:`list`, :class:`tuple` or object array of arrays, such as weights,
+    several density components, gradients or coordinates, and return the
+    reordered arrays in the same structure. All arrays are reordered in one
+    pass:
+
+    * :class:`numpy.ndarray` instances may have any number of axes, with the
+      particles along *axis*. They are gathered together in blocks of
+      :attr:`block_size` particles, so that each block of the permutation is
+      read once for all arrays.
+
+    * :class:`pyopencl.array.Array` instances must be one-dimensional. They
+      are all gathered by a single kernel launch.
+
+    .. attribute:: block_size
+
+    .. automethod:: reorder_sources
+    .. automethod:: reorder_potentials
+
+    .. versionadded:: 2016.1
+    """
+
+    block_size = 2**14
+
+    def __init__(self, tree):
+        self.tree = tree
+
+        self._host_permutations = {}
+        self._device_permutations = {}
+        self._copy_kernels = {}
+
+    def _get_permutation(self, name, queue, on_device):
+        perm = getattr(self.tree, name)
+
+        if on_device:
+            if isinstance(perm, cl.array.Array):
+                return perm.with_queue(queue)
+
+            try:
+                return self._device_permutations[name].with_queue(queue)
+            except KeyError:
+                result = cl.array.to_device(queue, perm)
+                result.finish()
+                self._device_permutations[name] = result.with_queue(None)
+                return result
+        else:
+            if isinstance(perm, np.ndarray):
+                return perm
+
+            try:
+                return self._host_permutations[name]
+            except KeyError:
+                if queue is None:
+                    queue = perm.queue
+                if queue is None:
+                    raise ValueError("a queue is required to reorder host "
+                            "arrays for a tree on the device")
+
+                result = perm.get(queue=queue)
+                self._host_permutations[name] = result
+                return result
+
+    def _get_copy_kernel(self, context):
+        try:
+            return self._copy_kernels[context]
+        except KeyError:
+            from boxtree.tools import GappyCopyAndMapKernel
+            result = GappyCopyAndMapKernel(context)
+            self._copy_kernels[context] = result
+            return result
+
+    def _gather(self, perm_name, arys, queue, axis):
+        host_arys = []
+        device_arys = []
+
+        def collect(ary):
+            if isinstance(ary, cl.array.Array):
+                device_arys.append(ary)
+            elif isinstance(ary, np.ndarray):
+                host_arys.append(ary)
+            else:
+                raise TypeError("cannot reorder object of type '%s'"
+                        % type(ary).__name__)
+            return ary
+
+        _map_particle_arrays(collect, arys)
+
+        results = {}
+
+        # {{{ host
+
+        if host_arys:
+            perm = self._get_permutation(perm_name, queue, on_device=False)
+            nparticles = len(perm)
+
+            sources = []
+            targets = []
+            for ary in host_arys:
+                if ary.shape[axis] != nparticles:
+                    raise ValueError("arrays must have one entry per particle "
+                            "along axis %d" % axis)
+
+                shape = list(ary.shape)
+                shape[axis] = nparticles
+                result = np.empty(shape, ary.dtype)
+
+                sources.append(np.moveaxis(ary, axis, -1))
+                targets.append(np.moveaxis(result, axis, -1))
+                results[id(ary)] = result
+
+            for start in range(0, nparticles, self.block_size):
+                block = slice(start, start + self.block_size)
+                perm_block = perm[block]
+                for source, target in zip(sources, targets):
+                    target[..., block] = source[..., perm_block]
+
+        # }}}
+
+        # {{{ device
+
+        if device_arys:
+            if queue is None:
+                queue = device_arys[0].queue
+            if queue is None:
+                raise ValueError("no queue given and arrays have no queue")
+
+            perm = self._get_permutation(perm_name, queue, on_device=True)
+            nparticles = len(perm)
+
+            for ary in device_arys:
+                if len(ary.shape) != 1 or len(ary) != nparticles:
+                    raise ValueError("device arrays must be one-dimensional "
+                            "with one entry per particle")
+
+            device_results, evt = self._get_copy_kernel(queue.context).copy_many(
+                    queue, device_arys[0].allocator, nparticles, device_arys,
+                    src_indices=perm, range=slice(nparticles),
+                    wait_for=[dep_evt
+                        for ary in device_arys + [perm] for dep_evt in ary.events])
+
+            for ary, result in zip(device_arys, device_results):
+                result.add_event(evt)
+                results[id(ary)] = result
+
+        # }}}
+
+        return _map_particle_arrays(lambda ary: results[id(ary)], arys)
+
+    def reorder_sources(self, source_arrays, queue=None, axis=-1):
+        """Return copies of *source_arrays*, which are in user source order,
+        in tree source order.
+
+        :arg queue: a :class:`pyopencl.CommandQueue`. Only needed if
+            device arrays have no queue, or if host arrays are reordered for
+            a tree whose arrays live on the device.
+        :arg axis: the axis along which particles are numbered in
+            :class:`numpy.ndarray` instances.
+        """
+        return self._gather("user_source_ids", source_arrays, queue, axis)
+
+    def reorder_potentials(self, potentials, queue=None, axis=-1):
+        """Return copies of *potentials*, which are in tree target order,
+        in user target order.
+
+        See :meth:`reorder_sources` for the arguments.
+        """
+        return self._gather("sorted_target_ids", potentials, queue, axis)
+
+# }}}
+
+
 # {{{ filtered target lists
 
 class FilteredTargetListsInUserOrder(DeviceDataRecord):
@@ -663,10 +1029,7 @@ def filter_target_lists_in_user_order(queue, tree, flags):
     user_order_flags = flags
     del flags
 
-    user_target_ids = cl.array.empty(queue, tree.ntargets,
-            tree.sorted_target_ids.dtype)
-    user_target_ids[tree.sorted_target_ids] = cl.array.arange(
-            queue, tree.ntargets, user_target_ids.dtype)
+    user_target_ids = tree.get_user_target_ids(queue)
 
     from pyopencl.tools import VectorArg, dtype_to_ctype
     from pyopencl.algorithm import ListOfListsBuilder
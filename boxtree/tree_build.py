@@ -77,7 +77,7 @@ class TreeBuilder(object):
             max_particles_in_box=None, allocator=None, debug=False,
             targets=None, source_radii=None, target_radii=None,
             stick_out_factor=0.25, refine_weights=None,
-            max_leaf_refine_weight=None, wait_for=None, **kwargs):
+            max_leaf_refine_weight=None, wait_for=None, bbox=None, **kwargs):
         """
         :arg queue: a :class:`pyopencl.CommandQueue` instance
         :arg particles: an object array of (XYZ) point coordinate arrays.
@@ -114,6 +114,16 @@ class TreeBuilder(object):
         :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
             instances for whose completion this command waits before starting
             execution.
+        :arg bbox: If not *None*, a :mod:`numpy` array of shape
+            *(dimensions, 2)* giving the lower and upper bound of the root box
+            along each axis. The root box must be a cube, and all particles
+            must lie in its half-open interior. If *None*, the root box is
+            computed from the particles. Specifying the root box is useful,
+            for instance, to make it coincide with a periodic cell (see
+            :class:`boxtree.area_query.AreaQueryBuilder`).
+
+            .. versionadded:: 2016.1
+
         :arg kwargs: Used internally for debugging.
 
         :returns: a tuple ``(tree, event)``, where *tree* is an instance of
@@ -307,21 +317,45 @@ class TreeBuilder(object):
 
         # {{{ find and process bounding box
 
+        given_bbox = bbox
+
         bbox, _ = self.bbox_finder(srcntgts, srcntgt_radii, wait_for=wait_for)
         bbox = bbox.get()
 
-        root_extent = max(
-                bbox["max_"+ax] - bbox["min_"+ax]
-                for ax in axis_names) * (1+TreeBuilder.ROOT_EXTENT_STRETCH_FACTOR)
+        if given_bbox is None:
+            root_extent = max(
+                    bbox["max_"+ax] - bbox["min_"+ax]
+                    for ax in axis_names) * (
+                            1+TreeBuilder.ROOT_EXTENT_STRETCH_FACTOR)
 
-        # make bbox square and slightly larger at the top, to ensure scaled
-        # coordinates are always < 1
-        bbox_min = np.empty(dimensions, coord_dtype)
-        for i, ax in enumerate(axis_names):
-            bbox_min[i] = bbox["min_"+ax]
+            # make bbox square and slightly larger at the top, to ensure scaled
+            # coordinates are always < 1
+            bbox_min = np.empty(dimensions, coord_dtype)
+            for i, ax in enumerate(axis_names):
+                bbox_min[i] = bbox["min_"+ax]
+
+        else:
+            given_bbox = np.asarray(given_bbox, dtype=coord_dtype)
+            if given_bbox.shape != (dimensions, 2):
+                raise ValueError("bbox has an invalid shape")
+
+            bbox_min = given_bbox[:, 0].copy()
+            extents = given_bbox[:, 1] - given_bbox[:, 0]
+            root_extent = coord_dtype.type(np.max(extents))
+
+            if not np.allclose(extents, root_extent):
+                raise ValueError("bbox must be a cube")
+
+            # scaled coordinates must be in [0, 1)
+            for i, ax in enumerate(axis_names):
+                scaled_min = (bbox["min_"+ax] - bbox_min[i]) / root_extent
+                scaled_max = (bbox["max_"+ax] - bbox_min[i]) / root_extent
+                if scaled_min < 0 or scaled_max >= 1:
+                    raise ValueError("particles must lie inside bbox")
 
         bbox_max = bbox_min + root_extent
         for i, ax in enumerate(axis_names):
+            bbox["min_"+ax] = bbox_min[i]
             bbox["max_"+ax] = bbox_max[i]
 
         # }}}
@@ -683,12 +717,6 @@ class TreeBuilder(object):
 
                 wait_for.extend(dst_box_id.events)
 
-                realloc_array = partial(self.gappy_copy_and_map,
-                        dst_indices=dst_box_id, range=slice(old_box_count),
-                        debug=debug)
-                realloc_and_renumber_array = partial(self.gappy_copy_and_map,
-                        dst_indices=dst_box_id, map_values=dst_box_id,
-                        range=slice(old_box_count), debug=debug)
                 renumber_array = partial(self.map_values_kernel, dst_box_id)
 
                 # }}}
@@ -706,8 +734,6 @@ class TreeBuilder(object):
 
                 del new_level_start_box_nrs
             else:
-                from boxtree.tools import realloc_array
-                realloc_and_renumber_array = realloc_array
                 renumber_array = None
                 level_start_box_nrs_updated = False
                 nboxes_new = nboxes_minimal
@@ -728,66 +754,79 @@ class TreeBuilder(object):
                     return cl.array.empty(queue, allocator=allocator,
                             shape=nboxes_guess, dtype=ary.dtype)
 
-                def my_realloc_zeros_nocopy(ary):
-                    result = cl.array.zeros(queue, allocator=allocator,
-                            shape=nboxes_guess, dtype=ary.dtype)
-                    return result, result.events[0]
-
-                my_realloc = partial(realloc_array,
-                        queue, allocator, nboxes_guess, wait_for=wait_for)
-                my_realloc_zeros = partial(realloc_array,
-                        queue, allocator, nboxes_guess, zero_fill=True,
-                        wait_for=wait_for)
-                my_realloc_zeros_and_renumber = partial(realloc_and_renumber_array,
-                        queue, allocator, nboxes_guess, zero_fill=True,
-                        wait_for=wait_for)
-
                 resize_events = []
 
                 split_box_ids = my_realloc_nocopy(split_box_ids)
 
-                # *Most*, but not *all* of the values in this array are
-                # rewritten when the morton scan is redone. Specifically,
+                # *Most*, but not *all* of the values in box_morton_bin_counts
+                # are rewritten when the morton scan is redone. Specifically,
                 # only the box morton bin counts of boxes on the level
                 # currently being processed are written-but we need to
                 # retain the box morton bin counts from the higher levels.
-                box_morton_bin_counts, evt = my_realloc_zeros(
-                        box_morton_bin_counts)
-                resize_events.append(evt)
-
+                #
                 # force_split_box is unused unless level restriction is enabled.
+                #
+                # The second entry of each pair indicates whether the array
+                # holds box IDs.
+                per_box_arrays = [(box_morton_bin_counts, False)]
                 if knl_info.level_restrict:
-                    force_split_box, evt = my_realloc_zeros(force_split_box)
-                    resize_events.append(evt)
-
-                box_srcntgt_starts, evt = my_realloc_zeros(box_srcntgt_starts)
-                resize_events.append(evt)
-
-                box_srcntgt_counts_cumul, evt = \
-                        my_realloc_zeros(box_srcntgt_counts_cumul)
-                resize_events.append(evt)
-
-                box_has_children, evt = my_realloc_zeros(box_has_children)
-                resize_events.append(evt)
-
-                box_centers, evts = zip(
-                    *(my_realloc(ary) for ary in box_centers))
-                resize_events.extend(evts)
-
-                box_child_ids, evts = zip(
-                    *(my_realloc_zeros_and_renumber(ary)
-                      for ary in box_child_ids))
-                resize_events.extend(evts)
-
-                box_parent_ids, evt = my_realloc_zeros_and_renumber(box_parent_ids)
-                resize_events.append(evt)
-
+                    per_box_arrays.append((force_split_box, False))
+                per_box_arrays.extend([
+                        (box_srcntgt_starts, False),
+                        (box_srcntgt_counts_cumul, False),
+                        (box_has_children, False),
+                        (box_parent_ids, True),
+                        ])
+                per_box_arrays.extend((ary, False) for ary in box_centers)
+                per_box_arrays.extend((ary, True) for ary in box_child_ids)
                 if not level_start_box_nrs_updated:
-                    box_levels, evt = my_realloc(box_levels)
+                    per_box_arrays.append((box_levels, False))
+
+                if level_start_box_nrs_updated:
+                    # Boxes move to new positions and are renumbered. Do
+                    # this for all per-box arrays in a single kernel launch.
+                    new_arrays, evt = self.gappy_copy_and_map.copy_many(
+                            queue, allocator, nboxes_guess,
+                            [ary for ary, _ in per_box_arrays],
+                            dst_indices=dst_box_id, map_values=dst_box_id,
+                            map_value_flags=[
+                                is_box_ids for _, is_box_ids in per_box_arrays],
+                            zero_fill=True, range=slice(old_box_count),
+                            wait_for=wait_for, debug=debug)
                     resize_events.append(evt)
                 else:
-                    box_levels, evt = my_realloc_zeros_nocopy(box_levels)
-                    cl.wait_for_events([evt])
+                    # Boxes keep their numbers, so the arrays only grow,
+                    # in place if their buffers have room to spare.
+                    from boxtree.tools import realloc_array
+                    new_arrays = []
+                    for ary, _ in per_box_arrays:
+                        new_ary, evt = realloc_array(
+                                queue, allocator, nboxes_guess, ary,
+                                zero_fill=True, wait_for=wait_for,
+                                reuse_capacity=True)
+                        new_arrays.append(new_ary)
+                        resize_events.append(evt)
+
+                del per_box_arrays
+
+                new_arrays = iter(new_arrays)
+                box_morton_bin_counts = next(new_arrays)
+                if knl_info.level_restrict:
+                    force_split_box = next(new_arrays)
+                box_srcntgt_starts = next(new_arrays)
+                box_srcntgt_counts_cumul = next(new_arrays)
+                box_has_children = next(new_arrays)
+                box_parent_ids = next(new_arrays)
+                box_centers = tuple(next(new_arrays) for ary in box_centers)
+                box_child_ids = tuple(next(new_arrays) for ary in box_child_ids)
+                if not level_start_box_nrs_updated:
+                    box_levels = next(new_arrays)
+                del new_arrays
+
+                if level_start_box_nrs_updated:
+                    box_levels = cl.array.zeros(queue, allocator=allocator,
+                            shape=nboxes_guess, dtype=box_levels.dtype)
+                    cl.wait_for_events(box_levels.events)
                     for box_level, (level_start, level_end) in enumerate(zip(
                             level_start_box_nrs, level_start_box_nrs[1:])):
                         box_levels[level_start:level_end].fill(box_level)
@@ -797,16 +836,9 @@ class TreeBuilder(object):
                     srcntgt_box_ids, evt = renumber_array(srcntgt_box_ids)
                     resize_events.append(evt)
 
-                del my_realloc_zeros
                 del my_realloc_nocopy
-                del my_realloc_zeros_nocopy
                 del renumber_array
 
-                # Can't del on Py2.7 - these are used in generator expressions
-                # above, which are nested scopes
-                my_realloc = None
-                my_realloc_zeros_and_renumber = None
-
                 # retry
                 logger.info("nboxes_guess exceeded: "
                             "enlarged allocations, restarting level")
@@ -1188,16 +1220,43 @@ class TreeBuilder(object):
         if should_prune:
             prune_events = []
 
-            prune_empty = partial(self.gappy_copy_and_map,
-                    queue, allocator, nboxes_post_prune,
-                    src_indices=src_box_id,
-                    range=slice(nboxes_post_prune), debug=debug)
+            # Move all per-box arrays with a single kernel launch. The
+            # second entry of each pair indicates whether the array holds
+            # box IDs that need to be renumbered.
+            per_box_arrays = [
+                    (box_srcntgt_starts, False),
+                    (box_srcntgt_counts_cumul, False),
+                    (box_parent_ids, True),
+                    (box_levels, False),
+                    (box_has_children, False),
+                    ]
+            if srcntgts_have_extent:
+                per_box_arrays.append((box_srcntgt_counts_nonchild, False))
+            per_box_arrays.extend((ary, True) for ary in box_child_ids)
+            per_box_arrays.extend((ary, False) for ary in box_centers)
 
-            box_srcntgt_starts, evt = prune_empty(box_srcntgt_starts)
+            pruned_arrays, evt = self.gappy_copy_and_map.copy_many(
+                    queue, allocator, nboxes_post_prune,
+                    [ary for ary, _ in per_box_arrays],
+                    src_indices=src_box_id, map_values=dst_box_id,
+                    map_value_flags=[is_box_ids for _, is_box_ids in per_box_arrays],
+                    range=slice(nboxes_post_prune), wait_for=wait_for,
+                    debug=debug)
             prune_events.append(evt)
 
-            box_srcntgt_counts_cumul, evt = prune_empty(box_srcntgt_counts_cumul)
-            prune_events.append(evt)
+            del per_box_arrays
+
+            pruned_arrays = iter(pruned_arrays)
+            box_srcntgt_starts = next(pruned_arrays)
+            box_srcntgt_counts_cumul = next(pruned_arrays)
+            box_parent_ids = next(pruned_arrays)
+            box_levels = next(pruned_arrays)
+            box_has_children = next(pruned_arrays)
+            if srcntgts_have_extent:
+                box_srcntgt_counts_nonchild = next(pruned_arrays)
+            box_child_ids = tuple(next(pruned_arrays) for ary in box_child_ids)
+            box_centers = tuple(next(pruned_arrays) for ary in box_centers)
+            del pruned_arrays
 
             if debug and prune_empty_leaves:
                 assert (box_srcntgt_counts_cumul.get() > 0).all()
@@ -1206,29 +1265,6 @@ class TreeBuilder(object):
                     dst_box_id, srcntgt_box_ids)
             prune_events.append(evt)
 
-            box_parent_ids, evt = prune_empty(box_parent_ids, map_values=dst_box_id)
-            prune_events.append(evt)
-
-            box_levels, evt = prune_empty(box_levels)
-            prune_events.append(evt)
-
-            if srcntgts_have_extent:
-                box_srcntgt_counts_nonchild, evt = prune_empty(
-                        box_srcntgt_counts_nonchild)
-                prune_events.append(evt)
-
-            box_has_children, evt = prune_empty(box_has_children)
-            prune_events.append(evt)
-
-            box_child_ids, evts = zip(
-                *(prune_empty(ary, map_values=dst_box_id)
-                  for ary in box_child_ids))
-            prune_events.extend(evts)
-
-            box_centers, evts = zip(
-                *(prune_empty(ary) for ary in box_centers))
-            prune_events.extend(evts)
-
             # Update box counts and level start box indices.
             box_levels.finish()
 
@@ -33,10 +33,12 @@ from pyopencl.tools import (  # noqa
         pytest_generate_tests_for_pyopencl as pytest_generate_tests)
 
 from boxtree.tools import (
+        expand_ranges,
         make_normal_particle_array as p_normal,
         make_surface_particle_array as p_surface,
         make_uniform_particle_array as p_uniform,
         particle_array_to_host)
+from boxtree import constant_one
 
 import logging
 logger = logging.getLogger(__name__)
@@ -196,19 +198,19 @@ class ConstantOneExpansionWrangler(object):
 
 
 class ConstantOneExpansionWranglerWithFilteredTargetsInTreeOrder(
-        ConstantOneExpansionWrangler):
+        constant_one.ConstantOneExpansionWrangler):
     def __init__(self, tree, filtered_targets):
-        ConstantOneExpansionWrangler.__init__(self, tree)
+        constant_one.ConstantOneExpansionWrangler.__init__(self, tree)
         self.filtered_targets = filtered_targets
 
     def potential_zeros(self):
-        return np.zeros(self.filtered_targets.nfiltered_targets, dtype=np.float64)
+        return np.zeros(self.filtered_targets.nfiltered_targets, dtype=self.dtype)
 
-    def _get_target_slice(self, ibox):
-        pstart = self.filtered_targets.box_target_starts[ibox]
-        return slice(
-                pstart, pstart
-                + self.filtered_targets.box_target_counts_nonchild[ibox])
+    def box_target_starts(self):
+        return self.filtered_targets.box_target_starts
+
+    def box_target_counts_nonchild(self):
+        return self.filtered_targets.box_target_counts_nonchild
 
     def reorder_potentials(self, potentials):
         tree_order_all_potentials = np.zeros(self.tree.ntargets, potentials.dtype)
@@ -220,16 +222,18 @@ class ConstantOneExpansionWranglerWithFilteredTargetsInTreeOrder(
 
 
 class ConstantOneExpansionWranglerWithFilteredTargetsInUserOrder(
-        ConstantOneExpansionWrangler):
+        constant_one.ConstantOneExpansionWrangler):
     def __init__(self, tree, filtered_targets):
-        ConstantOneExpansionWrangler.__init__(self, tree)
+        constant_one.ConstantOneExpansionWrangler.__init__(self, tree)
         self.filtered_targets = filtered_targets
 
-    def _get_target_slice(self, ibox):
+    def box_target_ids(self, boxes):
+        target_starts = self.filtered_targets.target_starts
+        counts = target_starts[boxes + 1] - target_starts[boxes]
         user_target_ids = self.filtered_targets.target_lists[
-                self.filtered_targets.target_starts[ibox]:
-                self.filtered_targets.target_starts[ibox+1]]
-        return self.tree.sorted_target_ids[user_target_ids]
+                expand_ranges(target_starts[boxes], counts)]
+
+        return self.tree.sorted_target_ids[user_target_ids], counts
 
 
 @pytest.mark.parametrize(("dims", "nsources_req", "ntargets_req",
@@ -452,6 +456,402 @@ def test_fmm_completeness(ctx_getter, dims, nsources_req, ntargets_req,
 # }}}
 
 
+# {{{ dual tree fmm interaction completeness test
+
+@pytest.mark.parametrize(("dims", "nsources_req", "ntargets_req", "theta"), [
+    (2, 10**4, None, 0.5),
+    (2, 10**4, 5000, 0.7),
+    (3, 10**4, None, 0.5),
+    (3, 10**4, 5000, 0.3),
+    ])
+def test_dual_tree_fmm_completeness(ctx_getter, dims, nsources_req,
+        ntargets_req, theta):
+    logging.basicConfig(level=logging.INFO)
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+
+    sources = p_normal(queue, nsources_req, dims, dtype, seed=15)
+    if ntargets_req is None:
+        targets = None
+    else:
+        targets = p_normal(queue, ntargets_req, dims, dtype, seed=16)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, sources, targets=targets,
+            max_particles_in_box=30, debug=True)
+
+    from boxtree.traversal import DualTreeTraversalBuilder
+    tbuild = DualTreeTraversalBuilder(ctx)
+    trav, _ = tbuild(queue, tree, theta=theta, debug=True)
+
+    host_trav = trav.get(queue=queue)
+
+    weights = np.random.randn(nsources_req)
+    weights_sum = np.sum(weights)
+
+    wrangler = ConstantOneExpansionWrangler(host_trav.tree)
+
+    from boxtree.fmm import drive_dual_tree_fmm
+    pot = drive_dual_tree_fmm(host_trav, wrangler, weights)
+
+    rel_err = la.norm((pot - weights_sum) / nsources_req)
+    assert rel_err < 1e-8
+
+    # make sure the far field actually got exercised
+    assert host_trav.far_source_boxes_starts[-1] > 0
+
+# }}}
+
+
+# {{{ host-built tree and traversal fmm completeness test
+
+@pytest.mark.parametrize(("dims", "nsources_req", "ntargets_req"), [
+    (2, 10**4, None),
+    (2, 10**4, 5000),
+    (3, 10**4, None),
+    (3, 10**4, 5000),
+    ])
+def test_host_build_fmm_completeness(dims, nsources_req, ntargets_req):
+    logging.basicConfig(level=logging.INFO)
+
+    rng = np.random.RandomState(15)
+    sources = rng.randn(dims, nsources_req)
+    if ntargets_req is None:
+        targets = None
+    else:
+        targets = rng.randn(dims, ntargets_req)
+
+    from boxtree.host_build import HostTreeBuilder, HostTraversalBuilder
+    tree = HostTreeBuilder()(sources, targets=targets, max_particles_in_box=30)
+    trav = HostTraversalBuilder()(tree)
+
+    weights = rng.randn(nsources_req)
+    weights_sum = np.sum(weights)
+
+    wrangler = ConstantOneExpansionWrangler(tree)
+
+    from boxtree.fmm import drive_fmm
+    pot = drive_fmm(trav, wrangler, weights)
+
+    rel_err = la.norm((pot - weights_sum) / nsources_req)
+    assert rel_err < 1e-8
+
+
+HOST_BUILD_WITHOUT_PYOPENCL_SCRIPT = """
+import sys
+import numpy as np
+
+# The boxtree package itself imports pyopencl. Anything beyond that is
+# unavailable from here on.
+import boxtree  # noqa
+
+
+class BlockPyOpenCL(object):
+    def find_spec(self, name, path, target=None):
+        if name.split(".")[0] == "pyopencl":
+            raise ImportError("pyopencl is unavailable: " + name)
+        return None
+
+    def find_module(self, name, path=None):
+        self.find_spec(name, path)
+        return None
+
+
+sys.meta_path.insert(0, BlockPyOpenCL())
+
+from boxtree.host_build import HostTreeBuilder, HostTraversalBuilder
+from boxtree.constant_one import ConstantOneExpansionWrangler
+from boxtree.fmm import drive_fmm
+
+rng = np.random.RandomState(15)
+sources = rng.rand(%(dims)d, 3000)
+targets = rng.rand(%(dims)d, 1000)
+
+tree = HostTreeBuilder()(sources, targets=targets, max_particles_in_box=30)
+trav = HostTraversalBuilder()(tree)
+
+pot = drive_fmm(trav, ConstantOneExpansionWrangler(tree), np.ones(3000))
+assert (pot == 3000).all()
+"""
+
+
+@pytest.mark.parametrize("dims", [2, 3])
+def test_host_build_without_pyopencl(dims):
+    import os
+    import sys
+    import subprocess
+
+    from boxtree.host_build import HostTreeBuilder
+    from boxtree.tree_build_kernels import refine_weight_dtype
+    assert HostTreeBuilder.refine_weight_dtype == refine_weight_dtype
+
+    import boxtree
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+            [os.path.dirname(os.path.dirname(boxtree.__file__))]
+            + [p for p in [env.get("PYTHONPATH")] if p])
+
+    subprocess.check_call(
+            [sys.executable, "-c",
+                HOST_BUILD_WITHOUT_PYOPENCL_SCRIPT % {"dims": dims}],
+            env=env)
+
+# }}}
+
+
+# {{{ vectorized interaction check test
+
+@pytest.mark.parametrize(("dims", "who_has_extent"), [
+    (2, ""),
+    (2, "st"),
+    (3, ""),
+    (3, "st"),
+    ])
+def test_check_fmm_interactions(ctx_getter, dims, who_has_extent):
+    logging.basicConfig(level=logging.INFO)
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+    nsources = 10**4
+    ntargets = 5000
+
+    sources = p_normal(queue, nsources, dims, dtype, seed=15)
+    targets = p_normal(queue, ntargets, dims, dtype, seed=16)
+
+    from pyopencl.clrandom import PhiloxGenerator
+    rng = PhiloxGenerator(queue.context, seed=12)
+    if "s" in who_has_extent:
+        source_radii = 2**rng.uniform(queue, nsources, dtype=dtype, a=-10, b=0)
+    else:
+        source_radii = None
+    if "t" in who_has_extent:
+        target_radii = 2**rng.uniform(queue, ntargets, dtype=dtype, a=-10, b=0)
+    else:
+        target_radii = None
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, sources, targets=targets, max_particles_in_box=30,
+            source_radii=source_radii, target_radii=target_radii, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tbuild = FMMTraversalBuilder(ctx)
+    trav, _ = tbuild(queue, tree, debug=True)
+
+    from boxtree.constant_one import check_fmm_interactions
+
+    result = check_fmm_interactions(trav, queue)
+    assert result.all_exact
+    assert (result.interaction_counts == nsources).all()
+    assert len(result.get_failed_target_ids()) == 0
+
+    # {{{ compare with the reference wrangler
+
+    host_trav = trav.get(queue=queue)
+    wrangler = constant_one.ConstantOneExpansionWrangler(host_trav.tree)
+    ref_wrangler = ConstantOneExpansionWrangler(host_trav.tree)
+
+    from boxtree.fmm import drive_fmm
+
+    weights = np.random.randn(nsources)
+    pot = drive_fmm(host_trav, wrangler, weights)
+    ref_pot = drive_fmm(host_trav, ref_wrangler, weights)
+    assert la.norm(pot - ref_pot) < 1e-12 * la.norm(ref_pot)
+
+    # integer weights make the sums exact, regardless of their order
+    weights = np.random.randint(-100, 100, nsources).astype(np.float64)
+    pot = drive_fmm(host_trav, wrangler, weights)
+    ref_pot = drive_fmm(host_trav, ref_wrangler, weights)
+    assert (pot == ref_pot).all()
+
+    # }}}
+
+    # {{{ damage list 1 and make sure that is found
+
+    host_tree = host_trav.tree
+
+    lists = host_trav.neighbor_source_boxes_lists.copy()
+    start = host_trav.neighbor_source_boxes_starts[0]
+    dropped_box, duplicated_box = lists[start:start+2]
+    lists[start] = duplicated_box
+    host_trav.neighbor_source_boxes_lists = lists
+
+    result = check_fmm_interactions(host_trav)
+    assert not result.all_exact
+
+    target_box = host_trav.target_boxes[0]
+    tgt_start = host_tree.box_target_starts[target_box]
+    failed_target_ids = host_tree.get_user_target_ids()[
+            tgt_start:tgt_start+host_tree.box_target_counts_nonchild[target_box]]
+    assert (np.sort(result.get_failed_target_ids())
+            == np.sort(failed_target_ids)).all()
+
+    counts_change = (
+            host_tree.box_source_counts_nonchild[duplicated_box]
+            - host_tree.box_source_counts_nonchild[dropped_box])
+    assert (result.interaction_counts[failed_target_ids]
+            == nsources + counts_change).all()
+    assert (result.nmissing - result.nduplicated
+            == nsources - result.interaction_counts).all()
+
+    # }}}
+
+# }}}
+
+
+# {{{ periodic interaction check test
+
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("periodic", [True, (False, True, False)])
+def test_check_periodic_fmm_interactions(ctx_getter, dims, periodic):
+    logging.basicConfig(level=logging.INFO)
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+    nsources = 5000
+    ntargets = 2000
+
+    if not isinstance(periodic, bool):
+        periodic = periodic[:dims]
+        nimages = 3
+    else:
+        nimages = 3**dims
+
+    # a uniform and a clustered half, to get lists 3 and 4
+    rng = np.random.RandomState(15)
+    sources_host = np.concatenate([
+        rng.rand(nsources // 2, dims),
+        0.97 + 0.02*rng.rand(nsources - nsources // 2, dims)]).T
+    import pyopencl.array  # noqa
+    from pytools.obj_array import make_obj_array
+    sources = make_obj_array([
+        cl.array.to_device(queue, sources_host[i].copy())
+        for i in range(dims)])
+    targets = make_obj_array([
+        cl.array.to_device(queue, rng.rand(ntargets)**4)
+        for i in range(dims)])
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, sources, targets=targets, max_particles_in_box=10,
+            bbox=np.array([[0, 1]]*dims, dtype=dtype), debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tbuild = FMMTraversalBuilder(ctx)
+    trav, _ = tbuild(queue, tree, periodic=periodic, debug=True)
+
+    from boxtree.constant_one import check_fmm_interactions
+
+    result = check_fmm_interactions(trav, queue)
+    assert result.nimages == nimages
+    assert result.all_exact
+    assert (result.interaction_counts == nimages*nsources).all()
+
+    # {{{ damage an image shift in list 1 and make sure that is found
+
+    host_trav = trav.get(queue=queue)
+
+    iaxis = list(host_trav.periodic).index(True)
+    image_shifts = host_trav.neighbor_source_boxes_image_shifts.copy()
+    axis_shifts = image_shifts[iaxis].copy()
+    start = host_trav.neighbor_source_boxes_starts[0]
+    axis_shifts[start] = 1 if axis_shifts[start] != 1 else -1
+    image_shifts[iaxis] = axis_shifts
+    host_trav.neighbor_source_boxes_image_shifts = image_shifts
+
+    result = check_fmm_interactions(host_trav)
+    assert not result.all_exact
+
+    # }}}
+
+# }}}
+
+
+# {{{ release-on-consume test
+
+@pytest.mark.parametrize(("dims", "ntargets_req"), [
+    (2, None),
+    (3, 5000),
+    ])
+def test_fmm_release_consumed(ctx_getter, dims, ntargets_req):
+    logging.basicConfig(level=logging.INFO)
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+    nsources = 10**4
+
+    sources = p_normal(queue, nsources, dims, dtype, seed=15)
+    if ntargets_req is None:
+        targets = None
+    else:
+        targets = p_normal(queue, ntargets_req, dims, dtype, seed=16)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, sources, targets=targets,
+            max_particles_in_box=30, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tbuild = FMMTraversalBuilder(ctx)
+    trav, _ = tbuild(queue, tree, debug=True)
+
+    host_trav = trav.get(queue=queue)
+    ref_sep_bigger_lists = host_trav.sep_bigger_lists
+
+    weights = np.random.randn(nsources)
+    wrangler = ConstantOneExpansionWrangler(host_trav.tree)
+
+    from boxtree.fmm import drive_fmm
+    ref_pot = drive_fmm(host_trav, wrangler, weights)
+    pot = drive_fmm(host_trav, wrangler, weights, release_consumed=True)
+
+    assert (pot == ref_pot).all()
+
+    # the FMM released the lists of a copy, not of host_trav
+    assert "sep_bigger_lists" in host_trav.__dict__
+    assert not host_trav.__dict__.get("_released_fields")
+
+    # released lists are gone...
+    neighbor_source_boxes_lists = host_trav.neighbor_source_boxes_lists
+    host_trav.release("sep_bigger_lists", "sep_smaller_by_level")
+    assert "sep_bigger_lists" not in host_trav.__dict__
+
+    # ...but come back on demand, on the host
+    sep_bigger_lists = host_trav.sep_bigger_lists
+    assert isinstance(sep_bigger_lists, np.ndarray)
+    assert (sep_bigger_lists == ref_sep_bigger_lists).all()
+    assert len(host_trav.sep_smaller_by_level) == host_trav.tree.nlevels
+
+    # only the released lists were rebuilt
+    assert host_trav.neighbor_source_boxes_lists is neighbor_source_boxes_lists
+
+    # and a second run works just the same
+    pot = drive_fmm(host_trav, wrangler, weights, release_consumed=True)
+    assert (pot == ref_pot).all()
+
+    # copies cannot regenerate released lists, so they refuse to release them
+    with pytest.raises(ValueError):
+        host_trav.copy().release("sep_bigger_lists")
+    with pytest.raises(ValueError):
+        drive_fmm(host_trav.copy(), wrangler, weights, release_consumed=True)
+
+# }}}
+
+
 # {{{ test Helmholtz fmm with pyfmmlib
 
 @pytest.mark.parametrize("dims", [2, 3])
@@ -519,9 +919,163 @@ def test_pyfmmlib_fmm(ctx_getter, dims):
     logger.info("relative l2 error: %g" % rel_err)
     assert rel_err < 1e-5
 
+
+@pytest.mark.parametrize("dims", [2, 3])
+def test_pyfmmlib_fmm_lazy(ctx_getter, dims):
+    logging.basicConfig(level=logging.INFO)
+
+    from pytest import importorskip
+    importorskip("pyfmmlib")
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    nsources = 3000
+    ntargets = 1000
+    dtype = np.float64
+
+    helmholtz_k = 2
+
+    sources = p_normal(queue, nsources, dims, dtype, seed=15)
+    targets = (
+            p_normal(queue, ntargets, dims, dtype, seed=18)
+            + np.array([2, 0, 0])[:dims])
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, sources, targets=targets,
+            max_particles_in_box=30, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tbuild = FMMTraversalBuilder(ctx)
+    trav, _ = tbuild(queue, tree, debug=True)
+
+    from pyopencl.clrandom import PhiloxGenerator
+    rng = PhiloxGenerator(queue.context, seed=20)
+
+    weights = rng.uniform(queue, nsources, dtype=np.float64).get()
+
+    from boxtree.pyfmmlib_integration import HelmholtzExpansionWrangler
+    from boxtree.fmm import drive_fmm
+
+    host_trav = trav.get(queue=queue)
+    wrangler = HelmholtzExpansionWrangler(host_trav.tree, helmholtz_k, nterms=10)
+    pot = drive_fmm(host_trav, wrangler, weights)
+
+    # The wrangler only sees lazily transferred host data.
+    lazy_trav = trav.get_lazy(queue)
+    lazy_wrangler = HelmholtzExpansionWrangler(
+            lazy_trav.tree, helmholtz_k, nterms=10)
+    lazy_pot = drive_fmm(lazy_trav, lazy_wrangler, weights)
+
+    assert (lazy_pot == pot).all()
+
+
+@pytest.mark.parametrize("dims", [2, 3])
+def test_periodic_pyfmmlib_fmm(ctx_getter, dims):
+    logging.basicConfig(level=logging.INFO)
+
+    from pytest import importorskip
+    importorskip("pyfmmlib")
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    nsources = 1000
+    ntargets = 300
+    helmholtz_k = 2
+    dtype = np.float64
+
+    rng = np.random.RandomState(15)
+    sources_host = rng.rand(dims, nsources)
+    targets_host = rng.rand(dims, ntargets)
+
+    import pyopencl.array  # noqa
+    from pytools.obj_array import make_obj_array
+    sources = make_obj_array([
+        cl.array.to_device(queue, sources_host[i].copy())
+        for i in range(dims)])
+    targets = make_obj_array([
+        cl.array.to_device(queue, targets_host[i].copy())
+        for i in range(dims)])
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, sources, targets=targets, max_particles_in_box=30,
+            bbox=np.array([[0, 1]]*dims, dtype=dtype), debug=True)
+    assert tree.root_extent == 1
+
+    periodic = (True,) + (False,)*(dims-1)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tbuild = FMMTraversalBuilder(ctx)
+    trav, _ = tbuild(queue, tree, periodic=periodic, debug=True)
+
+    trav = trav.get(queue=queue)
+
+    weights = rng.rand(nsources)
+
+    from boxtree.pyfmmlib_integration import HelmholtzExpansionWrangler
+    wrangler = HelmholtzExpansionWrangler(trav.tree, helmholtz_k, nterms=10)
+
+    from boxtree.fmm import drive_fmm
+    pot = drive_fmm(trav, wrangler, weights)
+
+    logger.info("computing direct (reference) result")
+
+    # sources in the images of the tree shifted by -1, 0 and 1 along x
+    image_sources = np.hstack([
+        sources_host + np.array([shift] + [0]*(dims-1))[:, np.newaxis]
+        for shift in [-1, 0, 1]])
+    image_weights = np.tile(weights, 3)
+
+    if dims == 2:
+        from pyfmmlib import hpotgrad2dall_vec
+        ref_pot, _, _ = hpotgrad2dall_vec(ifgrad=False, ifhess=False,
+                sources=image_sources, charge=image_weights,
+                targets=targets_host, zk=helmholtz_k)
+    else:
+        from pyfmmlib import hpotfld3dall_vec
+        ref_pot, _ = hpotfld3dall_vec(iffld=False,
+                sources=image_sources, charge=image_weights,
+                targets=targets_host, zk=helmholtz_k)
+
+    rel_err = la.norm(pot - ref_pot) / la.norm(ref_pot)
+    logger.info("relative l2 error: %g" % rel_err)
+    assert rel_err < 1e-5
+
 # }}}
 
 
+def test_translation_operator_cache():
+    from boxtree.pyfmmlib_integration import TranslationOperatorCache
+
+    op_nbytes = np.zeros((4, 4), np.complex128).nbytes
+    cache = TranslationOperatorCache(max_nbytes=2*op_nbytes)
+
+    for i in range(3):
+        cache.insert(i, np.full((4, 4), i, np.complex128))
+
+    # the least recently used operator got evicted
+    assert 0 not in cache
+    assert cache.nbytes == 2*op_nbytes
+
+    assert cache.get(1)[0, 0] == 1
+    cache.insert(3, np.zeros((4, 4), np.complex128))
+    assert 1 in cache
+    assert 2 not in cache
+
+    assert cache.get(2) is None
+    assert (cache.nhits, cache.nmisses) == (1, 1)
+
+    # operators that do not fit are not stored
+    cache.insert(4, np.zeros((8, 8), np.complex128))
+    assert 4 not in cache
+    assert len(cache) == 2
+
+
 # You can test individual routines by typing
 # $ python test_fmm.py 'test_routine(cl.create_some_context)'
 
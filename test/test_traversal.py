@@ -251,6 +251,422 @@ def test_tree_connectivity(ctx_getter, dims, sources_are_targets):
 # }}}
 
 
+# {{{ close list merging test
+
+@pytest.mark.opencl
+@pytest.mark.parametrize(("dims", "who_has_extent"), [
+    (2, "st"),
+    (2, "s"),
+    (3, "t"),
+    ])
+def test_merge_close_lists(ctx_getter, dims, who_has_extent):
+    logging.basicConfig(level=logging.INFO)
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+    nsources = 10**4
+    ntargets = 5000
+
+    sources = make_normal_particle_array(queue, nsources, dims, dtype)
+    targets = make_normal_particle_array(queue, ntargets, dims, dtype, seed=19)
+
+    from pyopencl.clrandom import PhiloxGenerator
+    rng = PhiloxGenerator(queue.context, seed=12)
+
+    source_radii = None
+    target_radii = None
+    if "s" in who_has_extent:
+        source_radii = 2**rng.uniform(queue, nsources, dtype=dtype, a=-10, b=0)
+    if "t" in who_has_extent:
+        target_radii = 2**rng.uniform(queue, ntargets, dtype=dtype, a=-10, b=0)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+    tree, _ = tb(queue, sources, targets=targets, max_particles_in_box=30,
+            source_radii=source_radii, target_radii=target_radii, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(ctx)
+    trav, _ = tg(queue, tree, debug=True)
+
+    # periodic traversals do not support particles with extent
+    with pytest.raises(ValueError):
+        tg(queue, tree, periodic=True)
+
+    merged_trav = trav.merge_close_lists(queue, debug=True)
+    assert merged_trav.merge_close_lists(queue) is merged_trav
+
+    # cached results share the data, but are bound to the given queue
+    queue2 = cl.CommandQueue(ctx)
+    cached_trav = trav.merge_close_lists(queue2)
+    assert (cached_trav.neighbor_source_boxes_lists.base_data
+            == merged_trav.neighbor_source_boxes_lists.base_data)
+    assert cached_trav.neighbor_source_boxes_lists.queue == queue2
+
+    # lists from a given allocator bypass the cache
+    from pyopencl.tools import MemoryPool, ImmediateAllocator
+    pool = MemoryPool(ImmediateAllocator(queue))
+    pooled_trav = trav.merge_close_lists(queue, allocator=pool)
+    assert (pooled_trav.neighbor_source_boxes_lists.base_data
+            != merged_trav.neighbor_source_boxes_lists.base_data)
+    assert trav.__dict__["_merged_close_lists"] is merged_trav
+
+    # merged lists cannot be regenerated, so they cannot be released
+    with pytest.raises(ValueError):
+        merged_trav.release("neighbor_source_boxes_lists")
+
+    # releasing fields drops the cache
+    trav.release("sep_bigger_lists")
+    assert "_merged_close_lists" not in trav.__dict__
+    remerged_trav = trav.merge_close_lists(queue)
+    assert (remerged_trav.neighbor_source_boxes_lists.get()
+            == merged_trav.neighbor_source_boxes_lists.get()).all()
+
+    trav = trav.get(queue=queue)
+    merged_trav = merged_trav.get(queue=queue)
+
+    assert merged_trav.sep_close_smaller_starts is None
+    assert merged_trav.sep_close_bigger_starts is None
+
+    totp_box_nrs = dict(
+            (box_id, i)
+            for i, box_id in enumerate(trav.target_or_target_parent_boxes))
+
+    for itgt_box, box_id in enumerate(trav.target_boxes):
+        ref_row = list(trav.get_box_list("neighbor_source_boxes", itgt_box))
+        if trav.sep_close_smaller_starts is not None:
+            ref_row.extend(trav.get_box_list("sep_close_smaller", itgt_box))
+        if trav.sep_close_bigger_starts is not None:
+            ref_row.extend(trav.get_box_list(
+                "sep_close_bigger", totp_box_nrs[box_id]))
+
+        row = merged_trav.get_box_list("neighbor_source_boxes", itgt_box)
+        assert list(row) == ref_row
+
+# }}}
+
+
+# {{{ statistics test
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+def test_traversal_statistics(ctx_getter, dims):
+    logging.basicConfig(level=logging.INFO)
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+
+    sources = make_normal_particle_array(queue, 2 * 10**4, dims, dtype)
+    targets = make_normal_particle_array(queue, 3 * 10**4, dims, dtype, seed=19)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+    tree, _ = tb(queue, sources, max_particles_in_box=30,
+            targets=targets, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(ctx)
+    trav, _ = tg(queue, tree, debug=True)
+
+    stats = trav.get_statistics(queue)
+
+    tree = tree.get(queue=queue)
+    trav = trav.get(queue=queue)
+
+    for lstats in stats.lists:
+        if lstats.name.startswith("sep_smaller_by_level["):
+            csr = trav.sep_smaller_by_level[int(lstats.name[21:-1])]
+            starts, lists = csr.starts, csr.lists
+        else:
+            starts = getattr(trav, lstats.name + "_starts")
+            lists = getattr(trav, lstats.name + "_lists")
+
+        row_lengths = np.diff(starts)
+        assert lstats.nrows == len(row_lengths)
+        assert lstats.nentries == starts[-1]
+        assert lstats.max_row_length == row_lengths.max()
+        assert abs(lstats.mean_row_length - row_lengths.mean()) < 1e-12
+        assert lstats.nbytes == starts.nbytes + lists.nbytes
+
+        if lstats.name == "colleagues":
+            row_levels = tree.box_levels
+        elif lstats.name in ["sep_siblings", "sep_bigger"]:
+            row_levels = tree.box_levels[trav.target_or_target_parent_boxes]
+        else:
+            row_levels = tree.box_levels[trav.target_boxes]
+
+        for level in range(tree.nlevels):
+            level_row_lengths = row_lengths[row_levels == level]
+            assert lstats.level_nentries[level] == level_row_lengths.sum()
+            assert lstats.level_max_row_length[level] == (
+                    level_row_lengths.max() if len(level_row_lengths) else 0)
+
+    # {{{ check direct interaction count
+
+    nsources_in_list_1 = np.array([
+        tree.box_source_counts_nonchild[
+            trav.neighbor_source_boxes_lists[start:end]].sum()
+        for start, end in zip(
+            trav.neighbor_source_boxes_starts[:-1],
+            trav.neighbor_source_boxes_starts[1:])])
+
+    ref_direct_cost = np.dot(
+            tree.box_target_counts_nonchild[trav.target_boxes],
+            nsources_in_list_1)
+
+    assert stats.estimated_cost["eval_direct"] == ref_direct_cost
+
+    # }}}
+
+    assert stats.total_estimated_cost > 0
+    logger.info("traversal statistics:\n%s" % stats)
+
+# }}}
+
+
+# {{{ list 1 schedule test
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+def test_list_1_schedule(ctx_getter, dims):
+    logging.basicConfig(level=logging.INFO)
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+
+    sources = make_normal_particle_array(queue, 2 * 10**4, dims, dtype)
+    targets = make_normal_particle_array(queue, 3 * 10**4, dims, dtype, seed=19)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+    tree, _ = tb(queue, sources, max_particles_in_box=30,
+            targets=targets, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(ctx)
+    trav, _ = tg(queue, tree, debug=True)
+
+    schedule = trav.get_list_1_schedule(queue).get(queue=queue)
+    tree = tree.get(queue=queue)
+    trav = trav.get(queue=queue)
+
+    ref_work = np.array([
+        tree.box_target_counts_nonchild[box_id]
+        * tree.box_source_counts_nonchild[
+            trav.get_box_list("neighbor_source_boxes", itgt_box)].sum()
+        for itgt_box, box_id in enumerate(trav.target_boxes)])
+
+    assert (schedule.target_box_work == ref_work).all()
+    assert (np.sort(schedule.target_box_nrs)
+            == np.arange(len(trav.target_boxes))).all()
+
+    nbuckets = schedule.nbuckets
+    for ibucket in range(nbuckets):
+        start, end = schedule.bucket_starts[ibucket:ibucket+2]
+        bucket_work = ref_work[schedule.target_box_nrs[start:end]]
+
+        if ibucket == nbuckets - 1:
+            assert (bucket_work == 0).all()
+        else:
+            assert (2**(nbuckets-2-ibucket) <= bucket_work).all()
+            assert (bucket_work < 2**(nbuckets-1-ibucket)).all()
+
+    assert (np.diff(schedule.work_prefix_sums)
+            == ref_work[schedule.target_box_nrs]).all()
+
+    nparts = 8
+    splits = schedule.partition(nparts)
+    part_work = np.diff(schedule.work_prefix_sums[splits])
+    assert part_work.sum() == ref_work.sum()
+    assert part_work.max() <= ref_work.sum() / nparts + ref_work.max()
+
+# }}}
+
+
+# {{{ asynchronous and lazy get test
+
+@pytest.mark.opencl
+def test_traversal_get_async_and_lazy(ctx_getter):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dims = 2
+    dtype = np.float64
+
+    sources = make_normal_particle_array(queue, 5000, dims, dtype)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    queue.finish()
+    tree, _ = tb(queue, sources, max_particles_in_box=30, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(ctx)
+    trav, _ = tg(queue, tree)
+
+    host_trav = trav.get(queue=queue)
+
+    from boxtree.tools import DeviceDataRecord
+
+    def assert_on_host(record):
+        for field_name in record.__class__.fields:
+            try:
+                val = getattr(record, field_name)
+            except AttributeError:
+                continue
+
+            def check(subval):
+                assert not isinstance(subval, cl.array.Array), field_name
+                if isinstance(subval, DeviceDataRecord):
+                    assert_on_host(subval)
+                return subval
+
+            DeviceDataRecord._transform_value(check, val)
+
+    for pinned in [False, True]:
+        async_trav = trav.get_async(queue, pinned=pinned).wait()
+        assert_on_host(async_trav)
+
+        # box_centers has padding columns beyond nboxes
+        assert (async_trav.tree.box_centers[:, :tree.nboxes]
+                == host_trav.tree.box_centers[:, :tree.nboxes]).all()
+        assert (async_trav.neighbor_source_boxes_lists
+                == host_trav.neighbor_source_boxes_lists).all()
+
+    # The tree is wrapped in a lazy view of its own rather than transferred.
+    from boxtree.tools import LazyHostRecord
+    lazy_trav = trav.get_lazy(queue)
+    lazy_tree = lazy_trav.tree
+    assert isinstance(lazy_tree, LazyHostRecord)
+    assert lazy_trav.total_fetched_nbytes == 0
+    assert (lazy_tree.box_centers[:, :tree.nboxes]
+            == host_trav.tree.box_centers[:, :tree.nboxes]).all()
+    assert lazy_trav.fetched_nbytes == {}
+    assert lazy_trav.total_fetched_nbytes == tree.box_centers.nbytes
+
+# }}}
+
+
+# {{{ allocator test
+
+@pytest.mark.opencl
+def test_traversal_allocator(ctx_getter):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dims = 2
+    dtype = np.float64
+
+    sources = make_normal_particle_array(queue, 10**4, dims, dtype)
+    targets = make_normal_particle_array(queue, 5 * 10**3, dims, dtype, seed=19)
+    target_radii = cl.array.zeros(queue, 5 * 10**3, dtype) + 1e-3
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    queue.finish()
+    tree, _ = tb(queue, sources, targets=targets, target_radii=target_radii,
+            max_particles_in_box=30, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(ctx)
+    ref_trav, _ = tg(queue, tree)
+
+    from pyopencl.tools import MemoryPool, ImmediateAllocator
+    from boxtree.tools import AccountingAllocator
+    pool = MemoryPool(ImmediateAllocator(queue))
+
+    allocator = AccountingAllocator(pool)
+    trav, _ = tg(queue, tree, allocator=allocator)
+    queue.finish()
+
+    assert allocator.nallocations > 0
+    assert 0 < allocator.live_nbytes <= allocator.peak_nbytes
+    assert allocator.peak_nbytes <= allocator.allocated_nbytes
+
+    merge_allocator = AccountingAllocator(pool)
+    merged_trav = trav.merge_close_lists(queue, allocator=merge_allocator)
+    ref_merged_trav = ref_trav.merge_close_lists(queue)
+    assert merge_allocator.live_nbytes > 0
+
+    for name in ["neighbor_source_boxes_starts", "neighbor_source_boxes_lists"]:
+        assert (getattr(merged_trav, name).get(queue)
+                == getattr(ref_merged_trav, name).get(queue)).all()
+
+    live_nbytes = allocator.live_nbytes
+    del trav
+    del merged_trav
+    assert allocator.live_nbytes < live_nbytes
+
+# }}}
+
+
+# {{{ host traversal builder test
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("sources_are_targets", [False, True])
+def test_host_traversal_builder(ctx_getter, dims, sources_are_targets):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+
+    sources = make_normal_particle_array(queue, 5000, dims, dtype)
+    if sources_are_targets:
+        targets = None
+    else:
+        targets = make_normal_particle_array(queue, 3000, dims, dtype, seed=19)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    queue.finish()
+    tree, _ = tb(queue, sources, targets=targets, max_particles_in_box=30,
+            debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(ctx)
+    trav, _ = tg(queue, tree, debug=True)
+    ref_trav = trav.get(queue=queue)
+
+    from boxtree.host_build import HostTraversalBuilder
+    host_trav = HostTraversalBuilder()(ref_trav.tree)
+
+    for name in ["source_boxes", "target_boxes", "source_parent_boxes",
+            "target_or_target_parent_boxes", "level_start_source_box_nrs",
+            "level_start_target_box_nrs", "level_start_source_parent_box_nrs",
+            "level_start_target_or_target_parent_box_nrs"]:
+        assert (getattr(host_trav, name) == getattr(ref_trav, name)).all(), name
+
+    def rows(starts, lists):
+        return [sorted(lists[starts[i]:starts[i+1]])
+                for i in range(len(starts) - 1)]
+
+    for name in ["colleagues", "neighbor_source_boxes", "sep_siblings",
+            "sep_bigger"]:
+        assert (
+                rows(getattr(host_trav, name + "_starts"),
+                    getattr(host_trav, name + "_lists"))
+                == rows(getattr(ref_trav, name + "_starts"),
+                    getattr(ref_trav, name + "_lists"))), name
+
+    assert len(host_trav.sep_smaller_by_level) == len(ref_trav.sep_smaller_by_level)
+    for host_l3, ref_l3 in zip(
+            host_trav.sep_smaller_by_level, ref_trav.sep_smaller_by_level):
+        assert (rows(host_l3.starts, host_l3.lists)
+                == rows(ref_l3.starts, ref_l3.lists))
+
+# }}}
+
+
 # {{{ visualization helper (not a test)
 
 def plot_traversal(ctx_getter, do_plot=False):
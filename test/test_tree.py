@@ -81,6 +81,106 @@ def test_bounding_box(ctx_getter, dtype, dims, nparticles):
 # }}}
 
 
+# {{{ particle distribution generator test
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+def test_particle_distributions(ctx_getter, dims):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+    nparticles = 10**4
+
+    from boxtree.tools import (
+            make_plummer_particle_array, make_gaussian_mixture_particle_array,
+            make_mesh_surface_particle_array, iter_particle_array_chunks)
+
+    def to_host(particles):
+        return np.array([coord.get(queue) for coord in particles])
+
+    # The shared random number generator must not change the results.
+    assert (to_host(make_normal_particle_array(queue, nparticles, dims, dtype))
+            == to_host(make_normal_particle_array(
+                queue, nparticles, dims, dtype))).all()
+
+    # {{{ plummer
+
+    particles = to_host(make_plummer_particle_array(
+        queue, nparticles, dims, dtype, scale=2))
+    radii = np.sqrt(np.sum(particles**2, axis=0))
+
+    # Half of the mass is within this radius.
+    if dims == 2:
+        median_radius = 2
+    else:
+        median_radius = 2 / np.sqrt(0.5**(-2/3) - 1)
+
+    assert abs(np.median(radii) / median_radius - 1) < 0.05
+
+    # }}}
+
+    # {{{ gaussian mixture
+
+    centers = np.zeros((2, dims))
+    centers[1, 0] = 10
+    particles = to_host(make_gaussian_mixture_particle_array(
+        queue, nparticles, dims, dtype,
+        centers=centers, scales=[1, 1e-3], weights=[3, 1]))
+
+    in_second = particles[0] > 5
+    assert abs(np.mean(in_second) - 0.25) < 0.02
+    assert np.max(np.abs(particles[:, in_second] - centers[1, :, np.newaxis])) < 0.01
+
+    # }}}
+
+    # {{{ mesh surface
+
+    # the boundary of the unit square, or of the unit simplex
+    if dims == 2:
+        vertices = np.array([[0, 1, 1, 0], [0, 0, 1, 1]])
+        elements = np.array([[0, 1], [1, 2], [2, 3], [3, 0]])
+    else:
+        vertices = np.array([[0, 1, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]])
+        elements = np.array([[0, 1, 2], [0, 1, 3], [0, 2, 3], [1, 2, 3]])
+
+    particles = to_host(make_mesh_surface_particle_array(
+        queue, nparticles, vertices, elements, dtype))
+
+    assert (particles >= -1e-14).all()
+    assert (particles <= 1 + 1e-14).all()
+
+    on_first_face = particles[dims-1] == 0
+    if dims == 2:
+        assert abs(np.mean(on_first_face) - 0.25) < 0.02
+    else:
+        assert abs(np.mean(on_first_face) - 0.5 / (1.5 + np.sqrt(3)/2)) < 0.02
+
+    # }}}
+
+    # {{{ chunks
+
+    chunks = list(iter_particle_array_chunks(
+        queue, 2500, 1000, dims, dtype, distribution="plummer"))
+    assert [len(chunk[0]) for chunk in chunks] == [1000, 1000, 500]
+
+    other_chunks = iter_particle_array_chunks(
+        queue, 2500, 1000, dims, dtype, distribution="plummer")
+    for chunk, other_chunk in zip(chunks, other_chunks):
+        # Interleaved use of the shared generator does not disturb chunks.
+        make_normal_particle_array(queue, 100, dims, dtype)
+        assert (to_host(chunk) == to_host(other_chunk)).all()
+
+    assert (to_host(chunks[0]) != to_host(chunks[1])[:, :1000]).any()
+
+    with pytest.raises(ValueError):
+        iter_particle_array_chunks(queue, 10, 5, dims, dtype, distribution="x")
+
+    # }}}
+
+# }}}
+
+
 # {{{ test basic (no source/target distinction) tree build
 
 def run_build_test(builder, queue, dims, dtype, nparticles, do_plot,
@@ -638,12 +738,482 @@ def test_extent_tree(ctx_getter, dims, do_plot=False):
 # }}}
 
 
+# {{{ asynchronous get test
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("pinned", [True, False])
+def test_tree_get_async(ctx_getter, pinned):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dims = 2
+    dtype = np.float64
+
+    sources = make_normal_particle_array(queue, 5000, dims, dtype)
+    targets = make_normal_particle_array(queue, 3000, dims, dtype, seed=19)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    queue.finish()
+    tree, _ = tb(queue, sources, targets=targets, max_particles_in_box=30,
+            debug=True)
+
+    host_tree = tree.get(queue=queue)
+    async_tree = tree.get_async(queue, pinned=pinned).wait()
+
+    def compare(a, b):
+        if isinstance(a, np.ndarray) and a.dtype == object:
+            for ai, bi in zip(a, b):
+                compare(ai, bi)
+        elif isinstance(a, np.ndarray):
+            # Compare bytes, since unused padding entries may hold NaNs.
+            assert isinstance(b, np.ndarray)
+            assert a.dtype == b.dtype and a.shape == b.shape
+            assert a.tobytes() == b.tobytes()
+        else:
+            assert a == b
+
+    for field_name in tree.__class__.fields:
+        try:
+            expected = getattr(host_tree, field_name)
+        except AttributeError:
+            continue
+        compare(expected, getattr(async_tree, field_name))
+
+    transfer = tree.get_async(queue, fields=["box_centers", "box_levels"],
+            pinned=pinned)
+    partial_tree = transfer.wait()
+    assert transfer.is_done()
+    compare(host_tree.box_centers, partial_tree.box_centers)
+    compare(host_tree.box_levels, partial_tree.box_levels)
+    assert isinstance(partial_tree.box_parent_ids, cl.array.Array)
+
+    with pytest.raises(ValueError):
+        tree.get_async(queue, fields=["no_such_field"])
+
+# }}}
+
+
+# {{{ lazy host view test
+
+@pytest.mark.opencl
+def test_tree_get_lazy(ctx_getter):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dims = 2
+    dtype = np.float64
+    nsources = 5000
+
+    sources = make_normal_particle_array(queue, nsources, dims, dtype)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    queue.finish()
+    tree, _ = tb(queue, sources, max_particles_in_box=30, debug=True)
+
+    host_tree = tree.get(queue=queue)
+    lazy_tree = tree.get_lazy(queue)
+
+    # Shape-derived properties do not trigger transfers.
+    assert lazy_tree.nboxes == host_tree.nboxes
+    assert lazy_tree.dimensions == dims
+    assert lazy_tree.total_fetched_nbytes == 0
+
+    nboxes = host_tree.nboxes
+    assert (lazy_tree.box_centers[:, :nboxes]
+            == host_tree.box_centers[:, :nboxes]).all()
+    assert lazy_tree.fetched_nbytes == {"box_centers": tree.box_centers.nbytes}
+
+    # Cached fields are not transferred again.
+    lazy_tree.box_centers
+    assert lazy_tree.total_fetched_nbytes == tree.box_centers.nbytes
+
+    isources = np.arange(0, nsources, 37)
+    assert (lazy_tree.find_box_nrs_for_sources(isources)
+            == host_tree.find_box_nrs_for_sources(isources)).all()
+    assert set(
+            name for name, nbytes in lazy_tree.fetched_nbytes.items()
+            if nbytes) == set([
+                "box_centers", "box_source_starts",
+                "box_source_counts_nonchild"])
+
+    for iaxis in range(dims):
+        assert (lazy_tree.sources[iaxis] == host_tree.sources[iaxis]).all()
+
+# }}}
+
+
+# {{{ batched gappy copy and reallocation tests
+
+@pytest.mark.opencl
+def test_gappy_copy_many(ctx_getter):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    n = 1000
+    rng = np.random.RandomState(17)
+
+    box_ids = rng.randint(0, n, n).astype(np.int32)
+    values = rng.rand(n)
+    levels = rng.randint(0, 20, n).astype(np.uint8)
+    src_indices = np.sort(rng.choice(n, 600, replace=False)).astype(np.int32)
+    value_map = rng.permutation(n).astype(np.int32)
+
+    from boxtree.tools import GappyCopyAndMapKernel
+    gappy_copy = GappyCopyAndMapKernel(ctx)
+
+    (new_box_ids, new_values, new_levels), evt = gappy_copy.copy_many(
+            queue, None, len(src_indices),
+            [cl.array.to_device(queue, ary)
+                for ary in [box_ids, values, levels]],
+            src_indices=cl.array.to_device(queue, src_indices),
+            map_values=cl.array.to_device(queue, value_map),
+            map_value_flags=[True, False, False])
+    evt.wait()
+
+    assert (new_box_ids.get() == value_map[box_ids[src_indices]]).all()
+    assert (new_values.get() == values[src_indices]).all()
+    assert (new_levels.get() == levels[src_indices]).all()
+
+
+@pytest.mark.opencl
+def test_realloc_array_reuses_capacity(ctx_getter):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    from pyopencl.tools import MemoryPool, ImmediateAllocator
+    from boxtree.tools import realloc_array
+
+    n = 1000
+    host_ary = np.arange(n, dtype=np.int32)
+
+    # Exact-size buffers have no spare capacity, so growing copies.
+    ary = cl.array.to_device(queue, host_ary)
+    new_ary, evt = realloc_array(queue, None, 2*n, ary, zero_fill=True)
+    evt.wait()
+    assert new_ary.base_data.int_ptr != ary.base_data.int_ptr
+    assert (new_ary.get()[:n] == host_ary).all()
+    assert (new_ary.get()[n:] == 0).all()
+
+    # Growing within the slack left by the pool does not.
+    pool = MemoryPool(ImmediateAllocator(queue))
+    ary = cl.array.to_device(queue, host_ary, allocator=pool)
+    capacity = ary.base_data.size // ary.dtype.itemsize
+    assert capacity > n
+
+    new_ary, evt = realloc_array(queue, pool, capacity, ary, zero_fill=True,
+            reuse_capacity=True)
+    evt.wait()
+    assert new_ary.base_data is ary.base_data
+    assert (new_ary.get()[:n] == host_ary).all()
+    assert (new_ary.get()[n:] == 0).all()
+
+    # Unless asked to, views of larger arrays are never grown in place.
+    big_ary = cl.array.to_device(queue, host_ary)
+    new_ary, evt = realloc_array(queue, None, n//2, big_ary[:n//4],
+            zero_fill=True)
+    evt.wait()
+    assert new_ary.base_data.int_ptr != big_ary.base_data.int_ptr
+    assert (new_ary.get()[:n//4] == host_ary[:n//4]).all()
+    assert (new_ary.get()[n//4:] == 0).all()
+    assert (big_ary.get() == host_ary).all()
+
+# }}}
+
+
+# {{{ reverse permutation test
+
+@pytest.mark.opencl
+def test_reverse_permutations(ctx_getter):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dims = 2
+    dtype = np.float64
+    nsources = 5000
+    ntargets = 3000
+
+    sources = make_normal_particle_array(queue, nsources, dims, dtype)
+    targets = make_normal_particle_array(queue, ntargets, dims, dtype, seed=19)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    queue.finish()
+    tree, _ = tb(queue, sources, targets=targets, max_particles_in_box=30,
+            debug=True)
+    host_tree = tree.get(queue=queue)
+
+    tree_source_ids = host_tree.get_tree_source_ids()
+    assert (host_tree.user_source_ids[tree_source_ids]
+            == np.arange(nsources)).all()
+    assert host_tree.get_tree_source_ids() is tree_source_ids
+
+    user_target_ids = host_tree.get_user_target_ids()
+    assert (user_target_ids[host_tree.sorted_target_ids]
+            == np.arange(ntargets)).all()
+
+    isources = np.arange(0, nsources, 7)
+    assert (host_tree.indices_to_tree_source_order(isources)
+            == tree_source_ids[isources]).all()
+
+    with pytest.raises(ValueError):
+        tree.get_user_target_ids()
+
+    assert (tree.get_tree_source_ids(queue).get() == tree_source_ids).all()
+    assert (tree.get_user_target_ids(queue).get() == user_target_ids).all()
+
+    # Once computed, the device arrays are available without a queue.
+    assert (tree.get_user_target_ids().get(queue) == user_target_ids).all()
+
+# }}}
+
+
+# {{{ particle reorderer test
+
+@pytest.mark.opencl
+def test_particle_reorderer(ctx_getter):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dims = 2
+    dtype = np.float64
+    nsources = 5000
+    ntargets = 3000
+
+    sources = make_normal_particle_array(queue, nsources, dims, dtype)
+    targets = make_normal_particle_array(queue, ntargets, dims, dtype, seed=19)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    queue.finish()
+    tree, _ = tb(queue, sources, targets=targets, max_particles_in_box=30,
+            debug=True)
+    host_tree = tree.get(queue=queue)
+
+    from boxtree.tree import ParticleReorderer
+
+    rng = np.random.RandomState(15)
+    weights = rng.rand(nsources)
+    densities = rng.rand(3, nsources).astype(np.float32)
+    user_sources = np.array([src.get(queue) for src in sources])
+
+    for tr in [host_tree, tree]:
+        reorderer = ParticleReorderer(tr)
+        reorderer.block_size = 1000
+
+        # {{{ host arrays
+
+        w, (d,), srcs = reorderer.reorder_sources(
+                (weights, [densities], user_sources), queue)
+
+        assert (w == weights[host_tree.user_source_ids]).all()
+        assert d.dtype == densities.dtype
+        assert (d == densities[:, host_tree.user_source_ids]).all()
+        assert isinstance(srcs, np.ndarray)
+        for idim in range(dims):
+            assert (srcs[idim] == host_tree.sources[idim]).all()
+
+        pot = rng.rand(ntargets, 2)
+        assert (reorderer.reorder_potentials(pot, queue, axis=0)
+                == pot[host_tree.sorted_target_ids]).all()
+
+        # }}}
+
+        # {{{ device arrays
+
+        dev_srcs = reorderer.reorder_sources(sources)
+        assert dev_srcs.dtype == object
+        for idim in range(dims):
+            assert (dev_srcs[idim].get(queue) == host_tree.sources[idim]).all()
+
+        dev_pot = cl.array.to_device(queue, pot[:, 0].copy())
+        dev_w, dev_pot_user = reorderer.reorder_potentials(
+                [cl.array.to_device(queue, weights[:ntargets]), dev_pot])
+        assert (dev_w.get(queue)
+                == weights[:ntargets][host_tree.sorted_target_ids]).all()
+        assert (dev_pot_user.get(queue)
+                == pot[host_tree.sorted_target_ids, 0]).all()
+
+        # }}}
+
+    with pytest.raises(ValueError):
+        ParticleReorderer(tree).reorder_sources(weights[:-1], queue)
+
+# }}}
+
+
+# {{{ host tree builder test
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("sources_are_targets", [False, True])
+def test_host_tree_builder(ctx_getter, dims, sources_are_targets):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+
+    sources = make_normal_particle_array(queue, 5000, dims, dtype)
+    if sources_are_targets:
+        targets = None
+    else:
+        targets = make_normal_particle_array(queue, 3000, dims, dtype, seed=19)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    queue.finish()
+    tree, _ = tb(queue, sources, targets=targets, max_particles_in_box=30,
+            debug=True)
+    ref_tree = tree.get(queue=queue)
+
+    from boxtree.host_build import HostTreeBuilder
+    host_tree = HostTreeBuilder()(
+            [coord.get(queue) for coord in sources],
+            targets=(
+                None if targets is None
+                else [coord.get(queue) for coord in targets]),
+            max_particles_in_box=30)
+
+    assert host_tree.nboxes == ref_tree.nboxes
+    assert host_tree.nlevels == ref_tree.nlevels
+    assert host_tree.root_extent == ref_tree.root_extent
+
+    nboxes = ref_tree.nboxes
+    for name in ["level_start_box_nrs", "box_levels", "box_parent_ids",
+            "box_flags", "box_source_starts", "box_source_counts_cumul",
+            "box_source_counts_nonchild", "box_target_starts",
+            "box_target_counts_cumul", "box_target_counts_nonchild"]:
+        assert (getattr(host_tree, name)
+                == getattr(ref_tree, name)[:nboxes]).all(), name
+
+    assert (host_tree.box_child_ids == ref_tree.box_child_ids[:, :nboxes]).all()
+    assert np.allclose(host_tree.box_centers, ref_tree.box_centers[:, :nboxes])
+
+    # Particle order within a box is not specified, so compare the sorted
+    # particles box by box.
+    for ibox in np.flatnonzero(host_tree.box_source_counts_nonchild):
+        start = host_tree.box_source_starts[ibox]
+        pslice = slice(start, start + host_tree.box_source_counts_nonchild[ibox])
+        assert (np.sort(host_tree.user_source_ids[pslice])
+                == np.sort(ref_tree.user_source_ids[pslice])).all()
+
+    for idim in range(dims):
+        assert (host_tree.sources[idim]
+                == sources[idim].get(queue)[host_tree.user_source_ids]).all()
+        assert (host_tree.targets[idim][host_tree.sorted_target_ids]
+                == (sources if targets is None else targets)[idim].get(queue)
+                ).all()
+
+
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("nrandom", [0, 100])
+@pytest.mark.parametrize("ncoincident", [1, 50])
+def test_host_tree_builder_coincident_particles(dims, nrandom, ncoincident):
+    rng = np.random.RandomState(15)
+    particles = np.concatenate([
+        np.full((dims, ncoincident), 0.3),
+        rng.rand(dims, nrandom)], axis=1)
+
+    from boxtree.host_build import HostTreeBuilder, HostTraversalBuilder
+    tree = HostTreeBuilder()(particles, max_particles_in_box=10)
+
+    assert tree.root_extent > 0
+    assert np.isfinite(tree.box_centers).all()
+    if nrandom == 0:
+        assert tree.nboxes == 1
+
+    # Coincident particles stop the refinement instead of exhausting the
+    # Morton key bits.
+    assert tree.nlevels < 12
+
+    # Every particle is in the non-child list of exactly one box, which
+    # contains it.
+    nparticles = ncoincident + nrandom
+    counts = tree.box_source_counts_nonchild
+    assert counts.sum() == nparticles
+
+    box_nrs = tree.find_box_nrs_for_sources(np.arange(nparticles))
+    half_sizes = tree.root_extent / 2**(tree.box_levels[box_nrs] + 1)
+    for iaxis in range(dims):
+        assert (np.abs(tree.sources[iaxis] - tree.box_centers[iaxis, box_nrs])
+                <= half_sizes).all()
+
+    # Sources are targets, so each target box is its own neighbor source box.
+    trav = HostTraversalBuilder()(tree)
+    for itarget_box, tgt_ibox in enumerate(trav.target_boxes):
+        start, end = trav.neighbor_source_boxes_starts[itarget_box:itarget_box+2]
+        assert tgt_ibox in trav.neighbor_source_boxes_lists[start:end]
+
+# }}}
+
+
+# {{{ particle-to-box lookup test
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+def test_particle_box_nrs(ctx_getter, dims):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+    nsources = 10**4
+    ntargets = 3 * 10**3
+
+    sources = make_normal_particle_array(queue, nsources, dims, dtype)
+    targets = make_normal_particle_array(queue, ntargets, dims, dtype, seed=19)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    queue.finish()
+    tree, _ = tb(queue, sources, targets=targets, max_particles_in_box=30,
+            debug=True)
+
+    from boxtree.tree import find_particle_box_nrs
+    source_box_nrs, _ = find_particle_box_nrs(queue, tree, "sources")
+    target_box_nrs, _ = find_particle_box_nrs(queue, tree, "targets")
+
+    host_tree = tree.get(queue=queue)
+
+    for kind, nparticles, box_nrs in [
+            ("source", nsources, source_box_nrs),
+            ("target", ntargets, target_box_nrs)]:
+        starts = getattr(host_tree, "box_%s_starts" % kind)
+        counts = getattr(host_tree, "box_%s_counts_nonchild" % kind)
+
+        host_box_nrs = getattr(host_tree, "find_box_nrs_for_%ss" % kind)(
+                np.arange(nparticles))
+        assert (host_box_nrs == box_nrs.get(queue)).all()
+
+        for iparticle in range(0, nparticles, 97):
+            ibox = host_box_nrs[iparticle]
+            assert starts[ibox] <= iparticle < starts[ibox] + counts[ibox]
+            assert getattr(host_tree, "find_box_nr_for_%s" % kind)(
+                    iparticle) == ibox
+
+    # The cached map must follow reassigned box arrays.
+    counts = np.zeros_like(host_tree.box_source_counts_nonchild)
+    counts[0] = nsources
+    host_tree.box_source_starts = np.zeros_like(host_tree.box_source_starts)
+    host_tree.box_source_counts_nonchild = counts
+    assert (host_tree.find_box_nrs_for_sources(np.arange(nsources)) == 0).all()
+
+# }}}
+
+
 # {{{ leaves to balls query test
 
 @pytest.mark.opencl
 @pytest.mark.geo_lookup
+@pytest.mark.parametrize("ball_norm", ["linf", "l2"])
 @pytest.mark.parametrize("dims", [2, 3])
-def test_leaves_to_balls_query(ctx_getter, dims, do_plot=False):
+def test_leaves_to_balls_query(ctx_getter, dims, ball_norm, do_plot=False):
     logging.basicConfig(level=logging.INFO)
 
     ctx = ctx_getter()
@@ -671,7 +1241,7 @@ def test_leaves_to_balls_query(ctx_getter, dims, do_plot=False):
     from boxtree.area_query import LeavesToBallsLookupBuilder
     lblb = LeavesToBallsLookupBuilder(ctx)
 
-    lbl, _ = lblb(queue, tree, ball_centers, ball_radii)
+    lbl, _ = lblb(queue, tree, ball_centers, ball_radii, ball_norm=ball_norm)
 
     # get data to host for test
     tree = tree.get(queue=queue)
@@ -692,8 +1262,13 @@ def test_leaves_to_balls_query(ctx_getter, dims, do_plot=False):
         ext_l, ext_h = tree.get_box_extent(ibox)
         box_rad = 0.5*(ext_h-ext_l)[0]
 
-        linf_circle_dists = np.max(np.abs(ball_centers-box_center), axis=-1)
-        near_circles, = np.where(linf_circle_dists - ball_radii < box_rad)
+        if ball_norm == "l2":
+            l2_box_dists = np.sqrt(np.sum(np.maximum(
+                np.abs(ball_centers-box_center) - box_rad, 0)**2, axis=-1))
+            near_circles, = np.where(l2_box_dists < ball_radii)
+        else:
+            linf_circle_dists = np.max(np.abs(ball_centers-box_center), axis=-1)
+            near_circles, = np.where(linf_circle_dists - ball_radii < box_rad)
 
         start, end = lbl.balls_near_box_starts[ibox:ibox+2]
         assert sorted(lbl.balls_near_box_lists[start:end]) == sorted(near_circles)
@@ -703,14 +1278,16 @@ def test_leaves_to_balls_query(ctx_getter, dims, do_plot=False):
 
 # {{{ area query test
 
-def run_area_query_test(ctx, queue, tree, ball_centers, ball_radii):
+def run_area_query_test(ctx, queue, tree, ball_centers, ball_radii,
+        ball_norm="linf"):
     """
     Performs an area query and checks that the result is as expected.
     """
     from boxtree.area_query import AreaQueryBuilder
     aqb = AreaQueryBuilder(ctx)
 
-    area_query, _ = aqb(queue, tree, ball_centers, ball_radii)
+    area_query, _ = aqb(queue, tree, ball_centers, ball_radii,
+            ball_norm=ball_norm)
 
     # Get data to host for test.
     tree = tree.get(queue=queue)
@@ -733,9 +1310,16 @@ def run_area_query_test(ctx, queue, tree, ball_centers, ball_radii):
 
     for ball_nr, (ball_center, ball_radius) \
             in enumerate(zip(ball_centers, ball_radii)):
-        linf_box_dists = np.max(np.abs(ball_center - leaf_box_centers), axis=-1)
-        near_leaves_indices, \
-            = np.where(linf_box_dists < ball_radius + leaf_box_radii)
+        if ball_norm == "l2":
+            l2_box_dists = np.sqrt(np.sum(np.maximum(
+                np.abs(ball_center - leaf_box_centers)
+                - leaf_box_radii.reshape(-1, 1), 0)**2, axis=-1))
+            near_leaves_indices, = np.where(l2_box_dists < ball_radius)
+        else:
+            linf_box_dists = np.max(
+                    np.abs(ball_center - leaf_box_centers), axis=-1)
+            near_leaves_indices, \
+                = np.where(linf_box_dists < ball_radius + leaf_box_radii)
         near_leaves = leaf_boxes[near_leaves_indices]
 
         start, end = area_query.leaves_near_ball_starts[ball_nr:ball_nr+2]
@@ -746,8 +1330,9 @@ def run_area_query_test(ctx, queue, tree, ball_centers, ball_radii):
 
 @pytest.mark.opencl
 @pytest.mark.area_query
+@pytest.mark.parametrize("ball_norm", ["linf", "l2"])
 @pytest.mark.parametrize("dims", [2, 3])
-def test_area_query(ctx_getter, dims, do_plot=False):
+def test_area_query(ctx_getter, dims, ball_norm, do_plot=False):
     ctx = ctx_getter()
     queue = cl.CommandQueue(ctx)
 
@@ -770,7 +1355,8 @@ def test_area_query(ctx_getter, dims, do_plot=False):
     ball_centers = make_normal_particle_array(queue, nballs, dims, dtype)
     ball_radii = cl.array.empty(queue, nballs, dtype).fill(0.1)
 
-    run_area_query_test(ctx, queue, tree, ball_centers, ball_radii)
+    run_area_query_test(ctx, queue, tree, ball_centers, ball_radii,
+            ball_norm=ball_norm)
 
 
 @pytest.mark.opencl
@@ -813,6 +1399,207 @@ def test_area_query_balls_outside_bbox(ctx_getter, dims, do_plot=False):
     run_area_query_test(ctx, queue, tree, ball_centers, ball_radii)
 
 
+@pytest.mark.opencl
+@pytest.mark.area_query
+@pytest.mark.parametrize(("dims", "periodic"), [
+    (2, True),
+    (2, (True, False)),
+    (3, (False, True, True)),
+    ])
+def test_periodic_area_query(ctx_getter, dims, periodic):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+    rng = np.random.RandomState(15)
+
+    from pytools.obj_array import make_obj_array
+
+    def make_uniform_points(npoints):
+        return make_obj_array([
+            cl.array.to_device(queue, rng.rand(npoints).astype(dtype))
+            for _ in range(dims)])
+
+    particles = make_uniform_points(10**4)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    queue.finish()
+    tree, _ = tb(queue, particles, max_particles_in_box=30, debug=True,
+            bbox=np.array([[0, 1]] * dims, dtype))
+    assert tree.root_extent == 1
+    assert (tree.bounding_box[0] == 0).all()
+
+    with pytest.raises(ValueError):
+        tb(queue, particles, max_particles_in_box=30,
+                bbox=np.array([[0, 1]] * (dims - 1) + [[0, 2]], dtype))
+    with pytest.raises(ValueError):
+        tb(queue, particles, max_particles_in_box=30,
+                bbox=np.array([[0.5, 1.5]] * dims, dtype))
+
+    nballs = 300
+    ball_centers = make_uniform_points(nballs)
+    ball_radii = cl.array.empty(queue, nballs, dtype).fill(0.15)
+
+    from boxtree.area_query import AreaQueryBuilder
+    aqb = AreaQueryBuilder(ctx)
+    area_query, _ = aqb(queue, tree, ball_centers, ball_radii,
+            periodic=periodic)
+
+    tree = tree.get(queue=queue)
+    area_query = area_query.get(queue=queue)
+    ball_centers = np.array([x.get() for x in ball_centers]).T
+    ball_radii = ball_radii.get()
+
+    if isinstance(periodic, bool):
+        periodic = (periodic,) * dims
+
+    from boxtree import box_flags_enum
+    leaf_boxes, = (tree.box_flags & box_flags_enum.HAS_CHILDREN == 0).nonzero()
+    leaf_box_centers = tree.box_centers[:, leaf_boxes].T
+    leaf_box_radii = 0.5 * tree.root_extent / 2.0**tree.box_levels[leaf_boxes]
+
+    from itertools import product
+    image_shifts = [
+            np.array(shift)
+            for shift in product(*[
+                (-1, 0, 1) if is_periodic else (0,)
+                for is_periodic in periodic])]
+
+    for ball_nr, (ball_center, ball_radius) \
+            in enumerate(zip(ball_centers, ball_radii)):
+        expected = set()
+        for shift in image_shifts:
+            linf_box_dists = np.max(np.abs(
+                ball_center - leaf_box_centers - shift * tree.root_extent),
+                axis=-1)
+            near_leaves, = np.where(
+                    linf_box_dists <= ball_radius + leaf_box_radii)
+            expected.update(
+                    (leaf_boxes[i], tuple(shift)) for i in near_leaves)
+
+        start, end = area_query.leaves_near_ball_starts[ball_nr:ball_nr+2]
+        found = [
+                (leaf, tuple(
+                    area_query.leaves_near_ball_image_shifts[iaxis][i]
+                    for iaxis in range(dims)))
+                for i, leaf in enumerate(
+                    area_query.leaves_near_ball_lists[start:end], start)]
+
+        assert len(found) == len(set(found))
+        assert set(found) == expected
+
+
+@pytest.mark.opencl
+@pytest.mark.area_query
+@pytest.mark.parametrize("download", [False, True])
+@pytest.mark.parametrize("dims", [2, 3])
+def test_area_query_chunks(ctx_getter, dims, download):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    nparticles = 10**4
+    dtype = np.float64
+
+    particles = make_normal_particle_array(queue, nparticles, dims, dtype)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    queue.finish()
+    tree, _ = tb(queue, particles, max_particles_in_box=30, debug=True)
+
+    nballs = 10**3 + 17
+    ball_centers = make_normal_particle_array(queue, nballs, dims, dtype)
+    ball_radii = cl.array.empty(queue, nballs, dtype).fill(0.1)
+
+    from boxtree.area_query import AreaQueryBuilder
+    aqb = AreaQueryBuilder(ctx)
+
+    ref_area_query, _ = aqb(queue, tree, ball_centers, ball_radii)
+    ref_area_query = ref_area_query.get(queue=queue)
+
+    chunk_size = 300
+    next_ball = 0
+    for ball_slice, area_query in aqb.iter_chunks(
+            queue, tree, ball_centers, ball_radii, chunk_size,
+            download=download):
+        assert ball_slice.start == next_ball
+        assert ball_slice.stop - ball_slice.start <= chunk_size
+        next_ball = ball_slice.stop
+
+        starts = area_query.leaves_near_ball_starts
+        lists = area_query.leaves_near_ball_lists
+        if not download:
+            starts = starts.get(queue)
+            lists = lists.get(queue)
+
+        assert len(starts) == ball_slice.stop - ball_slice.start + 1
+
+        for i, ball_nr in enumerate(range(ball_slice.start, ball_slice.stop)):
+            ref_start, ref_end = \
+                    ref_area_query.leaves_near_ball_starts[ball_nr:ball_nr+2]
+            assert (
+                    sorted(lists[starts[i]:starts[i+1]])
+                    == sorted(ref_area_query.leaves_near_ball_lists[
+                        ref_start:ref_end]))
+
+    assert next_ball == nballs
+
+
+@pytest.mark.opencl
+@pytest.mark.area_query
+@pytest.mark.parametrize("ball_norm", ["linf", "l2"])
+@pytest.mark.parametrize("dims", [2, 3])
+def test_multi_radius_area_query(ctx_getter, dims, ball_norm):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    nparticles = 10**4
+    dtype = np.float64
+
+    particles = make_normal_particle_array(queue, nparticles, dims, dtype)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    queue.finish()
+    tree, _ = tb(queue, particles, max_particles_in_box=30, debug=True)
+
+    nballs = 10**3
+    ball_centers = make_normal_particle_array(queue, nballs, dims, dtype)
+    ball_radii = cl.array.empty(queue, nballs, dtype).fill(0.05)
+    radius_multipliers = [1, 4, 0.5, 2]
+
+    from boxtree.area_query import AreaQueryBuilder, MultiRadiusAreaQueryBuilder
+    aqb = AreaQueryBuilder(ctx)
+    mraqb = MultiRadiusAreaQueryBuilder(ctx)
+
+    area_queries, _ = mraqb(queue, tree, ball_centers, ball_radii,
+            radius_multipliers, ball_norm=ball_norm)
+    assert len(area_queries) == len(radius_multipliers)
+
+    for mult, area_query in zip(radius_multipliers, area_queries):
+        ref_area_query, _ = aqb(queue, tree, ball_centers, mult * ball_radii,
+                ball_norm=ball_norm)
+
+        area_query = area_query.get(queue=queue)
+        ref_area_query = ref_area_query.get(queue=queue)
+
+        for ball_nr in range(nballs):
+            start, end = area_query.leaves_near_ball_starts[ball_nr:ball_nr+2]
+            ref_start, ref_end = \
+                    ref_area_query.leaves_near_ball_starts[ball_nr:ball_nr+2]
+            assert (
+                    set(area_query.leaves_near_ball_lists[start:end])
+                    == set(ref_area_query.leaves_near_ball_lists[
+                        ref_start:ref_end]))
+
+    with pytest.raises(ValueError):
+        mraqb(queue, tree, ball_centers, ball_radii, [])
+
+
 @pytest.mark.opencl
 @pytest.mark.area_query
 @pytest.mark.parametrize("dims", [2, 3])
@@ -876,6 +1663,389 @@ def test_area_query_elwise(ctx_getter, dims, do_plot=False):
 
     cl.wait_for_events([evt])
 
+
+@pytest.mark.opencl
+@pytest.mark.area_query
+def test_peer_list_cache(ctx_getter):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dims = 2
+    nparticles = 10**4
+    dtype = np.float64
+
+    particles = make_normal_particle_array(queue, nparticles, dims, dtype)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    queue.finish()
+    tree, _ = tb(queue, particles, max_particles_in_box=30, debug=True)
+
+    nballs = 10**3
+    ball_centers = make_normal_particle_array(queue, nballs, dims, dtype)
+    ball_radii = cl.array.empty(queue, nballs, dtype).fill(0.1)
+
+    from boxtree.area_query import (
+        AreaQueryBuilder, SpaceInvaderQueryBuilder, PeerListFinder)
+
+    # Separate builders share the peer lists cached on the tree.
+    AreaQueryBuilder(ctx)(queue, tree, ball_centers, ball_radii)
+    peer_lists, _ = PeerListFinder(ctx)(queue, tree)
+    siq_peer_lists, evt = SpaceInvaderQueryBuilder(ctx).peer_list_finder(
+            queue, tree)
+    assert siq_peer_lists.peer_lists is peer_lists.peer_lists
+    assert siq_peer_lists.tree is tree
+    evt.wait()
+
+    uncached_peer_lists, _ = PeerListFinder(ctx)(queue, tree, use_cache=False)
+    assert (uncached_peer_lists.peer_lists.get(queue)
+            == peer_lists.peer_lists.get(queue)).all()
+
+    # Copies of the tree, and trees whose arrays were replaced, do not
+    # reuse stale peer lists.
+    tree_copy = tree.with_queue(queue)
+    assert (PeerListFinder(ctx)(queue, tree_copy)[0].peer_lists
+            is not peer_lists.peer_lists)
+
+    # The cache does not keep the tree alive through a reference cycle.
+    import gc
+    import weakref
+    gc.disable()
+    try:
+        tree_copy_ref = weakref.ref(tree_copy)
+        del tree_copy
+        assert tree_copy_ref() is None
+    finally:
+        gc.enable()
+
+    # Peer lists from a caller-provided allocator are not cached.
+    from pyopencl.tools import ImmediateAllocator
+    tree_copy = tree.with_queue(queue)
+    PeerListFinder(ctx)(queue, tree_copy,
+            allocator=ImmediateAllocator(queue))
+    assert "_peer_list_cache" not in tree_copy.__dict__
+
+    tree.box_flags = tree.box_flags.copy(queue=queue)
+    new_peer_lists, _ = PeerListFinder(ctx)(queue, tree)
+    assert new_peer_lists.peer_lists is not peer_lists.peer_lists
+    assert new_peer_lists.peer_lists is not uncached_peer_lists.peer_lists
+    assert (new_peer_lists.peer_list_starts.get(queue)
+            == peer_lists.peer_list_starts.get(queue)).all()
+
+# }}}
+
+
+# {{{ particle area query test
+
+@pytest.mark.opencl
+@pytest.mark.area_query
+@pytest.mark.parametrize(("particle_kind", "order"), [
+    ("sources", "tree"),
+    ("sources", "user"),
+    ("targets", "user"),
+    ])
+@pytest.mark.parametrize("dims", [2, 3])
+def test_particle_area_query(ctx_getter, dims, particle_kind, order):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+
+    sources = make_normal_particle_array(queue, 10**4, dims, dtype)
+    targets = make_normal_particle_array(queue, 5000, dims, dtype, seed=19)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    queue.finish()
+    tree, _ = tb(queue, sources, targets=targets, max_particles_in_box=30,
+            debug=True)
+
+    nballs = 300
+    ball_centers = make_normal_particle_array(queue, nballs, dims, dtype,
+            seed=21)
+    ball_radii = cl.array.empty(queue, nballs, dtype).fill(0.2)
+
+    from boxtree.area_query import ParticleAreaQueryBuilder
+    paqb = ParticleAreaQueryBuilder(ctx)
+    paq, _ = paqb(queue, tree, ball_centers, ball_radii,
+            particle_kind=particle_kind, order=order, with_distances=True)
+
+    paq = paq.get(queue=queue)
+    ball_centers = np.array([x.get() for x in ball_centers]).T
+    ball_radii = ball_radii.get()
+
+    particles = np.array([
+        x.get() for x in {"sources": sources, "targets": targets}[
+            particle_kind]]).T
+    if order == "tree":
+        host_tree = tree.get(queue=queue)
+        particles = np.array(list(getattr(host_tree, particle_kind))).T
+
+    for ball_nr, (ball_center, ball_radius) \
+            in enumerate(zip(ball_centers, ball_radii)):
+        dists = np.max(np.abs(particles - ball_center), axis=-1)
+        ref_found, = np.where(dists <= ball_radius)
+
+        start, end = paq.particles_in_ball_starts[ball_nr:ball_nr+2]
+        found = paq.particles_in_ball_lists[start:end]
+
+        assert sorted(found) == sorted(ref_found)
+        assert np.allclose(paq.particle_distances[start:end], dists[found])
+
+# }}}
+
+
+# {{{ k nearest neighbors test
+
+@pytest.mark.opencl
+@pytest.mark.area_query
+@pytest.mark.parametrize("particle_kind", ["sources", "targets"])
+@pytest.mark.parametrize(("dims", "k"), [(2, 1), (2, 10), (3, 7)])
+def test_k_nearest_neighbors(ctx_getter, dims, k, particle_kind):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+
+    sources = make_normal_particle_array(queue, 10**4, dims, dtype)
+    targets = make_normal_particle_array(queue, 5000, dims, dtype, seed=19)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    queue.finish()
+    tree, _ = tb(queue, sources, targets=targets, max_particles_in_box=30,
+            debug=True)
+
+    # include query points outside the bounding box
+    nqueries = 500
+    from pyopencl.clrandom import PhiloxGenerator
+    rng = PhiloxGenerator(ctx, seed=13)
+    bbox_min = tree.bounding_box[0].min()
+    bbox_max = tree.bounding_box[1].max()
+    from pytools.obj_array import make_obj_array
+    query_points = make_obj_array([
+        rng.uniform(queue, nqueries, dtype=dtype, a=bbox_min-1, b=bbox_max+1)
+        for i in range(dims)])
+
+    from boxtree.area_query import KNearestNeighborsBuilder
+    knnb = KNearestNeighborsBuilder(ctx)
+    knn, _ = knnb(queue, tree, query_points, k, particle_kind=particle_kind)
+
+    knn = knn.get(queue=queue)
+    tree = tree.get(queue=queue)
+    query_points = np.array([qp.get() for qp in query_points]).T
+    particles = np.array(list(getattr(tree, particle_kind))).T
+
+    assert knn.neighbor_ids.shape == (nqueries, k)
+
+    for iquery, query_point in enumerate(query_points):
+        dists = np.linalg.norm(particles - query_point, axis=-1)
+        ref_dists = np.sort(dists)[:k]
+
+        assert np.allclose(knn.neighbor_distances[iquery], ref_dists)
+        assert np.allclose(dists[knn.neighbor_ids[iquery]], ref_dists)
+
+
+@pytest.mark.opencl
+@pytest.mark.area_query
+def test_k_nearest_neighbors_far_from_sources(ctx_getter):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    k = 5
+
+    # A cluster near (1, 1) and one lone source at the origin. The nearest
+    # neighbors of a query next to the lone source are much farther away
+    # (in the l2 sense) than the l^inf distance to the edges of the tree.
+    rng = np.random.RandomState(15)
+    host_sources = np.concatenate([
+        np.zeros((2, 1)),
+        1 + 1e-3 * rng.rand(2, 200)], axis=1)
+
+    from pytools.obj_array import make_obj_array
+    sources = make_obj_array([
+        cl.array.to_device(queue, host_sources[i].copy()) for i in range(2)])
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+    tree, _ = tb(queue, sources, max_particles_in_box=30, debug=True)
+
+    query_point = np.array([0.0005, 0.0005])
+    query_points = make_obj_array([
+        cl.array.to_device(queue, query_point[i:i+1].copy()) for i in range(2)])
+
+    from boxtree.area_query import KNearestNeighborsBuilder
+    knnb = KNearestNeighborsBuilder(ctx)
+    knn, _ = knnb(queue, tree, query_points, k)
+    knn = knn.get(queue=queue)
+    tree = tree.get(queue=queue)
+
+    particles = np.array(list(tree.sources)).T
+    dists = np.linalg.norm(particles - query_point, axis=-1)
+    ref_dists = np.sort(dists)[:k]
+
+    assert np.allclose(knn.neighbor_distances[0], ref_dists)
+    assert np.allclose(dists[knn.neighbor_ids[0]], ref_dists)
+
+
+@pytest.mark.opencl
+@pytest.mark.area_query
+def test_k_nearest_neighbors_rejects_invalid_input(ctx_getter):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+    nsources = 1000
+
+    sources = make_normal_particle_array(queue, nsources, 2, dtype)
+    source_radii = cl.array.empty(queue, nsources, dtype).fill(1e-3)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+    tree, _ = tb(queue, sources, targets=sources, source_radii=source_radii,
+            max_particles_in_box=30, debug=True)
+
+    from boxtree.area_query import KNearestNeighborsBuilder
+    knnb = KNearestNeighborsBuilder(ctx)
+    with pytest.raises(ValueError):
+        knnb(queue, tree, sources, 5)
+
+    tree, _ = tb(queue, sources, max_particles_in_box=30, debug=True)
+    with pytest.raises(ValueError):
+        knnb(queue, tree, sources, knnb.MAX_K + 1)
+
+# }}}
+
+
+# {{{ range count query test
+
+@pytest.mark.opencl
+@pytest.mark.area_query
+@pytest.mark.parametrize("ball_norm", ["linf", "l2"])
+@pytest.mark.parametrize(("dims", "particle_kind", "weighted"), [
+    (2, "sources", False),
+    (2, "targets", True),
+    (3, "sources", True),
+    ])
+def test_range_count_query(ctx_getter, dims, particle_kind, weighted,
+        ball_norm):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+    nsources = 10**4
+    ntargets = 3 * 10**3
+
+    sources = make_normal_particle_array(queue, nsources, dims, dtype)
+    targets = make_normal_particle_array(queue, ntargets, dims, dtype, seed=19)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    queue.finish()
+    tree, _ = tb(queue, sources, targets=targets, max_particles_in_box=30,
+            debug=True)
+
+    nballs = 500
+    ball_centers = make_normal_particle_array(queue, nballs, dims, dtype,
+            seed=23)
+    ball_radii = cl.array.to_device(queue,
+            np.linspace(0.01, 0.5, nballs).astype(dtype))
+
+    nparticles = nsources if particle_kind == "sources" else ntargets
+    if weighted:
+        rng = np.random.RandomState(17)
+        host_weights = rng.randint(0, 5, nparticles).astype(np.int32)
+        weights = cl.array.to_device(queue, host_weights)
+    else:
+        host_weights = np.ones(nparticles, np.int32)
+        weights = None
+
+    from boxtree.area_query import RangeCountQueryBuilder
+    rcqb = RangeCountQueryBuilder(ctx)
+    counts, _ = rcqb(queue, tree, ball_centers, ball_radii,
+            particle_kind=particle_kind, weights=weights, ball_norm=ball_norm)
+    counts = counts.get(queue)
+
+    # Particles in user order
+    user_particles = (sources if particle_kind == "sources" else targets)
+    user_particles = np.array([x.get() for x in user_particles])
+    ball_centers = np.array([x.get() for x in ball_centers])
+    ball_radii = ball_radii.get()
+
+    for ball_nr in range(nballs):
+        diff = user_particles - ball_centers[:, ball_nr].reshape(-1, 1)
+        if ball_norm == "l2":
+            dists = np.sqrt(np.sum(diff**2, axis=0))
+        else:
+            dists = np.max(np.abs(diff), axis=0)
+
+        assert counts[ball_nr] == np.sum(
+                host_weights[dists <= ball_radii[ball_nr]])
+
+# }}}
+
+
+# {{{ point locator test
+
+@pytest.mark.opencl
+@pytest.mark.area_query
+@pytest.mark.parametrize("dims", [2, 3])
+def test_point_locator(ctx_getter, dims):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    nparticles = 10**4
+    dtype = np.float64
+
+    particles = make_normal_particle_array(queue, nparticles, dims, dtype)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    queue.finish()
+    tree, _ = tb(queue, particles, max_particles_in_box=30, debug=True)
+
+    npoints = 2000
+    # Wider than the particle distribution, so that some points are outside
+    # the root box.
+    points = make_normal_particle_array(queue, npoints, dims, dtype, seed=19)
+    from pytools.obj_array import make_obj_array
+    points = make_obj_array([1.5 * pt for pt in points])
+
+    from boxtree.area_query import PointLocator
+    locator = PointLocator(ctx)
+    result, _ = locator(queue, tree, points)
+
+    tree = tree.get(queue=queue)
+    result = result.get(queue=queue)
+    points = np.array([pt.get() for pt in points])
+
+    bbox_min, bbox_max = tree.bounding_box
+    outside = ((points.T < bbox_min) | (points.T >= bbox_max)).any(axis=1)
+    assert outside.any()
+    assert (result.box_ids[outside] == -1).all()
+
+    from boxtree import box_flags_enum
+    for ipoint in np.where(~outside)[0]:
+        ibox = result.box_ids[ipoint]
+        assert result.box_levels[ipoint] == tree.box_levels[ibox]
+
+        ext_l, ext_h = tree.get_box_extent(ibox)
+        point = points[:, ipoint]
+        assert ((ext_l <= point) & (point <= ext_h)).all()
+
+        if tree.box_flags[ibox] & box_flags_enum.HAS_CHILDREN:
+            # Only possible if the point lies in a pruned child.
+            for child in tree.box_child_ids[:, ibox]:
+                if child:
+                    ch_ext_l, ch_ext_h = tree.get_box_extent(child)
+                    assert not (
+                            (ch_ext_l <= point) & (point < ch_ext_h)).all()
+
 # }}}
 
 
@@ -965,8 +2135,9 @@ def test_level_restriction(ctx_getter, dims, skip_prune, lookbehind, do_plot=Fal
 @pytest.mark.opencl
 @pytest.mark.geo_lookup
 @pytest.mark.parametrize("dtype", [np.float32, np.float64])
+@pytest.mark.parametrize("ball_norm", ["linf", "l2"])
 @pytest.mark.parametrize("dims", [2, 3])
-def test_space_invader_query(ctx_getter, dims, dtype, do_plot=False):
+def test_space_invader_query(ctx_getter, dims, dtype, ball_norm, do_plot=False):
     logging.basicConfig(level=logging.INFO)
 
     ctx = ctx_getter()
@@ -1005,8 +2176,8 @@ def test_space_invader_query(ctx_getter, dims, dtype, do_plot=False):
     # each box, and from there to compute the outer space invader distance.
     lblb = LeavesToBallsLookupBuilder(ctx)
 
-    siq, _ = siqb(queue, tree, ball_centers, ball_radii)
-    lbl, _ = lblb(queue, tree, ball_centers, ball_radii)
+    siq, _ = siqb(queue, tree, ball_centers, ball_radii, ball_norm=ball_norm)
+    lbl, _ = lblb(queue, tree, ball_centers, ball_radii, ball_norm=ball_norm)
 
     # get data to host for test
     tree = tree.get(queue=queue)